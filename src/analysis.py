@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Background analysis.
+
+``ANALYZE`` without ``WAIT``, or :func:`bayesdb_analysis_start`,
+starts an analysis job and returns immediately.  The job runs in a
+worker thread with its own connection to the database file, and
+commits the models' states at every checkpoint -- every iteration,
+unless the ``CHECKPOINT`` clause says otherwise -- so that queries on
+the original connection see the last committed checkpoint while
+analysis continues.
+
+Each job has a record in the ``bayesdb_analysis_job`` table with its
+state and its progress as of the last checkpoint::
+
+    job = bdb.execute('ANALYZE t_cc FOR 1000 ITERATIONS').fetchvalue()
+    bdb.execute('SHOW ANALYSES FOR t_cc')
+    bdb.execute('PAUSE ANALYSIS %d' % (job,))
+    bdb.execute('RESUME ANALYSIS %d' % (job,))
+    bdb.execute('CANCEL ANALYSIS %d' % (job,))
+
+Pausing and cancelling take effect at the next checkpoint.  Closing
+the BayesDB pauses its jobs, which may be resumed later, by the same
+or another process.
+
+To let the two connections proceed concurrently, the database is
+switched to SQLite's write-ahead log journal mode when the first job
+starts.  If the original connection writes to the database while a
+worker is analyzing, the worker discards the uncommitted work since
+its last checkpoint and tries again, after a pause that doubles with
+each consecutive conflict; after too many in a row the job fails.
+The worker analyzes with its own copies of the metamodels, made by
+:meth:`~bayeslite.IBayesDBMetamodel.copy`, so it shares no engine or
+other state with the original connection.
+"""
+
+import apsw
+import json
+import struct
+import threading
+import time
+import traceback
+
+import bayeslite.core as core
+
+from bayeslite.exception import BQLError
+from bayeslite.schema import bayesdb_schema_required
+from bayeslite.util import cursor_value
+
+# Milliseconds for either connection to wait for the other's locks.
+BUSY_TIMEOUT = 60000
+
+# Number of consecutive conflicts with the other connection after which
+# a worker gives up, and seconds to wait after the first of them.
+BUSY_RETRIES = 8
+BUSY_BACKOFF = 0.1
+
+def bayesdb_analysis_start(bdb, generator_id, modelnos=None, iterations=None,
+        max_seconds=None, ckpt_iterations=None, ckpt_seconds=None):
+    """Start analyzing models of a generator in the background.
+
+    Arguments are as for
+    :meth:`~bayeslite.IBayesDBMetamodel.analyze_models`, except that
+    at least one of `iterations` and `max_seconds` must be specified.
+    Returns the job id.
+    """
+    bayesdb_schema_required(bdb, 8, 'background analysis')
+    if bdb.pathname == ':memory:':
+        raise BQLError(bdb, 'Background analysis needs a database file')
+    if bdb.txn_depth:
+        raise BQLError(bdb, 'Background analysis cannot start'
+            ' in a transaction')
+    if iterations is None and max_seconds is None:
+        raise ValueError('Background analysis needs a limit')
+    _bayesdb_analysis_setup(bdb)
+    with bdb.savepoint():
+        generator = core.bayesdb_generator_name(bdb, generator_id)
+        sql = '''
+            SELECT modelno FROM bayesdb_generator_model
+                WHERE generator_id = ?
+        '''
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        existing = set(modelno for (modelno,) in cursor)
+        if len(existing) == 0:
+            raise BQLError(bdb, 'No models to analyze for generator: %s' %
+                (generator,))
+        if modelnos is not None:
+            missing = sorted(set(modelnos) - existing)
+            if 0 < len(missing):
+                raise BQLError(bdb, 'No such models in generator %s: %r' %
+                    (generator, missing))
+        insert_job_sql = '''
+            INSERT INTO bayesdb_analysis_job
+                (generator_id, modelnos, state, iterations, seconds,
+                    ckpt_iterations, ckpt_seconds, start_time)
+                VALUES (:generator_id, :modelnos, 'running', :iterations,
+                    :seconds, :ckpt_iterations, :ckpt_seconds, :start_time)
+        '''
+        bdb.sql_execute(insert_job_sql, {
+            'generator_id': generator_id,
+            'modelnos': None if modelnos is None else json.dumps(modelnos),
+            'iterations': iterations,
+            'seconds': max_seconds,
+            'ckpt_iterations': ckpt_iterations,
+            'ckpt_seconds': ckpt_seconds,
+            'start_time': time.time(),
+        })
+        job_id = bdb.last_insert_rowid()
+    _bayesdb_analysis_spawn(bdb, job_id)
+    return job_id
+
+def bayesdb_analysis_jobs(bdb, generator_id=None):
+    """Return a cursor over the analysis job records, optionally for
+    one generator."""
+    bayesdb_schema_required(bdb, 8, 'background analysis')
+    if generator_id is None:
+        sql = 'SELECT * FROM bayesdb_analysis_job ORDER BY id'
+        return bdb.sql_execute(sql)
+    else:
+        sql = '''
+            SELECT * FROM bayesdb_analysis_job WHERE generator_id = ?
+                ORDER BY id
+        '''
+        return bdb.sql_execute(sql, (generator_id,))
+
+def bayesdb_analysis_forget(bdb, generator_id):
+    """Delete the analysis job records of a generator, e.g. to drop it.
+
+    Fails if any of them is still running or paused.
+    """
+    with bdb.savepoint():
+        sql = '''
+            SELECT id FROM bayesdb_analysis_job
+                WHERE generator_id = ? AND state IN ('running', 'paused')
+        '''
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        active = [job_id for (job_id,) in cursor]
+        if 0 < len(active):
+            generator = core.bayesdb_generator_name(bdb, generator_id)
+            raise BQLError(bdb, 'Generator %s has unfinished analysis'
+                ' jobs: %r' % (generator, active))
+        sql = 'DELETE FROM bayesdb_analysis_job WHERE generator_id = ?'
+        bdb.sql_execute(sql, (generator_id,))
+
+def bayesdb_analysis_pause(bdb, job_id):
+    """Pause the analysis job `job_id` at its next checkpoint."""
+    job = _bayesdb_analysis_live_job(bdb, job_id)
+    if job is not None:
+        job.request('paused')
+    elif _bayesdb_analysis_state(bdb, job_id) == 'running':
+        # Its worker is gone, e.g. because the process running it
+        # was killed.
+        _bayesdb_analysis_set_state(bdb, job_id, 'paused')
+
+def bayesdb_analysis_resume(bdb, job_id):
+    """Resume the paused analysis job `job_id`.
+
+    If the job was started by another BayesDB handle that has since
+    been closed, continue it in a new worker for this one.
+    """
+    job = _bayesdb_analysis_live_job(bdb, job_id)
+    if job is not None:
+        job.request('running')
+    else:
+        _bayesdb_analysis_state(bdb, job_id)
+        if bdb.txn_depth:
+            raise BQLError(bdb, 'Background analysis cannot resume'
+                ' in a transaction')
+        _bayesdb_analysis_setup(bdb)
+        _bayesdb_analysis_set_state(bdb, job_id, 'running')
+        _bayesdb_analysis_spawn(bdb, job_id)
+
+def bayesdb_analysis_cancel(bdb, job_id):
+    """Cancel the analysis job `job_id` at its next checkpoint.
+
+    Analysis up to that checkpoint is kept.
+    """
+    job = _bayesdb_analysis_live_job(bdb, job_id)
+    if job is not None:
+        job.request('cancelled')
+    else:
+        _bayesdb_analysis_state(bdb, job_id)
+        _bayesdb_analysis_set_state(bdb, job_id, 'cancelled',
+            end_time=time.time())
+
+def bayesdb_analysis_wait(bdb, job_id, timeout=None):
+    """Wait for the analysis job `job_id` to stop running.
+
+    Returns true if it has stopped, or false if `timeout` seconds
+    elapsed first.  Note that a paused job has not stopped running.
+    """
+    job = bdb.analysis_jobs.get(job_id)
+    if job is not None:
+        job.join(timeout)
+        if job.is_alive():
+            return False
+    return True
+
+def bayesdb_analysis_stop(bdb):
+    """Pause all analysis jobs of `bdb` and wait for their workers.
+
+    Called when `bdb` is closed.  The jobs may be resumed later.
+    """
+    jobs = [job for job in bdb.analysis_jobs.itervalues() if job.is_alive()]
+    for job in jobs:
+        job.request('stopped')
+    for job in jobs:
+        job.join()
+    bdb.analysis_jobs.clear()
+
+def _bayesdb_analysis_setup(bdb):
+    bdb._sqlite3.setbusytimeout(BUSY_TIMEOUT)
+    sql = 'PRAGMA journal_mode = WAL'
+    mode = cursor_value(bdb._sqlite3.cursor().execute(sql))
+    if mode != 'wal':
+        raise BQLError(bdb, 'Background analysis needs write-ahead log'
+            ' journal mode, but the database is in %s mode' % (mode,))
+
+def _bayesdb_analysis_spawn(bdb, job_id):
+    # Give the worker its own seed, drawn from ours, so that it does
+    # not share a pseudorandom number stream with anyone.
+    words = [bdb.py_prng.randrange(2**64) for _ in range(4)]
+    seed = struct.pack('<QQQQ', *words)
+    job = AnalysisJob(bdb, job_id, seed)
+    bdb.analysis_jobs[job_id] = job
+    job.start()
+
+def _bayesdb_analysis_live_job(bdb, job_id):
+    job = bdb.analysis_jobs.get(job_id)
+    if job is None or not job.is_alive():
+        return None
+    return job
+
+def _bayesdb_analysis_state(bdb, job_id):
+    # Return the state of a job that can still be paused, resumed,
+    # or cancelled, or fail if there is no such job.
+    bayesdb_schema_required(bdb, 8, 'background analysis')
+    sql = 'SELECT state FROM bayesdb_analysis_job WHERE id = ?'
+    rows = bdb.sql_execute(sql, (job_id,)).fetchall()
+    if len(rows) == 0:
+        raise BQLError(bdb, 'No such analysis job: %r' % (job_id,))
+    state = rows[0][0]
+    if state not in ('running', 'paused'):
+        raise BQLError(bdb, 'Analysis job %d is %s' % (job_id, state))
+    return state
+
+def _bayesdb_analysis_set_state(bdb, job_id, state, end_time=None):
+    with bdb.savepoint():
+        sql = '''
+            UPDATE bayesdb_analysis_job SET state = ?, end_time = ?
+                WHERE id = ?
+        '''
+        bdb.sql_execute(sql, (state, end_time, job_id))
+
+class AnalysisJob(threading.Thread):
+    """Worker thread for one background analysis job.
+
+    The job's parameters and progress so far are read from its record
+    in the ``bayesdb_analysis_job`` table of `bdb`, so a job can be
+    resumed by a new worker after its old one has stopped.
+    """
+
+    def __init__(self, bdb, job_id, seed):
+        threading.Thread.__init__(self,
+            name='bayesdb analysis job %d' % (job_id,))
+        self.daemon = True
+        self.job_id = job_id
+        self._pathname = bdb.pathname
+        self._metamodels = [metamodel.copy()
+            for metamodel in bdb.metamodels.itervalues()]
+        self._analysis_processes = bdb.analysis_processes
+        self._seed = seed
+        sql = '''
+            SELECT generator_id, modelnos, iterations, seconds,
+                    ckpt_iterations, ckpt_seconds,
+                    iterations_done, seconds_done, checkpoints
+                FROM bayesdb_analysis_job WHERE id = ?
+        '''
+        cursor = bdb.sql_execute(sql, (job_id,))
+        (self._generator_id, modelnos, self._iterations, self._seconds,
+                self._ckpt_iterations, self._ckpt_seconds,
+                self._iterations_done, self._seconds_done,
+                self._checkpoints) = cursor.fetchall()[0]
+        self._modelnos = None if modelnos is None else json.loads(modelnos)
+        # The state requested by the controlling thread: running,
+        # paused, cancelled, or stopped.
+        self._condition = threading.Condition()
+        self._request = 'running'
+
+    def request(self, state):
+        """Ask the worker to enter `state` at its next checkpoint."""
+        assert state in ('running', 'paused', 'cancelled', 'stopped')
+        with self._condition:
+            self._request = state
+            self._condition.notify_all()
+
+    def run(self):
+        # Imported here because bayeslite.bayesdb imports us.
+        from bayeslite.bayesdb import bayesdb_open
+        from bayeslite.metamodel import bayesdb_register_metamodel
+        bdb = None
+        try:
+            bdb = bayesdb_open(pathname=self._pathname,
+                builtin_metamodels=False, seed=self._seed, compatible=True,
+                analysis_processes=self._analysis_processes)
+            bdb._sqlite3.setbusytimeout(BUSY_TIMEOUT)
+            for metamodel in self._metamodels:
+                bayesdb_register_metamodel(bdb, metamodel)
+            state = self._analyze(bdb)
+            if state == 'stopped':
+                self._update(bdb, state='paused')
+            else:
+                self._update(bdb, state=state, end_time=time.time())
+        except Exception:
+            if bdb is not None:
+                self._update(bdb, state='failed', end_time=time.time(),
+                    error=traceback.format_exc())
+        finally:
+            if bdb is not None:
+                bdb.close()
+
+    def _analyze(self, bdb):
+        with bdb.savepoint():
+            metamodel = core.bayesdb_generator_metamodel(bdb,
+                self._generator_id)
+        conflicts = 0
+        while True:
+            request = self._await_request(bdb)
+            if request != 'running':
+                return request
+            if self._iterations is not None and \
+                    self._iterations <= self._iterations_done:
+                return 'done'
+            if self._seconds is not None and \
+                    self._seconds <= self._seconds_done:
+                return 'done'
+            iterations, max_seconds = self._next_checkpoint()
+            iterations_before = self._model_iterations(bdb)
+            start = time.time()
+            try:
+                metamodel.analyze_models(bdb, self._generator_id,
+                    modelnos=self._modelnos, iterations=iterations,
+                    max_seconds=max_seconds,
+                    ckpt_iterations=self._ckpt_iterations,
+                    ckpt_seconds=self._ckpt_seconds)
+            except apsw.BusyError:
+                # The other connection wrote to the database since we
+                # read the models.  Count any checkpoints committed
+                # before that and try again, unless that keeps
+                # happening without progress.
+                conflicts += 1
+            else:
+                conflicts = 0
+            self._seconds_done += time.time() - start
+            iterations = self._model_iterations(bdb) - iterations_before
+            if 0 < iterations:
+                self._iterations_done += iterations
+                self._checkpoints += 1
+                conflicts = min(conflicts, 1)
+            if BUSY_RETRIES < conflicts:
+                raise BQLError(bdb, 'Analysis job %d gave up after %d'
+                    ' conflicting writes in a row' %
+                    (self.job_id, conflicts))
+            with bdb.savepoint():
+                logscore = metamodel.analysis_logscore(bdb,
+                    self._generator_id, self._modelnos)
+            self._update(bdb, logscore=logscore,
+                last_checkpoint=time.time())
+            if 0 < conflicts:
+                self._backoff(BUSY_BACKOFF * 2**(conflicts - 1))
+
+    def _await_request(self, bdb):
+        with self._condition:
+            request = self._request
+        if request == 'paused':
+            self._update(bdb, state='paused')
+            with self._condition:
+                while self._request == 'paused':
+                    self._condition.wait()
+                request = self._request
+            if request == 'running':
+                self._update(bdb, state='running')
+        return request
+
+    def _backoff(self, seconds):
+        # Give the other connection a chance to finish writing, but
+        # wake up early for any request from the controlling thread.
+        with self._condition:
+            if self._request == 'running':
+                self._condition.wait(seconds)
+
+    def _next_checkpoint(self):
+        # Analyze until the next checkpoint, which is by default
+        # after every iteration so that progress is visible and the
+        # job responds promptly to requests.
+        iterations = None
+        if self._iterations is not None:
+            iterations = self._iterations - self._iterations_done
+        max_seconds = None
+        if self._seconds is not None:
+            max_seconds = self._seconds - self._seconds_done
+        if self._ckpt_iterations is not None:
+            iterations = self._ckpt_iterations if iterations is None \
+                else min(iterations, self._ckpt_iterations)
+        elif self._ckpt_seconds is not None:
+            max_seconds = self._ckpt_seconds if max_seconds is None \
+                else min(max_seconds, self._ckpt_seconds)
+        else:
+            iterations = 1
+        return iterations, max_seconds
+
+    def _model_iterations(self, bdb):
+        sql = '''
+            SELECT modelno, iterations FROM bayesdb_generator_model
+                WHERE generator_id = ?
+        '''
+        with bdb.savepoint():
+            cursor = bdb.sql_execute(sql, (self._generator_id,))
+            iterations = [n for modelno, n in cursor
+                if self._modelnos is None or modelno in self._modelnos]
+        return max(iterations) if 0 < len(iterations) else 0
+
+    def _update(self, bdb, **kwargs):
+        kwargs.update({
+            'iterations_done': self._iterations_done,
+            'seconds_done': self._seconds_done,
+            'checkpoints': self._checkpoints,
+        })
+        assignments = ', '.join('%s = :%s' % (column, column)
+            for column in sorted(kwargs))
+        sql = 'UPDATE bayesdb_analysis_job SET %s WHERE id = :id' % \
+            (assignments,)
+        kwargs['id'] = self.job_id
+        with bdb.savepoint():
+            bdb.sql_execute(sql, kwargs)
@@ -112,6 +112,23 @@ DropModels = namedtuple('DropModels', [
     'generator',
     'modelnos',
 ])
+ShowAnalyses = namedtuple('ShowAnalyses', [
+    'generator',                # XXX name, or None for all generators
+])
+PauseAnalysis = namedtuple('PauseAnalysis', [
+    'job',                      # job id
+])
+ResumeAnalysis = namedtuple('ResumeAnalysis', [
+    'job',                      # job id
+])
+CancelAnalysis = namedtuple('CancelAnalysis', [
+    'job',                      # job id
+])
+
+Explain = namedtuple('Explain', [
+    'analyze',                  # bool, run the query too?
+    'query',                    # query phrase
+])
 
 Simulate = namedtuple('Simulate', [
     'columns',                  # [XXX name]
@@ -20,6 +20,7 @@ import numpy.random
 import random
 import struct
 
+import bayeslite.analysis as analysis
 import bayeslite.bql as bql
 import bayeslite.bqlfn as bqlfn
 import bayeslite.metamodel as metamodel
@@ -33,7 +34,8 @@ from bayeslite.util import cursor_value
 bayesdb_open_cookie = 0xed63e2c26d621a5b5146a334849d43f0
 
 def bayesdb_open(pathname=None, builtin_metamodels=None, seed=None,
-        version=None, compatible=None):
+        version=None, compatible=None, analysis_processes=None,
+        plan_cache_size=None, simulation_processes=None):
     """Open the BayesDB in the file at `pathname`.
 
     If there is no file at `pathname`, it is automatically created.
@@ -49,11 +51,34 @@ def bayesdb_open(pathname=None, builtin_metamodels=None, seed=None,
     bayeslite cannot read it.  If `compatible` is `True`,
     `bayesdb_open` will not incompatibly change the format of the
     database (but some newer bayesdb features may not work).
+
+    `analysis_processes`, if specified, is the number of worker
+    processes with which to analyze models in parallel, for
+    metamodels that support it and generators that do not specify
+    their own.  Results depend only on `seed`, not on the number of
+    worker processes.
+
+    `simulation_processes`, if specified, is the number of worker
+    processes with which to simulate rows for ``CREATE TABLE AS
+    SIMULATE``, as described in :mod:`bayeslite.simulation`, which
+    falls back to simulating in the calling process when workers could
+    not see the data.  Results depend only on `seed`, not on the number
+    of worker processes.
+
+    `plan_cache_size`, if specified, is the number of parsed and
+    compiled BQL phrases to remember by their text, so that executing
+    the same BQL again need not parse it again, nor compile it again
+    unless the tables, generators, or models it refers to may have
+    changed.  Defaults to 256.  Hits and misses are counted in
+    ``bdb.plan_cache.hits`` and ``bdb.plan_cache.misses``.
     """
     if builtin_metamodels is None:
         builtin_metamodels = True
     bdb = BayesDB(bayesdb_open_cookie, pathname=pathname, seed=seed,
-        version=version, compatible=compatible)
+        version=version, compatible=compatible,
+        analysis_processes=analysis_processes,
+        plan_cache_size=plan_cache_size,
+        simulation_processes=simulation_processes)
     if builtin_metamodels:
         metamodel.bayesdb_register_builtin_metamodels(bdb)
     return bdb
@@ -71,27 +96,44 @@ class BayesDB(object):
     """
 
     def __init__(self, cookie, pathname=None, seed=None, version=None,
-            compatible=None):
+            compatible=None, analysis_processes=None, plan_cache_size=None,
+            simulation_processes=None):
         if cookie != bayesdb_open_cookie:
             raise ValueError('Do not construct BayesDB objects directly!')
         if pathname is None:
             pathname = ":memory:"
+        if analysis_processes is not None and analysis_processes < 1:
+            raise ValueError('Invalid number of analysis processes: %r' %
+                (analysis_processes,))
+        if simulation_processes is not None and simulation_processes < 1:
+            raise ValueError('Invalid number of simulation processes: %r' %
+                (simulation_processes,))
+        if plan_cache_size is None:
+            plan_cache_size = 256
         self.pathname = pathname
+        self.analysis_processes = analysis_processes
+        self.simulation_processes = simulation_processes
         self._sqlite3 = apsw.Connection(pathname)
         self.txn_depth = 0
         self.metamodels = {}
         self.tracer = None
         self.sql_tracer = None
         self.cache = None
+        self.persistent_cache = {}
+        self.bql_memo = None
+        self.hypothetical_rows = None
+        self.query_profile = None
+        self.simulations = {}
+        self.plan_cache = bql.PlanCache(plan_cache_size)
+        self.catalog_version = 0
+        self.analysis_jobs = {}
+        self.data_version = None
         self.temptable = 0
         self.qid = 0
+        self._traced_bql = []
         if seed is None:
             seed = struct.pack('<QQQQ', 0, 0, 0, 0)
-        self._prng = weakprng.weakprng(seed)
-        pyrseed = self._prng.weakrandom32()
-        self._py_prng = random.Random(pyrseed)
-        nprseed = [self._prng.weakrandom32() for _ in range(4)]
-        self._np_prng = numpy.random.RandomState(nprseed)
+        self._seed(seed)
         schema.bayesdb_install_schema(self, version=version,
             compatible=compatible)
         bqlfn.bayesdb_install_bql(self._sqlite3, self)
@@ -109,9 +151,33 @@ class BayesDB(object):
     def close(self):
         """Close the database.  Further use is not allowed."""
         assert self.txn_depth == 0, "pending BayesDB transactions"
+        analysis.bayesdb_analysis_stop(self)
         self._sqlite3.close()
         self._sqlite3 = None
 
+    def _seed(self, seed):
+        self._prng = weakprng.weakprng(seed)
+        pyrseed = self._prng.weakrandom32()
+        self._py_prng = random.Random(pyrseed)
+        nprseed = [self._prng.weakrandom32() for _ in range(4)]
+        self._np_prng = numpy.random.RandomState(nprseed)
+
+    @contextlib.contextmanager
+    def seeded(self, seed):
+        """Reseed the pseudorandom number generators for the duration.
+
+        Within the context, :attr:`py_prng` and :attr:`np_prng` are
+        initialized from the 32-byte string `seed` as if it had been
+        supplied to :func:`bayesdb_open`.  On exit, they are restored
+        to their previous states.
+        """
+        saved = (self._prng, self._py_prng, self._np_prng)
+        self._seed(seed)
+        try:
+            yield
+        finally:
+            (self._prng, self._py_prng, self._np_prng) = saved
+
     @property
     def py_prng(self):
         """A :class:`random.Random` object local to this BayesDB instance.
@@ -165,6 +231,17 @@ class BayesDB(object):
         assert self.tracer == tracer
         self.tracer = None
 
+    def trace_progress(self, done, total):
+        """Report progress of the BQL query being executed.
+
+        If the query is traced by an :class:`~IBayesDBTracer`, its
+        :meth:`~IBayesDBTracer.progress` method is called with `done`
+        and `total`.  Otherwise, this does nothing.
+        """
+        if 0 < len(self._traced_bql):
+            tracer, qid = self._traced_bql[-1]
+            tracer.progress(qid, done, total)
+
     def sql_trace(self, tracer):
         """Trace execution of SQL queries.
 
@@ -230,7 +307,14 @@ class BayesDB(object):
         qid = self._qid()
         tracer.start(qid, string, bindings)
         try:
-            cursor = meth(string, bindings)
+            if meth == self._do_execute:
+                self._traced_bql.append((tracer, qid))
+                try:
+                    cursor = meth(string, bindings)
+                finally:
+                    self._traced_bql.pop()
+            else:
+                cursor = meth(string, bindings)
             tracer.ready(qid, cursor)
             if cursor == self._empty_cursor:
                 tracer.finished(qid)
@@ -249,19 +333,23 @@ class BayesDB(object):
             raise
 
     def _do_execute(self, string, bindings):
-        phrases = parse.parse_bql_string(string)
-        phrase = None
-        try:
-            phrase = phrases.next()
-        except StopIteration:
-            raise ValueError('no BQL phrase in string')
-        try:
-            phrases.next()
-        except StopIteration:
-            pass
-        else:
-            raise ValueError('>1 phrase in string')
-        cursor = bql.execute_phrase(self, phrase, bindings)
+        plan = self.plan_cache.get(string)
+        if plan is None:
+            phrases = parse.parse_bql_string(string)
+            phrase = None
+            try:
+                phrase = phrases.next()
+            except StopIteration:
+                raise ValueError('no BQL phrase in string')
+            try:
+                phrases.next()
+            except StopIteration:
+                pass
+            else:
+                raise ValueError('>1 phrase in string')
+            plan = bql.Plan(phrase)
+            self.plan_cache.put(string, plan)
+        cursor = bql.execute_phrase(self, plan.phrase, bindings, plan=plan)
         return self._empty_cursor if cursor is None else cursor
 
     def sql_execute(self, string, bindings=None):
@@ -285,6 +373,29 @@ class BayesDB(object):
         cursor.execute(string, bindings)
         return bql.BayesDBCursor(self, cursor)
 
+    def sql_executemany(self, string, bindings_list):
+        """Execute a SQL query once for each of a sequence of bindings.
+
+        The argument `string` is as for :meth:`~BayesDB.sql_execute`,
+        and is prepared only once.  The argument `bindings_list` is a
+        sequence of sequences or dictionaries of bindings.  A tracer
+        sees the query once for each of them, as if it had been
+        executed by :meth:`~BayesDB.sql_execute`.
+        """
+        if not self.sql_tracer:
+            return self._do_sql_executemany(string, bindings_list)
+        # sqlite3 still prepares the query only once, since apsw
+        # caches the prepared statement.
+        cursor = bql.BayesDBCursor(self, self._sqlite3.cursor())
+        for bindings in bindings_list:
+            cursor = self.sql_execute(string, bindings)
+        return cursor
+
+    def _do_sql_executemany(self, string, bindings_list):
+        cursor = self._sqlite3.cursor()
+        cursor.executemany(string, bindings_list)
+        return bql.BayesDBCursor(self, cursor)
+
     @contextlib.contextmanager
     def savepoint(self):
         """Savepoint context.  On return, commit; on exception, roll back.
@@ -415,6 +526,15 @@ class IBayesDBTracer(object):
         """Called when all query results are consumed."""
         pass
 
+    def progress(self, qid, done, total):
+        """Called as a long-running BQL command makes progress.
+
+        The arguments are the query id, and how many of how many units
+        of work are done, e.g. rows simulated for ``CREATE TABLE AS
+        SIMULATE``.
+        """
+        pass
+
     def abandoned(self, qid):
         """Called when a query is abandoned.
 
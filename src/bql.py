@@ -24,21 +24,89 @@ language) are executed directly.
 """
 
 import apsw
+import contextlib
 
+import bayeslite.analysis as analysis
 import bayeslite.ast as ast
 import bayeslite.bqlfn as bqlfn
 import bayeslite.compiler as compiler
 import bayeslite.core as core
+import bayeslite.explain as explain
+import bayeslite.lrucache as lrucache
+import bayeslite.simulation as simulation
 import bayeslite.txn as txn
 
 from bayeslite.exception import BQLError
 from bayeslite.schema import bayesdb_schema_required
+from bayeslite.schema import bayesdb_schema_version
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
-def execute_phrase(bdb, phrase, bindings=()):
-    """Execute the BQL AST phrase `phrase` and return a cursor of results."""
+# Commands that may change what the catalog says about tables,
+# generators, or models, and so how queries against them compile.
+CATALOG_PHRASES = (
+    ast.CreateTabAs,
+    ast.CreateTabSim,
+    ast.DropTab,
+    ast.AlterTab,
+    ast.CreateGen,
+    ast.DropGen,
+    ast.AlterGen,
+    ast.InitModels,
+    ast.DropModels,
+)
+
+class Plan(object):
+    """Parsed BQL phrase, with its compiled SQL if it is a query.
+
+    A query's compiled SQL is kept only if compiling it consulted
+    nothing but the catalog, and is reused with new bindings for as
+    long as the catalog version is what it was when it was compiled.
+    """
+
+    def __init__(self, phrase):
+        self.phrase = phrase
+        self.executed = False
+        self.catalog_version = None
+        self.out = None
+
+class PlanCache(object):
+    """Least-recently-used cache of up to `size` BQL plans, by text.
+
+    `hits` counts executions that reused a plan whole, neither parsing
+    nor compiling anything, and `misses` counts all others.
+    """
+
+    def __init__(self, size):
+        self._plans = lrucache.LRUCache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._plans)
+
+    def get(self, string):
+        """Return the plan for the BQL text `string`, or None."""
+        return self._plans.get(string)
+
+    def put(self, string, plan):
+        """Remember `plan` for the BQL text `string`."""
+        self._plans.put(string, plan, 1)
+
+    def clear(self):
+        """Forget all plans."""
+        self._plans.clear()
+
+def execute_phrase(bdb, phrase, bindings=(), plan=None):
+    """Execute the BQL AST phrase `phrase` and return a cursor of results.
+
+    If `plan` is not None, it is the :class:`Plan` of `phrase`, whose
+    compiled query is reused if possible and is otherwise updated.
+    """
+    if plan is not None:
+        reused = plan.executed
+        plan.executed = True
     if isinstance(phrase, ast.Parametrized):
         n_numpar = phrase.n_numpar
         nampar_map = phrase.nampar_map
@@ -50,15 +118,42 @@ def execute_phrase(bdb, phrase, bindings=()):
         # Ignore extraneous bindings.  XXX Bad idea?
 
     if ast.is_query(phrase):
-        # Compile the query in the transaction in case we need to
-        # execute subqueries to determine column lists.  Compiling is
-        # a quick tree descent, so this should be fast.
-        out = compiler.Output(n_numpar, nampar_map, bindings)
-        with bdb.savepoint():
-            compiler.compile_query(bdb, phrase, out)
-        winders, unwinders = out.getwindings()
-        return execute_wound(bdb, winders, unwinders, out.getvalue(),
-            out.getbindings())
+        out = None
+        if plan is not None:
+            catalog_version = core.bayesdb_catalog_version(bdb)
+            if plan.out is not None and \
+                    plan.catalog_version == catalog_version:
+                out = plan.out.rebind(bindings)
+            else:
+                reused = False
+        if out is None:
+            # Compile the query in the transaction in case we need to
+            # execute subqueries to determine column lists.  Compiling
+            # is a quick tree descent, so this should be fast.
+            out = compiler.Output(n_numpar, nampar_map, bindings)
+            with bdb.savepoint():
+                compiler.compile_query(bdb, phrase, out)
+            if plan is not None:
+                plan.out = out if out.cacheable else None
+                plan.catalog_version = catalog_version
+        if plan is not None:
+            if reused:
+                bdb.plan_cache.hits += 1
+            else:
+                bdb.plan_cache.misses += 1
+        return execute_query(bdb, out)
+
+    if plan is not None:
+        if reused:
+            bdb.plan_cache.hits += 1
+        else:
+            bdb.plan_cache.misses += 1
+
+    if isinstance(phrase, ast.Explain):
+        return execute_explain(bdb, phrase, n_numpar, nampar_map, bindings)
+
+    if isinstance(phrase, CATALOG_PHRASES):
+        bdb.catalog_version += 1
 
     if isinstance(phrase, ast.Begin):
         txn.bayesdb_begin_transaction(bdb)
@@ -82,8 +177,10 @@ def execute_phrase(bdb, phrase, bindings=()):
             out.write('CREATE %sTABLE %s%s AS ' % (temp, ifnotexists, qt))
             compiler.compile_query(bdb, phrase.query, out)
             winders, unwinders = out.getwindings()
+            memo = bqlfn.bayesdb_memo() if out.memoize else None
             with compiler.bayesdb_wind(bdb, winders, unwinders):
-                bdb.sql_execute(out.getvalue(), out.getbindings())
+                with computing(bdb, memo, bqlfn.bayesdb_shared_rows()):
+                    bdb.sql_execute(out.getvalue(), out.getbindings())
         return empty_cursor(bdb)
 
     if isinstance(phrase, ast.CreateTabSim):
@@ -168,9 +265,9 @@ def execute_phrase(bdb, phrase, bindings=()):
             insert_sql = '''
                 INSERT INTO %s (%s) VALUES (%s)
             ''' % (qn, ','.join(qcns), ','.join('?' for qcn in qcns))
-            for row in bqlfn.bayesdb_simulate(bdb, generator_id, constraints,
-                    colnos, modelno=modelno, numpredictions=nsamples):
-                bdb.sql_execute(insert_sql, row)
+            simulation.bayesdb_simulate_insert(bdb, insert_sql, generator_id,
+                constraints, colnos, modelno=modelno, numpredictions=nsamples,
+                processes=bdb.simulation_processes)
         return empty_cursor(bdb)
 
     if isinstance(phrase, ast.DropTab):
@@ -255,6 +352,7 @@ def execute_phrase(bdb, phrase, bindings=()):
                         'new': cmd.new,
                     })
                     assert bdb._sqlite3.totalchanges() - total_changes == 1
+                    bdb.catalog_version += 1
                     # ...except metamodels may have the (case-folded)
                     # name cached.
                     if old_folded != new_folded:
@@ -287,6 +385,7 @@ def execute_phrase(bdb, phrase, bindings=()):
                     total_changes = bdb._sqlite3.totalchanges()
                     bdb.sql_execute(set_default_sql, (generator_id,))
                     assert bdb._sqlite3.totalchanges() - total_changes == 1
+                    bdb.catalog_version += 1
                 elif isinstance(cmd, ast.AlterTabUnsetDefGen):
                     unset_default_sql = '''
                         UPDATE bayesdb_generator SET defaultp = 0
@@ -295,6 +394,7 @@ def execute_phrase(bdb, phrase, bindings=()):
                     total_changes = bdb._sqlite3.totalchanges()
                     bdb.sql_execute(unset_default_sql, (table,))
                     assert bdb._sqlite3.totalchanges() - total_changes in (0, 1)
+                    bdb.catalog_version += 1
                 else:
                     assert False, 'Invalid alter table command: %s' % \
                         (cmd,)
@@ -336,6 +436,11 @@ def execute_phrase(bdb, phrase, bindings=()):
             generator_id = core.bayesdb_get_generator(bdb, phrase.name)
             metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
 
+            # Forget its finished analysis jobs; refuse to drop it
+            # while any are still going.
+            if 8 <= bayesdb_schema_version(bdb):
+                analysis.bayesdb_analysis_forget(bdb, generator_id)
+
             # Metamodel-specific destruction.
             metamodel.drop_generator(bdb, generator_id)
 
@@ -352,6 +457,7 @@ def execute_phrase(bdb, phrase, bindings=()):
                 DELETE FROM bayesdb_generator WHERE id = ?
             '''
             bdb.sql_execute(drop_generator_sql, (generator_id,))
+            bdb.catalog_version += 1
         return empty_cursor(bdb)
 
     if isinstance(phrase, ast.AlterGen):
@@ -382,6 +488,7 @@ def execute_phrase(bdb, phrase, bindings=()):
                     bdb.sql_execute(update_generator_sql,
                         (cmd.name, generator_id))
                     assert bdb._sqlite3.totalchanges() - total_changes == 1
+                    bdb.catalog_version += 1
                     # Remember the new name for subsequent commands.
                     generator = cmd.name
                 else:
@@ -438,8 +545,6 @@ def execute_phrase(bdb, phrase, bindings=()):
         return empty_cursor(bdb)
 
     if isinstance(phrase, ast.AnalyzeModels):
-        if not phrase.wait:
-            raise NotImplementedError('No background analysis -- use WAIT.')
         # WARNING: It is the metamodel's responsibility to work in a
         # transaction.
         #
@@ -455,6 +560,14 @@ def execute_phrase(bdb, phrase, bindings=()):
                 (phrase.generator,))
         generator_id = core.bayesdb_get_generator_default(bdb,
             phrase.generator)
+        if not phrase.wait:
+            job_id = analysis.bayesdb_analysis_start(bdb, generator_id,
+                modelnos=phrase.modelnos,
+                iterations=phrase.iterations,
+                max_seconds=phrase.seconds,
+                ckpt_iterations=phrase.ckpt_iterations,
+                ckpt_seconds=phrase.ckpt_seconds)
+            return bdb.sql_execute('SELECT ? AS job', (job_id,))
         metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
         # XXX Should allow parameters for iterations and ckpt/iter.
         metamodel.analyze_models(bdb, generator_id,
@@ -465,6 +578,28 @@ def execute_phrase(bdb, phrase, bindings=()):
             ckpt_seconds=phrase.ckpt_seconds)
         return empty_cursor(bdb)
 
+    if isinstance(phrase, ast.ShowAnalyses):
+        generator_id = None
+        if phrase.generator is not None:
+            if not core.bayesdb_has_generator_default(bdb, phrase.generator):
+                raise BQLError(bdb, 'No such generator: %s' %
+                    (phrase.generator,))
+            generator_id = core.bayesdb_get_generator_default(bdb,
+                phrase.generator)
+        return analysis.bayesdb_analysis_jobs(bdb, generator_id)
+
+    if isinstance(phrase, ast.PauseAnalysis):
+        analysis.bayesdb_analysis_pause(bdb, phrase.job)
+        return empty_cursor(bdb)
+
+    if isinstance(phrase, ast.ResumeAnalysis):
+        analysis.bayesdb_analysis_resume(bdb, phrase.job)
+        return empty_cursor(bdb)
+
+    if isinstance(phrase, ast.CancelAnalysis):
+        analysis.bayesdb_analysis_cancel(bdb, phrase.job)
+        return empty_cursor(bdb)
+
     if isinstance(phrase, ast.DropModels):
         with bdb.savepoint():
             generator_id = core.bayesdb_get_generator_default(bdb,
@@ -538,6 +673,8 @@ def instantiate_generator(bdb, gen_name, table, metamodel, columns,
             'metamodel': metamodel.name(),
             'defaultp': default,
         })
+        # Make the catalog mirror see the new generator.
+        bdb.catalog_version += 1
     generator_id = core.bayesdb_get_generator(bdb, gen_name)
 
     assert generator_id
@@ -608,6 +745,7 @@ def instantiate_generator(bdb, gen_name, table, metamodel, columns,
                 'colno': colno,
                 'stattype': stattype,
             })
+        bdb.catalog_version += 1
 
     column_list = sorted((column_map[casefold(name)], name, stattype)
         for name, stattype in columns)
@@ -638,21 +776,68 @@ def rename_table(bdb, old, new):
         UPDATE bayesdb_generator SET tabname = ? WHERE tabname = ?
     '''
     bdb.sql_execute(update_generators_sql, (new, old))
+    bdb.catalog_version += 1
 
 def empty_cursor(bdb):
     return None
 
+def execute_query(bdb, out):
+    winders, unwinders = out.getwindings()
+    memo = bqlfn.bayesdb_memo() if out.memoize else None
+    rows = bqlfn.bayesdb_shared_rows()
+    with computing(bdb, memo, rows):
+        cursor = execute_wound(bdb, winders, unwinders, out.getvalue(),
+            out.getbindings())
+    cursor.memo = memo
+    cursor.rows = rows
+    return cursor
+
+@contextlib.contextmanager
+def computing(bdb, memo, rows):
+    """Compute BQL functions with `memo` and shared hypothetical `rows`."""
+    with bqlfn.bayesdb_memoizing(bdb, memo):
+        with bqlfn.bayesdb_sharing_rows(bdb, rows):
+            yield
+
+def execute_explain(bdb, phrase, n_numpar, nampar_map, bindings):
+    out = compiler.Output(n_numpar, nampar_map, bindings)
+    profile = None
+    if phrase.analyze:
+        profile = explain.QueryProfile()
+        with profile.measuring(bdb):
+            with bdb.savepoint():
+                compiler.compile_query(bdb, phrase.query, out)
+            cursor = execute_query(bdb, out)
+            if cursor is not None:
+                for _row in cursor:
+                    profile.rows += 1
+                del cursor
+    else:
+        with bdb.savepoint():
+            compiler.compile_query(bdb, phrase.query, out)
+    rows = explain.bayesdb_explain_rows(bdb, out, profile)
+    # Return the rows through a temporary table like any other query.
+    qt = sqlite3_quote_name(bdb.temp_table_name())
+    winders = [('CREATE TEMP TABLE %s (item TEXT, detail TEXT, value)' %
+        (qt,), ())]
+    for row in rows:
+        winders.append(('INSERT INTO %s (item, detail, value)'
+            ' VALUES (?, ?, ?)' % (qt,), row))
+    unwinders = [('DROP TABLE %s' % (qt,), ())]
+    sql = 'SELECT item, detail, value FROM %s ORDER BY _rowid_' % (qt,)
+    return execute_wound(bdb, winders, unwinders, sql, ())
+
 def execute_wound(bdb, winders, unwinders, sql, bindings):
     if len(winders) == 0 and len(unwinders) == 0:
         return bdb.sql_execute(sql, bindings)
     with bdb.savepoint():
         for (wsql, wbindings) in winders:
-            bdb.sql_execute(wsql, wbindings)
+            compiler.execute_winding(bdb, wsql, wbindings)
         try:
             return WoundCursor(bdb, bdb.sql_execute(sql, bindings), unwinders)
         except:
             for (usql, ubindings) in unwinders:
-                bdb.sql_execute(usql, ubindings)
+                compiler.execute_winding(bdb, usql, ubindings)
             raise
 
 class BayesDBCursor(object):
@@ -660,6 +845,11 @@ class BayesDBCursor(object):
     def __init__(self, bdb, cursor):
         self._bdb = bdb
         self._cursor = cursor
+        # Memo for BQL functions computing the results, if the query
+        # computes any of them more than once, and the hypothetical
+        # rows they share, for the life of the query.
+        self.memo = None
+        self.rows = None
         # XXX Must save the description early because apsw discards it
         # after we have iterated over all rows -- or if there are no
         # rows, discards it immediately!
@@ -674,17 +864,23 @@ class BayesDBCursor(object):
     def __iter__(self):
         return self
     def next(self):
-        return self._cursor.next()
+        if self.memo is None and self.rows is None:
+            return self._cursor.next()
+        with computing(self._bdb, self.memo, self.rows):
+            return self._cursor.next()
     def fetchone(self):
-        return self._cursor.fetchone()
+        with computing(self._bdb, self.memo, self.rows):
+            return self._cursor.fetchone()
     def fetchvalue(self):
         return cursor_value(self)
     def fetchmany(self, size=1):
         with txn.bayesdb_caching(self._bdb):
-            return self._cursor.fetchmany(size=size)
+            with computing(self._bdb, self.memo, self.rows):
+                return self._cursor.fetchmany(size=size)
     def fetchall(self):
         with txn.bayesdb_caching(self._bdb):
-            return self._cursor.fetchall()
+            with computing(self._bdb, self.memo, self.rows):
+                return self._cursor.fetchall()
     @property
     def connection(self):
         return self._bdb
@@ -711,6 +907,6 @@ class WoundCursor(BayesDBCursor):
         # depend on that, which is not such a great idea.)
         if self._bdb._sqlite3 is not None:
             for sql, bindings in reversed(self._unwinders):
-                self._bdb.sql_execute(sql, bindings)
+                compiler.execute_winding(self._bdb, sql, bindings)
         # Apparently object doesn't have a __del__ method.
         #super(WoundCursor, self).__del__()
@@ -14,11 +14,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import contextlib
 import json
 import math
 import numpy
 
 import bayeslite.core as core
+import bayeslite.lrucache as lrucache
 import bayeslite.stats as stats
 
 from bayeslite.exception import BQLError
@@ -29,22 +31,107 @@ from bayeslite.math_util import ieee_exp
 from bayeslite.util import casefold
 
 def bayesdb_install_bql(db, cookie):
-    def function(name, nargs, fn):
-        db.createscalarfunction(name, (lambda *args: fn(cookie, *args)), nargs)
-    function("bql_column_correlation", 3, bql_column_correlation)
-    function("bql_column_correlation_pvalue", 3, bql_column_correlation_pvalue)
+    def function(name, nargs, fn, memoize=False, deterministic=False):
+        if memoize:
+            # The result depends only on the arguments and on the
+            # database, which cannot change during a query, so
+            # remember it for queries that compute it more than once.
+            def call(*args):
+                return bayesdb_memoized(cookie, name, fn, args)
+        else:
+            def call(*args):
+                return fn(cookie, *args)
+        if deterministic:
+            # The result depends only on the arguments, so sqlite3 may
+            # compute it once for constant arguments.  Not for anything
+            # that reads models or tables, which may change between
+            # runs of a prepared statement.
+            try:
+                db.createscalarfunction(name, call, nargs,
+                    deterministic=True)
+            except TypeError:
+                # apsw too old to know about deterministic functions.
+                db.createscalarfunction(name, call, nargs)
+        else:
+            db.createscalarfunction(name, call, nargs)
+    function("bql_column_correlation", 3, bql_column_correlation,
+        memoize=True)
+    function("bql_column_correlation_pvalue", 3, bql_column_correlation_pvalue,
+        memoize=True)
     function("bql_column_dependence_probability", 4,
-        bql_column_dependence_probability)
+        bql_column_dependence_probability, memoize=True)
     function("bql_column_mutual_information", 5, bql_column_mutual_information)
-    function("bql_column_value_probability", -1, bql_column_value_probability)
-    function("bql_row_similarity", -1, bql_row_similarity)
+    function("bql_column_value_probability", -1, bql_column_value_probability,
+        memoize=True)
+    function("bql_row_similarity", -1, bql_row_similarity, memoize=True)
     function("bql_row_column_predictive_probability", 4,
-        bql_row_column_predictive_probability)
+        bql_row_column_predictive_probability, memoize=True)
     function("bql_predict", 5, bql_predict)
     function("bql_predict_confidence", 4, bql_predict_confidence)
-    function("bql_json_get", 2, bql_json_get)
-    function("bql_pdf_joint", -1, bql_pdf_joint)
-
+    function("bql_json_get", 2, bql_json_get, deterministic=True)
+    function("bql_pdf_joint", -1, bql_pdf_joint, memoize=True)
+    db.createmodule("bql_simulate", _SimulateModule(cookie))
+
+# Number of results of BQL functions to remember while a query runs.
+# sqlite3 computes all the results for a row before moving on to the
+# next one, so this need not be large to catch repeated expressions.
+_MEMO_SIZE = 1024
+
+_MEMO_NONE = object()
+
+@contextlib.contextmanager
+def bayesdb_memoizing(bdb, memo):
+    """Remember results of BQL functions in `memo` for the duration.
+
+    `memo` is a :class:`~bayeslite.lrucache.LRUCache` from
+    :func:`bayesdb_memo`, or `None` to remember nothing.
+    """
+    outer = bdb.bql_memo
+    bdb.bql_memo = memo
+    try:
+        yield
+    finally:
+        bdb.bql_memo = outer
+
+def bayesdb_memo():
+    """Return a fresh memo for :func:`bayesdb_memoizing`."""
+    return lrucache.LRUCache(_MEMO_SIZE)
+
+@contextlib.contextmanager
+def bayesdb_sharing_rows(bdb, rows):
+    """Share hypothetical rows through `rows` for the duration.
+
+    `rows` is a dict from :func:`bayesdb_shared_rows`, in which the
+    BQL functions of one query keep the hypothetical row they all ask
+    about and anything the metamodels derive from it, or `None` to
+    share nothing.
+    """
+    outer = bdb.hypothetical_rows
+    bdb.hypothetical_rows = rows
+    try:
+        yield
+    finally:
+        bdb.hypothetical_rows = outer
+
+def bayesdb_shared_rows():
+    """Return fresh shared rows for :func:`bayesdb_sharing_rows`."""
+    return {}
+
+def bayesdb_memoized(bdb, name, fn, args):
+    """Return ``fn(bdb, *args)``, remembered in the current memo if any."""
+    memo = bdb.bql_memo
+    if memo is None:
+        return fn(bdb, *args)
+    key = (name,) + args
+    try:
+        value = memo.get(key, _MEMO_NONE)
+    except TypeError:           # unhashable blob argument
+        return fn(bdb, *args)
+    if value is _MEMO_NONE:
+        value = fn(bdb, *args)
+        memo.put(key, value, 1)
+    return value
+
 ### BayesDB column functions
 
 def bql_column_stattypes_and_data(bdb, generator_id, colno0, colno1):
@@ -359,6 +446,17 @@ def bql_predict_confidence(bdb, generator_id, modelno, colno, rowid,
 def bql_json_get(bdb, blob, key):
     return json.loads(blob)[key]
 
+def bayesdb_predict_confidence_batch(bdb, generator_id, modelno, colno,
+        rowids, numsamples=None):
+    """Predict values for a column in many rows, with confidences.
+
+    Returns a list of ``(value, confidence)`` pairs, one for each row
+    in `rowids`.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.predict_confidence_batch(bdb, generator_id, modelno,
+        colno, rowids, numsamples=numsamples)
+
 def bayesdb_simulate(bdb, generator_id, constraints, colnos,
         modelno=None, numpredictions=1):
     """Simulate rows from a generative model, subject to constraints.
@@ -381,6 +479,170 @@ def bayesdb_simulate(bdb, generator_id, constraints, colnos,
     return metamodel.simulate_joint(bdb, generator_id, targets,
         constraints, modelno, num_predictions=numpredictions)
 
+# Number of rows to simulate at a time when simulating on demand.
+_SIMULATE_CHUNK = 1000
+
+def bayesdb_simulate_chunks(bdb, generator_id, constraints, colnos,
+        modelno=None, numpredictions=1, chunksize=None):
+    """Simulate rows like :func:`bayesdb_simulate`, a chunk at a time.
+
+    Returns an iterator of lists of at most `chunksize` tuples,
+    `numpredictions` tuples in all, which simulates each list only
+    when it is asked for.
+    """
+    if chunksize is None:
+        chunksize = _SIMULATE_CHUNK
+    assert 0 < chunksize
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    fake_rowid = core.bayesdb_generator_fresh_row_id(bdb, generator_id)
+    targets = [(fake_rowid, colno) for colno in colnos]
+    if constraints is not None:
+        constraints = [(fake_rowid, colno, val)
+                       for colno, val in constraints]
+    remaining = numpredictions
+    while 0 < remaining:
+        n = min(remaining, chunksize)
+        yield metamodel.simulate_joint(bdb, generator_id, targets,
+            constraints, modelno, num_predictions=n)
+        remaining -= n
+
+def bayesdb_simulation(bdb, table, columns, generator_id, constraints,
+        colnos, modelno=None, numpredictions=1):
+    """Arrange for the virtual table `table` to simulate rows on demand.
+
+    ``CREATE VIRTUAL TABLE temp.<table> USING bql_simulate`` then
+    creates a table whose columns are given by the list `columns` of
+    ``(name, sqltype)`` pairs, and whose rows are simulated as by
+    :func:`bayesdb_simulate` a chunk at a time as a query first reads
+    them, and shared by every later scan of the table.  Dropping the
+    table, or :func:`bayesdb_simulation_forget`, forgets the
+    simulation.
+    """
+    schema = 'CREATE TABLE x (%s)' % \
+        (','.join('%s %s' % (sqlite3_quote_name(name), sqltype)
+            for name, sqltype in columns),)
+    bdb.simulations[table] = (schema, generator_id, constraints, colnos,
+        modelno, numpredictions)
+
+def bayesdb_simulation_forget(bdb, table):
+    """Forget the simulation for `table`, if it has not been dropped."""
+    bdb.simulations.pop(table, None)
+
+class _SimulateModule(object):
+    """apsw virtual table module for :func:`bayesdb_simulation`."""
+    def __init__(self, bdb):
+        self._bdb = bdb
+    def Create(self, _db, _modulename, _dbname, tablename, *_args):
+        if tablename not in self._bdb.simulations:
+            raise ValueError('No such simulation: %s' % (repr(tablename),))
+        simulation = self._bdb.simulations[tablename]
+        schema = simulation[0]
+        return schema, _SimulateTable(self._bdb, tablename, simulation[1:])
+    Connect = Create
+
+class _SimulateTable(object):
+    # The rows simulated so far are kept with the table, which lives
+    # for one execution of a query, so that a query scanning it more
+    # than once, e.g. in a join, sees the same rows each time and
+    # simulates them only once.
+    def __init__(self, bdb, name, simulation):
+        self._bdb = bdb
+        self._name = name
+        self._simulation = simulation
+        self._chunks = None
+        self._rows = []
+    def BestIndex(self, _constraints, _orderbys):
+        return None
+    def Open(self):
+        return _SimulateCursor(self)
+    def Disconnect(self):
+        pass
+    def Destroy(self):
+        self._bdb.simulations.pop(self._name, None)
+    def row(self, i):
+        # Return the ith row, simulating more if necessary, or None if
+        # there are only i rows in all.
+        if self._chunks is None:
+            generator_id, constraints, colnos, modelno, numpredictions = \
+                self._simulation
+            self._chunks = bayesdb_simulate_chunks(self._bdb, generator_id,
+                constraints, colnos, modelno=modelno,
+                numpredictions=numpredictions)
+        while len(self._rows) <= i:
+            try:
+                self._rows.extend(next(self._chunks))
+            except StopIteration:
+                return None
+        return self._rows[i]
+
+class _SimulateCursor(object):
+    def __init__(self, table):
+        self._table = table
+        self._row = None
+        self._i = 0
+    def Filter(self, _indexnum, _indexname, _constraintargs):
+        self._i = 0
+        self._row = self._table.row(self._i)
+    def Eof(self):
+        return self._row is None
+    def Rowid(self):
+        return self._i + 1
+    def Column(self, n):
+        if n == -1:
+            return self._i + 1
+        return self._row[n]
+    def Next(self):
+        self._i += 1
+        self._row = self._table.row(self._i)
+    def Close(self):
+        self._row = None
+
+def bayesdb_column_dependence_probability_matrix(bdb, generator_id, modelno,
+        colnos):
+    """Compute dependence probabilities of all pairs of columns at once.
+
+    Returns a list of ``len(colnos)`` lists whose ``[i][j]`` entry is
+    the dependence probability of ``colnos[i]`` with ``colnos[j]``.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.column_dependence_probability_matrix(bdb, generator_id,
+        modelno, colnos)
+
+def bayesdb_column_mutual_information_batch(bdb, generator_id, modelno,
+        colno_pairs, numsamples=None):
+    """Compute mutual information of many pairs of columns at once.
+
+    Returns a list with the mutual information of each ``(colno0,
+    colno1)`` pair in `colno_pairs`.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.column_mutual_information_batch(bdb, generator_id,
+        modelno, colno_pairs, numsamples=numsamples)
+
+def bayesdb_row_similarity_batch(bdb, generator_id, modelno, rowids,
+        target_rowids, colnos):
+    """Compute similarities of many pairs of rows at once.
+
+    Returns a list of ``len(rowids)`` lists whose ``[i][j]`` entry is
+    the similarity of ``rowids[i]`` to ``target_rowids[j]`` with
+    respect to `colnos`.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.row_similarity_batch(bdb, generator_id, modelno, rowids,
+        target_rowids, colnos)
+
+def bayesdb_row_similarity_topk(bdb, generator_id, modelno, rowids,
+        target_rowids, colnos, k):
+    """Find the `k` most similar pairs of rows.
+
+    Returns a list of at most `k` triples ``(rowid, target_rowid,
+    similarity)`` for `rowid` in `rowids` and `target_rowid` in
+    `target_rowids`, in order of decreasing similarity.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.row_similarity_topk(bdb, generator_id, modelno, rowids,
+        target_rowids, colnos, k)
+
 def bayesdb_insert(bdb, generator_id, row):
     """Notify a generator that a row has been inserted into its table."""
     bayesdb_insertmany(bdb, generator_id, [row])
@@ -389,3 +651,27 @@ def bayesdb_insertmany(bdb, generator_id, rows):
     """Notify a generator that rows have been inserted into its table."""
     metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
     metamodel.insertmany(bdb, generator_id, rows)
+
+def bayesdb_row_column_predictive_probability_batch(bdb, generator_id,
+        modelno, colno, rowids):
+    """Compute predictive probabilities of a column in many rows at once.
+
+    Returns a list with the predictive probability of the value of
+    column `colno` in each row in `rowids`, or `None` where the value
+    is missing.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.row_column_predictive_probability_batch(bdb,
+        generator_id, modelno, colno, rowids)
+
+def bayesdb_row_column_predictive_probability_topk(bdb, generator_id,
+        modelno, colno, rowids, k, descending):
+    """Find the `k` rows first in order of predictive probability.
+
+    Returns a list of at most `k` pairs ``(rowid, probability)`` for
+    `rowid` in `rowids`, in the order of ``ORDER BY PREDICTIVE
+    PROBABILITY OF <col>``, or of ``... DESC`` if `descending`.
+    """
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    return metamodel.row_column_predictive_probability_topk(bdb,
+        generator_id, modelno, colno, rowids, k, descending)
@@ -36,8 +36,10 @@ import bayeslite.bqlfn as bqlfn
 import bayeslite.core as core
 
 from bayeslite.exception import BQLError
+from bayeslite.metamodel import bayesdb_metamodel_overrides
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
+from bayeslite.util import cursor_value
 
 class Output(object):
     """Compiled SQL output accumulator.
@@ -59,11 +61,34 @@ class Output(object):
         self.select = []                # map of output index -> input index
         self.winders = []               # list of pre-query (sql, bindings)
         self.unwinders = []             # list of post-query (sql, bindings)
+                                        # or (function, arguments)
+        self.cacheable = True           # depends only on catalog and text?
+        self.bql = []                   # list of (compiler, BQL expression)
+        self.memoize = False            # same BQL expression compiled twice?
 
     def subquery(self):
-        """Return an output accumulator for a subquery."""
+        """Return an output accumulator for a subquery.
+
+        Subqueries are evaluated while compiling, with the bindings of
+        this query, so the output is no longer fit to reuse.
+        """
+        self.cacheable = False
         return Output(self.n_numpar, self.nampar_map, self.bindings)
 
+    def rebind(self, bindings):
+        """Return a copy of the accumulated output for `bindings`.
+
+        Only output that is :attr:`cacheable`, and so does not depend
+        on the bindings it was compiled with, may be rebound.
+        """
+        assert self.cacheable
+        out = Output(self.n_numpar, self.nampar_map, bindings)
+        out.stringio.write(self.getvalue())
+        out.renumber = self.renumber
+        out.select = self.select
+        out.memoize = self.memoize
+        return out
+
     def getvalue(self):
         """Return the accumulated output."""
         return self.stringio.getvalue()
@@ -177,6 +202,7 @@ class Output(object):
         self.write_numpar(n)
 
     def winder(self, sql, bindings):
+        self.cacheable = False
         self.winders.append((sql, bindings))
     def unwinder(self, sql, bindings):
         self.unwinders.append((sql, bindings))
@@ -186,20 +212,29 @@ def bayesdb_wind(bdb, winders, unwinders):
     """Perform queries `winders` before and `unwinders` after.
 
     Each of `winders` and `unwinders` is a list of ``(<sql>,
-    <bindings>)`` tuples.
+    <bindings>)`` tuples, or of ``(<function>, <arguments>)`` tuples
+    for state outside the database, as by :func:`execute_winding`.
     """
     if 0 < len(winders) or 0 < len(unwinders):
         with bdb.savepoint():
             for (sql, bindings) in winders:
-                bdb.sql_execute(sql, bindings)
+                execute_winding(bdb, sql, bindings)
             try:
                 yield
             finally:
                 for (sql, bindings) in reversed(unwinders):
-                    bdb.sql_execute(sql, bindings)
+                    execute_winding(bdb, sql, bindings)
     else:
         yield
 
+def execute_winding(bdb, sql, bindings):
+    """Execute `sql` with `bindings`, or call `sql` with arguments
+    `bindings` if it is a function."""
+    if callable(sql):
+        sql(*bindings)
+    else:
+        bdb.sql_execute(sql, bindings)
+
 def compile_query(bdb, query, out):
     """Compile `query`, writing output to `output`.
 
@@ -290,8 +325,64 @@ def compile_select(bdb, select, out):
             compile_nobql_expression(bdb, select.limit.offset, out)
 
 def compile_infer_explicit_predict(bdb, infer, out):
+    if not core.bayesdb_has_generator_default(bdb, infer.generator):
+        raise BQLError(bdb, 'No such generator: %s' % (infer.generator,))
+    generator_id = core.bayesdb_get_generator_default(bdb, infer.generator)
+    for col in infer.columns:
+        if isinstance(col, ast.PredCol):
+            if not core.bayesdb_generator_has_column(bdb, generator_id,
+                    col.column):
+                generator = core.bayesdb_generator_name(bdb, generator_id)
+                raise BQLError(bdb, 'No such column in generator %s: %s' %
+                    (generator, col.column))
+        elif isinstance(col, ast.SelColAll):
+            raise NotImplementedError('You have no business'
+                ' mixing * with PREDICT!')
+        elif isinstance(col, ast.SelColSub):
+            raise NotImplementedError('You have no business'
+                ' mixing subquery-chosen columns with PREDICT!')
+        elif not isinstance(col, ast.SelColExp):
+            assert False, 'Invalid INFER column: %s' % (repr(col),)
+    # Run the query with the row id in place of each prediction, then
+    # predict each column for all of those rows at once, and store
+    # the results in a temporary table, as for SIMULATE.
+    precomputed = [(ast.ExpBQLPredictConf(col.column), '_rowid_')
+        for col in infer.columns
+        if isinstance(col, ast.PredCol)]
+    with bdb.savepoint():
+        subout = out.subquery()
+        named = False
+        compile_infer_explicit(bdb, infer, named, subout,
+            precomputed=precomputed)
+        winders, unwinders = subout.getwindings()
+        with bayesdb_wind(bdb, winders, unwinders):
+            rows = bdb.sql_execute(subout.getvalue(),
+                subout.getbindings()).fetchall()
+        modelno = evaluate_nobql_expression(bdb, infer.modelno, out,
+            'INTEGER')
+        assert modelno is None or isinstance(modelno, int)
+        results = []
+        for i, col in enumerate(infer.columns):
+            values = [row[i] for row in rows]
+            if isinstance(col, ast.PredCol):
+                colno = core.bayesdb_generator_column_number(bdb,
+                    generator_id, col.column)
+                rowids = sorted(set(rowid for rowid in values
+                        if rowid is not None))
+                predictions = dict(zip(rowids,
+                    bqlfn.bayesdb_predict_confidence_batch(bdb, generator_id,
+                        modelno, colno, rowids)))
+                predictions[None] = (None, None)
+                results.append([predictions[rowid][0] for rowid in values])
+                results.append([predictions[rowid][1] for rowid in values])
+            else:
+                results.append(values)
+        keys = [(rowno,) for rowno in xrange(len(rows))]
+        batch_table = compile_batch_table(bdb, ['rowno'], keys, results, out,
+            value_type=None)
     out.write('SELECT')
     first = True
+    j = 0
     for i, col in enumerate(infer.columns):
         if first:
             first = False
@@ -301,12 +392,14 @@ def compile_infer_explicit_predict(bdb, infer, out):
         if isinstance(col, ast.PredCol):
             vcn = col.column if col.name is None else col.name
             qvcn = sqlite3_quote_name(vcn)
-            out.write("bql_json_get(c%u, 'value') AS %s" % (i, qvcn))
+            out.write('pv.value%d AS %s' % (j, qvcn))
             out.write(', ')
             qccn = sqlite3_quote_name(col.confname)
-            out.write("bql_json_get(c%u, 'confidence') AS %s" % (i, qccn))
-        elif isinstance(col, ast.SelColExp):
-            out.write('c%u' % (i,))
+            out.write('pv.value%d AS %s' % (j + 1, qccn))
+            j += 2
+        else:
+            assert isinstance(col, ast.SelColExp)
+            out.write('pv.value%d' % (j,))
             if col.name is not None:
                 qcn = sqlite3_quote_name(col.name)
                 out.write(' AS %s' % (qcn,))
@@ -315,27 +408,21 @@ def compile_infer_explicit_predict(bdb, infer, out):
                 out.write(' AS %s' % (qcn,))
             else:
                 # XXX Preserve the expression as a column name...?
-                pass
-        elif isinstance(col, ast.SelColAll):
-            raise NotImplementedError('You have no business'
-                ' mixing * with PREDICT!')
-        elif isinstance(col, ast.SelColSub):
-            raise NotImplementedError('You have no business'
-                ' mixing subquery-chosen columns with PREDICT!')
-        else:
-            assert False, 'Invalid INFER column: %s' % (repr(col),)
-    out.write(' FROM ')
-    with compiling_paren(bdb, out, '(', ')'):
-        named = False
-        compile_infer_explicit(bdb, infer, named, out)
+                out.write(' AS c%u' % (i,))
+            j += 1
+    out.write(' FROM %s AS pv ORDER BY pv.rowno ASC' %
+        (sqlite3_quote_name(batch_table),))
 
-def compile_infer_explicit(bdb, infer, named, out):
+def compile_infer_explicit(bdb, infer, named, out, precomputed=()):
     assert isinstance(infer, ast.InferExplicit)
     out.write('SELECT')
     if not core.bayesdb_has_generator_default(bdb, infer.generator):
         raise BQLError(bdb, 'No such generator: %s' % (infer.generator,))
     generator_id = core.bayesdb_get_generator_default(bdb, infer.generator)
-    bql_compiler = BQLCompiler_1Row_Infer(generator_id, infer.modelno)
+    precomputed = list(precomputed) + \
+        compile_batch_1row(bdb, generator_id, infer, out)
+    bql_compiler = BQLCompiler_1Row_Infer(generator_id, infer.modelno,
+        precomputed=precomputed)
     compile_select_columns(bdb, infer.columns, named, bql_compiler, out)
     table_name = core.bayesdb_generator_table(bdb, generator_id)
     qt = sqlite3_quote_name(table_name)
@@ -419,13 +506,31 @@ def compile_estimate(bdb, estimate, out):
     if not core.bayesdb_has_generator_default(bdb, estimate.generator):
         raise BQLError(bdb, 'No such generator: %s' % (estimate.generator,))
     generator_id = core.bayesdb_get_generator_default(bdb, estimate.generator)
-    bql_compiler = BQLCompiler_1Row(generator_id, estimate.modelno)
-    named = True
-    compile_select_columns(bdb, estimate.columns, named, bql_compiler, out)
     table_name = core.bayesdb_generator_table(bdb, generator_id)
     qt = sqlite3_quote_name(table_name)
+    # If the rows are ordered by predictive probability and only the
+    # first few are wanted, find those up front, and compute the
+    # predictive probability only for them.
+    topk_table = None
+    precomputed = []
+    topk = estimate_topk_predprob(bdb, generator_id, estimate, out)
+    if topk is not None:
+        bql, topk_table = topk
+        qtt = sqlite3_quote_name(topk_table)
+        precomputed.append((bql,
+            '(SELECT value0 FROM %s WHERE sql_rowid = %s._rowid_)' %
+                (qtt, qt)))
+    else:
+        precomputed = compile_batch_1row(bdb, generator_id, estimate, out)
+    bql_compiler = BQLCompiler_1Row(generator_id, estimate.modelno,
+        precomputed=precomputed)
+    named = True
+    compile_select_columns(bdb, estimate.columns, named, bql_compiler, out)
     out.write(' FROM %s' % (qt,))
-    if estimate.condition is not None:
+    if topk_table is not None:
+        # The condition has already picked out the candidate rows.
+        out.write(' WHERE _rowid_ IN (SELECT sql_rowid FROM %s)' % (qtt,))
+    elif estimate.condition is not None:
         out.write(' WHERE ')
         compile_expression(bdb, estimate.condition, bql_compiler, out)
     if estimate.grouping is not None:
@@ -465,6 +570,300 @@ def compile_estimate(bdb, estimate, out):
             out.write(' OFFSET ')
             compile_expression(bdb, estimate.limit.offset, bql_compiler, out)
 
+def estimate_topk_predprob(bdb, generator_id, estimate, out):
+    """Find the rows of `estimate` first in order of predictive probability.
+
+    If `estimate` is ordered only by ``PREDICTIVE PROBABILITY OF
+    <col>``, possibly by an alias for it, and limited to the first `k`
+    rows, store the predictive probabilities of the `k` rows that
+    satisfy its condition and come first in that order in a temporary
+    table as :func:`compile_batch_table` does, keyed by
+    ``sql_rowid``, and return the ``PREDICTIVE PROBABILITY`` BQL
+    expression and the table's name.  Otherwise, return `None`.
+    """
+    if estimate.quantifier != ast.SELQUANT_ALL or \
+       estimate.grouping is not None or \
+       estimate.order is None or \
+       len(estimate.order) != 1 or \
+       estimate.limit is None:
+        return None
+    [order] = estimate.order
+    bql = order.expression
+    if isinstance(bql, ast.ExpCol) and bql.table is None:
+        # sqlite3 resolves a bare name in ORDER BY to a result column
+        # of that name first.
+        for selcol in estimate.columns:
+            if isinstance(selcol, ast.SelColExp) and \
+               selcol.name is not None and \
+               casefold(selcol.name) == casefold(bql.column):
+                bql = selcol.expression
+                break
+    if not isinstance(bql, ast.ExpBQLPredProb) or bql.column is None:
+        return None
+    if estimate.condition is not None and \
+       refers_to_result_column(estimate.condition, estimate.columns):
+        # The condition needs the values of the result columns, which
+        # picking out the rows by themselves does not compute.
+        return None
+    limit_compiler = BQLCompiler_Const(generator_id, estimate.modelno)
+    with bdb.savepoint():
+        limit = evaluate_expression(bdb, estimate.limit.limit,
+            limit_compiler, out, 'INTEGER')
+        offset = 0
+        if estimate.limit.offset is not None:
+            offset = evaluate_expression(bdb, estimate.limit.offset,
+                limit_compiler, out, 'INTEGER')
+        if limit is None or limit < 0 or offset is None or offset < 0:
+            return None
+        colno = core.bayesdb_generator_column_number(bdb, generator_id,
+            bql.column)
+        modelno = evaluate_nobql_expression(bdb, estimate.modelno, out,
+            'INTEGER')
+        assert modelno is None or isinstance(modelno, int)
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        subout = out.subquery()
+        subout.write('SELECT _rowid_ FROM %s' % (qt,))
+        if estimate.condition is not None:
+            subout.write(' WHERE ')
+            compile_expression(bdb, estimate.condition,
+                BQLCompiler_1Row(generator_id, estimate.modelno), subout)
+        subout.write(' ORDER BY _rowid_ ASC')
+        winders, unwinders = subout.getwindings()
+        with bayesdb_wind(bdb, winders, unwinders):
+            cursor = bdb.sql_execute(subout.getvalue(),
+                subout.getbindings())
+            rowids = [rowid for (rowid,) in cursor]
+        descending = order.sense == ast.ORD_DESC
+        top = bqlfn.bayesdb_row_column_predictive_probability_topk(bdb,
+            generator_id, modelno, colno, rowids, limit + offset, descending)
+        keys = [(rowid,) for rowid, _probability in top]
+        results = [[probability for _rowid, probability in top]]
+        topk_table = compile_batch_table(bdb, ['sql_rowid'], keys, results,
+            out)
+    return bql, topk_table
+
+# Tables with fewer rows than this are cheaper to compute 1-row BQL
+# functions for row by row than to stage in a temporary table.
+MIN_BATCH_ROWS = 100
+
+def compile_batch_1row(bdb, generator_id, query, out):
+    """Compute the 1-row BQL functions of `query` for all rows at once.
+
+    For each distinct ``PREDICTIVE PROBABILITY OF <col>`` and
+    ``SIMILARITY TO <row>`` expression in `query` whose metamodel
+    computes it for many rows at once, store its value in each row of
+    the generator's table that satisfies the condition in a temporary
+    table as :func:`compile_batch_table` does, keyed by
+    ``sql_rowid``, and return a list of ``(bql, sql)`` pairs of the
+    expressions and SQL expressions to look up their values, for
+    :class:`BQLCompiler_1Row`.  Return an empty list if the query is
+    better computed row by row.
+    """
+    if query.limit is not None and query.order is None:
+        # Only the first few rows are wanted, whichever they are.
+        return []
+    metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+    batch = []
+    for bql in query_bql_expressions(query):
+        if bql in batch:
+            continue
+        if isinstance(bql, ast.ExpBQLPredProb):
+            # The default batch method is worthwhile if logpdf_joint_batch
+            # is overridden.
+            if bql.column is not None and \
+               (bayesdb_metamodel_overrides(metamodel,
+                       'row_column_predictive_probability_batch') or
+                   bayesdb_metamodel_overrides(metamodel,
+                       'logpdf_joint_batch')):
+                batch.append(bql)
+        elif isinstance(bql, ast.ExpBQLSim):
+            if bql.condition is not None and \
+               not any(bql_expressions(bql.condition)) and \
+               bayesdb_metamodel_overrides(metamodel, 'row_similarity_batch'):
+                batch.append(bql)
+    if len(batch) == 0:
+        return []
+    table_name = core.bayesdb_generator_table(bdb, generator_id)
+    qt = sqlite3_quote_name(table_name)
+    # Count the rows without tracing, so that whether we batch does
+    # not show up in the query's SQL when we do not.  Writing rows
+    # does not change the catalog, so a plan compiled row by row for a
+    # small table must not be cached lest the table grow; it is cheap
+    # to compile again.
+    cursor = bdb._sqlite3.cursor().execute('SELECT COUNT(*) FROM %s' % (qt,))
+    if cursor_value(cursor) < MIN_BATCH_ROWS:
+        out.cacheable = False
+        return []
+    with bdb.savepoint():
+        modelno = evaluate_nobql_expression(bdb, query.modelno, out,
+            'INTEGER')
+        assert modelno is None or isinstance(modelno, int)
+        # Leave errors about missing models to the row-by-row functions.
+        if modelno is None:
+            if len(core.bayesdb_generator_modelnos(bdb, generator_id)) == 0:
+                return []
+        elif not core.bayesdb_generator_has_model(bdb, generator_id,
+                modelno):
+            return []
+        subout = out.subquery()
+        subout.write('SELECT _rowid_ FROM %s' % (qt,))
+        # Pick out the rows satisfying the condition first, unless
+        # that takes BQL or the values of the result columns.
+        if query.condition is not None and \
+           not any(bql_expressions(query.condition)) and \
+           not refers_to_result_column(query.condition, query.columns):
+            subout.write(' WHERE ')
+            compile_nobql_expression(bdb, query.condition, subout)
+        subout.write(' ORDER BY _rowid_ ASC')
+        winders, unwinders = subout.getwindings()
+        with bayesdb_wind(bdb, winders, unwinders):
+            cursor = bdb.sql_execute(subout.getvalue(),
+                subout.getbindings())
+            rowids = [rowid for (rowid,) in cursor]
+        if len(rowids) == 0:
+            return []
+        computed = []
+        results = []
+        for bql in batch:
+            if isinstance(bql, ast.ExpBQLPredProb):
+                colno = core.bayesdb_generator_column_number(bdb,
+                    generator_id, bql.column)
+                results.append(
+                    bqlfn.bayesdb_row_column_predictive_probability_batch(
+                        bdb, generator_id, modelno, colno, rowids))
+            else:
+                assert isinstance(bql, ast.ExpBQLSim)
+                subout = out.subquery()
+                subout.write('SELECT _rowid_ FROM %s WHERE ' % (qt,))
+                compile_nobql_expression(bdb, bql.condition, subout)
+                winders, unwinders = subout.getwindings()
+                with bayesdb_wind(bdb, winders, unwinders):
+                    cursor = bdb.sql_execute(subout.getvalue(),
+                        subout.getbindings())
+                    target = cursor.fetchone()
+                if target is None:
+                    # Leave the error to bql_row_similarity.
+                    continue
+                if len(bql.column_lists) == 1 and \
+                   isinstance(bql.column_lists[0], ast.ColListAll):
+                    colnos = core.bayesdb_generator_column_numbers(bdb,
+                        generator_id)
+                else:
+                    colnos = evaluate_column_lists(bdb, generator_id,
+                        bql.column_lists, out)
+                matrix = bqlfn.bayesdb_row_similarity_batch(bdb,
+                    generator_id, modelno, rowids, [target[0]], colnos)
+                results.append([similarities[0] for similarities in matrix])
+            computed.append(bql)
+        if len(computed) == 0:
+            return []
+        keys = [(rowid,) for rowid in rowids]
+        batch_table = compile_batch_table(bdb, ['sql_rowid'], keys, results,
+            out)
+    qtt = sqlite3_quote_name(batch_table)
+    return [(bql, '(SELECT value%d FROM %s WHERE sql_rowid = %s._rowid_)' %
+                (i, qtt, qt))
+        for i, bql in enumerate(computed)]
+
+def refers_to_result_column(condition, columns):
+    """True if `condition` names any of the result `columns` by alias."""
+    names = set(casefold(col.name) for col in columns
+        if isinstance(col, ast.SelColExp) and col.name is not None)
+    return any(isinstance(sub, ast.ExpCol) and sub.table is None and
+            casefold(sub.column) in names
+        for sub in subexpressions(condition))
+
+def query_bql_expressions(query):
+    """Yield the BQL expressions of `query` computed for each row.
+
+    `query` is an ESTIMATE or INFER EXPLICIT query; those in its
+    result columns, condition, grouping, and order are yielded.
+    """
+    parts = [
+        [col.expression for col in query.columns
+            if isinstance(col, ast.SelColExp)],
+        query.condition,
+    ]
+    if query.grouping is not None:
+        parts += [query.grouping.keys, query.grouping.condition]
+    if query.order is not None:
+        parts += [order.expression for order in query.order]
+    return bql_expressions(parts)
+
+def bql_expressions(exp):
+    """Yield the BQL expressions in `exp`, outside any subqueries."""
+    return (sub for sub in subexpressions(exp) if ast.is_bql(sub))
+
+def subexpressions(exp):
+    """Yield the subexpressions of `exp`, outside any subqueries and
+    the arguments of BQL functions."""
+    if isinstance(exp, tuple):
+        yield exp
+    if ast.is_bql(exp) or isinstance(exp, (ast.ExpSub, ast.ExpExists)):
+        return
+    if isinstance(exp, ast.ExpIn):
+        exp = [exp.expression]
+    if isinstance(exp, (tuple, list)):
+        for part in exp:
+            for sub in subexpressions(part):
+                yield sub
+
+def column_aliases(columns):
+    """Map the lowercased names of output `columns` to expressions.
+
+    `columns` is a list of ``(expression, name)`` pairs, with `name`
+    `None` if the column is unnamed.
+    """
+    return dict((name.lower(), exp) for exp, name in columns
+        if name is not None)
+
+def alias_reference(exp, aliases):
+    """Return the output column named by `exp` in `aliases`, if any."""
+    if isinstance(exp, ast.ExpCol) and exp.table is None and \
+       exp.column.lower() in aliases:
+        return aliases[exp.column.lower()]
+    return None
+
+def nobql_condition(condition, aliases):
+    """True if `condition` can be evaluated before its query runs.
+
+    That is, if it needs neither BQL nor any of the output columns
+    named in `aliases`.
+    """
+    for sub in subexpressions(condition):
+        if ast.is_bql(sub) or alias_reference(sub, aliases) is not None:
+            return False
+    return True
+
+def batch_candidates(columns, condition, order, limit, aliases, evaluable):
+    """Yield the subexpressions of `columns` evaluated on every row.
+
+    If `evaluable`, the rows are those satisfying `condition`, on each
+    of which the query evaluates its ORDER BY expressions, and, if
+    there is no LIMIT, its output columns too.  Otherwise the rows are
+    all rows, on each of which the query evaluates only `condition`.
+    """
+    needed = []
+    if evaluable:
+        if order is not None:
+            needed.extend(o.expression for o in order)
+        if limit is None:
+            needed.extend(exp for exp, _name in columns)
+    else:
+        needed.append(condition)
+    evaluated = []
+    for exp in needed:
+        for sub in subexpressions(exp):
+            evaluated.append(sub)
+            alias = alias_reference(sub, aliases)
+            if alias is not None:
+                evaluated.extend(subexpressions(alias))
+    for exp, _name in columns:
+        for sub in subexpressions(exp):
+            if sub in evaluated:
+                yield sub
+
 def compile_estimate_by(bdb, estby, out):
     assert isinstance(estby, ast.EstBy)
     out.write('SELECT ')
@@ -571,7 +970,6 @@ def compile_simulate(bdb, simulate, out):
         qtt = sqlite3_quote_name(temptable)
         qt = sqlite3_quote_name(table)
         column_names = simulate.columns
-        qcns = map(sqlite3_quote_name, column_names)
         cursor = bdb.sql_execute('PRAGMA table_info(%s)' % (qt,))
         column_sqltypes = {}
         for _colno, name, sqltype, _nonnull, _default, _primary in cursor:
@@ -616,18 +1014,17 @@ def compile_simulate(bdb, simulate, out):
         colnos = \
             [core.bayesdb_generator_column_number(bdb, generator_id, name)
                 for name in column_names]
-        out.winder('CREATE TEMP TABLE %s (%s)' %
-            (qtt,
-             ','.join('%s %s' %
-                    (qcn, column_sqltypes[casefold(column_name)])
-                for qcn, column_name in zip(qcns, column_names))),
-            ())
-        insert_sql = '''
-            INSERT INTO %s (%s) VALUES (%s)
-        ''' % (qtt, ','.join(qcns), ','.join('?' for qcn in qcns))
-        for row in bqlfn.bayesdb_simulate(bdb, generator_id, constraints,
-                colnos, modelno=modelno, numpredictions=nsamples):
-            out.winder(insert_sql, row)
+        # Simulate rows on demand as the query reads them, rather
+        # than all at once before it starts.  The simulation exists
+        # only while the query runs, so nothing is left behind if it
+        # is compiled but never run.
+        columns = [(column_name, column_sqltypes[casefold(column_name)])
+            for column_name in column_names]
+        out.winder(bqlfn.bayesdb_simulation, (bdb, temptable, columns,
+            generator_id, constraints, colnos, modelno, nsamples))
+        out.winder('CREATE VIRTUAL TABLE temp.%s USING bql_simulate' %
+            (qtt,), ())
+        out.unwinder(bqlfn.bayesdb_simulation_forget, (bdb, temptable))
         out.unwinder('DROP TABLE %s' % (qtt,), ())
         out.write('SELECT * FROM %s' % (qtt,))
 
@@ -645,7 +1042,53 @@ def compile_estcols(bdb, estcols, out):
         raise BQLError(bdb, 'No such generator: %s' % (estcols.generator,))
     generator_id = core.bayesdb_get_generator_default(bdb, estcols.generator)
     colno_exp = 'c.colno'       # XXX
-    bql_compiler = BQLCompiler_1Col(generator_id, estcols.modelno, colno_exp)
+    # Compute mutual information with a fixed column for all columns
+    # in one batch, rather than calling bql_column_mutual_information
+    # once per column -- but only for the columns that the query
+    # would compute it for anyway.
+    columns = [(col.expression, col.name) for col in estcols.columns
+        if isinstance(col, ast.SelColExp)]
+    aliases = column_aliases(columns)
+    evaluable = estcols.condition is None or \
+        nobql_condition(estcols.condition, aliases)
+    batch = []
+    for exp in batch_candidates(columns, estcols.condition, estcols.order,
+            estcols.limit, aliases, evaluable):
+        if isinstance(exp, ast.ExpBQLMutInf) and \
+           exp.column0 is not None and \
+           exp.column1 is None and \
+           core.bayesdb_generator_has_column(bdb, generator_id,
+                exp.column0) and \
+           exp not in batch:
+            batch.append(exp)
+    batch_table = None
+    precomputed = []
+    if 0 < len(batch):
+        if evaluable and estcols.condition is not None:
+            rows = evaluate_nobql_condition(bdb,
+                'SELECT c.colno AS colno, c.name AS name'
+                ' FROM bayesdb_generator AS g,'
+                ' bayesdb_generator_column AS gc,'
+                ' bayesdb_column AS c'
+                ' WHERE g.id = %(generator_id)d'
+                ' AND gc.generator_id = g.id'
+                ' AND c.tabname = g.tabname AND c.colno = gc.colno'
+                ' AND ' % {'generator_id': generator_id},
+                estcols.condition, ' ORDER BY colno ASC', out)
+            colnos = [colno for colno, _name in rows]
+        else:
+            colnos = core.bayesdb_generator_column_numbers(bdb, generator_id)
+        batches = []
+        for bql in batch:
+            colno0 = core.bayesdb_generator_column_number(bdb, generator_id,
+                bql.column0)
+            batches.append((bql, [(colno0, colno) for colno in colnos]))
+        batch_table = compile_batch_2col(bdb, generator_id, estcols.modelno,
+            ['colno'], [(colno,) for colno in colnos], batches, out)
+        precomputed = [(bql, 'pv.value%d' % (i,))
+            for i, bql in enumerate(batch)]
+    bql_compiler = BQLCompiler_1Col(generator_id, estcols.modelno, colno_exp,
+        precomputed=precomputed)
     out.write('SELECT')
     first = True
     for col in estcols.columns:
@@ -675,11 +1118,16 @@ def compile_estcols(bdb, estcols, out):
             assert False, 'Invalid ESTIMATE column: %s' % (repr(col),)
     out.write(' FROM bayesdb_generator AS g,'
         ' bayesdb_generator_column AS gc,'
-        ' bayesdb_column AS c'
+        ' bayesdb_column AS c')
+    if batch_table is not None:
+        out.write(', %s AS pv' % (sqlite3_quote_name(batch_table),))
+    out.write(
         ' WHERE g.id = %(generator_id)d'
         ' AND gc.generator_id = g.id'
         ' AND c.tabname = g.tabname AND c.colno = gc.colno' %
             {'generator_id': generator_id})
+    if batch_table is not None:
+        out.write(' AND pv.colno = c.colno')
     if estcols.condition is not None:
         out.write(' AND ')
         compile_expression(bdb, estcols.condition, bql_compiler, out)
@@ -714,8 +1162,61 @@ def compile_estpaircols(bdb, estpaircols, out):
         raise BQLError(bdb, 'No such generator: %s' % (estpaircols.generator,))
     generator_id = core.bayesdb_get_generator_default(bdb,
         estpaircols.generator)
+    # Compute bare dependence probability and mutual information for
+    # all pairs of columns in one batch each, rather than calling
+    # bql_column_dependence_probability or bql_column_mutual_information
+    # once per pair -- but only for the pairs that the query would
+    # compute them for anyway.
+    if len(estpaircols.columns) == 1 and estpaircols.columns[0][1] is None:
+        aliases = {'value': estpaircols.columns[0][0]}
+    else:
+        aliases = column_aliases(estpaircols.columns)
+    evaluable = estpaircols.condition is None or \
+        nobql_condition(estpaircols.condition, aliases)
+    batch = []
+    for exp in batch_candidates(estpaircols.columns, estpaircols.condition,
+            estpaircols.order, estpaircols.limit, aliases, evaluable):
+        if isinstance(exp, (ast.ExpBQLDepProb, ast.ExpBQLMutInf)) and \
+           exp.column0 is None and exp.column1 is None and \
+           exp not in batch:
+            batch.append(exp)
+    batch_table = None
+    precomputed = []
+    if 0 < len(batch):
+        if estpaircols.subcolumns is None:
+            colnos = core.bayesdb_generator_column_numbers(bdb, generator_id)
+        else:
+            colnos = evaluate_column_lists(bdb, generator_id,
+                estpaircols.subcolumns, out)
+        if evaluable and estpaircols.condition is not None:
+            rows = evaluate_nobql_condition(bdb,
+                'SELECT %(generator_id)d AS generator_id,'
+                ' c0.colno AS colno0, c1.colno AS colno1,'
+                ' c0.name AS name0, c1.name AS name1'
+                ' FROM bayesdb_generator AS g,'
+                ' bayesdb_generator_column AS gc0, bayesdb_column AS c0,'
+                ' bayesdb_generator_column AS gc1, bayesdb_column AS c1'
+                ' WHERE g.id = %(generator_id)d'
+                ' AND gc0.generator_id = g.id AND gc1.generator_id = g.id'
+                ' AND c0.tabname = g.tabname AND c0.colno = gc0.colno'
+                ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno'
+                ' AND ' % {'generator_id': generator_id},
+                estpaircols.condition, ' ORDER BY colno0 ASC, colno1 ASC',
+                out)
+            colno_set = set(colnos)
+            pairs = [(colno0, colno1)
+                for _generator_id, colno0, colno1, _name0, _name1 in rows
+                if colno0 in colno_set and colno1 in colno_set]
+        else:
+            pairs = [(colno0, colno1)
+                for colno0 in colnos for colno1 in colnos]
+        batch_table = compile_batch_2col(bdb, generator_id,
+            estpaircols.modelno, ['colno0', 'colno1'], pairs,
+            [(bql, pairs) for bql in batch], out)
+        precomputed = [(bql, 'pv.value%d' % (i,))
+            for i, bql in enumerate(batch)]
     bql_compiler = BQLCompiler_2Col(generator_id, estpaircols.modelno,
-        colno0_exp, colno1_exp)
+        colno0_exp, colno1_exp, precomputed=precomputed)
     out.write('SELECT'
         ' %d AS generator_id, c0.name AS name0, c1.name AS name1' %
         (generator_id,))
@@ -734,12 +1235,17 @@ def compile_estpaircols(bdb, estpaircols, out):
     out.write(' FROM'
         ' bayesdb_generator AS g,'
         ' bayesdb_generator_column AS gc0, bayesdb_column AS c0,'
-        ' bayesdb_generator_column AS gc1, bayesdb_column AS c1'
+        ' bayesdb_generator_column AS gc1, bayesdb_column AS c1')
+    if batch_table is not None:
+        out.write(', %s AS pv' % (sqlite3_quote_name(batch_table),))
+    out.write(
         ' WHERE g.id = %(generator_id)d'
         ' AND gc0.generator_id = g.id AND gc1.generator_id = g.id'
         ' AND c0.tabname = g.tabname AND c0.colno = gc0.colno'
         ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno' %
               {'generator_id': generator_id})
+    if batch_table is not None:
+        out.write(' AND pv.colno0 = c0.colno AND pv.colno1 = c1.colno')
     if estpaircols.subcolumns is not None:
         # XXX Would be nice not to duplicate these column lists.
         out.write(' AND c0.colno IN ')
@@ -777,6 +1283,97 @@ def compile_estpaircols(bdb, estpaircols, out):
             compile_expression(bdb, estpaircols.limit.offset, bql_compiler,
                 out)
 
+def evaluate_column_lists(bdb, generator_id, column_lists, out):
+    """Return the sorted column numbers named by `column_lists`."""
+    subout = out.subquery()
+    subout.write('SELECT DISTINCT colno FROM bayesdb_generator_column'
+        ' WHERE generator_id = %d AND colno IN ' % (generator_id,))
+    with compiling_paren(bdb, subout, '(', ')'):
+        compile_column_lists(bdb, generator_id, column_lists, None, subout)
+    subout.write(' ORDER BY colno ASC')
+    winders, unwinders = subout.getwindings()
+    with bayesdb_wind(bdb, winders, unwinders):
+        cursor = bdb.sql_execute(subout.getvalue(), subout.getbindings())
+        return [colno for (colno,) in cursor]
+
+def compile_batch_2col(bdb, generator_id, modelno, key_names, keys, batches,
+        out):
+    """Compute two-column BQL functions in batches for a query.
+
+    Each of `batches` is a pair ``(bql, pairs)`` of a two-column BQL
+    function and a list of ``(colno0, colno1)`` pairs to compute it
+    for, one for each of `keys`.  Arrange for `out` to store the
+    results in a temporary table while the query runs, with columns
+    `key_names` holding `keys` and columns ``value0``, ``value1``,
+    ..., holding the results of each batch, and return the name of
+    the table.
+    """
+    with bdb.savepoint():
+        modelno = evaluate_nobql_expression(bdb, modelno, out, 'INTEGER')
+        assert modelno is None or isinstance(modelno, int)
+        results = [compute_batch_2col(bdb, generator_id, modelno, bql, pairs,
+                out)
+            for bql, pairs in batches]
+        return compile_batch_table(bdb, key_names, keys, results, out)
+
+def compile_batch_table(bdb, key_names, keys, results, out,
+        value_type='REAL'):
+    """Arrange for `out` to store batch results while the query runs.
+
+    The temporary table has columns `key_names` holding `keys`, and
+    columns ``value0``, ``value1``, ..., holding each list of values
+    in `results`, one value for each key.  The value columns have
+    type `value_type`, or no type if it is `None`.  Returns the name
+    of the table.
+    """
+    # XXX Reduce copypasta with compile_simulate.
+    with bdb.savepoint():
+        temptable = bdb.temp_table_name()
+        assert not core.bayesdb_has_table(bdb, temptable)
+        qtt = sqlite3_quote_name(temptable)
+        value_names = ['value%d' % (i,) for i in range(len(results))]
+        names = key_names + value_names
+        out.winder('CREATE TEMP TABLE %s (%s, PRIMARY KEY(%s))' %
+            (qtt,
+             ', '.join(['%s INTEGER' % (name,) for name in key_names] +
+                [name if value_type is None else
+                    '%s %s' % (name, value_type)
+                    for name in value_names]),
+             ', '.join(key_names)),
+            ())
+        rows = [tuple(key) + tuple(values)
+            for key, values in zip(keys, zip(*results))]
+        # Insert several rows per statement, with a bounded number of
+        # parameters each.
+        nrows = max(1, 300 // len(names))
+        qrow = '(%s)' % (','.join('?' for _ in names),)
+        for i in xrange(0, len(rows), nrows):
+            chunk = rows[i:i + nrows]
+            out.winder('INSERT INTO %s (%s) VALUES %s' %
+                    (qtt, ','.join(names), ','.join(qrow for _ in chunk)),
+                [value for row in chunk for value in row])
+        out.unwinder('DROP TABLE %s' % (qtt,), ())
+    return temptable
+
+def compute_batch_2col(bdb, generator_id, modelno, bql, pairs, out):
+    if len(pairs) == 0:
+        return []
+    if isinstance(bql, ast.ExpBQLDepProb):
+        colnos = sorted(set(colno for pair in pairs for colno in pair))
+        index = dict((colno, i) for i, colno in enumerate(colnos))
+        matrix = bqlfn.bayesdb_column_dependence_probability_matrix(bdb,
+            generator_id, modelno, colnos)
+        return [matrix[index[colno0]][index[colno1]]
+            for colno0, colno1 in pairs]
+    elif isinstance(bql, ast.ExpBQLMutInf):
+        numsamples = None
+        if bql.nsamples:
+            numsamples = evaluate_nobql_expression(bdb, bql.nsamples, out)
+        return bqlfn.bayesdb_column_mutual_information_batch(bdb,
+            generator_id, modelno, pairs, numsamples=numsamples)
+    else:
+        assert False, 'Invalid batch BQL function: %s' % (repr(bql),)
+
 def compile_estpairrow(bdb, estpairrow, out):
     assert isinstance(estpairrow, ast.EstPairRow)
     if not core.bayesdb_has_generator_default(bdb, estpairrow.generator):
@@ -785,8 +1382,29 @@ def compile_estpairrow(bdb, estpairrow, out):
         estpairrow.generator)
     rowid0_exp = 'r0._rowid_'
     rowid1_exp = 'r1._rowid_'
+    # Compute similarity for all pairs of rows in one batch, rather
+    # than calling bql_row_similarity once per pair -- unless the
+    # condition itself needs BQL to pick out the pairs, in which case
+    # computing every pair up front may be far more than the query
+    # would otherwise compute.
+    batch = []
+    if estpairrow.condition is None or \
+       not any(bql_expressions(estpairrow.condition)):
+        for col in estpairrow.columns:
+            if isinstance(col, ast.SelColExp) and \
+               isinstance(col.expression, ast.ExpBQLSim) and \
+               col.expression.condition is None and \
+               col.expression not in batch:
+                batch.append(col.expression)
+    batch_table = None
+    precomputed = []
+    if 0 < len(batch):
+        batch_table = compile_batch_similarity(bdb, generator_id, estpairrow,
+            batch, out)
+        precomputed = [(bql, 'pv.value%d' % (i,))
+            for i, bql in enumerate(batch)]
     bql_compiler = BQLCompiler_2Row(generator_id, estpairrow.modelno,
-        rowid0_exp, rowid1_exp)
+        rowid0_exp, rowid1_exp, precomputed=precomputed)
     out.write('SELECT %s AS rowid0, %s AS rowid1,' % (rowid0_exp, rowid1_exp))
     named = True
     compile_select_columns(bdb, estpairrow.columns, named, bql_compiler, out)
@@ -794,7 +1412,14 @@ def compile_estpairrow(bdb, estpairrow, out):
     table_name = core.bayesdb_generator_table(bdb, generator_id)
     qt = sqlite3_quote_name(table_name)
     out.write(' FROM %s AS r0, %s AS r1' % (qt, qt))
-    if estpairrow.condition is not None:
+    if batch_table is not None:
+        out.write(', %s AS pv' % (sqlite3_quote_name(batch_table),))
+        out.write(' WHERE pv.rowid0 = %s AND pv.rowid1 = %s' %
+            (rowid0_exp, rowid1_exp))
+        if estpairrow.condition is not None:
+            out.write(' AND ')
+            compile_expression(bdb, estpairrow.condition, bql_compiler, out)
+    elif estpairrow.condition is not None:
         out.write(' WHERE ')
         compile_expression(bdb, estpairrow.condition, bql_compiler, out)
     if estpairrow.order is not None:
@@ -820,6 +1445,100 @@ def compile_estpairrow(bdb, estpairrow, out):
             out.write(' OFFSET ')
             compile_expression(bdb, estpairrow.limit.offset, bql_compiler, out)
 
+def compile_batch_similarity(bdb, generator_id, estpairrow, batch, out):
+    """Compute the SIMILARITY expressions in `batch` for pairs of rows.
+
+    Store them in a temporary table as :func:`compile_batch_table`
+    does, keyed by ``rowid0`` and ``rowid1``, and return its name.
+    Only the pairs satisfying the condition of `estpairrow`, which
+    must not need BQL, are computed.  If the query wants only the most
+    similar pairs, store only those.
+    """
+    with bdb.savepoint():
+        modelno = evaluate_nobql_expression(bdb, estpairrow.modelno, out,
+            'INTEGER')
+        assert modelno is None or isinstance(modelno, int)
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        cursor = bdb.sql_execute('SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC'
+            % (qt,))
+        rowids = [rowid for (rowid,) in cursor]
+        pairs = None
+        if estpairrow.condition is not None:
+            pairs = evaluate_nobql_condition(bdb,
+                'SELECT r0._rowid_ AS rowid0, r1._rowid_ AS rowid1'
+                ' FROM %s AS r0, %s AS r1 WHERE ' % (qt, qt),
+                estpairrow.condition, ' ORDER BY rowid0 ASC, rowid1 ASC', out)
+        colnos_list = []
+        for bql in batch:
+            if len(bql.column_lists) == 1 and \
+               isinstance(bql.column_lists[0], ast.ColListAll):
+                colnos = core.bayesdb_generator_column_numbers(bdb,
+                    generator_id)
+            else:
+                colnos = evaluate_column_lists(bdb, generator_id,
+                    bql.column_lists, out)
+            colnos_list.append(colnos)
+        # For ORDER BY SIMILARITY DESC LIMIT k with nothing else to
+        # filter or order the pairs, only the top k pairs are needed.
+        k = None
+        if len(batch) == 1 and \
+           estpairrow.condition is None and \
+           estpairrow.order is not None and \
+           len(estpairrow.order) == 1 and \
+           estpairrow.order[0].expression == batch[0] and \
+           estpairrow.order[0].sense == ast.ORD_DESC and \
+           estpairrow.limit is not None:
+            limit = evaluate_nobql_expression(bdb, estpairrow.limit.limit,
+                out, 'INTEGER')
+            offset = 0
+            if estpairrow.limit.offset is not None:
+                offset = evaluate_nobql_expression(bdb,
+                    estpairrow.limit.offset, out, 'INTEGER')
+            if limit is not None and 0 <= limit and \
+               offset is not None and 0 <= offset:
+                k = limit + offset
+        if k is not None:
+            top = bqlfn.bayesdb_row_similarity_topk(bdb, generator_id,
+                modelno, rowids, rowids, colnos_list[0], k)
+            keys = [(rowid0, rowid1) for rowid0, rowid1, _value in top]
+            results = [[value for _rowid0, _rowid1, value in top]]
+        elif pairs is None:
+            keys = [(rowid0, rowid1) for rowid0 in rowids for rowid1 in rowids]
+            results = []
+            for colnos in colnos_list:
+                matrix = bqlfn.bayesdb_row_similarity_batch(bdb, generator_id,
+                    modelno, rowids, rowids, colnos)
+                results.append([value for row in matrix for value in row])
+        else:
+            keys = [tuple(pair) for pair in pairs]
+            results = [compute_similarity_pairs(bdb, generator_id, modelno,
+                    keys, colnos)
+                for colnos in colnos_list]
+        return compile_batch_table(bdb, ['rowid0', 'rowid1'], keys, results,
+            out)
+
+def compute_similarity_pairs(bdb, generator_id, modelno, pairs, colnos):
+    """Return the similarity of each ``(rowid0, rowid1)`` in `pairs`.
+
+    Rows paired with the same set of rows are computed together in one
+    batch, so that, e.g., all pairs with one row take a single batch.
+    """
+    targets = {}
+    for rowid0, rowid1 in pairs:
+        targets.setdefault(rowid0, []).append(rowid1)
+    groups = {}
+    for rowid0, rowid1s in sorted(targets.iteritems()):
+        groups.setdefault(tuple(rowid1s), []).append(rowid0)
+    similarities = {}
+    for rowid1s, rowid0s in sorted(groups.iteritems()):
+        matrix = bqlfn.bayesdb_row_similarity_batch(bdb, generator_id,
+            modelno, rowid0s, list(rowid1s), colnos)
+        for rowid0, row in zip(rowid0s, matrix):
+            for rowid1, value in zip(rowid1s, row):
+                similarities[rowid0, rowid1] = value
+    return [similarities[pair] for pair in pairs]
+
 class BQLCompiler_None(object):
     def compile_bql(self, bdb, bql, out):
         # XXX Report source location.
@@ -868,11 +1587,17 @@ class BQLCompiler_Const(object):
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
 class BQLCompiler_1Row(BQLCompiler_Const):
+    def __init__(self, generator_id, modelno, precomputed=()):
+        super(BQLCompiler_1Row, self).__init__(generator_id, modelno)
+        self.precomputed = precomputed  # list of (bql, sql expression)
+
     def compile_bql(self, bdb, bql, out):
         assert ast.is_bql(bql)
         generator_id = self.generator_id
         rowid_col = '_rowid_'   # XXX Don't hard-code this.
-        if isinstance(bql, ast.ExpBQLPredProb):
+        if compile_precomputed(bql, self.precomputed, out):
+            pass
+        elif isinstance(bql, ast.ExpBQLPredProb):
             if bql.column is None:
                 raise BQLError(bdb, 'Predictive probability at row'
                     ' needs column.')
@@ -912,7 +1637,9 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
         assert ast.is_bql(bql)
         generator_id = self.generator_id
         rowid_col = '_rowid_' # XXX Don't hard-code this.
-        if isinstance(bql, ast.ExpBQLPredict):
+        if compile_precomputed(bql, self.precomputed, out):
+            pass
+        elif isinstance(bql, ast.ExpBQLPredict):
             assert bql.column is not None
             if not core.bayesdb_generator_has_column(bdb, generator_id,
                     bql.column):
@@ -937,7 +1664,8 @@ class BQLCompiler_1Row_Infer(BQLCompiler_1Row):
             super(BQLCompiler_1Row_Infer, self).compile_bql(bdb, bql, out)
 
 class BQLCompiler_2Row(object):
-    def __init__(self, generator_id, modelno, rowid0_exp, rowid1_exp):
+    def __init__(self, generator_id, modelno, rowid0_exp, rowid1_exp,
+            precomputed=()):
         assert isinstance(generator_id, int)
         assert isinstance(rowid0_exp, str)
         assert isinstance(rowid1_exp, str)
@@ -945,11 +1673,14 @@ class BQLCompiler_2Row(object):
         self.modelno = modelno
         self.rowid0_exp = rowid0_exp
         self.rowid1_exp = rowid1_exp
+        self.precomputed = precomputed  # list of (bql, sql expression)
 
     def compile_bql(self, bdb, bql, out):
         assert ast.is_bql(bql)
         generator_id = self.generator_id
-        if isinstance(bql, ast.ExpBQLProb):
+        if compile_precomputed(bql, self.precomputed, out):
+            pass
+        elif isinstance(bql, ast.ExpBQLProb):
             compile_pdf_joint(bdb, generator_id, self.modelno, bql.targets,
                 bql.constraints, self, out)
         elif isinstance(bql, ast.ExpBQLProbFn):
@@ -992,17 +1723,20 @@ class BQLCompiler_2Row(object):
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
 class BQLCompiler_1Col(object):
-    def __init__(self, generator_id, modelno, colno_exp):
+    def __init__(self, generator_id, modelno, colno_exp, precomputed=()):
         assert isinstance(generator_id, int)
         assert isinstance(colno_exp, str)
         self.generator_id = generator_id
         self.modelno = modelno
         self.colno_exp = colno_exp
+        self.precomputed = precomputed  # list of (bql, sql expression)
 
     def compile_bql(self, bdb, bql, out):
         assert ast.is_bql(bql)
         generator_id = self.generator_id
-        if isinstance(bql, ast.ExpBQLProb):
+        if compile_precomputed(bql, self.precomputed, out):
+            pass
+        elif isinstance(bql, ast.ExpBQLProb):
             compile_pdf_joint(bdb, generator_id, self.modelno, bql.targets,
                 bql.constraints, self, out)
         elif isinstance(bql, ast.ExpBQLProbFn):
@@ -1042,7 +1776,8 @@ class BQLCompiler_1Col(object):
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
 class BQLCompiler_2Col(object):
-    def __init__(self, generator_id, modelno, colno0_exp, colno1_exp):
+    def __init__(self, generator_id, modelno, colno0_exp, colno1_exp,
+            precomputed=()):
         assert isinstance(generator_id, int)
         assert isinstance(colno0_exp, str)
         assert isinstance(colno1_exp, str)
@@ -1050,11 +1785,14 @@ class BQLCompiler_2Col(object):
         self.modelno = modelno
         self.colno0_exp = colno0_exp
         self.colno1_exp = colno1_exp
+        self.precomputed = precomputed  # list of (bql, sql expression)
 
     def compile_bql(self, bdb, bql, out):
         assert ast.is_bql(bql)
         generator_id = self.generator_id
-        if isinstance(bql, ast.ExpBQLProb):
+        if compile_precomputed(bql, self.precomputed, out):
+            pass
+        elif isinstance(bql, ast.ExpBQLProb):
             compile_pdf_joint(bdb, generator_id, self.modelno, bql.targets,
                 bql.constraints, self, out)
         elif isinstance(bql, ast.ExpBQLProbFn):
@@ -1095,6 +1833,71 @@ class BQLCompiler_2Col(object):
         else:
             assert False, 'Invalid BQL function: %s' % (repr(bql),)
 
+# Names of the SQL functions computing BQL expressions.
+bql_function_names = {
+    ast.ExpBQLPredProb: 'bql_row_column_predictive_probability',
+    ast.ExpBQLProb: 'bql_pdf_joint',
+    ast.ExpBQLProbFn: 'bql_column_value_probability',
+    ast.ExpBQLSim: 'bql_row_similarity',
+    ast.ExpBQLDepProb: 'bql_column_dependence_probability',
+    ast.ExpBQLMutInf: 'bql_column_mutual_information',
+    ast.ExpBQLCorrel: 'bql_column_correlation',
+    ast.ExpBQLCorrelPval: 'bql_column_correlation_pvalue',
+    ast.ExpBQLPredict: 'bql_predict',
+    ast.ExpBQLPredictConf: 'bql_predict_confidence',
+}
+
+def estimate_bql_calls(bdb, out):
+    """Estimate how many times the query in `out` calls BQL functions.
+
+    Returns a list of ``(name, calls)`` pairs, sorted by the name of
+    the SQL function, with at most the number of calls the query may
+    make: once per row of the generator's table for 1-row functions,
+    once per column for 1-column functions, and so on.  Expressions
+    computed in advance while compiling, and repeated expressions
+    remembered while the query runs, are not counted.
+    """
+    calls = {}
+    counted = []
+    for bql_compiler, bql in out.bql:
+        precomputed = getattr(bql_compiler, 'precomputed', ())
+        if any(bql == p for p, _exp in precomputed):
+            continue
+        if out.memoize:
+            if (bql_compiler, bql) in counted:
+                continue
+            counted.append((bql_compiler, bql))
+        name = bql_function_names[type(bql)]
+        calls[name] = calls.get(name, 0) + \
+            estimate_bql_compiler_calls(bdb, bql_compiler)
+    return sorted(calls.iteritems())
+
+def estimate_bql_compiler_calls(bdb, bql_compiler):
+    generator_id = bql_compiler.generator_id
+    if isinstance(bql_compiler, (BQLCompiler_1Row, BQLCompiler_2Row)):
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        cursor = bdb.sql_execute('SELECT COUNT(*) FROM %s' % (qt,))
+        nrows = cursor_value(cursor)
+        if isinstance(bql_compiler, BQLCompiler_2Row):
+            return nrows*nrows
+        return nrows
+    elif isinstance(bql_compiler, (BQLCompiler_1Col, BQLCompiler_2Col)):
+        ncols = len(core.bayesdb_generator_column_numbers(bdb, generator_id))
+        if isinstance(bql_compiler, BQLCompiler_2Col):
+            return ncols*ncols
+        return ncols
+    else:
+        assert isinstance(bql_compiler, BQLCompiler_Const)
+        return 1
+
+def compile_precomputed(bql, precomputed, out):
+    for precomputed_bql, exp in precomputed:
+        if bql == precomputed_bql:
+            out.write(exp)
+            return True
+    return False
+
 def compile_pdf_joint(bdb, generator_id, modelno, targets, constraints,
         bql_compiler, out):
     out.write('bql_pdf_joint(%d, ' % (generator_id,))
@@ -1234,6 +2037,49 @@ def compile_nobql_expression(bdb, exp, out):
     bql_compiler = BQLCompiler_None()
     compile_expression(bdb, exp, bql_compiler, out)
 
+def evaluate_nobql_expression(bdb, exp, out, sqltype=None):
+    """Evaluate `exp` with the parameters of `out` and return its value.
+
+    If `sqltype` is not `None`, cast the value to it in SQL.
+    """
+    return evaluate_expression(bdb, exp, BQLCompiler_None(), out, sqltype)
+
+def evaluate_nobql_condition(bdb, prefix, condition, suffix, out):
+    """Evaluate a query filtered by `condition` and return its rows.
+
+    The query is the SQL `prefix`, followed by `condition`, which must
+    not need BQL, followed by the SQL `suffix`, with the parameters of
+    `out`.
+    """
+    subout = out.subquery()
+    subout.write(prefix)
+    compile_nobql_expression(bdb, condition, subout)
+    subout.write(suffix)
+    winders, unwinders = subout.getwindings()
+    with bayesdb_wind(bdb, winders, unwinders):
+        return bdb.sql_execute(subout.getvalue(),
+            subout.getbindings()).fetchall()
+
+def evaluate_expression(bdb, exp, bql_compiler, out, sqltype=None):
+    """Evaluate `exp` with the parameters of `out` and return its value.
+
+    BQL functions in `exp` are compiled by `bql_compiler`.  If
+    `sqltype` is not `None`, cast the value to it in SQL.
+    """
+    subout = out.subquery()
+    subout.write('SELECT ')
+    if sqltype is None:
+        compile_expression(bdb, exp, bql_compiler, subout)
+    else:
+        with compiling_paren(bdb, subout, 'CAST(', ' AS %s)' % (sqltype,)):
+            compile_expression(bdb, exp, bql_compiler, subout)
+    winders, unwinders = subout.getwindings()
+    with bayesdb_wind(bdb, winders, unwinders):
+        cursor = bdb.sql_execute(subout.getvalue(),
+            subout.getbindings()).fetchall()
+    assert len(cursor) == 1
+    return cursor[0][0]
+
 def compile_expression(bdb, exp, bql_compiler, out):
     if isinstance(exp, ast.ExpLit):
         compile_literal(bdb, exp.value, out)
@@ -1300,7 +2146,13 @@ def compile_expression(bdb, exp, bql_compiler, out):
             out.write(' ')
     else:
         assert ast.is_bql(exp)
+        # If the same BQL expression is computed more than once in a
+        # query, e.g. in the WHERE clause and in the result columns,
+        # have the BQL functions remember their results for the query.
+        if any(exp == bql for _bql_compiler, bql in out.bql):
+            out.memoize = True
         bql_compiler.compile_bql(bdb, exp, out)
+        out.bql.append((bql_compiler, exp))
 
 def compile_op(bdb, op, bql_compiler, out):
     fmt = operator_fmts[op.operator]
@@ -52,6 +52,106 @@ from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
+def bayesdb_catalog_version(bdb):
+    """Return a value that changes whenever the catalog may have changed.
+
+    It covers BQL commands that change tables, generators, or models,
+    rollbacks, changes by other connections, and, through sqlite3's
+    schema version, SQL that creates, alters, or drops tables.
+    """
+    # Query sqlite3 directly so this does not show up in SQL traces.
+    cursor = bdb._sqlite3.cursor().execute('PRAGMA schema_version')
+    return (bdb.catalog_version, cursor_value(cursor))
+
+class _Catalog(object):
+    """In-memory mirror of the bayeslite catalog tables.
+
+    Mirrors ``bayesdb_generator``, ``bayesdb_generator_column``, and
+    the column names in ``bayesdb_column``, as of the catalog version
+    `version`.  Names are keyed case-folded, as sqlite3 compares them
+    with ``COLLATE NOCASE``.
+    """
+
+    def __init__(self, bdb, version):
+        self.version = version
+        self.generators = {}
+        self.generator_ids = {}
+        self.default_ids = {}
+        self.generator_columns = {}
+        self.table_columns = {}
+        self.table_colnos = {}
+        # Tables whose columns bayesdb_table_guarantee_columns has
+        # checked against sqlite3 since the catalog last changed.
+        self.guaranteed = set()
+        # Query sqlite3 directly so this does not show up in SQL
+        # traces, which then do not depend on when we last loaded it.
+        cursor = bdb._sqlite3.cursor()
+        # Generator defaults came with schema version 6.
+        user_version = cursor_value(cursor.execute('PRAGMA user_version'))
+        generator_sql = '''
+            SELECT id, name, tabname, metamodel, %s
+                FROM bayesdb_generator
+        ''' % ('defaultp' if 6 <= user_version else '0',)
+        for generator_id, name, table, metamodel, defaultp in \
+                cursor.execute(generator_sql).fetchall():
+            self.generators[generator_id] = (name, table, metamodel)
+            self.generator_ids[casefold(name)] = generator_id
+            if defaultp:
+                self.default_ids[casefold(table)] = generator_id
+            self.generator_columns[generator_id] = {}
+        generator_column_sql = '''
+            SELECT generator_id, colno, stattype FROM bayesdb_generator_column
+        '''
+        for generator_id, colno, stattype in \
+                cursor.execute(generator_column_sql).fetchall():
+            self.generator_columns[generator_id][colno] = stattype
+        column_sql = 'SELECT tabname, colno, name FROM bayesdb_column'
+        for table, colno, name in cursor.execute(column_sql).fetchall():
+            table_folded = casefold(table)
+            if table_folded not in self.table_columns:
+                self.table_columns[table_folded] = {}
+                self.table_colnos[table_folded] = {}
+            self.table_columns[table_folded][colno] = name
+            self.table_colnos[table_folded][casefold(name)] = colno
+
+    def generator(self, generator_id):
+        """Return the (name, table, metamodel) of `generator_id`."""
+        if generator_id not in self.generators:
+            raise ValueError('No such generator: %s' % (repr(generator_id),))
+        return self.generators[generator_id]
+
+    def columns(self, generator_id):
+        """Return maps from `generator_id`'s column numbers to names
+        and to statistical types.
+        """
+        _name, table, _metamodel = self.generator(generator_id)
+        names = self.table_columns.get(casefold(table), {})
+        return names, self.generator_columns[generator_id]
+
+    def colno(self, generator_id, column_name):
+        """Return the number of `column_name` in the table of
+        `generator_id`, or None if there is no such column.
+        """
+        _name, table, _metamodel = self.generator(generator_id)
+        colnos = self.table_colnos.get(casefold(table), {})
+        return colnos.get(casefold(column_name))
+
+def bayesdb_catalog(bdb):
+    """Return the in-memory mirror of the catalog of `bdb`.
+
+    The mirror is reloaded whenever :func:`bayesdb_catalog_version`
+    changes, and forgotten with the rest of ``bdb.persistent_cache``
+    after rollbacks and changes by other connections.  Code that
+    writes the catalog tables must increment ``bdb.catalog_version``
+    before it next looks anything up.
+    """
+    version = bayesdb_catalog_version(bdb)
+    catalog = bdb.persistent_cache.get('catalog')
+    if catalog is None or catalog.version != version:
+        catalog = _Catalog(bdb, version)
+        bdb.persistent_cache['catalog'] = catalog
+    return catalog
+
 def bayesdb_has_table(bdb, name):
     """True if there is a table named `name` in `bdb`.
 
@@ -78,12 +178,9 @@ def bayesdb_table_column_names(bdb, table):
     ``bayesdb_column`` table if it has not yet been populated.
     """
     bayesdb_table_guarantee_columns(bdb, table)
-    sql = '''
-        SELECT name FROM bayesdb_column WHERE tabname = ?
-            ORDER BY colno ASC
-    '''
+    names = bayesdb_catalog(bdb).table_columns[casefold(table)]
     # str because column names can't contain Unicode in sqlite3.
-    return [str(row[0]) for row in bdb.sql_execute(sql, (table,))]
+    return [str(names[colno]) for colno in sorted(names)]
 
 def bayesdb_table_has_column(bdb, table, name):
     """True if the table named `table` has a column named `name`.
@@ -95,8 +192,8 @@ def bayesdb_table_has_column(bdb, table, name):
     ``bayesdb_column`` table if it has not yet been populated.
     """
     bayesdb_table_guarantee_columns(bdb, table)
-    sql = 'SELECT COUNT(*) FROM bayesdb_column WHERE tabname = ? AND name = ?'
-    return cursor_value(bdb.sql_execute(sql, (table, name)))
+    colnos = bayesdb_catalog(bdb).table_colnos[casefold(table)]
+    return casefold(name) in colnos
 
 def bayesdb_table_column_name(bdb, table, colno):
     """Return the name of the column numbered `colno` in `table`.
@@ -108,17 +205,11 @@ def bayesdb_table_column_name(bdb, table, colno):
     ``bayesdb_column`` table if it has not yet been populated.
     """
     bayesdb_table_guarantee_columns(bdb, table)
-    sql = '''
-        SELECT name FROM bayesdb_column WHERE tabname = ? AND colno = ?
-    '''
-    cursor = bdb.sql_execute(sql, (table, colno))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    names = bayesdb_catalog(bdb).table_columns[casefold(table)]
+    if colno not in names:
         raise ValueError('No such column number in table %s: %d' %
             (repr(table), colno))
-    else:
-        return row[0]
+    return names[colno]
 
 def bayesdb_table_column_number(bdb, table, name):
     """Return the number of column named `name` in `table`.
@@ -130,17 +221,11 @@ def bayesdb_table_column_number(bdb, table, name):
     ``bayesdb_column`` table if it has not yet been populated.
     """
     bayesdb_table_guarantee_columns(bdb, table)
-    sql = '''
-        SELECT colno FROM bayesdb_column WHERE tabname = ? AND name = ?
-    '''
-    cursor = bdb.sql_execute(sql, (table, name))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    colnos = bayesdb_catalog(bdb).table_colnos[casefold(table)]
+    if casefold(name) not in colnos:
         raise ValueError('No such column in table %s: %s' %
             (repr(table), repr(name)))
-    else:
-        return row[0]
+    return colnos[casefold(name)]
 
 def bayesdb_table_guarantee_columns(bdb, table):
     """Make sure ``bayesdb_column`` is populated with columns of `table`.
@@ -148,6 +233,8 @@ def bayesdb_table_guarantee_columns(bdb, table):
     `bdb` must have a table named `table`.  If you're not sure, call
     :func:`bayesdb_has_table` first.
     """
+    if casefold(table) in bayesdb_catalog(bdb).guaranteed:
+        return
     with bdb.savepoint():
         qt = sqlite3_quote_name(table)
         insert_column_sql = '''
@@ -155,28 +242,29 @@ def bayesdb_table_guarantee_columns(bdb, table):
                 VALUES (?, ?, ?)
         '''
         nrows = 0
+        total_changes = bdb._sqlite3.totalchanges()
         for row in bdb.sql_execute('PRAGMA table_info(%s)' % (qt,)):
             nrows += 1
             colno, name, _sqltype, _notnull, _default, _primary_key = row
             bdb.sql_execute(insert_column_sql, (table, colno, name))
         if nrows == 0:
             raise ValueError('No such table: %s' % (repr(table),))
+        if bdb._sqlite3.totalchanges() != total_changes:
+            bdb.catalog_version += 1
+        bayesdb_catalog(bdb).guaranteed.add(casefold(table))
 
 def bayesdb_has_generator(bdb, name):
     """True if there is a generator named `name` in `bdb`.
 
     Only actual generator names are considered.
     """
-    sql = 'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?'
-    return 0 != cursor_value(bdb.sql_execute(sql, (name,)))
+    return casefold(name) in bayesdb_catalog(bdb).generator_ids
 
 def bayesdb_has_generator_default(bdb, name):
     """True if there is a generator or default-modelled table named `name`."""
-    sql = '''
-        SELECT COUNT(*) FROM bayesdb_generator
-            WHERE name = :name OR (defaultp AND tabname = :name)
-    '''
-    return 0 != cursor_value(bdb.sql_execute(sql, {'name': name}))
+    catalog = bayesdb_catalog(bdb)
+    return casefold(name) in catalog.generator_ids or \
+        casefold(name) in catalog.default_ids
 
 def bayesdb_get_generator(bdb, name):
     """Return the id of the generator named `name` in `bdb`.
@@ -187,15 +275,12 @@ def bayesdb_get_generator(bdb, name):
     `bdb` must have a generator named `name`.  If you're not sure,
     call :func:`bayesdb_has_generator` first.
     """
-    sql = 'SELECT id FROM bayesdb_generator WHERE name = ?'
-    cursor = bdb.sql_execute(sql, (name,))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    generator_ids = bayesdb_catalog(bdb).generator_ids
+    if casefold(name) not in generator_ids:
         raise ValueError('No such generator: %s' % (repr(name),))
-    else:
-        assert isinstance(row[0], int)
-        return row[0]
+    generator_id = generator_ids[casefold(name)]
+    assert isinstance(generator_id, int)
+    return generator_id
 
 def bayesdb_get_generator_default(bdb, name):
     """Return the id of the (default) generator named `name` in `bdb`.
@@ -207,185 +292,90 @@ def bayesdb_get_generator_default(bdb, name):
     named `name` with a default generator.  If you're not sure, call
     :func:`bayesdb_has_generator_default` first.
     """
-    sql = '''
-        SELECT id FROM bayesdb_generator
-            WHERE name = :name OR (defaultp AND tabname = :name)
-    '''
-    cursor = bdb.sql_execute(sql, {'name': name})
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator: %s' % (repr(name),))
+    catalog = bayesdb_catalog(bdb)
+    if casefold(name) in catalog.generator_ids:
+        generator_id = catalog.generator_ids[casefold(name)]
+    elif casefold(name) in catalog.default_ids:
+        generator_id = catalog.default_ids[casefold(name)]
     else:
-        assert isinstance(row[0], int)
-        return row[0]
+        raise ValueError('No such generator: %s' % (repr(name),))
+    assert isinstance(generator_id, int)
+    return generator_id
 
 def bayesdb_generator_name(bdb, id):
     """Return the name of the generator with id `id`."""
-    sql = 'SELECT name FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator id: %d' % (repr(id),))
-    else:
-        return row[0]
+    generators = bayesdb_catalog(bdb).generators
+    if id not in generators:
+        raise ValueError('No such generator id: %s' % (repr(id),))
+    name, _table, _metamodel = generators[id]
+    return name
 
 def bayesdb_generator_metamodel(bdb, id):
     """Return the metamodel of the generator with id `id`."""
-    sql = 'SELECT metamodel FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator: %s' % (repr(id),))
-    else:
-        if row[0] not in bdb.metamodels:
-            name = bayesdb_generator_name(bdb, id)
-            raise ValueError('Metamodel of generator %s not registered: %s' %
-                (repr(name), repr(row[0])))
-        return bdb.metamodels[row[0]]
+    name, _table, metamodel = bayesdb_catalog(bdb).generator(id)
+    if metamodel not in bdb.metamodels:
+        raise ValueError('Metamodel of generator %s not registered: %s' %
+            (repr(name), repr(metamodel)))
+    if bdb.query_profile is not None:
+        # Time the calls for EXPLAIN ANALYZE.
+        return bdb.query_profile.timed_metamodel(bdb.metamodels[metamodel])
+    return bdb.metamodels[metamodel]
 
 def bayesdb_generator_table(bdb, id):
     """Return the name of the table of the generator with id `id`."""
-    sql = 'SELECT tabname FROM bayesdb_generator WHERE id = ?'
-    cursor = bdb.sql_execute(sql, (id,))
-    try:
-        row = cursor.next()
-    except StopIteration:
-        raise ValueError('No such generator: %s' % (repr(id),))
-    else:
-        assert len(row) == 1
-        return row[0]
+    _name, table, _metamodel = bayesdb_catalog(bdb).generator(id)
+    return table
 
 def bayesdb_generator_column_names(bdb, generator_id):
     """Return a list of names of columns modelled by `generator_id`."""
-    sql = '''
-        SELECT c.name
-            FROM bayesdb_column AS c,
-                bayesdb_generator AS g,
-                bayesdb_generator_column AS gc
-            WHERE g.id = ?
-                AND gc.generator_id = g.id
-                AND c.tabname = g.tabname
-                AND c.colno = gc.colno
-            ORDER BY c.colno ASC
-    '''
+    names, stattypes = bayesdb_catalog(bdb).columns(generator_id)
     # str because column names can't contain Unicode in sqlite3.
-    return [str(row[0]) for row in bdb.sql_execute(sql, (generator_id,))]
+    return [str(names[colno]) for colno in sorted(stattypes)
+        if colno in names]
 
 def bayesdb_generator_column_stattype(bdb, generator_id, colno):
     """Return the statistical type of the column `colno` in `generator_id`."""
-    sql = '''
-        SELECT stattype FROM bayesdb_generator_column
-            WHERE generator_id = ? AND colno = ?
-    '''
-    cursor = bdb.sql_execute(sql, (generator_id, colno))
-    try:
-        row = cursor.next()
-    except StopIteration:
+    names, stattypes = bayesdb_catalog(bdb).columns(generator_id)
+    if colno not in stattypes:
         generator = bayesdb_generator_name(bdb, generator_id)
-        sql = '''
-            SELECT COUNT(*)
-                FROM bayesdb_generator AS g, bayesdb_column AS c
-                WHERE g.id = :generator_id
-                    AND g.tabname = c.tabname
-                    AND c.colno = :colno
-        '''
-        cursor = bdb.sql_execute(sql, {
-            'generator_id': generator_id,
-            'colno': colno,
-        })
-        if cursor_value(cursor) == 0:
+        if colno not in names:
             raise ValueError('No such column in generator %s: %d' %
                 (generator, colno))
         else:
             raise ValueError('Column not modelled in generator %s: %d' %
                 (generator, colno))
-    else:
-        assert len(row) == 1
-        return row[0]
+    return stattypes[colno]
 
 def bayesdb_generator_has_column(bdb, generator_id, column_name):
     """True if `generator_id` models a column named `name`."""
-    sql = '''
-        SELECT COUNT(*)
-            FROM bayesdb_generator AS g,
-                bayesdb_generator_column as gc,
-                bayesdb_column AS c
-            WHERE g.id = :generator_id AND c.name = :column_name
-                AND g.id = gc.generator_id
-                AND g.tabname = c.tabname
-                AND gc.colno = c.colno
-    '''
-    cursor = bdb.sql_execute(sql, {
-        'generator_id': generator_id,
-        'column_name': column_name,
-    })
-    return cursor_value(cursor)
+    catalog = bayesdb_catalog(bdb)
+    colno = catalog.colno(generator_id, column_name)
+    return colno in catalog.generator_columns[generator_id]
 
 def bayesdb_generator_column_name(bdb, generator_id, colno):
     """Return the name of the column numbered `colno` in `generator_id`."""
-    sql = '''
-        SELECT c.name
-            FROM bayesdb_generator AS g,
-                bayesdb_generator_column AS gc,
-                bayesdb_column AS c
-            WHERE g.id = :generator_id
-                AND gc.colno = :colno
-                AND g.id = gc.generator_id
-                AND g.tabname = c.tabname
-                AND gc.colno = c.colno
-    '''
-    cursor = bdb.sql_execute(sql, {
-        'generator_id': generator_id,
-        'colno': colno,
-    })
-    try:
-        row = cursor.next()
-    except StopIteration:
+    names, stattypes = bayesdb_catalog(bdb).columns(generator_id)
+    if colno not in stattypes or colno not in names:
         generator = bayesdb_generator_name(bdb, generator_id)
         raise ValueError('No such column number in generator %s: %d' %
             (repr(generator), colno))
-    else:
-        assert len(row) == 1
-        return row[0]
+    return names[colno]
 
 def bayesdb_generator_column_number(bdb, generator_id, column_name):
     """Return the number of the column `column_name` in `generator_id`."""
-    sql = '''
-        SELECT c.colno
-            FROM bayesdb_generator AS g,
-                bayesdb_generator_column AS gc,
-                bayesdb_column AS c
-            WHERE g.id = :generator_id AND c.name = :column_name
-                AND g.id = gc.generator_id
-                AND g.tabname = c.tabname
-                AND gc.colno = c.colno
-    '''
-    cursor = bdb.sql_execute(sql, {
-        'generator_id': generator_id,
-        'column_name': column_name,
-    })
-    try:
-        row = cursor.next()
-    except StopIteration:
+    catalog = bayesdb_catalog(bdb)
+    colno = catalog.colno(generator_id, column_name)
+    if colno not in catalog.generator_columns[generator_id]:
         generator = bayesdb_generator_name(bdb, generator_id)
         raise ValueError('No such column in generator %s: %s' %
             (repr(generator), repr(column_name)))
-    else:
-        assert len(row) == 1
-        assert isinstance(row[0], int)
-        return row[0]
+    assert isinstance(colno, int)
+    return colno
 
 def bayesdb_generator_column_numbers(bdb, generator_id):
     """Return a list of the numbers of columns modelled in `generator_id`."""
-    sql = '''
-        SELECT colno FROM bayesdb_generator_column
-            WHERE generator_id = ?
-            ORDER BY colno ASC
-    '''
-    return [row[0] for row in bdb.sql_execute(sql, (generator_id,))]
+    _names, stattypes = bayesdb_catalog(bdb).columns(generator_id)
+    return sorted(stattypes)
 
 def bayesdb_generator_has_model(bdb, generator_id, modelno):
     """True if `generator_id` has a model numbered `modelno`."""
@@ -449,13 +439,31 @@ def bayesdb_generator_row_values(bdb, generator_id, rowid):
     return row
 
 def bayesdb_generator_fresh_row_id(bdb, generator_id):
+    """Return a row id not in the generator's table, for hypothetical rows.
+
+    While a query runs, the same row id is returned until something is
+    written through `bdb`, so that the BQL functions of the query all
+    share one hypothetical row rather than finding it for each call.
+    """
+    # Anything written through the connection may have taken the row
+    # id.  Writes by others cannot, while the query runs.
+    changes = bdb._sqlite3.totalchanges()
+    key = ('fresh_row_id', generator_id)
+    rows = bdb.hypothetical_rows
+    if rows is not None and key in rows:
+        fresh_row_id, fresh_changes = rows[key]
+        if fresh_changes == changes:
+            return fresh_row_id
     table_name = bayesdb_generator_table(bdb, generator_id)
     qt = sqlite3_quote_name(table_name)
     cursor = bdb.sql_execute('SELECT MAX(_rowid_) FROM %s' % (qt,))
     max_rowid = cursor_value(cursor)
     if max_rowid is None:
         max_rowid = 0
-    return max_rowid + 1   # Synthesize a non-existent SQLite row id
+    fresh_row_id = max_rowid + 1   # Synthesize a non-existent SQLite row id
+    if rows is not None:
+        rows[key] = (fresh_row_id, changes)
+    return fresh_row_id
 
 # XXX This should be stored in the database by adding a column to the
 # bayesdb_stattype table -- when we are later willing to contemplate
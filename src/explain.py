@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Query plans.
+
+``EXPLAIN <query>`` compiles a BQL query without running it and
+returns rows ``(item, detail, value)`` describing what it compiled to:
+the SQL query, the SQL statements run before and after it to set up
+and tear down temporary tables, and at most how many times it may call
+each BQL function::
+
+    bdb.execute('EXPLAIN ESTIMATE * FROM t_cc'
+        ' ORDER BY PREDICTIVE PROBABILITY OF x LIMIT 10')
+
+``EXPLAIN ANALYZE <query>`` also runs the query, discarding its
+results, and adds rows measuring it: the number of rows, wall-clock
+seconds, SQL statements executed, calls to each metamodel method and
+seconds spent in them, and the seconds spent in metamodels versus
+elsewhere, i.e. in sqlite3 and in bayeslite itself.
+
+Compiling some queries computes parts of them in advance, such as the
+predictions of ``INFER EXPLICIT PREDICT``, so even ``EXPLAIN`` alone
+may take time for those.
+"""
+
+import contextlib
+import time
+
+import bayeslite.compiler as compiler
+import bayeslite.metamodel as metamodel
+
+def bayesdb_explain_rows(bdb, out, profile=None):
+    """Return rows ``(item, detail, value)`` explaining the query in `out`.
+
+    If `profile` is not `None`, it is a :class:`QueryProfile` of
+    running the query, whose measurements are included.
+    """
+    rows = [('sql', out.getvalue(), None)]
+    winders, unwinders = out.getwindings()
+    rows += _explain_statements('winder', winders)
+    rows += _explain_statements('unwinder', unwinders)
+    for name, calls in compiler.estimate_bql_calls(bdb, out):
+        rows.append(('bql calls', name, calls))
+    if profile is not None:
+        rows += profile.explain_rows()
+    return rows
+
+def _explain_statements(item, statements):
+    # Batch results are inserted by many statements of the same text,
+    # so count repeated statements rather than listing each one.
+    # Windings that call functions are listed by the functions' names.
+    rows = []
+    for sql, _bindings in statements:
+        if callable(sql):
+            sql = sql.__name__
+        if 0 < len(rows) and rows[-1][1] == sql:
+            rows[-1] = (item, sql, rows[-1][2] + 1)
+        else:
+            rows.append((item, sql, 1))
+    return rows
+
+class QueryProfile(object):
+    """Measurements of running a query for ``EXPLAIN ANALYZE``.
+
+    Counts SQL statements with a tracer installed by :meth:`measuring`
+    in front of any tracer established with
+    :meth:`~bayeslite.BayesDB.sql_trace`, and times the calls bayeslite
+    makes to metamodels of the generators in the query, through
+    stand-ins returned by
+    :func:`~bayeslite.core.bayesdb_generator_metamodel` for the
+    duration.  The metamodels themselves are not modified, so other
+    BayesDBs and threads sharing them are not measured.  Seconds spent
+    in metamodels count only the outermost metamodel calls.
+    """
+
+    def __init__(self):
+        self.seconds = 0.
+        self.rows = 0
+        self.sql_statements = 0
+        self.metamodel_seconds = 0.
+        self.calls = {}                 # 'metamodel.method' -> calls
+        self.call_seconds = {}          # 'metamodel.method' -> seconds
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def measuring(self, bdb):
+        """Measure everything `bdb` does for the duration."""
+        # bayeslite.bayesdb imports bayeslite.bql, which imports us.
+        from bayeslite.bayesdb import IBayesDBTracer
+        class CountingTracer(IBayesDBTracer):
+            def __init__(self, profile, tracer):
+                self._profile = profile
+                self._tracer = tracer
+                self._articulate = isinstance(tracer, IBayesDBTracer)
+            def start(self, qid, query, bindings):
+                self._profile.sql_statements += 1
+                if self._articulate:
+                    self._tracer.start(qid, query, bindings)
+                elif self._tracer:
+                    self._tracer(query, bindings)
+            def ready(self, qid, cursor):
+                if self._articulate:
+                    self._tracer.ready(qid, cursor)
+            def error(self, qid, e):
+                if self._articulate:
+                    self._tracer.error(qid, e)
+            def finished(self, qid):
+                if self._articulate:
+                    self._tracer.finished(qid)
+            def abandoned(self, qid):
+                if self._articulate:
+                    self._tracer.abandoned(qid)
+        sql_tracer = bdb.sql_tracer
+        query_profile = bdb.query_profile
+        bdb.sql_tracer = CountingTracer(self, sql_tracer)
+        bdb.query_profile = self
+        try:
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.seconds += time.time() - start
+        finally:
+            bdb.query_profile = query_profile
+            bdb.sql_tracer = sql_tracer
+
+    def timed_metamodel(self, metamodel):
+        """Return a stand-in for `metamodel` that times its methods."""
+        return _TimedMetamodel(self, metamodel)
+
+    def _timed(self, key, method):
+        def timed(*args, **kwargs):
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self._depth += 1
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                self._depth -= 1
+                self.call_seconds[key] = \
+                    self.call_seconds.get(key, 0.) + seconds
+                if self._depth == 0:
+                    self.metamodel_seconds += seconds
+        return timed
+
+    def explain_rows(self):
+        """Return rows ``(item, detail, value)`` of the measurements."""
+        rows = [
+            ('rows', None, self.rows),
+            ('seconds', None, self.seconds),
+            ('sql statements', None, self.sql_statements),
+            ('metamodel seconds', None, self.metamodel_seconds),
+            ('other seconds', None, self.seconds - self.metamodel_seconds),
+        ]
+        for key in sorted(self.calls):
+            rows.append(('metamodel calls', key, self.calls[key]))
+            rows.append(('metamodel seconds', key, self.call_seconds[key]))
+        return rows
+
+class _TimedMetamodel(object):
+    # Passes everything through to the metamodel, timing the methods
+    # of the metamodel interface.  Claims the metamodel's class, so
+    # that isinstance and bayesdb_metamodel_overrides see through it.
+    def __init__(self, profile, metamodel):
+        self._profile = profile
+        self._metamodel = metamodel
+    @property
+    def __class__(self):
+        return self._metamodel.__class__
+    def __getattr__(self, name):
+        attr = getattr(self._metamodel, name)
+        if name in _metamodel_methods:
+            key = '%s.%s' % (self._metamodel.name(), name)
+            attr = self._profile._timed(key, attr)
+        return attr
+
+# Methods of the metamodel interface to measure.
+_metamodel_methods = sorted(name
+    for name in dir(metamodel.IBayesDBMetamodel)
+    if not name.startswith('_')
+    if name not in ('name', 'register'))
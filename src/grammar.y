@@ -99,6 +99,11 @@ command(analyze_models)	::= K_ANALYZE generator_name(generator)
 				wait_opt(wait).
 command(drop_models)	::= K_DROP K_MODEL|K_MODELS modelset_opt(models)
 				K_FROM generator_name(generator).
+command(show_analyses)	::= K_SHOW K_ANALYSES
+				anfor_opt(generator).
+command(pause_analysis)	::= K_PAUSE K_ANALYSIS L_INTEGER(job).
+command(resume_analysis)	::= K_RESUME K_ANALYSIS L_INTEGER(job).
+command(cancel_analysis)	::= K_CANCEL K_ANALYSIS L_INTEGER(job).
 
 temp_opt(none)		::= .
 temp_opt(some)		::= K_TEMP|K_TEMPORARY.
@@ -131,6 +136,18 @@ anduration(seconds)	::= L_INTEGER(n) K_SECOND|K_SECONDS.
 wait_opt(none)		::= .
 wait_opt(some)		::= K_WAIT.
 
+anfor_opt(none)		::= .
+anfor_opt(some)		::= K_FOR generator_name(generator).
+
+/*
+ * Query plans
+ */
+command(explain)	::= K_EXPLAIN explain_analyze_opt(analyze)
+				query(query).
+
+explain_analyze_opt(none)	::= .
+explain_analyze_opt(some)	::= K_ANALYZE.
+
 simulate(s)		::= K_SIMULATE simulate_columns(cols)
 				K_FROM generator_name(generator)
 				usingmodel_opt(modelno)
@@ -567,6 +584,8 @@ typearg(negative)	::= T_MINUS L_INTEGER(i).
 %fallback L_NAME
 	K_ALL
 	K_ALTER
+	K_ANALYSES
+	K_ANALYSIS
 	K_ANALYZE
 	K_AND
 	K_AS
@@ -576,6 +595,7 @@ typearg(negative)	::= T_MINUS L_INTEGER(i).
 	K_BTABLE
 	K_BY
 	/* K_CASE */
+	K_CANCEL
 	K_CAST
 	K_CHECKPOINT
 	K_COLLATE
@@ -629,6 +649,7 @@ typearg(negative)	::= T_MINUS L_INTEGER(i).
 	K_OR
 	K_ORDER
 	K_PAIRWISE
+	K_PAUSE
 	K_PREDICT
 	K_PREDICTIVE
 	K_PROBABILITY
@@ -636,6 +657,7 @@ typearg(negative)	::= T_MINUS L_INTEGER(i).
 	K_REGEXP
 	K_RENAME
 	K_RESPECT
+	K_RESUME
 	K_ROLLBACK
 	K_ROW
 	K_SAMPLES
@@ -643,6 +665,7 @@ typearg(negative)	::= T_MINUS L_INTEGER(i).
 	K_SECONDS
 	K_SELECT
 	K_SET
+	K_SHOW
 	K_SIMILARITY
 	K_SIMULATE
 	K_TABLE
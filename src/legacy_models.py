@@ -17,10 +17,10 @@
 """Support for legacy models from the previous incarnation of BayesDB."""
 
 import gzip
-import json
 import pickle
 
 import bayeslite.core as core
+import bayeslite.metamodels.crosscat_theta_codec as crosscat_theta_codec
 
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import casefold
@@ -208,10 +208,10 @@ def bayesdb_load_legacy_models(bdb, generator, table, metamodel, pathname,
                 (generator_id, modelno, iterations)
                 VALUES (:generator_id, :modelno, :iterations)
         '''
-        insert_theta_json_sql = '''
+        insert_theta_sql = '''
             INSERT INTO bayesdb_crosscat_theta
-                (generator_id, modelno, theta_json)
-                VALUES (:generator_id, :modelno, :theta_json)
+                (generator_id, modelno, theta)
+                VALUES (:generator_id, :modelno, :theta)
         '''
         for i, modelno_ext in enumerate(sorted(models.keys())):
             modelno = modelno_start + i
@@ -224,10 +224,10 @@ def bayesdb_load_legacy_models(bdb, generator, table, metamodel, pathname,
                 'modelno': modelno,
                 'iterations': iterations,
             })
-            bdb.sql_execute(insert_theta_json_sql, {
+            bdb.sql_execute(insert_theta_sql, {
                 'generator_id': generator_id,
                 'modelno': modelno,
-                'theta_json': json.dumps(theta),
+                'theta': buffer(crosscat_theta_codec.encode(theta)),
             })
 
 def bayesdb_generator_column_stattypes(bdb, generator_id):
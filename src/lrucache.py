@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Least-recently-used cache with a size budget.
+
+Used for caching state, such as parsed model states, across
+transactions in a :class:`bayeslite.BayesDB` handle.  Unlike the
+per-transaction ``bdb.cache``, entries here may outlive the
+transaction that created them, so callers must arrange to invalidate
+them when the underlying database records change.
+"""
+
+import collections
+
+class LRUCache(object):
+    """Map from keys to values, evicting least recently used entries.
+
+    Each entry has a caller-supplied size, in arbitrary units (usually
+    approximate bytes).  When the total size of all entries exceeds
+    `budget`, the least recently used entries are evicted until it no
+    longer does.  An entry larger than the whole budget is never
+    stored.
+    """
+
+    def __init__(self, budget):
+        assert 0 <= budget
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if there is none.
+
+        Marks the entry for `key`, if any, as most recently used.
+        """
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        """Store `value` for `key`, with the given `size`."""
+        assert 0 <= size
+        self.discard(key)
+        if self.budget < size:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.budget < self.size:
+            _key, (_value, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def discard(self, key):
+        """Remove the entry for `key`, if there is one."""
+        if key in self._entries:
+            _value, size = self._entries.pop(key)
+            self.size -= size
+
+    def discard_if(self, predicate):
+        """Remove every entry whose key satisfies `predicate`."""
+        for key in [key for key in self._entries if predicate(key)]:
+            self.discard(key)
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+        self.size = 0
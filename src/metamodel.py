@@ -40,6 +40,14 @@ implications of the data in the table::
        print x
 """
 
+import copy
+import heapq
+import math
+
+import bayeslite.core as core
+
+from bayeslite.math_util import ieee_exp
+
 builtin_metamodels = []
 builtin_metamodel_names = set()
 
@@ -74,6 +82,69 @@ def bayesdb_deregister_metamodel(bdb, metamodel):
     assert bdb.metamodels[name] == metamodel
     del bdb.metamodels[name]
 
+def bayesdb_metamodel_overrides(metamodel, name):
+    """True if `metamodel` overrides the default method `name`.
+
+    Batch methods of :class:`IBayesDBMetamodel` have defaults that
+    merely loop over the one-at-a-time methods, which is no better
+    than calling them from SQL.
+    """
+    # Not type(metamodel), which would not see through the stand-ins
+    # for metamodels that EXPLAIN ANALYZE uses to time calls.
+    method = getattr(metamodel.__class__, name)
+    default = getattr(IBayesDBMetamodel, name)
+    return method.im_func is not default.im_func
+
+def bayesdb_select_topk(rowids, k, descending, evaluate, bounds=None,
+        blocksize=64):
+    """Find the `k` rows first in SQL order of a value to be computed.
+
+    Returns a list of at most `k` pairs ``(rowid, value)`` for `rowid`
+    in `rowids`, in the order of ``ORDER BY <value> [DESC]``: values
+    that are `None` or NaN, which sqlite3 stores as NULL, come first,
+    or last if `descending`.
+
+    `evaluate(indices)` must return a list of the values for the rows
+    ``rowids[i]`` for `i` in `indices`.  It is called with blocks of
+    at most `blocksize` rows, and only for rows that may make the cut.
+    If `bounds` is not `None`, it is a list with a pair ``(lower,
+    upper)`` of bounds on the value of each row, either of which may
+    be `None` if unknown; rows are then evaluated in order of their
+    most favourable bound, and once `k` rows have values at least as
+    favourable as the next row's bound, the rest are skipped.
+    """
+    def score(value):
+        # Larger scores come first.
+        if value is None or math.isnan(value):
+            return (0, 0) if descending else (2, 0)
+        return (1, value if descending else -value)
+    def optimistic(i):
+        if bounds is None or bounds[i] is None:
+            return (3, 0)
+        lower, upper = bounds[i]
+        bound = upper if descending else lower
+        if bound is None:
+            return (3, 0)
+        return score(bound)
+    if k <= 0 or len(rowids) == 0:
+        return []
+    order = range(len(rowids))
+    if bounds is not None:
+        order.sort(key=optimistic, reverse=True)
+    best = []                   # heap of the (score, -index, value)
+    for start in xrange(0, len(order), blocksize):
+        if len(best) == k and optimistic(order[start]) <= best[0][0]:
+            break
+        block = order[start:start + blocksize]
+        for i, value in zip(block, evaluate(block)):
+            item = (score(value), -i, value)
+            if len(best) < k:
+                heapq.heappush(best, item)
+            elif best[0] < item:
+                heapq.heapreplace(best, item)
+    return [(rowids[-negi], value)
+        for _score, negi, value in sorted(best, reverse=True)]
+
 class IBayesDBMetamodel(object):
     """BayesDB metamodel interface.
 
@@ -98,6 +169,16 @@ class IBayesDBMetamodel(object):
         """
         raise NotImplementedError
 
+    def copy(self):
+        """Return an instance of the metamodel for another thread.
+
+        Background analysis runs in a worker thread with its own
+        instance, so that it shares no engines, pseudorandom number
+        generators, or other mutable state with the thread that
+        started it.  The default is a deep copy.
+        """
+        return copy.deepcopy(self)
+
     def create_generator(self, bdb, table, schema, instantiate):
         """Create a generator for a table with the given schema.
 
@@ -166,21 +247,140 @@ class IBayesDBMetamodel(object):
         """
         raise NotImplementedError
 
+    def analysis_logscore(self, bdb, generator_id, modelnos=None):
+        """Return the mean log score of the models after their last analysis.
+
+        If `modelnos` is `None`, average over all models.  Used to
+        report the progress of background analysis; return `None` if
+        the metamodel does not record a log score.
+        """
+        return None
+
     def column_dependence_probability(self, bdb, generator_id, modelno, colno0,
             colno1):
         """Compute ``DEPENDENCE PROBABILITY OF <col0> WITH <col1>``."""
         raise NotImplementedError
 
+    def column_dependence_probability_matrix(self, bdb, generator_id,
+            modelno, colnos):
+        """Compute ``DEPENDENCE PROBABILITY`` of every pair in `colnos`.
+
+        Returns a list of ``len(colnos)`` lists whose ``[i][j]`` entry
+        is the dependence probability of ``colnos[i]`` with
+        ``colnos[j]``.  Used for ``ESTIMATE DEPENDENCE PROBABILITY FROM
+        PAIRWISE COLUMNS``.  The default computes each entry with
+        :meth:`column_dependence_probability`; metamodels that can do
+        better for the whole matrix should override it.
+        """
+        return [[self.column_dependence_probability(bdb, generator_id,
+                    modelno, colno0, colno1)
+                for colno1 in colnos]
+            for colno0 in colnos]
+
     def column_mutual_information(self, bdb, generator_id, modelno, colno0,
             colno1, numsamples=100):
         """Compute ``MUTUAL INFORMATION OF <col0> WITH <col1>``."""
         raise NotImplementedError
 
+    def column_mutual_information_batch(self, bdb, generator_id, modelno,
+            colno_pairs, numsamples=None):
+        """Compute ``MUTUAL INFORMATION`` of every pair in `colno_pairs`.
+
+        Returns a list with the mutual information of each ``(colno0,
+        colno1)`` pair in `colno_pairs`.  The default computes each
+        with :meth:`column_mutual_information`; metamodels that can
+        share work between pairs should override it.
+        """
+        return [self.column_mutual_information(bdb, generator_id, modelno,
+                colno0, colno1, numsamples=numsamples)
+            for colno0, colno1 in colno_pairs]
+
     def row_similarity(self, bdb, generator_id, modelno, rowid, target_rowid,
             colnos):
         """Compute ``SIMILARITY TO <target_row>`` for given `rowid`."""
         raise NotImplementedError
 
+    def row_similarity_batch(self, bdb, generator_id, modelno, rowids,
+            target_rowids, colnos):
+        """Compute ``SIMILARITY`` of every row in `rowids` to every row
+        in `target_rowids`.
+
+        Returns a list of ``len(rowids)`` lists whose ``[i][j]`` entry
+        is the similarity of ``rowids[i]`` to ``target_rowids[j]``.
+        Used for ``ESTIMATE SIMILARITY FROM PAIRWISE``.  The default
+        computes each entry with :meth:`row_similarity`.
+        """
+        return [[self.row_similarity(bdb, generator_id, modelno, rowid,
+                    target_rowid, colnos)
+                for target_rowid in target_rowids]
+            for rowid in rowids]
+
+    def row_similarity_topk(self, bdb, generator_id, modelno, rowids,
+            target_rowids, colnos, k):
+        """Find the `k` most similar pairs of rows.
+
+        Returns a list of at most `k` triples ``(rowid, target_rowid,
+        similarity)`` in order of decreasing similarity.  Used for
+        ``ESTIMATE SIMILARITY FROM PAIRWISE ... ORDER BY SIMILARITY DESC
+        LIMIT k``.  The default computes :meth:`row_similarity_batch`
+        one row at a time, keeping only the best pairs so far.
+        """
+        def pairs():
+            for rowid in rowids:
+                [similarities] = self.row_similarity_batch(bdb, generator_id,
+                    modelno, [rowid], target_rowids, colnos)
+                for target_rowid, similarity in zip(target_rowids,
+                        similarities):
+                    yield rowid, target_rowid, similarity
+        return heapq.nlargest(k, pairs(), key=lambda pair: pair[2])
+
+    def row_column_predictive_probability_batch(self, bdb, generator_id,
+            modelno, colno, rowids):
+        """Compute ``PREDICTIVE PROBABILITY OF <col>`` in many rows.
+
+        Returns a list with the predictive probability of the value
+        of column `colno` in each row in `rowids`, or `None` where the
+        value is missing.  The default calls :meth:`logpdf_joint_batch`
+        for the rows with values.
+        """
+        probabilities = [None] * len(rowids)
+        indices = []
+        queries = []
+        for i, rowid in enumerate(rowids):
+            value = core.bayesdb_generator_cell_value(bdb, generator_id,
+                rowid, colno)
+            if value is None:
+                continue
+            indices.append(i)
+            queries.append(([(rowid, colno, value)], []))
+        if 0 < len(queries):
+            logps = self.logpdf_joint_batch(bdb, generator_id, queries,
+                modelno)
+            for i, logp in zip(indices, logps):
+                probabilities[i] = ieee_exp(logp)
+        return probabilities
+
+    def row_column_predictive_probability_topk(self, bdb, generator_id,
+            modelno, colno, rowids, k, descending):
+        """Find the `k` rows first in order of predictive probability.
+
+        Returns a list of at most `k` pairs ``(rowid, probability)``
+        for `rowid` in `rowids`, ordered as ``ORDER BY PREDICTIVE
+        PROBABILITY OF <col> [DESC]`` would order them, so that rows
+        with missing values come first, or last if `descending`.  Used
+        for ``ESTIMATE ... ORDER BY PREDICTIVE PROBABILITY OF <col>
+        LIMIT k``.  The default computes
+        :meth:`row_column_predictive_probability_batch` for all rows;
+        metamodels that can bound the probabilities cheaply should
+        override it to skip rows that cannot make the cut, using
+        :func:`bayesdb_select_topk`.
+        """
+        def evaluate(indices):
+            return self.row_column_predictive_probability_batch(bdb,
+                generator_id, modelno, colno,
+                [rowids[i] for i in indices])
+        return bayesdb_select_topk(rowids, k, descending, evaluate)
+
     def predict(self, bdb, generator_id, modelno, colno, rowid, threshold,
             numsamples=None):
         """Predict a value for a column, if confidence is high enough."""
@@ -195,6 +395,18 @@ class IBayesDBMetamodel(object):
         """Predict a value for a column and return confidence."""
         raise NotImplementedError
 
+    def predict_confidence_batch(self, bdb, generator_id, modelno, colno,
+            rowids, numsamples=None):
+        """Predict values for a column in many rows, with confidences.
+
+        Returns a list of ``(value, confidence)`` pairs, one for each
+        row in `rowids`.  Used for ``INFER EXPLICIT PREDICT``.  The
+        default calls :meth:`predict_confidence` for each row.
+        """
+        return [self.predict_confidence(bdb, generator_id, modelno, colno,
+                rowid, numsamples=numsamples)
+            for rowid in rowids]
+
     def simulate_joint(self, bdb, generator_id, targets, constraints, modelno,
             num_predictions=1):
         """Simulate `targets` from a generator, subject to `constraints`.
@@ -215,6 +427,21 @@ class IBayesDBMetamodel(object):
         """
         raise NotImplementedError
 
+    def simulate_joint_batch(self, bdb, generator_id, queries, modelno=None,
+            num_predictions=1):
+        """Simulate for many pairs of `targets` and `constraints`.
+
+        `queries` is a list of ``(targets, constraints)`` pairs as for
+        :meth:`simulate_joint`, and `modelno` is a model number or
+        `None`, meaning all models.  Returns a list with the result of
+        :meth:`simulate_joint` for each.  The default calls
+        :meth:`simulate_joint` for each pair; metamodels that can share
+        the work of loading their latent state should override it.
+        """
+        return [self.simulate_joint(bdb, generator_id, targets, constraints,
+                modelno, num_predictions=num_predictions)
+            for targets, constraints in queries]
+
     def logpdf_joint(self, bdb, generator_id, targets, constraints,
             modelno=None):
         """Evalute the joint probability of `targets` subject to `constraints`.
@@ -229,6 +456,20 @@ class IBayesDBMetamodel(object):
         """
         raise NotImplementedError
 
+    def logpdf_joint_batch(self, bdb, generator_id, queries, modelno=None):
+        """Evaluate the joint probability of many pairs of `targets`
+        and `constraints`.
+
+        `queries` is a list of ``(targets, constraints)`` pairs as for
+        :meth:`logpdf_joint`.  Returns a list with the log density of
+        each.  The default calls :meth:`logpdf_joint` for each pair;
+        metamodels that can share the work of loading their latent
+        state should override it.
+        """
+        return [self.logpdf_joint(bdb, generator_id, targets, constraints,
+                modelno)
+            for targets, constraints in queries]
+
     def insertmany(self, bdb, generator_id, rows):
         """Insert `rows` into a generator, updating analyses accordingly.
 
@@ -23,20 +23,26 @@ interface for Crosscat.
 """
 
 import apsw
+import copy
 import itertools
 import json
 import math
+import numpy
 import struct
 import time
 
 import bayeslite.core as core
 import bayeslite.guess as guess
+import bayeslite.lrucache as lrucache
 import bayeslite.metamodel as metamodel
 import bayeslite.weakprng as weakprng
 import crosscat_generator_schema
+import crosscat_parallel
+import crosscat_theta_codec
 import crosscat_theta_validator
 
 from bayeslite.exception import BQLError
+from bayeslite.math_util import ieee_exp
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.stats import arithmetic_mean
 from bayeslite.util import casefold
@@ -208,26 +214,138 @@ CREATE TABLE bayesdb_crosscat_column_dependency (
 );
 '''
 
+crosscat_schema_6to7 = '''
+UPDATE bayesdb_metamodel SET version = 7 WHERE name = 'crosscat';
+
+-- Store thetas in the binary encoding of crosscat_theta_codec rather
+-- than as JSON.  The data are converted by CrosscatMetamodel.register.
+ALTER TABLE bayesdb_crosscat_theta
+    RENAME TO bayesdb_crosscat_theta_temp;
+CREATE TABLE bayesdb_crosscat_theta (
+    generator_id	INTEGER NOT NULL REFERENCES bayesdb_generator(id),
+    modelno		INTEGER NOT NULL,
+    theta		BLOB NOT NULL,
+    PRIMARY KEY(generator_id, modelno),
+    FOREIGN KEY(generator_id, modelno)
+        REFERENCES bayesdb_generator_model(generator_id, modelno)
+);
+'''
+
+crosscat_schema_7to8 = '''
+UPDATE bayesdb_metamodel SET version = 8 WHERE name = 'crosscat';
+
+-- Number of processes with which to analyze a generator's models, for
+-- generators created with PARALLEL(...).  Zero means PARALLEL(OFF).
+CREATE TABLE bayesdb_crosscat_parallel (
+    generator_id	INTEGER NOT NULL PRIMARY KEY
+				REFERENCES bayesdb_crosscat_metadata,
+    processes		INTEGER NOT NULL CHECK (0 <= processes)
+);
+'''
+
+crosscat_schema_8to9 = '''
+UPDATE bayesdb_metamodel SET version = 9 WHERE name = 'crosscat';
+
+-- Checkpoints stored as changes to a model's theta, in the delta
+-- encoding of crosscat_theta_codec, applied in order of seq.  Deleted
+-- whenever the theta itself is rewritten.
+CREATE TABLE bayesdb_crosscat_theta_delta (
+    generator_id	INTEGER NOT NULL,
+    modelno		INTEGER NOT NULL,
+    seq			INTEGER NOT NULL CHECK (0 <= seq),
+    delta		BLOB NOT NULL,
+    PRIMARY KEY(generator_id, modelno, seq),
+    FOREIGN KEY(generator_id, modelno)
+        REFERENCES bayesdb_crosscat_theta(generator_id, modelno)
+);
+'''
+
+crosscat_schema_9to10 = '''
+UPDATE bayesdb_metamodel SET version = 10 WHERE name = 'crosscat';
+
+-- Number rows of each subsample in the order of their SQL rowids, in
+-- which the coded data were hitherto read, so that rows added to a
+-- subsample may come after it in any order.
+UPDATE bayesdb_crosscat_subsample SET cc_row_id = -1 - cc_row_id;
+UPDATE bayesdb_crosscat_subsample SET cc_row_id =
+    (SELECT COUNT(*) FROM bayesdb_crosscat_subsample AS s
+        WHERE s.generator_id = bayesdb_crosscat_subsample.generator_id
+            AND s.sql_rowid < bayesdb_crosscat_subsample.sql_rowid);
+
+-- Size to which to grow the subsample of a generator created with
+-- SUBSAMPLE(GROW FROM k TO target), as it is analyzed.
+CREATE TABLE bayesdb_crosscat_subsample_growth (
+    generator_id	INTEGER NOT NULL PRIMARY KEY
+				REFERENCES bayesdb_crosscat_metadata,
+    target		INTEGER NOT NULL CHECK (0 < target)
+);
+'''
+
 class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
     """Crosscat metamodel for BayesDB.
 
     :param crosscat: Crosscat engine.
+    :param int cache_budget: approximate number of bytes of serialized
+        model states, metadata, and coded data to keep in memory across
+        transactions, per BayesDB.  Defaults to 256 MB.
+    :param bool verify: if true, check cached coded data against the
+        database whenever it is used, and check the data Crosscat
+        returns after inserting rows.  This costs time linear in the
+        size of the data.  Defaults to false.
+    :param float checkpoint_delta_ratio: if not None, write each
+        checkpoint of analysis as the changes to the model since the
+        last, until they add up to more than this fraction of the size
+        of the whole model, at which point the whole model is written
+        again.  Defaults to None, meaning always write whole models.
 
     The metamodel is named ``crosscat`` in BQL::
 
         CREATE GENERATOR t_cc FOR t USING crosscat(...)
 
+    Models are normally analyzed together by `crosscat`.  With
+    ``PARALLEL(n)`` in the generator schema, or with
+    `analysis_processes` passed to :func:`bayeslite.bayesdb_open`,
+    each model is instead analyzed separately, with its own seed, in
+    a pool of `n` worker processes; the results are the same for any
+    `n`.  ``PARALLEL(OFF)`` overrides `analysis_processes`.
+
+    Models are analyzed on a subsample of the table, chosen uniformly
+    at random, of the size given by ``SUBSAMPLE(k)``, or all of it
+    with ``SUBSAMPLE(OFF)``.  With ``SUBSAMPLE(GROW FROM k TO n)``,
+    the subsample starts with `k` rows and, before each iteration of
+    analysis after the models' first, doubles in size, up to `n` rows,
+    by placing rows chosen from the rest of the table in the models as
+    INSERT does.  Until the subsample reaches `n` rows, each iteration
+    is a checkpoint.
+
     Internally, the Crosscat metamodel adds SQL tables to the database
     with names that begin with ``bayesdb_crosscat_``.
     """
 
-    def __init__(self, crosscat, subsample=None):
+    def __init__(self, crosscat, subsample=None, cache_budget=None,
+            verify=None, checkpoint_delta_ratio=None):
         if subsample is None:
             subsample = False
+        if cache_budget is None:
+            cache_budget = 256*1024*1024
+        if verify is None:
+            verify = False
         self._crosscat = crosscat
         self._subsample = subsample
+        self._cache_budget = cache_budget
+        self._verify = verify
+        self._checkpoint_delta_ratio = checkpoint_delta_ratio
         self._theta_validator = crosscat_theta_validator.Validator()
 
+    def copy(self):
+        # A Crosscat engine draws default seeds from a generator, which
+        # two threads cannot run at once, and may hold worker processes
+        # that cannot be copied, so give the copy a new engine of the
+        # same class.  Everything else here is configuration.
+        other = copy.copy(self)
+        other._crosscat = type(self._crosscat)()
+        return other
+
     def _crosscat_cache_nocreate(self, bdb):
         if bdb.cache is None:
             return None
@@ -245,55 +363,134 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             bdb.cache['crosscat'] = cc_cache
             return cc_cache
 
+    def _crosscat_lru(self, bdb):
+        # Parsed metadata and thetas that survive across transactions.
+        # Metadata is keyed by ('metadata', generator_id), column maps
+        # by ('columns', generator_id), and coded data by ('data',
+        # generator_id); thetas are keyed by
+        # (generator_id, modelno, iterations), where iterations
+        # comes from bayesdb_generator_model, and placements of rows
+        # outside the subsample by (generator_id, modelno, iterations,
+        # 'placement', rowid).  Anything
+        # that changes a theta without changing its iteration count
+        # must call _crosscat_lru_discard.  Rollbacks clear the whole
+        # cache in bayeslite.txn.
+        if 'crosscat' in bdb.persistent_cache:
+            return bdb.persistent_cache['crosscat']
+        else:
+            lru = lrucache.LRUCache(self._cache_budget)
+            bdb.persistent_cache['crosscat'] = lru
+            return lru
+
+    def _crosscat_lru_discard(self, bdb, generator_id, modelnos=None):
+        if 'crosscat' not in bdb.persistent_cache:
+            return
+        lru = bdb.persistent_cache['crosscat']
+        if modelnos is None:
+            lru.discard_if(lambda key: key[0] == generator_id)
+        else:
+            modelnos = set(modelnos)
+            lru.discard_if(lambda key:
+                key[0] == generator_id and key[1] in modelnos)
+
     def _crosscat_metadata(self, bdb, generator_id):
         cc_cache = self._crosscat_cache(bdb)
         if cc_cache is not None and generator_id in cc_cache.metadata:
             return cc_cache.metadata[generator_id]
-        sql = '''
-            SELECT metadata_json FROM bayesdb_crosscat_metadata
-                WHERE generator_id = ?
-        '''
-        cursor = bdb.sql_execute(sql, (generator_id,))
-        try:
-            row = cursor.next()
-        except StopIteration:
-            generator = core.bayesdb_generator_name(bdb, generator_id)
-            raise BQLError(bdb, 'No crosscat metadata for generator: %s' %
-                (generator,))
-        else:
+        lru = self._crosscat_lru(bdb)
+        metadata = lru.get(('metadata', generator_id))
+        if metadata is None:
+            sql = '''
+                SELECT metadata_json FROM bayesdb_crosscat_metadata
+                    WHERE generator_id = ?
+            '''
+            cursor = bdb.sql_execute(sql, (generator_id,))
+            try:
+                row = cursor.next()
+            except StopIteration:
+                generator = core.bayesdb_generator_name(bdb, generator_id)
+                raise BQLError(bdb, 'No crosscat metadata for generator: %s' %
+                    (generator,))
             metadata = json.loads(row[0])
-            if cc_cache is not None:
-                cc_cache.metadata[generator_id] = metadata
-            return metadata
+            lru.put(('metadata', generator_id), metadata, len(row[0]))
+        if cc_cache is not None:
+            cc_cache.metadata[generator_id] = metadata
+        return metadata
+
+    def _crosscat_columns(self, bdb, generator_id):
+        # Column maps are cached alongside the metadata, under
+        # ('columns', generator_id), and must be discarded whenever
+        # the generator's columns or metadata change.
+        lru = self._crosscat_lru(bdb)
+        columns = lru.get(('columns', generator_id))
+        if columns is None:
+            M_c = self._crosscat_metadata(bdb, generator_id)
+            sql = '''
+                SELECT cc.colno, c.name, gc.stattype
+                    FROM bayesdb_crosscat_column AS cc,
+                        bayesdb_generator AS g,
+                        bayesdb_generator_column AS gc,
+                        bayesdb_column AS c
+                    WHERE cc.generator_id = ?
+                        AND g.id = cc.generator_id
+                        AND gc.generator_id = cc.generator_id
+                        AND gc.colno = cc.colno
+                        AND c.tabname = g.tabname
+                        AND c.colno = cc.colno
+                    ORDER BY cc.cc_colno ASC
+            '''
+            rows = bdb.sql_execute(sql, (generator_id,)).fetchall()
+            columns = CrosscatColumns(bdb, generator_id, rows, M_c)
+            # The value/code maps are counted with the metadata.
+            lru.put(('columns', generator_id), columns, 64*len(rows))
+        return columns
+
+    def _crosscat_select_codes(self, bdb, generator_id, sql, bindings=()):
+        # Select the modelled columns of the generator's table, aliased
+        # as t, by `sql` with a %s for the column expressions, and
+        # encode the resulting rows.
+        columns = self._crosscat_columns(bdb, generator_id)
+        qexpressions = ','.join('CAST(t.%s AS %s)' %
+                (sqlite3_quote_name(name), sqlite3_quote_name(affinity))
+            for name, affinity in zip(columns.names, columns.affinities))
+        cursor = bdb.sql_execute(sql % (qexpressions,), bindings)
+        return columns.encode(cursor.fetchall())
 
     def _crosscat_data(self, bdb, generator_id, M_c):
+        # The coded subsample is cached alongside the metadata, under
+        # ('data', generator_id), together with the table's change
+        # count when it was read.  The cached array is shared, so it
+        # is read-only; make a copy to modify it.
         table_name = core.bayesdb_generator_table(bdb, generator_id)
+        changes = crosscat_table_changes(bdb, table_name)
+        lru = self._crosscat_lru(bdb)
+        cached = lru.get(('data', generator_id))
+        if cached is not None and cached[0] == (table_name, changes):
+            T = cached[1]
+            if self._verify:
+                assert crosscat_codes_equal(T,
+                    self._crosscat_data_load(bdb, generator_id, table_name))
+            return T
+        T = self._crosscat_data_load(bdb, generator_id, table_name)
+        self._crosscat_data_update(bdb, generator_id, table_name, T)
+        return T
+
+    def _crosscat_data_load(self, bdb, generator_id, table_name):
         qt = sqlite3_quote_name(table_name)
-        columns_sql = '''
-            SELECT c.name, c.colno, gc.stattype
-                FROM bayesdb_column AS c,
-                    bayesdb_generator AS g,
-                    bayesdb_generator_column AS gc
-                WHERE g.id = ?
-                    AND c.tabname = g.tabname
-                    AND c.colno = gc.colno
-                    AND gc.generator_id = g.id
-                ORDER BY c.colno ASC
-        '''
-        columns = bdb.sql_execute(columns_sql, (generator_id,)).fetchall()
-        qexpressions = ','.join('CAST(t.%s AS %s)' %
-                (sqlite3_quote_name(name),
-                    sqlite3_quote_name(core.bayesdb_stattype_affinity(bdb,
-                            stattype)))
-            for name, _colno, stattype in columns)
-        cursor = bdb.sql_execute('''
-            SELECT %s FROM %s AS t, bayesdb_crosscat_subsample AS s
+        return self._crosscat_select_codes(bdb, generator_id, '''
+            SELECT %%s FROM %s AS t, bayesdb_crosscat_subsample AS s
                 WHERE s.generator_id = ?
                     AND s.sql_rowid = t._rowid_
-        ''' % (qexpressions, qt), (generator_id,))
-        return [[crosscat_value_to_code(bdb, generator_id, M_c, colno, value)
-                for value, (_name, colno, _stattype) in zip(row, columns)]
-            for row in cursor]
+                ORDER BY s.cc_row_id ASC
+        ''' % (qt,), (generator_id,))
+
+    def _crosscat_data_update(self, bdb, generator_id, table_name, T):
+        # Record T as the coded subsample as of the table's current
+        # change count.
+        T.flags.writeable = False
+        changes = crosscat_table_changes(bdb, table_name)
+        self._crosscat_lru(bdb).put(('data', generator_id),
+            ((table_name, changes), T), T.nbytes)
 
     def _crosscat_thetas(self, bdb, generator_id, modelno):
         if modelno is not None:
@@ -312,26 +509,79 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
            generator_id in cc_cache.thetas and \
            modelno in cc_cache.thetas[generator_id]:
             return cc_cache.thetas[generator_id][modelno]
+        theta = self._crosscat_theta_load(bdb, generator_id, modelno)
+        if cc_cache is not None:
+            if generator_id in cc_cache.thetas:
+                assert modelno not in cc_cache.thetas[generator_id]
+                cc_cache.thetas[generator_id][modelno] = theta
+            else:
+                cc_cache.thetas[generator_id] = {modelno: theta}
+        return theta
+
+    def _crosscat_theta_load(self, bdb, generator_id, modelno):
+        def nomodel():
+            generator = core.bayesdb_generator_name(bdb, generator_id)
+            return BQLError(bdb, 'No such crosscat model for generator %s: %d' %
+                (repr(generator), modelno))
         sql = '''
-            SELECT theta_json FROM bayesdb_crosscat_theta
+            SELECT iterations FROM bayesdb_generator_model
                 WHERE generator_id = ? AND modelno = ?
         '''
         cursor = bdb.sql_execute(sql, (generator_id, modelno))
         try:
             row = cursor.next()
         except StopIteration:
-            generator = core.bayesdb_generator_name(bdb, generator_id)
-            raise BQLError(bdb, 'No such crosscat model for generator %s: %d' %
-                (repr(generator), modelno))
-        else:
-            theta = json.loads(row[0])
-            if cc_cache is not None:
-                if generator_id in cc_cache.thetas:
-                    assert modelno not in cc_cache.thetas[generator_id]
-                    cc_cache.thetas[generator_id][modelno] = theta
-                else:
-                    cc_cache.thetas[generator_id] = {modelno: theta}
+            raise nomodel()
+        key = (generator_id, modelno, row[0])
+        lru = self._crosscat_lru(bdb)
+        theta = lru.get(key)
+        if theta is not None:
             return theta
+        sql = '''
+            SELECT theta FROM bayesdb_crosscat_theta
+                WHERE generator_id = ? AND modelno = ?
+        '''
+        cursor = bdb.sql_execute(sql, (generator_id, modelno))
+        try:
+            row = cursor.next()
+        except StopIteration:
+            raise nomodel()
+        theta_blob = self._crosscat_theta_apply_deltas(bdb, generator_id,
+            modelno, row[0])
+        theta = crosscat_theta_codec.decode(theta_blob)
+        self._crosscat_lru_discard(bdb, generator_id, [modelno])
+        lru.put(key, theta, len(theta_blob))
+        return theta
+
+    def _crosscat_theta_apply_deltas(self, bdb, generator_id, modelno,
+            theta_blob):
+        # Bring a model's stored theta up to date with the deltas
+        # written by checkpoints since.
+        sql = '''
+            SELECT delta FROM bayesdb_crosscat_theta_delta
+                WHERE generator_id = ? AND modelno = ?
+                ORDER BY seq ASC
+        '''
+        for (delta,) in bdb.sql_execute(sql, (generator_id, modelno)):
+            theta_blob = crosscat_theta_codec.apply_delta(theta_blob, delta)
+        return theta_blob
+
+    def _crosscat_lru_update(self, bdb, generator_id, modelno, theta,
+            size, iterations=None):
+        # Replace the cached theta, of approximately size bytes
+        # encoded, for a model whose encoded theta we have just
+        # written, under its current iteration count, which the caller
+        # may supply if it knows it.
+        self._crosscat_lru_discard(bdb, generator_id, [modelno])
+        if iterations is None:
+            sql = '''
+                SELECT iterations FROM bayesdb_generator_model
+                    WHERE generator_id = ? AND modelno = ?
+            '''
+            iterations = cursor_value(bdb.sql_execute(sql,
+                (generator_id, modelno)))
+        key = (generator_id, modelno, iterations)
+        self._crosscat_lru(bdb).put(key, theta, size)
 
     def _crosscat_latent_stata(self, bdb, generator_id, modelno):
         thetas = self._crosscat_thetas(bdb, generator_id, modelno)
@@ -346,14 +596,80 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         return [statum[1] for statum
             in self._crosscat_latent_stata(bdb, generator_id, modelno)]
 
-    def _crosscat_get_row(self, bdb, generator_id, rowid, X_L_list, X_D_list):
+    def _crosscat_model_versions(self, bdb, generator_id, modelno):
+        # Return (modelno, iterations) for each model whose latent
+        # state _crosscat_latent_state returns, in the same order.
+        thetas = self._crosscat_thetas(bdb, generator_id, modelno)
+        return [(modelno, thetas[modelno]['iterations'])
+            for modelno in sorted(thetas.iterkeys())]
+
+    def _crosscat_get_row(self, bdb, generator_id, modelno, rowid, X_L_list,
+            X_D_list):
         [row_id], X_L_list, X_D_list = \
-            self._crosscat_get_rows(bdb, generator_id, [rowid], X_L_list,
-                X_D_list)
+            self._crosscat_get_rows(bdb, generator_id, modelno, [rowid],
+                X_L_list, X_D_list)
         return row_id, X_L_list, X_D_list
 
-    def _crosscat_get_rows(self, bdb, generator_id, rowids, X_L_list,
-            X_D_list):
+    def _crosscat_get_rows(self, bdb, generator_id, modelno, rowids,
+            X_L_list, X_D_list):
+        # The BQL functions of a query, such as PROBABILITY OF for
+        # each column, may ask for the same hypothetical row over and
+        # over.  Remember the last rows placed in each generator's
+        # latent states in the query's shared rows, until something
+        # is written through bdb.
+        shared = bdb.hypothetical_rows
+        key = (tuple(sorted(set(rowids))),
+            tuple(self._crosscat_model_versions(bdb, generator_id, modelno)),
+            bdb._sqlite3.totalchanges())
+        if shared is not None and ('crosscat', generator_id) in shared:
+            entry_key, row_id_map, X_L_list_new, X_D_list_new = \
+                shared['crosscat', generator_id]
+            if entry_key == key:
+                return [row_id_map[rowid] for rowid in rowids], \
+                    X_L_list_new, X_D_list_new
+        row_ids, X_L_list_new, X_D_list_new = self._crosscat_place_rows(bdb,
+            generator_id, modelno, rowids, X_L_list, X_D_list)
+        if shared is not None:
+            # Placing the rows may itself have written bookkeeping, as
+            # crosscat_table_changes does the first time.
+            key = key[:-1] + (bdb._sqlite3.totalchanges(),)
+            shared['crosscat', generator_id] = (key,
+                dict(zip(rowids, row_ids)), X_L_list_new, X_D_list_new)
+        return row_ids, X_L_list_new, X_D_list_new
+
+    def _crosscat_place_rows(self, bdb, generator_id, modelno, rowids,
+            X_L_list, X_D_list):
+        # Return the Crosscat row ids of the rows `rowids`, and the
+        # latent states extended with those of them outside the
+        # subsample, each placed as if it were the only one.
+        row_ids, placements, nrows = self._crosscat_row_placements(bdb,
+            generator_id, modelno, rowids, X_L_list, X_D_list)
+        if 0 < len(placements):
+            placed = sorted(placements.itervalues())
+            X_L_list, X_D_list = crosscat_extend_latent_states(X_L_list,
+                X_D_list, [row_placements for _row_id, row_placements
+                    in placed])
+        return row_ids, X_L_list, X_D_list
+
+    def _crosscat_row_placements(self, bdb, generator_id, modelno, rowids,
+            X_L_list, X_D_list):
+        # Return the Crosscat row ids of the rows `rowids`, a dict
+        # mapping each of them that is in the table but outside the
+        # subsample to its row id and its list of CrosscatPlacements,
+        # one for each model, and the number of rows in the subsample.
+        # Rows outside the subsample get row ids past its end, those
+        # in the table first in order of rowid and then any others,
+        # such as fresh row ids for hypothetical rows.
+        #
+        # Each row is placed in each model's latent state by itself,
+        # so that where it lands depends only on the model and the
+        # row, not on what else has been placed before or alongside
+        # it.  That takes no engine calls: crosscat_place_rows places
+        # all the rows a model needs at once, without the subsample's
+        # data.  Placements are cached under (generator_id, modelno,
+        # iterations, 'placement', rowid), together with the table's
+        # change count, so they go when the model or the data change,
+        # and are evicted under the metamodel's cache budget.
         row_ids = [None] * len(rowids)
         index = {}
         for i, rowid in enumerate(rowids):
@@ -371,86 +687,91 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             for i in index[rowid]:
                 row_ids[i] = row_id
             del index[rowid]
-        if 0 < len(index):
-            rowids = sorted(set(index.keys()))
-            table_name = core.bayesdb_generator_table(bdb, generator_id)
-            qt = sqlite3_quote_name(table_name)
-            columns = bdb.sql_execute('''
-                SELECT c.name, c.colno, gc.stattype
-                    FROM bayesdb_column AS c,
-                        bayesdb_generator AS g,
-                        bayesdb_generator_column AS gc
-                    WHERE g.id = ?
-                        AND c.tabname = g.tabname
-                        AND c.colno = gc.colno
-                        AND gc.generator_id = g.id
-                    ORDER BY c.colno ASC
-            ''', (generator_id,)).fetchall()
-            qexpressions = ','.join('CAST(%s AS %s)' %
-                    (sqlite3_quote_name(name),
-                        sqlite3_quote_name(core.bayesdb_stattype_affinity(bdb,
-                                stattype)))
-                for name, _colno, stattype in columns)
-            qrowids = ','.join('%d' % (rowid,) for rowid in rowids)
-            M_c = self._crosscat_metadata(bdb, generator_id)
-            cursor = bdb.sql_execute('''
-                SELECT %s FROM %s WHERE _rowid_ IN (%s) ORDER BY _rowid_ ASC
-            ''' % (qexpressions, qt, qrowids))
-            rows = [[crosscat_value_to_code(bdb, generator_id, M_c, colno, x)
-                     for x, (_name, colno, _stattype) in zip(row, columns)]
-                for row in cursor]
-            if len(rows) > 0:
-                # Need to put more stuff into the subsample temporarily
-                T = self._crosscat_data(bdb, generator_id, M_c)
-                X_L_list, X_D_list, T = self._crosscat.insert(
-                    M_c=M_c,
-                    T=T,
-                    X_L_list=X_L_list,
-                    X_D_list=X_D_list,
-                    new_rows=rows,
-                )
-                for r0, r1 in \
-                    zip(T, self._crosscat_data(bdb, generator_id, M_c) + rows):
-                    assert all(x0 == x1 or (math.isnan(x0) and math.isnan(x1))
-                               for x0, x1 in zip(r0, r1))
-            cursor = bdb.sql_execute('''
-                SELECT MAX(cc_row_id) + 1 FROM bayesdb_crosscat_subsample
-                    WHERE generator_id = ?
-            ''', (generator_id,))
-            next_row_id = cursor_value(cursor)
-            for n, rowid in enumerate(rowids):
-                for i in index[rowid]:
-                    row_ids[i] = next_row_id + n
-        assert all(row_id is not None for row_id in row_ids)
-        return row_ids, X_L_list, X_D_list
-
-    def _crosscat_remap_mixed(self, bdb, generator_id, X_L_list,
+        placements = {}
+        if len(index) == 0:
+            return row_ids, placements, None
+        M_c = self._crosscat_metadata(bdb, generator_id)
+        T = self._crosscat_data(bdb, generator_id, M_c)
+        nrows = len(T)
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        cursor = bdb.sql_execute('''
+            SELECT _rowid_ FROM %s WHERE _rowid_ IN (%s) ORDER BY _rowid_ ASC
+        ''' % (qt, ','.join('%d' % (rowid,) for rowid in sorted(index))))
+        present = [rowid for (rowid,) in cursor]
+        absent = sorted(set(index) - set(present))
+        for n, rowid in enumerate(present + absent):
+            for i in index[rowid]:
+                row_ids[i] = nrows + n
+        if 0 < len(present):
+            changes = crosscat_table_changes(bdb, table_name)
+            versions = self._crosscat_model_versions(bdb, generator_id,
+                modelno)
+            assert len(versions) == len(X_L_list)
+            lru = self._crosscat_lru(bdb)
+            missing = []
+            for n, rowid in enumerate(present):
+                row_placements = []
+                for modelno_, iterations in versions:
+                    entry = lru.get((generator_id, modelno_, iterations,
+                        'placement', rowid))
+                    if entry is not None and entry[0] == changes:
+                        row_placements.append(entry[1])
+                    else:
+                        row_placements.append(None)
+                placements[rowid] = (nrows + n, row_placements)
+                if None in row_placements:
+                    missing.append(rowid)
+            if 0 < len(missing):
+                rows = self._crosscat_select_codes(bdb, generator_id, '''
+                    SELECT %%s FROM %s AS t WHERE _rowid_ IN (%s)
+                        ORDER BY _rowid_ ASC
+                ''' % (qt, ','.join('%d' % (rowid,) for rowid in missing)))
+                for i, (modelno_, iterations) in enumerate(versions):
+                    unplaced = [j for j, rowid in enumerate(missing)
+                        if placements[rowid][1][i] is None]
+                    if len(unplaced) == 0:
+                        continue
+                    nviews = len(X_D_list[i])
+                    uniforms = [crosscat_placement_uniforms(generator_id,
+                            modelno_, iterations, missing[j], nviews)
+                        for j in unplaced]
+                    placed = crosscat_place_rows(M_c, X_L_list[i],
+                        X_D_list[i], rows[unplaced], uniforms)
+                    for j, placement in zip(unplaced, placed):
+                        rowid = missing[j]
+                        placements[rowid][1][i] = placement
+                        lru.put((generator_id, modelno_, iterations,
+                                'placement', rowid),
+                            (changes, placement), placement.size())
+        return row_ids, placements, nrows
+
+    def _crosscat_remap_mixed(self, bdb, generator_id, modelno, X_L_list,
             X_D_list, items):
         # XXX Why special-case empty items?
         if items is None:
             return None, X_L_list, X_D_list
-        M_c = self._crosscat_metadata(bdb, generator_id)
+        columns = self._crosscat_columns(bdb, generator_id)
         rowids = [item[0] for item in items]
         row_ids, X_L_list, X_D_list = self._crosscat_get_rows(
-            bdb, generator_id, rowids, X_L_list, X_D_list)
+            bdb, generator_id, modelno, rowids, X_L_list, X_D_list)
         def remap_tuple(row_id, item):
             # XXX See the comment on _crosscat_remap_two below for an
             # explanation of this horrible type dispatch.
             if len(item) == 2:
                 (_, colno) = item
-                return (row_id, crosscat_cc_colno(bdb, generator_id, colno))
+                return (row_id, columns.cc_colno(bdb, colno))
             if len(item) == 3:
                 (_, colno, value) = item
-                new_colno = crosscat_cc_colno(bdb, generator_id, colno)
-                new_value = crosscat_value_to_code(
-                    bdb, generator_id, M_c, colno, value)
+                new_colno = columns.cc_colno(bdb, colno)
+                new_value = columns.cc_value_to_code(new_colno, value)
                 return (row_id, new_colno, new_value)
         res = [remap_tuple(row_id, item)
                for row_id, item in zip(row_ids, items)]
         return res, X_L_list, X_D_list
 
-    def _crosscat_remap_two(self, bdb, generator_id, X_L_list, X_D_list,
-            first, second):
+    def _crosscat_remap_two(self, bdb, generator_id, modelno, X_L_list,
+            X_D_list, first, second):
         # XXX This kludgerosity (together with the tuple size dispatch
         # in _crosscat_remap_mixed) is trying to apply a consistent
         # row id mapping to both the targets and the constraints.  In
@@ -464,30 +785,50 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         # effective subsample).
         if first is None:
             new_second, X_L_list, X_D_list = self._crosscat_remap_mixed(
-                bdb, generator_id, X_L_list, X_D_list, second)
+                bdb, generator_id, modelno, X_L_list, X_D_list, second)
             return None, new_second, X_L_list, X_D_list
         if second is None:
             new_first, X_L_list, X_D_list = self._crosscat_remap_mixed(
-                bdb, generator_id, X_L_list, X_D_list, first)
+                bdb, generator_id, modelno, X_L_list, X_D_list, first)
             return new_first, None, X_L_list, X_D_list
         new, X_L_list, X_D_list = self._crosscat_remap_mixed(
-            bdb, generator_id, X_L_list, X_D_list, first + second)
+            bdb, generator_id, modelno, X_L_list, X_D_list, first + second)
         return new[:len(first)], new[len(first):], X_L_list, X_D_list
 
+    def _crosscat_remap_batch(self, bdb, generator_id, modelno, X_L_list,
+            X_D_list, queries):
+        # Remap each (first, second) pair in queries as
+        # _crosscat_remap_two does by itself, and return a list of
+        # (first, second, X_L_list, X_D_list) for each.  Pairs about
+        # the same rows are remapped one after another so that they
+        # share the latent states placing those rows.
+        def rowids(query):
+            return sorted(set(item[0]
+                for items in query
+                if items is not None
+                for item in items))
+        remapped = [None] * len(queries)
+        for i in sorted(range(len(queries)),
+                key=lambda i: rowids(queries[i])):
+            first, second = queries[i]
+            remapped[i] = self._crosscat_remap_two(bdb, generator_id, modelno,
+                X_L_list, X_D_list, first, second)
+        return remapped
+
     def name(self):
         return 'crosscat'
 
     def register(self, bdb):
         with bdb.savepoint():
             schema_sql = 'SELECT version FROM bayesdb_metamodel WHERE name = ?'
-            cursor = bdb.sql_execute(schema_sql, (self.name(),))
+            # Fetch everything so that no statement is left pending,
+            # which would make the DROP TABLEs below fail.
+            rows = bdb.sql_execute(schema_sql, (self.name(),)).fetchall()
             version = None
-            try:
-                row = cursor.next()
-            except StopIteration:
+            if len(rows) == 0:
                 version = 0
             else:
-                version = row[0]
+                version = rows[0][0]
             assert version is not None
             if version == 0:
                 # XXX WHATTAKLUDGE!
@@ -563,7 +904,41 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                 for stmt in crosscat_schema_5to6.split(';'):
                     bdb.sql_execute(stmt)
                 version = 6
-            if version != 6:
+            if version == 6:
+                for stmt in crosscat_schema_6to7.split(';'):
+                    bdb.sql_execute(stmt)
+                sql = '''
+                    SELECT generator_id, modelno, theta_json
+                        FROM bayesdb_crosscat_theta_temp
+                '''
+                insert_sql = '''
+                    INSERT INTO bayesdb_crosscat_theta
+                        (generator_id, modelno, theta)
+                        VALUES (:generator_id, :modelno, :theta)
+                '''
+                for generator_id, modelno, theta_json \
+                        in bdb.sql_execute(sql).fetchall():
+                    theta = json.loads(theta_json)
+                    bdb.sql_execute(insert_sql, {
+                        'generator_id': generator_id,
+                        'modelno': modelno,
+                        'theta': buffer(crosscat_theta_codec.encode(theta)),
+                    })
+                bdb.sql_execute('DROP TABLE bayesdb_crosscat_theta_temp')
+                version = 7
+            if version == 7:
+                for stmt in crosscat_schema_7to8.split(';'):
+                    bdb.sql_execute(stmt)
+                version = 8
+            if version == 8:
+                for stmt in crosscat_schema_8to9.split(';'):
+                    bdb.sql_execute(stmt)
+                version = 9
+            if version == 9:
+                for stmt in crosscat_schema_9to10.split(';'):
+                    bdb.sql_execute(stmt)
+                version = 10
+            if version != 10:
                 raise BQLError(bdb, 'Crosscat already installed'
                     ' with unknown schema version: %d' % (version,))
 
@@ -642,28 +1017,19 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             qt = sqlite3_quote_name(table)
             cursor = None
             if parsed_schema.subsample:
-                # Sample k of the n rowids without replacement,
-                # choosing from all the k-of-n combinations uniformly
-                # at random.
-                #
-                # XXX Let the user pass in a seed.
                 k = parsed_schema.subsample
+                if isinstance(k, tuple):
+                    k, target = k
+                    insert_growth_sql = '''
+                        INSERT INTO bayesdb_crosscat_subsample_growth
+                            (generator_id, target)
+                            VALUES (?, ?)
+                    '''
+                    bdb.sql_execute(insert_growth_sql, (generator_id, target))
                 sql = 'SELECT COUNT(*) FROM %s' % (qt,)
                 n = cursor_value(bdb.sql_execute(sql))
                 sql = 'SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC' % (qt,)
-                cursor = bdb.sql_execute(sql)
-                seed = struct.pack('<QQQQ', 0, 0, k, n)
-                uniform = weakprng.weakprng(seed).weakrandom_uniform
-                # https://en.wikipedia.org/wiki/Reservoir_sampling
-                samples = []
-                for i, row in enumerate(cursor):
-                    if i < k:
-                        samples.append(row)
-                    else:
-                        r = uniform(i + 1)
-                        if r < k:
-                            samples[r] = row
-                cursor = samples
+                cursor = crosscat_sample_rows(bdb.sql_execute(sql), k, 0, n)
             else:
                 cursor = bdb.sql_execute('''
                      SELECT _rowid_ FROM %s ORDER BY _rowid_ ASC
@@ -702,6 +1068,16 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                         # helpful error message).
                         raise BQLError(bdb, 'Invalid dependency constraints!')
 
+            # Store the analysis parallelism, if specified.
+            if parsed_schema.parallel is not None:
+                insert_parallel_sql = '''
+                    INSERT INTO bayesdb_crosscat_parallel
+                        (generator_id, processes)
+                        VALUES (?, ?)
+                '''
+                processes = parsed_schema.parallel or 0
+                bdb.sql_execute(insert_parallel_sql, (generator_id, processes))
+
     def drop_generator(self, bdb, generator_id):
         with bdb.savepoint():
             # Remove the metadata from the cache.
@@ -711,10 +1087,15 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                     del cc_cache.metadata[generator_id]
                 if generator_id in cc_cache.thetas:
                     del cc_cache.thetas[generator_id]
+            self._crosscat_lru(bdb).discard(('metadata', generator_id))
+            self._crosscat_lru(bdb).discard(('columns', generator_id))
+            self._crosscat_lru(bdb).discard(('data', generator_id))
+            self._crosscat_lru_discard(bdb, generator_id)
 
             # Delete all the things referring to the generator:
             # - diagnostics
             # - column depedencies
+            # - parallelism
             # - models
             # - subsample
             # - codemap
@@ -730,6 +1111,15 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                     WHERE generator_id = ?
             '''
             bdb.sql_execute(delete_column_dependency_sql, (generator_id,))
+            delete_parallel_sql = '''
+                DELETE FROM bayesdb_crosscat_parallel WHERE generator_id = ?
+            '''
+            bdb.sql_execute(delete_parallel_sql, (generator_id,))
+            delete_deltas_sql = '''
+                DELETE FROM bayesdb_crosscat_theta_delta
+                    WHERE generator_id = ?
+            '''
+            bdb.sql_execute(delete_deltas_sql, (generator_id,))
             delete_models_sql = '''
                 DELETE FROM bayesdb_crosscat_theta
                     WHERE generator_id = ?
@@ -740,6 +1130,11 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                     WHERE generator_id = ?
             '''
             bdb.sql_execute(delete_subsample_sql, (generator_id,))
+            delete_growth_sql = '''
+                DELETE FROM bayesdb_crosscat_subsample_growth
+                    WHERE generator_id = ?
+            '''
+            bdb.sql_execute(delete_growth_sql, (generator_id,))
             delete_codemap_sql = '''
                 DELETE FROM bayesdb_crosscat_column_codemap
                     WHERE generator_id = ?
@@ -780,6 +1175,8 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         cc_cache = self._crosscat_cache_nocreate(bdb)
         if cc_cache is not None:
             cc_cache.metadata[generator_id] = M_c
+        self._crosscat_lru(bdb).discard(('metadata', generator_id))
+        self._crosscat_lru(bdb).discard(('columns', generator_id))
 
     def initialize_models(self, bdb, generator_id, modelnos, model_config):
         cc_cache = self._crosscat_cache(bdb)
@@ -806,8 +1203,9 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             X_L_list = [X_L_list]
             X_D_list = [X_D_list]
         # Ensure dependent columns if necessary.
-        dep_constraints = [(crosscat_cc_colno(bdb, generator_id, colno1),
-                crosscat_cc_colno(bdb, generator_id, colno2), dep)
+        columns = self._crosscat_columns(bdb, generator_id)
+        dep_constraints = [(columns.cc_colno(bdb, colno1),
+                columns.cc_colno(bdb, colno2), dep)
             for colno1, colno2, dep in
                 crosscat_gen_column_dependencies(bdb, generator_id)]
         if 0 < len(dep_constraints):
@@ -822,8 +1220,8 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             )
         insert_theta_sql = '''
             INSERT INTO bayesdb_crosscat_theta
-                (generator_id, modelno, theta_json)
-                VALUES (:generator_id, :modelno, :theta_json)
+                (generator_id, modelno, theta)
+                VALUES (:generator_id, :modelno, :theta)
         '''
         for modelno, (X_L, X_D) in zip(modelnos, zip(X_L_list, X_D_list)):
             theta = {
@@ -833,11 +1231,14 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                 'model_config': model_config,
             }
             self._theta_validator.validate(theta)
+            theta_blob = crosscat_theta_codec.encode(theta)
             bdb.sql_execute(insert_theta_sql, {
                 'generator_id': generator_id,
                 'modelno': modelno,
-                'theta_json': json.dumps(theta),
+                'theta': buffer(theta_blob),
             })
+            self._crosscat_lru_update(bdb, generator_id, modelno, theta,
+                len(theta_blob))
             if cc_cache is not None:
                 if generator_id in cc_cache.thetas:
                     assert modelno not in cc_cache.thetas[generator_id]
@@ -851,15 +1252,25 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             if cc_cache is not None:
                 if generator_id in cc_cache.thetas:
                     del cc_cache.thetas[generator_id]
+            delete_deltas_sql = '''
+                DELETE FROM bayesdb_crosscat_theta_delta
+                    WHERE generator_id = ?
+            '''
             delete_theta_sql = '''
                 DELETE FROM bayesdb_crosscat_theta WHERE generator_id = ?
             '''
             delete_diag_sql = '''
                 DELETE FROM bayesdb_crosscat_diagnostics WHERE generator_id = ?
             '''
+            bdb.sql_execute(delete_deltas_sql, (generator_id,))
             bdb.sql_execute(delete_theta_sql, (generator_id,))
             bdb.sql_execute(delete_diag_sql, (generator_id,))
+            self._crosscat_lru_discard(bdb, generator_id)
         else:
+            delete_deltas_sql = '''
+                DELETE FROM bayesdb_crosscat_theta_delta
+                    WHERE generator_id = ? AND modelno = ?
+            '''
             delete_theta_sql = '''
                 DELETE FROM bayesdb_crosscat_theta
                     WHERE generator_id = ? AND modelno = ?
@@ -869,6 +1280,7 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                     WHERE generator_id = ? AND modelno = ?
             '''
             for modelno in modelnos:
+                bdb.sql_execute(delete_deltas_sql, (generator_id, modelno))
                 bdb.sql_execute(delete_theta_sql, (generator_id, modelno))
                 bdb.sql_execute(delete_diag_sql, (generator_id, modelno))
             if cc_cache is not None and generator_id in cc_cache.thetas:
@@ -877,6 +1289,86 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                         del cc_cache.thetas[generator_id][modelno]
                 if len(cc_cache.thetas[generator_id]) == 0:
                     del cc_cache.thetas[generator_id]
+            self._crosscat_lru_discard(bdb, generator_id, modelnos)
+
+    def _crosscat_analysis_processes(self, bdb, generator_id):
+        # Number of worker processes for analysis, or None to analyze
+        # all models at once with self._crosscat.
+        sql = '''
+            SELECT processes FROM bayesdb_crosscat_parallel
+                WHERE generator_id = ?
+        '''
+        rows = bdb.sql_execute(sql, (generator_id,)).fetchall()
+        if len(rows) == 0:
+            return bdb.analysis_processes
+        processes = rows[0][0]
+        return None if processes == 0 else processes
+
+    def _crosscat_subsample_growth_target(self, bdb, generator_id):
+        # Number of rows to which the subsample is to grow, or None if
+        # it was not created to grow.
+        sql = '''
+            SELECT target FROM bayesdb_crosscat_subsample_growth
+                WHERE generator_id = ?
+        '''
+        rows = bdb.sql_execute(sql, (generator_id,)).fetchall()
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def _crosscat_models_analyzed(self, bdb, generator_id, modelnos):
+        # True if the models modelnos, or all of them if None, have
+        # each been analyzed for at least one iteration.
+        sql = '''
+            SELECT modelno, iterations FROM bayesdb_generator_model
+                WHERE generator_id = ?
+        '''
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        iterations = [n for modelno, n in cursor
+            if modelnos is None or modelno in modelnos]
+        return 0 < len(iterations) and 0 < min(iterations)
+
+    def _crosscat_subsample_grow(self, bdb, generator_id, M_c, T, target):
+        # Add to the subsample of coded data T as many rows again as
+        # it has, but no more than target in all, chosen uniformly at
+        # random from the rest of the table, and place them in the
+        # models.  Return the new coded data, or None if the subsample
+        # already has every row of the table.
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        m = len(T)
+        sql = 'SELECT COUNT(*) FROM %s' % (qt,)
+        n = cursor_value(bdb.sql_execute(sql)) - m
+        k = min(max(m, 1), target - m, n)
+        if k <= 0:
+            return None
+        with bdb.savepoint():
+            sql = '''
+                SELECT _rowid_ FROM %s
+                    WHERE _rowid_ NOT IN
+                        (SELECT sql_rowid FROM bayesdb_crosscat_subsample
+                            WHERE generator_id = ?)
+                    ORDER BY _rowid_ ASC
+            ''' % (qt,)
+            cursor = bdb.sql_execute(sql, (generator_id,))
+            rows = crosscat_sample_rows(cursor, k, m, n)
+            insert_subsample_sql = '''
+                INSERT INTO bayesdb_crosscat_subsample
+                    (generator_id, sql_rowid, cc_row_id)
+                    VALUES (?, ?, ?)
+            '''
+            bdb.sql_executemany(insert_subsample_sql,
+                [(generator_id, row[0], m + i) for i, row in enumerate(rows)])
+            modelled_rows = self._crosscat_select_codes(bdb, generator_id, '''
+                SELECT %%s FROM %s AS t, bayesdb_crosscat_subsample AS s
+                    WHERE s.generator_id = ?
+                        AND s.sql_rowid = t._rowid_
+                        AND ? <= s.cc_row_id
+                    ORDER BY s.cc_row_id ASC
+            ''' % (qt,), (generator_id, m))
+            self._crosscat_subsample_append(bdb, generator_id, M_c, T,
+                modelled_rows)
+        return self._crosscat_data(bdb, generator_id, M_c)
 
     def analyze_models(self, bdb, generator_id, modelnos=None, iterations=1,
             max_seconds=None, ckpt_iterations=None, ckpt_seconds=None):
@@ -884,22 +1376,7 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         # analysis?
         M_c = self._crosscat_metadata(bdb, generator_id)
         T = self._crosscat_data(bdb, generator_id, M_c)
-        update_iterations_sql = '''
-            UPDATE bayesdb_generator_model
-                SET iterations = iterations + :iterations
-                WHERE generator_id = :generator_id AND modelno = :modelno
-        '''
-        update_theta_json_sql = '''
-            UPDATE bayesdb_crosscat_theta SET theta_json = :theta_json
-                WHERE generator_id = :generator_id AND modelno = :modelno
-        '''
-        insert_diagnostics_sql = '''
-            INSERT INTO bayesdb_crosscat_diagnostics
-                (generator_id, modelno, checkpoint,
-                    logscore, num_views, column_crp_alpha, iterations)
-                VALUES (:generator_id, :modelno, :checkpoint,
-                    :logscore, :num_views, :column_crp_alpha, :iterations)
-        '''
+        writer = CrosscatCheckpointWriter(self, bdb, generator_id)
         if max_seconds is not None:
             deadline = time.time() + max_seconds
         if ckpt_seconds is not None:
@@ -908,154 +1385,203 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
                 ckpt_deadline = min(ckpt_deadline, deadline)
         if ckpt_iterations is not None and iterations is not None:
             ckpt_iterations = min(ckpt_iterations, iterations)
-        while (iterations is None or 0 < iterations) and \
-              (max_seconds is None or time.time() < deadline):
-            n_steps = 1
-            if ckpt_seconds is not None:
-                n_steps = 1
-            elif ckpt_iterations is not None:
-                assert 0 < ckpt_iterations
-                n_steps = ckpt_iterations
-                if iterations is not None:
-                    n_steps = min(n_steps, iterations)
-            elif iterations is not None and max_seconds is None:
-                n_steps = iterations
-            with bdb.savepoint():
-                if modelnos is None:
-                    numbered_thetas = self._crosscat_thetas(bdb, generator_id,
-                        None)
-                    update_modelnos = sorted(numbered_thetas.iterkeys())
-                    thetas = [numbered_thetas[modelno] for modelno in
-                        update_modelnos]
+        processes = self._crosscat_analysis_processes(bdb, generator_id)
+        growth_target = self._crosscat_subsample_growth_target(bdb,
+            generator_id)
+        def more():
+            return (iterations is None or 0 < iterations) and \
+                (max_seconds is None or time.time() < deadline)
+        def growing():
+            return growth_target is not None and len(T) < growth_target
+        while more():
+            # Grow the subsample, if it is to grow, before every
+            # iteration but the models' first, whatever the
+            # checkpoints, so that the models are analyzed at every
+            # size and never grown just to stop.
+            if growing() and \
+                    self._crosscat_models_analyzed(bdb, generator_id,
+                        modelnos):
+                T_grown = self._crosscat_subsample_grow(bdb, generator_id,
+                    M_c, T, growth_target)
+                if T_grown is None:
+                    growth_target = None
                 else:
-                    update_modelnos = modelnos
-                    thetas = [self._crosscat_theta(bdb, generator_id, modelno)
-                        for modelno in update_modelnos]
-                if len(thetas) == 0:
-                    raise BQLError(bdb, 'No models to analyze'
-                        ' for generator: %s' %
-                        (core.bayesdb_generator_name(bdb, generator_id),))
-                X_L_list = [theta['X_L'] for theta in thetas]
-                X_D_list = [theta['X_D'] for theta in thetas]
-                # XXX It would be nice to take advantage of Crosscat's
-                # internal timer to avoid transferring states between
-                # Python and C++ more often than is necessary, but it
-                # doesn't report back to us the number of iterations
-                # actually performed.
-                iterations_in_ckpt = 0
-                while True:
-                    X_L_list_0 = X_L_list
-                    X_L_list, X_D_list, diagnostics = self._crosscat.analyze(
-                        seed=crosscat_seed(bdb),
-                        M_c=M_c,
-                        T=T,
-                        do_diagnostics=True,
-                        # XXX Require the models share a common kernel_list.
-                        kernel_list=thetas[0]['model_config']['kernel_list'],
-                        X_L=X_L_list,
-                        X_D=X_D_list,
-                        n_steps=n_steps,
-                    )
-                    iterations_in_ckpt += n_steps
-                    if iterations is not None:
-                        assert n_steps <= iterations
-                        iterations -= n_steps
-                        if iterations == 0:
-                            break
-                    if ckpt_iterations is not None:
-                        if ckpt_iterations <= iterations_in_ckpt:
-                            break
-                    elif ckpt_seconds is not None:
-                        if ckpt_deadline < time.time():
-                            break
-                    else:
+                    T = T_grown
+                    writer = CrosscatCheckpointWriter(self, bdb,
+                        generator_id)
+            # While the subsample is still to grow, analyze one
+            # iteration at a time, with a checkpoint after each.
+            grow = growing()
+            pool_seed = None if processes is None else crosscat_seed(bdb)
+            with crosscat_parallel.analysis_pool(processes,
+                    type(self._crosscat), pool_seed, M_c, T) as pool:
+                while more():
+                    n_steps = 1
+                    if grow or ckpt_seconds is not None:
+                        n_steps = 1
+                    elif ckpt_iterations is not None:
+                        assert 0 < ckpt_iterations
+                        n_steps = ckpt_iterations
+                        if iterations is not None:
+                            n_steps = min(n_steps, iterations)
+                    elif iterations is not None and max_seconds is None:
+                        n_steps = iterations
+                    with bdb.savepoint():
+                        if modelnos is None:
+                            numbered_thetas = self._crosscat_thetas(bdb,
+                                generator_id, None)
+                            update_modelnos = \
+                                sorted(numbered_thetas.iterkeys())
+                            thetas = [numbered_thetas[modelno] for modelno in
+                                update_modelnos]
+                        else:
+                            update_modelnos = modelnos
+                            thetas = [
+                                self._crosscat_theta(bdb, generator_id,
+                                    modelno)
+                                for modelno in update_modelnos
+                            ]
+                        if len(thetas) == 0:
+                            raise BQLError(bdb, 'No models to analyze'
+                                ' for generator: %s' %
+                                (core.bayesdb_generator_name(bdb,
+                                    generator_id),))
+                        X_L_list = [theta['X_L'] for theta in thetas]
+                        X_D_list = [theta['X_D'] for theta in thetas]
+                        # XXX It would be nice to take advantage of Crosscat's
+                        # internal timer to avoid transferring states between
+                        # Python and C++ more often than is necessary, but it
+                        # doesn't report back to us the number of iterations
+                        # actually performed.
+                        iterations_in_ckpt = 0
+                        while True:
+                            X_L_list_0 = X_L_list
+                            # XXX Require the models share a common
+                            # kernel_list.
+                            kernel_list = \
+                                thetas[0]['model_config']['kernel_list']
+                            if pool is None:
+                                X_L_list, X_D_list, diagnostics = \
+                                    self._crosscat.analyze(
+                                        seed=crosscat_seed(bdb),
+                                        M_c=M_c,
+                                        T=T,
+                                        do_diagnostics=True,
+                                        kernel_list=kernel_list,
+                                        X_L=X_L_list,
+                                        X_D=X_D_list,
+                                        n_steps=n_steps,
+                                    )
+                            else:
+                                X_L_list, X_D_list, diagnostics = pool.analyze(
+                                    crosscat_seed(bdb), update_modelnos,
+                                    kernel_list, X_L_list, X_D_list, n_steps)
+                            iterations_in_ckpt += n_steps
+                            if iterations is not None:
+                                assert n_steps <= iterations
+                                iterations -= n_steps
+                                if iterations == 0:
+                                    break
+                            if grow:
+                                break
+                            if ckpt_iterations is not None:
+                                if ckpt_iterations <= iterations_in_ckpt:
+                                    break
+                            elif ckpt_seconds is not None:
+                                if ckpt_deadline < time.time():
+                                    break
+                            else:
+                                break
+                        for i, X_L in enumerate(X_L_list):
+                            assert 0 < len(diagnostics['logscore'])
+                            assert i < len(diagnostics['logscore'][-1])
+                            assert diagnostics['logscore'][-1][i] is not None
+                            assert not math.isnan(
+                                    diagnostics['logscore'][-1][i]), \
+                                'bad X_L before %r after %r' % \
+                                    (X_L, X_L_list_0[i])
+                        assert 0 < len(diagnostics['num_views'])
+                        assert 0 < len(diagnostics['column_crp_alpha'])
+                        writer.write(update_modelnos, thetas, X_L_list,
+                            X_D_list, iterations_in_ckpt, diagnostics)
+                        if ckpt_seconds is not None:
+                            ckpt_deadline = time.time() + ckpt_seconds
+                    if grow:
                         break
-                cc_cache = self._crosscat_cache(bdb)
-                for i, (modelno, theta, X_L, X_D) \
-                        in enumerate(
-                            zip(update_modelnos, thetas, X_L_list, X_D_list)):
-                    theta['iterations'] += iterations_in_ckpt
-                    theta['X_L'] = X_L
-                    theta['X_D'] = X_D
-                    total_changes = bdb._sqlite3.totalchanges()
-                    bdb.sql_execute(update_iterations_sql, {
-                        'generator_id': generator_id,
-                        'modelno': modelno,
-                        'iterations': iterations_in_ckpt,
-                    })
-                    assert bdb._sqlite3.totalchanges() - total_changes == 1
-                    total_changes = bdb._sqlite3.totalchanges()
-                    self._theta_validator.validate(theta)
-                    bdb.sql_execute(update_theta_json_sql, {
-                        'generator_id': generator_id,
-                        'modelno': modelno,
-                        'theta_json': json.dumps(theta),
-                    })
-                    assert bdb._sqlite3.totalchanges() - total_changes == 1
-                    checkpoint_sql = '''
-                        SELECT 1 + MAX(checkpoint)
+
+    def analysis_logscore(self, bdb, generator_id, modelnos=None):
+        sql = '''
+            SELECT d.modelno, d.logscore FROM bayesdb_crosscat_diagnostics AS d
+                WHERE d.generator_id = :generator_id
+                    AND d.checkpoint =
+                        (SELECT MAX(checkpoint)
                             FROM bayesdb_crosscat_diagnostics
                             WHERE generator_id = :generator_id
-                                AND modelno = :modelno
-                    '''
-                    cursor = bdb.sql_execute(checkpoint_sql, {
-                        'generator_id': generator_id,
-                        'modelno': modelno,
-                    })
-                    checkpoint = cursor_value(cursor)
-                    if checkpoint is None:
-                        checkpoint = 0
-                    assert isinstance(checkpoint, int)
-                    assert 0 < len(diagnostics['logscore'])
-                    assert i < len(diagnostics['logscore'][-1])
-                    assert diagnostics['logscore'][-1][i] is not None
-                    assert not math.isnan(diagnostics['logscore'][-1][i]), \
-                        'bad X_L before %r after %r' % (X_L, X_L_list_0[i])
-                    assert 0 < len(diagnostics['num_views'])
-                    assert 0 < len(diagnostics['column_crp_alpha'])
-                    bdb.sql_execute(insert_diagnostics_sql, {
-                        'generator_id': generator_id,
-                        'modelno': modelno,
-                        'checkpoint': checkpoint,
-                        'logscore': diagnostics['logscore'][-1][i],
-                        'num_views': diagnostics['num_views'][-1][i],
-                        'column_crp_alpha':
-                            diagnostics['column_crp_alpha'][-1][i],
-                        'iterations': theta['iterations'],
-                    })
-                    if cc_cache is not None:
-                        if generator_id in cc_cache.thetas:
-                            cc_cache.thetas[generator_id][modelno] = theta
-                        else:
-                            cc_cache.thetas[generator_id] = {modelno: theta}
-                if ckpt_seconds is not None:
-                    ckpt_deadline = time.time() + ckpt_seconds
+                                AND modelno = d.modelno)
+        '''
+        cursor = bdb.sql_execute(sql, {'generator_id': generator_id})
+        logscores = [logscore for modelno, logscore in cursor
+            if modelnos is None or modelno in modelnos]
+        if len(logscores) == 0:
+            return None
+        return arithmetic_mean(logscores)
 
     def column_dependence_probability(self, bdb, generator_id, modelno,
             colno0, colno1):
         if colno0 == colno1:
             return 1
-        cc_colno0 = crosscat_cc_colno(bdb, generator_id, colno0)
-        cc_colno1 = crosscat_cc_colno(bdb, generator_id, colno1)
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colno0 = columns.cc_colno(bdb, colno0)
+        cc_colno1 = columns.cc_colno(bdb, colno1)
         count = 0
         nmodels = 0
-        for X_L, X_D in self._crosscat_latent_stata(bdb, generator_id,
-                modelno):
+        # Only the column partition matters here, so avoid decoding the
+        # rest of the latent state.
+        thetas = self._crosscat_thetas(bdb, generator_id, modelno)
+        for theta in thetas.itervalues():
             nmodels += 1
-            assignments = X_L['column_partition']['assignments']
+            column_partition = \
+                crosscat_theta_codec.theta_column_partition(theta)
+            assignments = column_partition['assignments']
             if assignments[cc_colno0] != assignments[cc_colno1]:
                 continue
             count += 1
         return float('NaN') if nmodels == 0 else (float(count)/float(nmodels))
 
+    def column_dependence_probability_matrix(self, bdb, generator_id,
+            modelno, colnos):
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colnos = numpy.array([columns.cc_colno(bdb, colno)
+            for colno in colnos], dtype=int)
+        counts = numpy.zeros((len(colnos), len(colnos)))
+        nmodels = 0
+        thetas = self._crosscat_thetas(bdb, generator_id, modelno)
+        for theta in thetas.itervalues():
+            nmodels += 1
+            column_partition = \
+                crosscat_theta_codec.theta_column_partition(theta)
+            assignments = \
+                numpy.asarray(column_partition['assignments'])[cc_colnos]
+            counts += assignments[:, None] == assignments[None, :]
+        if nmodels == 0:
+            matrix = numpy.empty(counts.shape)
+            matrix.fill(float('NaN'))
+        else:
+            matrix = counts / nmodels
+        # Every column depends on itself, even with no models.
+        colnos = numpy.asarray(colnos)
+        matrix[colnos[:, None] == colnos[None, :]] = 1
+        return matrix.tolist()
+
     def column_mutual_information(self, bdb, generator_id, modelno, colno0,
             colno1, numsamples=None):
         if numsamples is None:
             numsamples = 100
         X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
         X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
-        cc_colno0 = crosscat_cc_colno(bdb, generator_id, colno0)
-        cc_colno1 = crosscat_cc_colno(bdb, generator_id, colno1)
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colno0 = columns.cc_colno(bdb, colno0)
+        cc_colno1 = columns.cc_colno(bdb, colno1)
         r = self._crosscat.mutual_information(
             seed=crosscat_seed(bdb),
             M_c=self._crosscat_metadata(bdb, generator_id),
@@ -1072,23 +1598,326 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         # the mean.
         return arithmetic_mean(mi)
 
+    def column_mutual_information_batch(self, bdb, generator_id, modelno,
+            colno_pairs, numsamples=None):
+        if numsamples is None:
+            numsamples = 100
+        columns = self._crosscat_columns(bdb, generator_id)
+        # Mutual information is symmetric, so ask Crosscat about each
+        # unordered pair only once, all in one query.
+        Q = []
+        indices = []
+        index = {}
+        for colno0, colno1 in colno_pairs:
+            cc_colno0 = columns.cc_colno(bdb, colno0)
+            cc_colno1 = columns.cc_colno(bdb, colno1)
+            pair = (min(cc_colno0, cc_colno1), max(cc_colno0, cc_colno1))
+            if pair not in index:
+                index[pair] = len(Q)
+                Q.append(pair)
+            indices.append(index[pair])
+        X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
+        if len(X_L_list) == 0:
+            return [float('NaN')] * len(colno_pairs)
+        if len(Q) == 0:
+            return []
+        X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
+        r = self._crosscat.mutual_information(
+            seed=crosscat_seed(bdb),
+            M_c=self._crosscat_metadata(bdb, generator_id),
+            X_L_list=X_L_list,
+            X_D_list=X_D_list,
+            Q=Q,
+            n_samples=int(math.ceil(float(numsamples) / len(X_L_list)))
+        )
+        # r is (mi, linfoot), and mi has, for each element of Q, a list
+        # of results for model 0, model 1, ..., of which we want the
+        # mean.
+        mi, _linfoot = r
+        mis = [arithmetic_mean(mi_q) for mi_q in mi]
+        return [mis[i] for i in indices]
+
     def row_similarity(self, bdb, generator_id, modelno, rowid, target_rowid,
             colnos):
         X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
         X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
         [given_row_id, target_row_id], X_L_list, X_D_list = \
-            self._crosscat_get_rows(bdb, generator_id, [rowid, target_rowid],
-                X_L_list, X_D_list)
+            self._crosscat_get_rows(bdb, generator_id, modelno,
+                [rowid, target_rowid], X_L_list, X_D_list)
+        columns = self._crosscat_columns(bdb, generator_id)
         return self._crosscat.similarity(
             M_c=self._crosscat_metadata(bdb, generator_id),
             X_L_list=X_L_list,
             X_D_list=X_D_list,
             given_row_id=given_row_id,
             target_row_id=target_row_id,
-            target_columns=[crosscat_cc_colno(bdb, generator_id, colno)
+            target_columns=[columns.cc_colno(bdb, colno)
                 for colno in colnos],
         )
 
+    def row_similarity_batch(self, bdb, generator_id, modelno, rowids,
+            target_rowids, colnos):
+        similarity = self._crosscat_similarity(bdb, generator_id, modelno,
+            rowids, target_rowids, colnos)
+        return similarity(0, len(rowids)).tolist()
+
+    def row_similarity_topk(self, bdb, generator_id, modelno, rowids,
+            target_rowids, colnos, k):
+        similarity = self._crosscat_similarity(bdb, generator_id, modelno,
+            rowids, target_rowids, colnos)
+        if k <= 0 or len(rowids) == 0 or len(target_rowids) == 0:
+            return []
+        # Compute the matrix a block of rows at a time, keeping only
+        # the k best pairs seen so far, so that memory is bounded by
+        # the block size rather than by the square of the table size.
+        nblock = max(1, _SIMILARITY_BLOCK // len(target_rowids))
+        best_values = numpy.empty(0)
+        best_indices = numpy.empty(0, dtype=int)
+        for start in xrange(0, len(rowids), nblock):
+            end = min(start + nblock, len(rowids))
+            block = similarity(start, end).ravel()
+            values = numpy.concatenate((best_values, block))
+            indices = numpy.concatenate((best_indices,
+                numpy.arange(start*len(target_rowids),
+                    end*len(target_rowids))))
+            if k < len(values):
+                keep = numpy.argpartition(-values, k - 1)[:k]
+                values = values[keep]
+                indices = indices[keep]
+            best_values = values
+            best_indices = indices
+        order = numpy.argsort(-best_values, kind='mergesort')
+        return [(rowids[best_indices[i] // len(target_rowids)],
+                target_rowids[best_indices[i] % len(target_rowids)],
+                float(best_values[i]))
+            for i in order]
+
+    def _crosscat_similarity(self, bdb, generator_id, modelno, rowids,
+            target_rowids, colnos):
+        # Return a function similarity(start, end) giving the matrix of
+        # similarities of rowids[start:end] to target_rowids.  Crosscat
+        # defines the similarity of two rows as the fraction, averaged
+        # over models, of the views of colnos in which both rows lie in
+        # the same cluster, counting a view once for each column in it.
+        X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
+        X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
+        all_rowids = sorted(set(rowids) | set(target_rowids))
+        all_row_ids, X_L_list, X_D_list = self._crosscat_get_rows(bdb,
+            generator_id, modelno, all_rowids, X_L_list, X_D_list)
+        row_id_of = dict(zip(all_rowids, all_row_ids))
+        row_ids = numpy.array([row_id_of[rowid] for rowid in rowids],
+            dtype=int)
+        target_row_ids = numpy.array([row_id_of[rowid]
+            for rowid in target_rowids], dtype=int)
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colnos = numpy.array([columns.cc_colno(bdb, colno)
+            for colno in colnos], dtype=int)
+        # For each model, the cluster assignments of the given and
+        # target rows in each view of colnos, with a multiplicity.
+        models = []
+        for X_L, X_D in zip(X_L_list, X_D_list):
+            assignments = \
+                numpy.asarray(X_L['column_partition']['assignments'])
+            views, counts = numpy.unique(assignments[cc_colnos],
+                return_counts=True)
+            X_D = numpy.asarray(X_D)
+            models.append([(X_D[view][row_ids], X_D[view][target_row_ids],
+                    float(count) / len(cc_colnos))
+                for view, count in zip(views, counts)])
+        def similarity(start, end):
+            matrix = numpy.zeros((end - start, len(target_row_ids)))
+            if len(models) == 0:
+                matrix.fill(float('NaN'))
+                return matrix
+            for views in models:
+                for clusters, target_clusters, weight in views:
+                    matrix += weight * (clusters[start:end, None] ==
+                        target_clusters[None, :])
+            return matrix / len(models)
+        return similarity
+
+    def row_column_predictive_probability_batch(self, bdb, generator_id,
+            modelno, colno, rowids):
+        probabilities, _bounds = self._crosscat_predictive_probability(bdb,
+            generator_id, modelno, colno, rowids)
+        return probabilities(range(len(rowids)))
+
+    def row_column_predictive_probability_topk(self, bdb, generator_id,
+            modelno, colno, rowids, k, descending):
+        if k <= 0 or len(rowids) == 0:
+            return []
+        probabilities, bounds = self._crosscat_predictive_probability(bdb,
+            generator_id, modelno, colno, rowids)
+        return metamodel.bayesdb_select_topk(rowids, k, descending,
+            probabilities, bounds=bounds())
+
+    def _crosscat_predictive_probability(self, bdb, generator_id, modelno,
+            colno, rowids):
+        # Return functions probabilities(indices), giving the
+        # predictive probabilities of the values of colno in the rows
+        # rowids[i] for i in indices, and bounds(), giving bounds on
+        # all of them for bayesdb_select_topk or None.  The predictive
+        # probability of an observed value depends only on the value
+        # and on the row's cluster in the column's view in each model,
+        # so rows that agree in those share one engine call.
+        M_c = self._crosscat_metadata(bdb, generator_id)
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colno = columns.cc_colno(bdb, colno)
+        unique_rowids = sorted(set(rowids))
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        qcn = sqlite3_quote_name(columns.names[cc_colno])
+        cursor = bdb.sql_execute('''
+            SELECT _rowid_, %s FROM %s WHERE _rowid_ IN (%s)
+        ''' % (qcn, qt, ','.join('%d' % (rowid,) for rowid in unique_rowids)))
+        values = dict(cursor)
+        if len(values) != len(unique_rowids):
+            generator = core.bayesdb_generator_name(bdb, generator_id)
+            missing = min(set(unique_rowids) - set(values))
+            raise BQLError(bdb, 'No such row in %s: %d' %
+                (repr(generator), missing))
+        X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
+        X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
+        row_ids, placements, nrows = self._crosscat_row_placements(bdb,
+            generator_id, modelno, unique_rowids, X_L_list, X_D_list)
+        row_id_of = dict(zip(unique_rowids, row_ids))
+        views = [X_L['column_partition']['assignments'][cc_colno]
+            for X_L in X_L_list]
+        # For each row, its row id, code, and the key under which its
+        # probability is shared: None if its value is missing, and
+        # False if its value has no code.  A row outside the subsample
+        # is asked about in latent states with it alone placed, as it
+        # would be by itself, so it shares only with rows placed alike.
+        rows = []
+        placed = {}
+        for rowid in rowids:
+            value = values[rowid]
+            row_id = row_id_of[rowid]
+            if value is None:
+                rows.append((row_id, None, None))
+                continue
+            try:
+                code = columns.cc_value_to_code(cc_colno, value)
+            except KeyError:
+                rows.append((row_id, None, False))
+                continue
+            # NaN codes never compare equal, so don't share them.
+            shared = row_id if math.isnan(code) else code
+            if rowid in placements:
+                row_placements = placements[rowid][1]
+                clusters = tuple(placement.clusters[view]
+                    for placement, view in zip(row_placements, views))
+                key = ('placed', clusters, shared)
+                placed[key] = row_placements
+            else:
+                clusters = tuple(X_D[view][row_id]
+                    for X_D, view in zip(X_D_list, views))
+                key = (clusters, shared)
+            rows.append((row_id, code, key))
+        cache = {}
+        def probability(row_id, code, key):
+            X_L_list_row, X_D_list_row = X_L_list, X_D_list
+            if key in placed:
+                X_L_list_row, X_D_list_row = crosscat_extend_latent_states(
+                    X_L_list, X_D_list, [placed[key]])
+                row_id = nrows
+            return ieee_exp(self._crosscat.predictive_probability_multistate(
+                M_c=M_c,
+                X_L_list=X_L_list_row,
+                X_D_list=X_D_list_row,
+                Y=[],
+                Q=[(row_id, cc_colno, code)],
+            ))
+        def probabilities(indices):
+            results = []
+            for i in indices:
+                row_id, code, key = rows[i]
+                if key is None:
+                    results.append(None)
+                elif key is False:
+                    results.append(0.)
+                else:
+                    if key not in cache:
+                        cache[key] = probability(row_id, code, key)
+                    results.append(cache[key])
+            return results
+        def bounds():
+            # The bounds are in terms of the clusters of the models as
+            # they are, without any rows placed.
+            if 0 < len(placed):
+                return None
+            return self._crosscat_predictive_probability_bounds(M_c,
+                cc_colno, X_L_list, X_D_list, views, rows)
+        return probabilities, bounds
+
+    def _crosscat_predictive_probability_bounds(self, M_c, cc_colno,
+            X_L_list, X_D_list, views, rows):
+        # Bound the predictive probabilities of numerical values.  In
+        # each model, the predictive density of a value in a cluster
+        # is a Student t density centred on the cluster's posterior
+        # mean, so it is highest for the value nearest to the mean and
+        # lowest for the value farthest from it; and the probability
+        # averaged over models lies between the averages of those.
+        # This takes two engine calls per model and cluster, so it is
+        # worthwhile only if there are many more distinct values.
+        metadata = M_c['column_metadata'][cc_colno]
+        if metadata['modeltype'] != 'normal_inverse_gamma' or \
+           len(X_L_list) == 0:
+            return None
+        keys = set(key for _row_id, _code, key in rows if key)
+        nclusters = sum(len(set(X_D[view]))
+            for X_D, view in zip(X_D_list, views))
+        if len(keys) <= 2*nclusters:
+            return None
+        name = M_c['idx_to_name'][str(cc_colno)]
+        extremes = []
+        for X_L, X_D, view in zip(X_L_list, X_D_list, views):
+            hypers = X_L['column_hypers'][cc_colno]
+            view_state = X_L['view_state'][view]
+            suffstats = view_state['column_component_suffstats'][
+                view_state['column_names'].index(name)]
+            # Nearest and farthest (distance, row id, code) by cluster.
+            nearest = {}
+            farthest = {}
+            for row_id, code, key in rows:
+                if not key or math.isnan(code):
+                    continue
+                cluster = X_D[view][row_id]
+                stats = suffstats[cluster]
+                mean = (hypers['r']*hypers['mu'] + stats['sum_x']) / \
+                    (hypers['r'] + stats['N'])
+                candidate = (abs(code - mean), row_id, code)
+                if cluster not in nearest or candidate < nearest[cluster]:
+                    nearest[cluster] = candidate
+                if cluster not in farthest or farthest[cluster] < candidate:
+                    farthest[cluster] = candidate
+            def density(candidate):
+                _distance, row_id, code = candidate
+                return ieee_exp(
+                    self._crosscat.predictive_probability_multistate(
+                        M_c=M_c,
+                        X_L_list=[X_L],
+                        X_D_list=[X_D],
+                        Y=[],
+                        Q=[(row_id, cc_colno, code)],
+                    ))
+            extremes.append(dict((cluster,
+                    (density(farthest[cluster]), density(nearest[cluster])))
+                for cluster in nearest))
+        bounds = []
+        for row_id, code, key in rows:
+            if not key or math.isnan(code):
+                bounds.append(None)
+                continue
+            lower = 0.
+            upper = 0.
+            for X_D, view, extreme in zip(X_D_list, views, extremes):
+                cluster_lower, cluster_upper = extreme[X_D[view][row_id]]
+                lower += cluster_lower
+                upper += cluster_upper
+            bounds.append((lower / len(X_D_list), upper / len(X_D_list)))
+        return bounds
+
     def predict_confidence(self, bdb, generator_id, modelno, colno, rowid,
             numsamples=None):
         if numsamples is None:
@@ -1098,34 +1927,84 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
         X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
         row_id, X_L_list, X_D_list = \
-            self._crosscat_get_row(bdb, generator_id, rowid, X_L_list,
-                X_D_list)
-        cc_colno = crosscat_cc_colno(bdb, generator_id, colno)
+            self._crosscat_get_row(bdb, generator_id, modelno, rowid,
+                X_L_list, X_D_list)
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colno = columns.cc_colno(bdb, colno)
         code, confidence = self._crosscat.impute_and_confidence(
             seed=crosscat_seed(bdb),
             M_c=M_c,
             X_L=X_L_list,
             X_D=X_D_list,
-            Y=[(row_id,
-                cc_colno_,
-                crosscat_value_to_code(bdb, generator_id, M_c,
-                    crosscat_gen_colno(bdb, generator_id, cc_colno_), value))
+            Y=[(row_id, cc_colno_, columns.cc_value_to_code(cc_colno_, value))
                for cc_colno_, value in enumerate(row)
                if value is not None
                if cc_colno_ != cc_colno],
             Q=[(row_id, cc_colno)],
             n=numsamples,
         )
-        value = crosscat_code_to_value(bdb, generator_id, M_c, colno, code)
+        value = columns.cc_code_to_value(cc_colno, code)
         return value, confidence
 
+    def predict_confidence_batch(self, bdb, generator_id, modelno, colno,
+            rowids, numsamples=None):
+        if numsamples is None:
+            numsamples = 100    # XXXWARGHWTF
+        if len(rowids) == 0:
+            return []
+        M_c = self._crosscat_metadata(bdb, generator_id)
+        columns = self._crosscat_columns(bdb, generator_id)
+        cc_colno = columns.cc_colno(bdb, colno)
+        # Read and code all the rows in one query, rather than once
+        # per row.  Ask about each row outside the subsample in latent
+        # states with it alone placed, as predict_confidence does.
+        unique_rowids = sorted(set(rowids))
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        qt = sqlite3_quote_name(table_name)
+        qrowids = ','.join('%d' % (rowid,) for rowid in unique_rowids)
+        rows = self._crosscat_select_codes(bdb, generator_id, '''
+            SELECT %%s FROM %s AS t WHERE _rowid_ IN (%s)
+                ORDER BY _rowid_ ASC
+        ''' % (qt, qrowids))
+        if len(rows) != len(unique_rowids):
+            raise BQLError(bdb, 'No such row in table %s'
+                ' for generator %d' % (repr(table_name), generator_id))
+        X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
+        X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
+        row_ids, placements, nrows = self._crosscat_row_placements(bdb,
+            generator_id, modelno, unique_rowids, X_L_list, X_D_list)
+        predictions = {}
+        for rowid, row_id, row in zip(unique_rowids, row_ids, rows):
+            X_L_list_row, X_D_list_row = X_L_list, X_D_list
+            if rowid in placements:
+                X_L_list_row, X_D_list_row = crosscat_extend_latent_states(
+                    X_L_list, X_D_list, [placements[rowid][1]])
+                row_id = nrows
+            code, confidence = self._crosscat.impute_and_confidence(
+                seed=crosscat_seed(bdb),
+                M_c=M_c,
+                X_L=X_L_list_row,
+                X_D=X_D_list_row,
+                Y=[(row_id, cc_colno_, float(code_))
+                   for cc_colno_, code_ in enumerate(row)
+                   if not math.isnan(code_)
+                   if cc_colno_ != cc_colno],
+                Q=[(row_id, cc_colno)],
+                n=numsamples,
+            )
+            value = columns.cc_code_to_value(cc_colno, code)
+            predictions[rowid] = (value, confidence)
+        return [predictions[rowid] for rowid in rowids]
+
     def simulate_joint(self, bdb, generator_id, targets, constraints,
             modelno, num_predictions=1):
         M_c = self._crosscat_metadata(bdb, generator_id)
+        columns = self._crosscat_columns(bdb, generator_id)
         X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
         X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
         Q, Y, X_L_list, X_D_list = self._crosscat_remap_two(
-            bdb, generator_id, X_L_list, X_D_list, targets, constraints)
+            bdb, generator_id, modelno, X_L_list, X_D_list, targets,
+            constraints)
         raw_outputs = self._crosscat.simple_predictive_sample(
             seed=crosscat_seed(bdb),
             M_c=M_c,
@@ -1135,29 +2014,44 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
             Q=Q,
             n=num_predictions
         )
-        return [[crosscat_code_to_value(bdb, generator_id, M_c, colno, code)
-                for ((_, colno), code) in zip(targets, raw_output)]
-            for raw_output in raw_outputs]
+        return columns.decode([cc_colno for _row_id, cc_colno in Q],
+            raw_outputs)
+
+    def simulate_joint_batch(self, bdb, generator_id, queries, modelno=None,
+            num_predictions=1):
+        M_c = self._crosscat_metadata(bdb, generator_id)
+        columns = self._crosscat_columns(bdb, generator_id)
+        X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
+        X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
+        remapped = self._crosscat_remap_batch(bdb, generator_id, modelno,
+            X_L_list, X_D_list, queries)
+        results = []
+        for Q, Y, X_L_list, X_D_list in remapped:
+            raw_outputs = self._crosscat.simple_predictive_sample(
+                seed=crosscat_seed(bdb),
+                M_c=M_c,
+                X_L=X_L_list,
+                X_D=X_D_list,
+                Y=Y,
+                Q=Q,
+                n=num_predictions
+            )
+            results.append(columns.decode(
+                [cc_colno for _row_id, cc_colno in Q], raw_outputs))
+        return results
 
     def logpdf_joint(self, bdb, generator_id, targets, constraints,
             modelno=None):
         M_c = self._crosscat_metadata(bdb, generator_id)
-        try:
-            for _, colno, value in constraints:
-                crosscat_value_to_code(bdb, generator_id, M_c, colno, value)
-        except KeyError:
-            # Probability with constraint that has no code
-            return float('nan')
-        try:
-            for _, colno, value in targets:
-                crosscat_value_to_code(bdb, generator_id, M_c, colno, value)
-        except KeyError:
-            # Probability of value that has no code
-            return float('-inf')
+        columns = self._crosscat_columns(bdb, generator_id)
+        r = self._crosscat_logpdf_uncoded(bdb, columns, targets, constraints)
+        if r is not None:
+            return r
         X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
         X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
         Q, Y, X_L_list, X_D_list = self._crosscat_remap_two(
-            bdb, generator_id, X_L_list, X_D_list, targets, constraints)
+            bdb, generator_id, modelno, X_L_list, X_D_list, targets,
+            constraints)
         r = self._crosscat.predictive_probability_multistate(
             M_c=M_c,
             X_L_list=X_L_list,
@@ -1167,88 +2061,719 @@ class CrosscatMetamodel(metamodel.IBayesDBMetamodel):
         )
         return r
 
+    def logpdf_joint_batch(self, bdb, generator_id, queries, modelno=None):
+        M_c = self._crosscat_metadata(bdb, generator_id)
+        columns = self._crosscat_columns(bdb, generator_id)
+        results = [
+            self._crosscat_logpdf_uncoded(bdb, columns, targets, constraints)
+            for targets, constraints in queries
+        ]
+        indices = [i for i, r in enumerate(results) if r is None]
+        if len(indices) == 0:
+            return results
+        X_L_list = self._crosscat_latent_state(bdb, generator_id, modelno)
+        X_D_list = self._crosscat_latent_data(bdb, generator_id, modelno)
+        remapped = self._crosscat_remap_batch(bdb, generator_id, modelno,
+            X_L_list, X_D_list, [queries[i] for i in indices])
+        for i, (Q, Y, X_L_list, X_D_list) in zip(indices, remapped):
+            results[i] = self._crosscat.predictive_probability_multistate(
+                M_c=M_c,
+                X_L_list=X_L_list,
+                X_D_list=X_D_list,
+                Y=Y,
+                Q=Q,
+            )
+        return results
+
+    def _crosscat_logpdf_uncoded(self, bdb, columns, targets, constraints):
+        # Log density of targets given constraints if any of their
+        # values has no code, which Crosscat cannot evaluate, or None
+        # if they all have codes.
+        try:
+            for _, colno, value in constraints:
+                columns.value_to_code(bdb, colno, value)
+        except KeyError:
+            # Probability with constraint that has no code
+            return float('nan')
+        try:
+            for _, colno, value in targets:
+                columns.value_to_code(bdb, colno, value)
+        except KeyError:
+            # Probability of value that has no code
+            return float('-inf')
+        return None
+
     def insertmany(self, bdb, generator_id, rows):
         with bdb.savepoint():
-            # Insert the data into the table.
+            # Encode the modelled columns, which are the columns of
+            # the table numbered by colno.
+            M_c = self._crosscat_metadata(bdb, generator_id)
+            columns = self._crosscat_columns(bdb, generator_id)
             table_name = core.bayesdb_generator_table(bdb, generator_id)
-            qt = sqlite3_quote_name(table_name)
             sql_column_names = core.bayesdb_table_column_names(bdb, table_name)
-            qcns = map(sqlite3_quote_name, sql_column_names)
-            sql = '''
-                INSERT INTO %s (%s) VALUES (%s)
-            ''' % (qt, ', '.join(qcns), ', '.join('?' for _qcn in qcns))
             for row in rows:
                 if len(row) != len(sql_column_names):
                     raise BQLError(bdb, 'Wrong row length'
                         ': expected %d, got %d' %
                         (len(sql_column_names), len(row)))
-                bdb.sql_execute(sql, row)
-
-            # Find the indices of the modelled columns.
-            # XXX Simplify this -- we have the correspondence between
-            # colno and modelled_colno in the database.
-            modelled_column_names = \
-                core.bayesdb_generator_column_names(bdb, generator_id)
-            remap = []
-            for i, name in enumerate(sql_column_names):
-                colno = len(remap)
-                if len(modelled_column_names) <= colno:
-                    break
-                if casefold(name) == casefold(modelled_column_names[colno]):
-                    remap.append(i)
-            assert len(remap) == len(modelled_column_names)
-            M_c = self._crosscat_metadata(bdb, generator_id)
-            modelled_rows = [[crosscat_value_to_code(bdb, generator_id, M_c,
-                        colno, row[i])
-                    for colno, i in enumerate(remap)]
-                for row in rows]
+            modelled_rows = columns.encode([[row[colno]
+                        for colno in columns.colnos]
+                    for row in rows])
 
-            # Update the models.
+            # Get the coded data before the new rows join it.
             T = self._crosscat_data(bdb, generator_id, M_c)
-            models_sql = '''
-                SELECT m.modelno, ct.theta_json
-                    FROM bayesdb_generator_model AS m,
-                        bayesdb_crosscat_theta AS ct
-                    WHERE m.generator_id = ?
-                        AND m.generator_id = ct.generator_id
-                        AND m.modelno = ct.modelno
-                    ORDER BY m.modelno
-            '''
-            models = bdb.sql_execute(models_sql, (generator_id,)).fetchall()
-            modelnos = [modelno for modelno, _theta_json in models]
-            thetas = [json.loads(theta_json)
-                for _modelno, theta_json in models]
-            X_L_list, X_D_list, T = self._crosscat.insert(
-                M_c=M_c,
-                T=T,
-                X_L_list=[theta['X_L'] for theta in thetas],
-                X_D_list=[theta['X_D'] for theta in thetas],
-                new_rows=modelled_rows,
-            )
-            assert T == self._crosscat_data(bdb, generator_id, M_c) \
-                + modelled_rows
-            update_theta_sql = '''
-                UPDATE bayesdb_crosscat_theta SET theta_json = :theta_json
-                    WHERE generator_id = :generator_id AND modelno = :modelno
+
+            # Insert the data into the table, and the new rows into
+            # the subsample after the existing ones.
+            qt = sqlite3_quote_name(table_name)
+            qcns = map(sqlite3_quote_name, sql_column_names)
+            sql = '''
+                INSERT INTO %s (%s) VALUES (%s)
+            ''' % (qt, ', '.join(qcns), ', '.join('?' for _qcn in qcns))
+            insert_subsample_sql = '''
+                INSERT INTO bayesdb_crosscat_subsample
+                    (generator_id, sql_rowid, cc_row_id)
+                    VALUES (?, ?, ?)
             '''
-            for modelno, theta, X_L, X_D \
-                    in zip(modelnos, thetas, X_L_list, X_D_list):
-                theta['X_L'] = X_L
-                theta['X_D'] = X_D
-                total_changes = bdb._sqlite3.totalchanges()
-                self._theta_validator.validate(theta)
-                bdb.sql_execute(update_theta_sql, {
-                    'generator_id': generator_id,
-                    'modelno': modelno,
-                    'theta_json': json.dumps(theta),
-                })
-                assert bdb._sqlite3.totalchanges() - total_changes == 1
+            for i, row in enumerate(rows):
+                bdb.sql_execute(sql, row)
+                sql_rowid = bdb._sqlite3.last_insert_rowid()
+                bdb.sql_execute(insert_subsample_sql,
+                    (generator_id, sql_rowid, len(T) + i))
+
+            # Update the models.
+            self._crosscat_subsample_append(bdb, generator_id, M_c, T,
+                modelled_rows)
+
+    def _crosscat_subsample_append(self, bdb, generator_id, M_c, T,
+            modelled_rows):
+        # Add the coded rows modelled_rows, already recorded in the
+        # subsample after the rows of the coded data T, to the models
+        # and the cached coded data.
+        cc_cache = self._crosscat_cache(bdb)
+        table_name = core.bayesdb_generator_table(bdb, generator_id)
+        models_sql = '''
+            SELECT m.modelno, ct.theta
+                FROM bayesdb_generator_model AS m,
+                    bayesdb_crosscat_theta AS ct
+                WHERE m.generator_id = ?
+                    AND m.generator_id = ct.generator_id
+                    AND m.modelno = ct.modelno
+                ORDER BY m.modelno
+        '''
+        models = bdb.sql_execute(models_sql, (generator_id,)).fetchall()
+        modelnos = [modelno for modelno, _theta_blob in models]
+        thetas = [
+            crosscat_theta_codec.decode(self._crosscat_theta_apply_deltas(
+                bdb, generator_id, modelno, theta_blob))
+            for modelno, theta_blob in models
+        ]
+        X_L_list, X_D_list, T_new = self._crosscat.insert(
+            M_c=M_c,
+            T=T.tolist(),
+            X_L_list=[theta['X_L'] for theta in thetas],
+            X_D_list=[theta['X_D'] for theta in thetas],
+            new_rows=modelled_rows.tolist(),
+        )
+
+        # Append the new rows to the cached coded data.
+        T = numpy.vstack((T, modelled_rows))
+        if self._verify:
+            assert crosscat_codes_equal(T_new, T)
+            assert crosscat_codes_equal(T,
+                self._crosscat_data_load(bdb, generator_id, table_name))
+        self._crosscat_data_update(bdb, generator_id, table_name, T)
+
+        # The new thetas are written whole, superseding any deltas.
+        delete_deltas_sql = '''
+            DELETE FROM bayesdb_crosscat_theta_delta
+                WHERE generator_id = ?
+        '''
+        bdb.sql_execute(delete_deltas_sql, (generator_id,))
+        update_theta_sql = '''
+            UPDATE bayesdb_crosscat_theta SET theta = :theta
+                WHERE generator_id = :generator_id AND modelno = :modelno
+        '''
+        for modelno, theta, X_L, X_D \
+                in zip(modelnos, thetas, X_L_list, X_D_list):
+            theta['X_L'] = X_L
+            theta['X_D'] = X_D
+            total_changes = bdb._sqlite3.totalchanges()
+            self._theta_validator.validate(theta)
+            theta_blob = crosscat_theta_codec.encode(theta)
+            bdb.sql_execute(update_theta_sql, {
+                'generator_id': generator_id,
+                'modelno': modelno,
+                'theta': buffer(theta_blob),
+            })
+            assert bdb._sqlite3.totalchanges() - total_changes == 1
+            # The iteration count does not change, so the cached
+            # theta must be replaced rather than merely superseded.
+            self._crosscat_lru_update(bdb, generator_id, modelno, theta,
+                len(theta_blob))
+            if cc_cache is not None:
+                if generator_id in cc_cache.thetas:
+                    cc_cache.thetas[generator_id][modelno] = theta
+                else:
+                    cc_cache.thetas[generator_id] = {modelno: theta}
 
 class CrosscatCache(object):
     def __init__(self):
         self.metadata = {}
         self.thetas = {}
 
+class CrosscatCheckpointWriter(object):
+    """Writer of checkpoints of a Crosscat generator's models.
+
+    Keeps each model's iteration count and next diagnostics checkpoint
+    number in memory, read once when created, and writes all models'
+    checkpoints with one statement per table.  Thetas are validated
+    against the schema only when their shape -- number of rows,
+    columns, and views -- has changed since the last validation by
+    this writer, or always if the metamodel is verifying.
+
+    If the metamodel has a checkpoint delta ratio, a checkpoint is
+    written as a delta against the model's previous theta, unless the
+    deltas since its last full theta would then exceed that ratio of
+    its size, or the row assignments have changed shape, in which case
+    the full theta is written and the deltas deleted.
+    """
+
+    update_iterations_sql = '''
+        UPDATE bayesdb_generator_model
+            SET iterations = iterations + :iterations
+            WHERE generator_id = :generator_id AND modelno = :modelno
+    '''
+    update_theta_sql = '''
+        UPDATE bayesdb_crosscat_theta SET theta = :theta
+            WHERE generator_id = :generator_id AND modelno = :modelno
+    '''
+    delete_deltas_sql = '''
+        DELETE FROM bayesdb_crosscat_theta_delta
+            WHERE generator_id = :generator_id AND modelno = :modelno
+    '''
+    insert_delta_sql = '''
+        INSERT INTO bayesdb_crosscat_theta_delta
+            (generator_id, modelno, seq, delta)
+            VALUES (:generator_id, :modelno, :seq, :delta)
+    '''
+    insert_diagnostics_sql = '''
+        INSERT INTO bayesdb_crosscat_diagnostics
+            (generator_id, modelno, checkpoint,
+                logscore, num_views, column_crp_alpha, iterations)
+            VALUES (:generator_id, :modelno, :checkpoint,
+                :logscore, :num_views, :column_crp_alpha, :iterations)
+    '''
+
+    def __init__(self, metamodel, bdb, generator_id):
+        self._metamodel = metamodel
+        self._bdb = bdb
+        self._generator_id = generator_id
+        self._shapes = {}
+        sql = '''
+            SELECT modelno, iterations FROM bayesdb_generator_model
+                WHERE generator_id = ?
+        '''
+        self._iterations = dict(bdb.sql_execute(sql, (generator_id,)))
+        sql = '''
+            SELECT modelno, 1 + MAX(checkpoint)
+                FROM bayesdb_crosscat_diagnostics
+                WHERE generator_id = ?
+                GROUP BY modelno
+        '''
+        self._checkpoints = dict(bdb.sql_execute(sql, (generator_id,)))
+        # For each model, the size of its full theta, the sequence
+        # number of its next delta, and the total size of its deltas.
+        sql = '''
+            SELECT t.modelno, LENGTH(t.theta),
+                    1 + MAX(d.seq), SUM(LENGTH(d.delta))
+                FROM bayesdb_crosscat_theta AS t
+                    LEFT OUTER JOIN bayesdb_crosscat_theta_delta AS d
+                        ON d.generator_id = t.generator_id
+                            AND d.modelno = t.modelno
+                WHERE t.generator_id = ?
+                GROUP BY t.modelno
+        '''
+        self._theta_sizes = {}
+        self._delta_seqs = {}
+        self._delta_sizes = {}
+        cursor = bdb.sql_execute(sql, (generator_id,))
+        for modelno, theta_size, delta_seq, delta_size in cursor:
+            self._theta_sizes[modelno] = theta_size
+            self._delta_seqs[modelno] = delta_seq or 0
+            self._delta_sizes[modelno] = delta_size or 0
+
+    def write(self, modelnos, thetas, X_L_list, X_D_list, iterations,
+            diagnostics):
+        """Record `iterations` more iterations of the models `modelnos`.
+
+        `thetas` are the models' thetas before the iterations, which
+        are updated with the new latent states `X_L_list` and
+        `X_D_list`; `diagnostics` are as returned by Crosscat's
+        analyze, with the last entries for these iterations.
+        """
+        bdb = self._bdb
+        generator_id = self._generator_id
+        metamodel = self._metamodel
+        delta_ratio = metamodel._checkpoint_delta_ratio
+        iterations_bindings = []
+        theta_bindings = []
+        delete_deltas_bindings = []
+        delta_bindings = []
+        diagnostics_bindings = []
+        for i, (modelno, theta, X_L, X_D) in \
+                enumerate(zip(modelnos, thetas, X_L_list, X_D_list)):
+            old_X_D = theta['X_D'] if delta_ratio is not None else None
+            theta['iterations'] += iterations
+            theta['X_L'] = X_L
+            theta['X_D'] = X_D
+            shape = (len(X_D[0]) if 0 < len(X_D) else 0,
+                len(X_L['column_partition']['assignments']), len(X_D))
+            if metamodel._verify or self._shapes.get(modelno) != shape:
+                metamodel._theta_validator.validate(theta)
+                self._shapes[modelno] = shape
+            delta = None
+            if old_X_D is not None:
+                delta = crosscat_theta_codec.encode_delta(old_X_D, theta)
+            if delta is not None and \
+                    self._delta_sizes[modelno] + len(delta) <= \
+                        delta_ratio*self._theta_sizes[modelno]:
+                delta_bindings.append({
+                    'generator_id': generator_id,
+                    'modelno': modelno,
+                    'seq': self._delta_seqs[modelno],
+                    'delta': buffer(delta),
+                })
+                self._delta_seqs[modelno] += 1
+                self._delta_sizes[modelno] += len(delta)
+            else:
+                theta_blob = crosscat_theta_codec.encode(theta)
+                theta_bindings.append({
+                    'generator_id': generator_id,
+                    'modelno': modelno,
+                    'theta': buffer(theta_blob),
+                })
+                if 0 < self._delta_seqs[modelno]:
+                    delete_deltas_bindings.append({
+                        'generator_id': generator_id,
+                        'modelno': modelno,
+                    })
+                self._theta_sizes[modelno] = len(theta_blob)
+                self._delta_seqs[modelno] = 0
+                self._delta_sizes[modelno] = 0
+            checkpoint = self._checkpoints.get(modelno)
+            if checkpoint is None:
+                checkpoint = 0
+            assert isinstance(checkpoint, int)
+            self._checkpoints[modelno] = checkpoint + 1
+            iterations_bindings.append({
+                'generator_id': generator_id,
+                'modelno': modelno,
+                'iterations': iterations,
+            })
+            diagnostics_bindings.append({
+                'generator_id': generator_id,
+                'modelno': modelno,
+                'checkpoint': checkpoint,
+                'logscore': diagnostics['logscore'][-1][i],
+                'num_views': diagnostics['num_views'][-1][i],
+                'column_crp_alpha': diagnostics['column_crp_alpha'][-1][i],
+                'iterations': theta['iterations'],
+            })
+        total_changes = bdb._sqlite3.totalchanges()
+        bdb.sql_executemany(self.update_iterations_sql, iterations_bindings)
+        assert bdb._sqlite3.totalchanges() - total_changes == len(modelnos)
+        if 0 < len(theta_bindings):
+            total_changes = bdb._sqlite3.totalchanges()
+            bdb.sql_executemany(self.update_theta_sql, theta_bindings)
+            assert bdb._sqlite3.totalchanges() - total_changes == \
+                len(theta_bindings)
+        if 0 < len(delete_deltas_bindings):
+            bdb.sql_executemany(self.delete_deltas_sql,
+                delete_deltas_bindings)
+        if 0 < len(delta_bindings):
+            bdb.sql_executemany(self.insert_delta_sql, delta_bindings)
+        bdb.sql_executemany(self.insert_diagnostics_sql, diagnostics_bindings)
+        cc_cache = metamodel._crosscat_cache(bdb)
+        for modelno, theta in zip(modelnos, thetas):
+            self._iterations[modelno] += iterations
+            metamodel._crosscat_lru_update(bdb, generator_id, modelno, theta,
+                self._theta_sizes[modelno],
+                iterations=self._iterations[modelno])
+            if cc_cache is not None:
+                if generator_id in cc_cache.thetas:
+                    cc_cache.thetas[generator_id][modelno] = theta
+                else:
+                    cc_cache.thetas[generator_id] = {modelno: theta}
+
+class CrosscatPlacement(object):
+    """A row placed by itself in one model's latent state.
+
+    `clusters` lists the row's cluster in each view, numbered as in
+    the model's `X_D`, or None where the row is alone in a new
+    cluster; `suffstats` lists, for each view, the row's contribution
+    to the sufficient statistics of each column in the view, in dicts
+    like those of `X_L`.
+    """
+
+    def __init__(self, clusters, suffstats):
+        self.clusters = clusters
+        self.suffstats = suffstats
+
+    def size(self):
+        """Approximate bytes of the placement."""
+        nstats = sum(len(stats)
+            for contribution in self.suffstats
+            for stats in contribution)
+        return 64*(len(self.clusters) + nstats)
+
+def crosscat_place_rows(M_c, X_L, X_D, rows, uniforms):
+    """Place each of `rows` by itself in a model's latent state.
+
+    `rows` is a numpy array of coded rows, with NaN for missing
+    values, and `uniforms` lists, for each row, a number in [0, 1)
+    for each view.  As Crosscat's insert does, each row draws its
+    cluster in each view with probability proportional to the
+    cluster's count, or the view's CRP concentration for a new
+    cluster, times the predictive density of the row's values in the
+    cluster; the draw inverts the cumulative distribution at the
+    row's uniform.  But no row sees any other, so where each lands
+    depends only on the model, the row, and its uniforms.  Returns a
+    list of :class:`CrosscatPlacement`, one for each row.
+    """
+    rows = numpy.reshape(numpy.asarray(rows, dtype=float),
+        (len(rows), len(M_c['column_metadata'])))
+    uniforms = numpy.reshape(numpy.asarray(uniforms, dtype=float),
+        (len(rows), len(X_D)))
+    clusters = []
+    suffstats = []
+    for view, view_state in enumerate(X_L['view_state']):
+        counts = view_state['row_partition_model']['counts']
+        alpha = view_state['row_partition_model']['hypers']['alpha']
+        logps = numpy.tile(numpy.log(list(counts) + [alpha]),
+            (len(rows), 1))
+        contributions = []
+        for name, column_stats in zip(view_state['column_names'],
+                view_state['column_component_suffstats']):
+            cc_colno = M_c['name_to_idx'][name]
+            metadata = M_c['column_metadata'][cc_colno]
+            hypers = X_L['column_hypers'][cc_colno]
+            x = rows[:, cc_colno]
+            logps += crosscat_predictive_logps(metadata['modeltype'],
+                hypers, column_stats, x)
+            contributions.append(crosscat_row_suffstats(
+                metadata['modeltype'], x))
+        # Draw as numerics::draw_sample_unnormalized does.
+        weights = numpy.exp(logps - numpy.max(logps, axis=1)[:, None])
+        cumulative = numpy.cumsum(weights, axis=1)
+        thresholds = uniforms[:, view]*cumulative[:, -1]
+        drawn = numpy.sum(cumulative <= thresholds[:, None], axis=1)
+        drawn = numpy.minimum(drawn, len(counts))
+        clusters.append([None if cluster == len(counts) else int(cluster)
+            for cluster in drawn])
+        suffstats.append(contributions)
+    return [CrosscatPlacement([view_clusters[i] for view_clusters in clusters],
+            [[contribution[i] for contribution in contributions]
+                for contributions in suffstats])
+        for i in range(len(rows))]
+
+def crosscat_predictive_logps(modeltype, hypers, column_stats, x):
+    """Log predictive densities of values `x` of a Crosscat column.
+
+    Returns an array with a row for each value and a column for each
+    cluster with sufficient statistics in `column_stats`, and one more
+    for a new, empty cluster, giving the log density of the value in
+    the cluster under the column's `hypers`, or zero if the value is
+    missing.
+    """
+    column_stats = list(column_stats) + [{}]
+    present = ~numpy.isnan(x)
+    v = numpy.where(present, x, 0)[:, None]
+    def stat(key):
+        return numpy.array([stats.get(key, 0.) for stats in column_stats],
+            dtype=float)
+    N = stat('N')
+    if modeltype == 'normal_inverse_gamma':
+        r, nu, s, mu = hypers['r'], hypers['nu'], hypers['s'], hypers['mu']
+        sum_x = stat('sum_x')
+        sum_x_squared = stat('sum_x_squared')
+        def log_Z(r_n, nu_n, s_n):
+            lgammas = numpy.array([math.lgamma(n/2.) for n in nu_n])
+            return nu_n/2.*(math.log(2) - numpy.log(s_n)) + \
+                0.5*math.log(2*math.pi) - 0.5*numpy.log(r_n) + lgammas
+        def posterior(count, total, total_squared):
+            r_n = r + count
+            mu_n = (r*mu + total)/r_n
+            return r_n, nu + count, s + total_squared + r*mu*mu - r_n*mu_n*mu_n
+        log_Z_n = log_Z(*posterior(N, sum_x, sum_x_squared))
+        r_1, nu_1, s_1 = posterior(N + 1, sum_x + v, sum_x_squared + v*v)
+        logps = log_Z(r_1, nu_1, s_1) - log_Z_n - \
+            0.5*math.log(2*math.pi)
+    elif modeltype == 'symmetric_dirichlet_discrete':
+        K = int(hypers['K'])
+        dirichlet_alpha = hypers['dirichlet_alpha']
+        table = numpy.zeros((len(column_stats), K))
+        for cluster, stats in enumerate(column_stats):
+            for key, count in stats.iteritems():
+                if key != 'N':
+                    table[cluster, int(key)] = count
+        codes = v[:, 0].astype(int)
+        logps = numpy.log(table[:, codes].T + dirichlet_alpha) - \
+            numpy.log(N + K*dirichlet_alpha)
+    elif modeltype == 'vonmises':
+        a, b, kappa = hypers['a'], hypers['b'], hypers['kappa']
+        sum_cos = kappa*stat('sum_cos_x') + b*math.cos(a)
+        sum_sin = kappa*stat('sum_sin_x') + b*math.sin(a)
+        b_n = numpy.hypot(sum_cos, sum_sin)
+        b_1 = numpy.hypot(sum_cos + kappa*numpy.cos(v),
+            sum_sin + kappa*numpy.sin(v))
+        logps = crosscat_log_bessel_i0(b_1) - crosscat_log_bessel_i0(b_n) - \
+            math.log(2*math.pi) - crosscat_log_bessel_i0(kappa)
+    else:
+        raise ValueError('Unknown Crosscat model type: %r' % (modeltype,))
+    return numpy.where(present[:, None], logps, 0.)
+
+def crosscat_log_bessel_i0(x):
+    """Log of the modified Bessel function I_0, without overflowing."""
+    x = numpy.asarray(x, dtype=float)
+    small = numpy.log(numpy.i0(numpy.minimum(x, 700.)))
+    large = x - 0.5*numpy.log(2*math.pi*numpy.maximum(x, 700.))
+    return numpy.where(x <= 700., small, large)
+
+def crosscat_row_suffstats(modeltype, x):
+    """List the sufficient statistics of each of the values `x`.
+
+    A missing value contributes nothing.
+    """
+    stats = []
+    for value in x.tolist():
+        missing = math.isnan(value)
+        if modeltype == 'normal_inverse_gamma':
+            stats.append({'N': 0, 'sum_x': 0., 'sum_x_squared': 0.}
+                if missing else
+                {'N': 1, 'sum_x': value, 'sum_x_squared': value*value})
+        elif modeltype == 'symmetric_dirichlet_discrete':
+            stats.append({'N': 0} if missing else
+                {'N': 1, str(int(value)): 1})
+        elif modeltype == 'vonmises':
+            stats.append({'N': 0, 'sum_cos_x': 0., 'sum_sin_x': 0.}
+                if missing else
+                {'N': 1, 'sum_cos_x': math.cos(value),
+                    'sum_sin_x': math.sin(value)})
+        else:
+            raise ValueError('Unknown Crosscat model type: %r' % (modeltype,))
+    return stats
+
+def crosscat_placement_uniforms(generator_id, modelno, iterations, rowid,
+        nviews):
+    """Uniforms in [0, 1) for placing a row in each view of a model.
+
+    Drawn from a PRNG seeded by the model and the row, so that where a
+    row lands is the same whenever it is placed again, whatever other
+    rows are placed alongside it.
+    """
+    seed = struct.pack('<QQQq', generator_id, modelno, iterations, rowid)
+    prng = weakprng.weakprng(seed)
+    return [prng.weakrandom64()/2.**64 for _ in range(nviews)]
+
+def crosscat_extend_latent_state(X_L, X_D, placements):
+    """Extend a model's latent state with rows placed in it separately.
+
+    `placements` is a list of :class:`CrosscatPlacement` for the rows
+    to append to `X_D`, in order.  Each row joins its cluster in each
+    view, adding its contribution to the cluster's sufficient
+    statistics, or gets a new cluster of its own, apart from those of
+    the other rows.  Returns the extended ``(X_L, X_D)``, leaving the
+    arguments unchanged.
+    """
+    view_states = []
+    X_D_new = []
+    for view, (view_state, clusters) in \
+            enumerate(zip(X_L['view_state'], X_D)):
+        counts = list(view_state['row_partition_model']['counts'])
+        suffstats = [list(column_stats)
+            for column_stats in view_state['column_component_suffstats']]
+        clusters = list(clusters)
+        for placement in placements:
+            cluster = placement.clusters[view]
+            contribution = placement.suffstats[view]
+            if cluster is None:
+                cluster = len(counts)
+                counts.append(1)
+                for column_stats, stats in zip(suffstats, contribution):
+                    column_stats.append(dict(stats))
+            else:
+                counts[cluster] += 1
+                for column_stats, stats in zip(suffstats, contribution):
+                    column_stats[cluster] = crosscat_suffstats_sum(
+                        column_stats[cluster], stats)
+            clusters.append(cluster)
+        view_state_new = dict(view_state)
+        view_state_new['row_partition_model'] = \
+            dict(view_state['row_partition_model'], counts=counts)
+        view_state_new['column_component_suffstats'] = suffstats
+        view_states.append(view_state_new)
+        X_D_new.append(clusters)
+    return dict(X_L, view_state=view_states), X_D_new
+
+def crosscat_extend_latent_states(X_L_list, X_D_list, placements):
+    """Extend each model's latent state with rows placed separately.
+
+    `placements` is a list, for each row to append, of its
+    :class:`CrosscatPlacement` in each model.  Returns the extended
+    ``(X_L_list, X_D_list)``.
+    """
+    extended = [crosscat_extend_latent_state(X_L, X_D,
+            [row_placements[i] for row_placements in placements])
+        for i, (X_L, X_D) in enumerate(zip(X_L_list, X_D_list))]
+    return [X_L for X_L, _X_D in extended], [X_D for _X_L, X_D in extended]
+
+def crosscat_suffstats_difference(stats0, stats1):
+    """Return the sufficient statistics `stats0` less `stats1`.
+
+    Crosscat's sufficient statistics -- counts, sums, and sums of
+    squares, cosines, and sines -- are all additive.
+    """
+    return dict((key, stats0.get(key, 0) - stats1.get(key, 0))
+        for key in set(stats0) | set(stats1))
+
+def crosscat_suffstats_sum(stats0, stats1):
+    """Return the sum of the sufficient statistics `stats0` and `stats1`."""
+    return dict((key, stats0.get(key, 0) + stats1.get(key, 0))
+        for key in set(stats0) | set(stats1))
+
+# Number of row pairs whose similarities to compute at once when
+# finding only the most similar pairs.
+_SIMILARITY_BLOCK = 1024*1024
+
+# Kinds of statistical types, as far as coding values is concerned.
+CC_CATEGORICAL = 0
+CC_NUMERICAL = 1
+
+_STATTYPE_KINDS = {
+    'categorical': CC_CATEGORICAL,
+    'cyclic': CC_NUMERICAL,
+    'numerical': CC_NUMERICAL,
+}
+
+class CrosscatColumns(object):
+    """Modelled columns of a Crosscat generator, in Crosscat order.
+
+    Lists `colnos`, `names`, `stattypes`, `kinds` (``CC_CATEGORICAL``
+    or ``CC_NUMERICAL``), and `affinities` are indexed by Crosscat
+    column number.  The value/code maps are shared with the
+    generator's metadata.  Depends only on the generator's schema, so
+    it need be rebuilt only when that changes.
+
+    :meth:`encode` and :meth:`decode` code whole tables at a time,
+    column by column, with numpy.
+    """
+
+    def __init__(self, bdb, generator_id, columns, M_c):
+        self.generator_id = generator_id
+        self.colnos = [colno for colno, _name, _stattype in columns]
+        self.names = [name for _colno, name, _stattype in columns]
+        self.stattypes = [casefold(stattype)
+            for _colno, _name, stattype in columns]
+        self.kinds = [_STATTYPE_KINDS.get(stattype)
+            for stattype in self.stattypes]
+        self.affinities = [core.bayesdb_stattype_affinity(bdb, stattype)
+            for stattype in self.stattypes]
+        # For hysterical raisins, code_to_value and value_to_code are
+        # backwards in the metadata.
+        column_metadata = M_c['column_metadata']
+        self._value_codes = [metadata['code_to_value']
+            for metadata in column_metadata]
+        self._code_values = [metadata['value_to_code']
+            for metadata in column_metadata]
+        self._cc_colnos = dict((colno, cc_colno)
+            for cc_colno, colno in enumerate(self.colnos))
+        # For categorical columns, the values in sorted order with
+        # their codes, and the values indexed by code.
+        self._sorted_values = []
+        self._sorted_codes = []
+        self._values_by_code = []
+        for kind, value_codes, code_values \
+                in zip(self.kinds, self._value_codes, self._code_values):
+            if kind == CC_CATEGORICAL:
+                values = sorted(value_codes.iterkeys())
+                self._sorted_values.append(numpy.array(values, dtype=unicode))
+                self._sorted_codes.append(numpy.array(
+                    [value_codes[value] for value in values], dtype=float))
+                values_by_code = numpy.empty(len(code_values), dtype=object)
+                for code, value in code_values.iteritems():
+                    values_by_code[int(code)] = value
+                self._values_by_code.append(values_by_code)
+            else:
+                self._sorted_values.append(None)
+                self._sorted_codes.append(None)
+                self._values_by_code.append(None)
+
+    def __len__(self):
+        return len(self.colnos)
+
+    def cc_colno(self, bdb, colno):
+        """Return the Crosscat column number of the column `colno`."""
+        try:
+            return self._cc_colnos[colno]
+        except KeyError:
+            raise _column_not_modelled(bdb, self.generator_id, colno)
+
+    def value_to_code(self, bdb, colno, value):
+        return self.cc_value_to_code(self.cc_colno(bdb, colno), value)
+
+    def code_to_value(self, bdb, colno, code):
+        return self.cc_code_to_value(self.cc_colno(bdb, colno), code)
+
+    def cc_value_to_code(self, cc_colno, value):
+        return _value_to_code(self.kinds[cc_colno],
+            self._value_codes[cc_colno], value)
+
+    def cc_code_to_value(self, cc_colno, code):
+        return _code_to_value(self.kinds[cc_colno],
+            self._code_values[cc_colno], code)
+
+    def encode(self, rows):
+        """Encode `rows`, whose values are in Crosscat column order.
+
+        Returns a numpy array of floating-point codes with a row for
+        each row and a column for each column.  Raises `KeyError` if
+        any categorical value has no code.
+        """
+        values = numpy.empty((len(rows), len(self.colnos)), dtype=object)
+        if 0 < len(rows):
+            values[:] = rows
+        codes = numpy.empty(values.shape, dtype=float)
+        for cc_colno, kind in enumerate(self.kinds):
+            if kind == CC_CATEGORICAL:
+                codes[:, cc_colno] = _encode_categorical(
+                    self._sorted_values[cc_colno],
+                    self._sorted_codes[cc_colno], values[:, cc_colno])
+            elif kind == CC_NUMERICAL:
+                codes[:, cc_colno] = _encode_numerical(values[:, cc_colno])
+            else:
+                raise KeyError
+        return codes
+
+    def decode(self, cc_colnos, codes):
+        """Decode rows of `codes` for the columns `cc_colnos`.
+
+        Returns a list of rows of values, with None for missing ones.
+        """
+        codes = numpy.asarray(codes, dtype=float)
+        codes = codes.reshape((len(codes), len(cc_colnos)))
+        values = numpy.empty(codes.shape, dtype=object)
+        for i, cc_colno in enumerate(cc_colnos):
+            kind = self.kinds[cc_colno]
+            if kind == CC_CATEGORICAL:
+                values[:, i] = _decode_categorical(
+                    self._values_by_code[cc_colno], codes[:, i])
+            elif kind == CC_NUMERICAL:
+                values[:, i] = _decode_numerical(codes[:, i])
+            else:
+                raise KeyError
+        return values.tolist()
+
 def create_metadata(bdb, generator_id, column_list):
     ncols = len(column_list)
     column_names = [name for _colno, name, _stattype in column_list]
@@ -1302,47 +2827,156 @@ metadata_creators = {
 
 def crosscat_value_to_code(bdb, generator_id, M_c, colno, value):
     stattype = core.bayesdb_generator_column_stattype(bdb, generator_id, colno)
-    if stattype == 'categorical':
-        # For hysterical raisins, code_to_value and value_to_code are
-        # backwards.
-        #
-        # XXX Fix this.
+    kind = _STATTYPE_KINDS.get(casefold(stattype))
+    if kind == CC_CATEGORICAL:
+        cc_colno = crosscat_cc_colno(bdb, generator_id, colno)
+        value_codes = M_c['column_metadata'][cc_colno]['code_to_value']
+    else:
+        value_codes = None
+    return _value_to_code(kind, value_codes, value)
+
+def crosscat_code_to_value(bdb, generator_id, M_c, colno, code):
+    stattype = core.bayesdb_generator_column_stattype(bdb, generator_id, colno)
+    kind = _STATTYPE_KINDS.get(casefold(stattype))
+    if kind == CC_CATEGORICAL:
+        cc_colno = crosscat_cc_colno(bdb, generator_id, colno)
+        code_values = M_c['column_metadata'][cc_colno]['value_to_code']
+    else:
+        code_values = None
+    return _code_to_value(kind, code_values, code)
+
+def _value_to_code(kind, value_codes, value):
+    if kind == CC_CATEGORICAL:
         if value is None:
             return float('NaN')         # XXX !?!??!
-        cc_colno = crosscat_cc_colno(bdb, generator_id, colno)
-        key = unicode(value)
-        code = M_c['column_metadata'][cc_colno]['code_to_value'][key]
+        code = value_codes[unicode(value)]
         # XXX Crosscat expects floating-point codes.
         return float(code)
-    elif stattype in ('cyclic', 'numerical'):
+    elif kind == CC_NUMERICAL:
         # Data may be stored in the SQL table as strings, if imported
         # from wacky sources like CSV files, in which case both NULL
         # and non-numerical data -- including the string `nan' which
         # makes sense, and anything else which doesn't -- will be
         # represented by NaN.
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return float('NaN')
+        return _float_or_nan(value)
     else:
         raise KeyError
 
-def crosscat_code_to_value(bdb, generator_id, M_c, colno, code):
-    stattype = core.bayesdb_generator_column_stattype(bdb, generator_id, colno)
-    if stattype == 'categorical':
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return float('NaN')
+
+def _code_to_value(kind, code_values, code):
+    if kind == CC_CATEGORICAL:
         if math.isnan(code):
             return None
-        cc_colno = crosscat_cc_colno(bdb, generator_id, colno)
         # XXX Whattakludge.
-        key = unicode(int(code))
-        return M_c['column_metadata'][cc_colno]['value_to_code'][key]
-    elif stattype in ('cyclic', 'numerical'):
+        return code_values[unicode(int(code))]
+    elif kind == CC_NUMERICAL:
         if math.isnan(code):
             return None
         return code
     else:
         raise KeyError
 
+def _encode_categorical(sorted_values, sorted_codes, values):
+    codes = numpy.empty(len(values), dtype=float)
+    codes.fill(float('NaN'))
+    strings = values.astype(unicode)
+    # NULL becomes u'None' here.  Comparing strings is much faster
+    # than comparing every object with None, so check only those.
+    present = strings != u'None'
+    present[~present] = ~numpy.equal(values[~present], None)
+    strings = strings[present]
+    if len(strings) == 0:
+        return codes
+    # Look up the codes by binary search, as in factorizing the
+    # column, rather than by a dict lookup per value.
+    i = numpy.searchsorted(sorted_values, strings)
+    known = i < len(sorted_values)
+    known[known] = sorted_values[i[known]] == strings[known]
+    if not known.all():
+        raise KeyError(strings[~known][0])
+    codes[present] = sorted_codes[i]
+    return codes
+
+def _encode_numerical(values):
+    try:
+        # NULL becomes NaN here, as in _value_to_code.
+        return values.astype(float)
+    except (ValueError, TypeError):
+        # Some value is not a number at all, so convert them one by
+        # one, mapping the bad ones to NaN.
+        with numpy.errstate(invalid='ignore'):
+            return _floats_or_nans(values).astype(float)
+
+_floats_or_nans = numpy.frompyfunc(_float_or_nan, 1, 1)
+
+def _decode_categorical(values_by_code, codes):
+    values = numpy.empty(len(codes), dtype=object)
+    present = ~numpy.isnan(codes)
+    values[present] = values_by_code[codes[present].astype(int)]
+    return values
+
+def _decode_numerical(codes):
+    values = codes.astype(object)
+    values[numpy.isnan(codes)] = None
+    return values
+
+def crosscat_codes_equal(T0, T1):
+    """True if the coded tables `T0` and `T1` agree, NaN for NaN."""
+    T0 = numpy.asarray(T0, dtype=float)
+    T1 = numpy.asarray(T1, dtype=float)
+    if T0.shape != T1.shape:
+        return False
+    return ((T0 == T1) | (numpy.isnan(T0) & numpy.isnan(T1))).all()
+
+def crosscat_table_changes(bdb, table):
+    """Return a count of writes to `table` through `bdb`'s connection.
+
+    The count is kept by temporary triggers, installed on first use,
+    and only ever increases.  Writes by other connections are not
+    counted -- :mod:`bayeslite.txn` notices those by ``PRAGMA
+    data_version`` instead.  Queries sqlite3 directly so that this
+    bookkeeping does not show up in SQL traces.
+    """
+    cursor = bdb._sqlite3.cursor()
+    trigger_sql = '''
+        SELECT COUNT(*) FROM sqlite_temp_master
+            WHERE type = 'trigger' AND name = ?
+    '''
+    triggers = [(event, 'bayesdb_crosscat_changes_%s_%s' % (event, table))
+        for event in ('INSERT', 'UPDATE', 'DELETE')]
+    if cursor_value(cursor.execute(trigger_sql, (triggers[0][1],))) == 0:
+        cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS bayesdb_crosscat_table_changes (
+                tabname TEXT NOT NULL PRIMARY KEY,
+                changes INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            INSERT OR IGNORE INTO bayesdb_crosscat_table_changes (tabname)
+                VALUES (?)
+        ''', (table,))
+        qt = sqlite3_quote_name(table)
+        # Triggers cannot take parameters, so quote the table name as
+        # an SQL string literal.
+        qtabname = "'%s'" % (table.replace("'", "''"),)
+        for event, trigger in triggers:
+            cursor.execute('''
+                CREATE TEMP TRIGGER IF NOT EXISTS %s AFTER %s ON %s
+                BEGIN
+                    UPDATE bayesdb_crosscat_table_changes
+                        SET changes = changes + 1 WHERE tabname = %s;
+                END
+            ''' % (sqlite3_quote_name(trigger), event, qt, qtabname))
+    changes_sql = '''
+        SELECT changes FROM bayesdb_crosscat_table_changes WHERE tabname = ?
+    '''
+    return cursor_value(cursor.execute(changes_sql, (table,)))
+
 def crosscat_cc_colno(bdb, generator_id, colno):
     sql = '''
         SELECT cc_colno FROM bayesdb_crosscat_column
@@ -1352,15 +2986,19 @@ def crosscat_cc_colno(bdb, generator_id, colno):
     try:
         row = cursor.next()
     except StopIteration:
-        generator = core.bayesdb_generator_name(bdb, generator_id)
-        colname = core.bayesdb_generator_column_name(bdb, generator_id, colno)
-        raise BQLError(bdb, 'Column not modelled in generator %s: %s' %
-            (repr(generator), repr(colname)))
+        raise _column_not_modelled(bdb, generator_id, colno)
     else:
         assert len(row) == 1
         assert isinstance(row[0], int)
         return row[0]
 
+def _column_not_modelled(bdb, generator_id, colno):
+    generator = core.bayesdb_generator_name(bdb, generator_id)
+    table = core.bayesdb_generator_table(bdb, generator_id)
+    colname = core.bayesdb_table_column_name(bdb, table, colno)
+    return BQLError(bdb, 'Column not modelled in generator %s: %s' %
+        (repr(generator), repr(colname)))
+
 def crosscat_gen_colno(bdb, generator_id, cc_colno):
     sql = '''
         SELECT colno FROM bayesdb_crosscat_column
@@ -1388,6 +3026,26 @@ def crosscat_gen_column_dependencies(bdb, generator_id):
     '''
     return bdb.sql_execute(sql, (generator_id,)).fetchall()
 
+def crosscat_sample_rows(cursor, k, m, n):
+    # Sample k of the n rows of cursor without replacement, choosing
+    # from all the k-of-n combinations uniformly at random, for a
+    # subsample that already has m other rows, and return them in
+    # order.
+    #
+    # XXX Let the user pass in a seed.
+    seed = struct.pack('<QQQQ', 0, m, k, n)
+    uniform = weakprng.weakprng(seed).weakrandom_uniform
+    # https://en.wikipedia.org/wiki/Reservoir_sampling
+    samples = []
+    for i, row in enumerate(cursor):
+        if i < k:
+            samples.append(row)
+        else:
+            r = uniform(i + 1)
+            if r < k:
+                samples[r] = row
+    return sorted(samples)
+
 def crosscat_seed(bdb):
     # XXX Pass a 32-byte seed from weakprng once Crosscat supports
     # that.  Crosscat Github issue #93:
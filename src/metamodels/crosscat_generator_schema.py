@@ -5,13 +5,15 @@ import collections
 from bayeslite.exception import BQLError
 from bayeslite.util import casefold
 
-# guess is bool. subsample is False or an int. columns is a list of pairs
+# guess is bool. subsample is False, an int, or a pair (k, target) of ints
+# for a subsample of k rows to grow to target rows. columns is a list of pairs
 # (column name, type). dep_constraints is a list of (column names, dep), where
 # column names is a list of column names and dep is a bool indicating whether
-# they're dependent or independent.
+# they're dependent or independent.  parallel is None (use the BayesDB's
+# default), False, or the number of analysis processes.
 GeneratorSchema = collections.namedtuple(
     'GeneratorSchema',
-    ['guess', 'subsample', 'columns', 'dep_constraints'])
+    ['guess', 'subsample', 'columns', 'dep_constraints', 'parallel'])
 
 
 def parse(schema, subsample_default):
@@ -29,6 +31,7 @@ def parse(schema, subsample_default):
 
     guess = False
     subsample = subsample_default
+    parallel = None
     columns = []
     dep_constraints = []
     for directive in schema:
@@ -55,6 +58,11 @@ def parse(schema, subsample_default):
         elif (op == 'subsample' and isinstance(directive[1], list) and
                 len(directive[1]) == 1):
             subsample = _parse_subsample_clause(directive[1][0])
+        elif op == 'subsample' and isinstance(directive[1], list):
+            subsample = _parse_subsample_growth_clause(directive[1])
+        elif (op == 'parallel' and isinstance(directive[1], list) and
+                len(directive[1]) == 1):
+            parallel = _parse_parallel_clause(directive[1][0])
         elif op == 'dependent':
             constraint = (_parse_dependent_clause(directive[1]), True)
             dep_constraints.append(constraint)
@@ -68,7 +76,7 @@ def parse(schema, subsample_default):
                 None, 'Invalid crosscat column model: %r' % (directive),)
     return GeneratorSchema(
         guess=guess, subsample=subsample, columns=columns,
-        dep_constraints=dep_constraints)
+        dep_constraints=dep_constraints, parallel=parallel)
 
 
 def _parse_subsample_clause(clause):
@@ -80,6 +88,27 @@ def _parse_subsample_clause(clause):
         raise BQLError(None, 'Invalid subsampling: %r' % (clause,))
 
 
+def _parse_subsample_growth_clause(args):
+    # GROW FROM k TO target
+    if (len(args) == 5 and
+            all(isinstance(args[i], basestring) for i in (0, 1, 3)) and
+            [casefold(args[i]) for i in (0, 1, 3)] == ['grow', 'from', 'to'] and
+            isinstance(args[2], int) and isinstance(args[4], int) and
+            0 < args[2] <= args[4]):
+        return (args[2], args[4])
+    else:
+        raise BQLError(None, 'Invalid subsampling: %r' % (args,))
+
+
+def _parse_parallel_clause(clause):
+    if isinstance(clause, basestring) and casefold(clause) == 'off':
+        return False
+    elif isinstance(clause, int) and 0 < clause:
+        return clause
+    else:
+        raise BQLError(None, 'Invalid analysis parallelism: %r' % (clause,))
+
+
 def _parse_dependent_clause(args):
     i = 0
     dep_columns = []
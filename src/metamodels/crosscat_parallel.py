@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Analysis of Crosscat models in a pool of worker processes.
+
+Each model is analyzed by a separate call to a Crosscat engine, of
+the class configured for the metamodel, with its own seed, derived by
+:func:`model_seed` from a seed for the whole round of analysis and
+the model number.  Which worker analyzes which model therefore does
+not affect the results, so they are the same for any number of
+workers.  Each worker's engine is also created with a seed of its
+own, derived by :func:`worker_seed` from a seed for the whole pool,
+from which it draws any seeds it is not given.
+"""
+
+# This module is imported by bayeslite.metamodels.crosscat, whose name
+# would otherwise shadow the crosscat package here.
+from __future__ import absolute_import
+
+import contextlib
+import multiprocessing
+import struct
+
+import bayeslite.weakprng as weakprng
+
+def model_seed(seed, modelno):
+    """Return a 32-bit Crosscat seed for `modelno` in a round `seed`."""
+    prng = weakprng.weakprng(struct.pack('<QQQQ', 0, 0, seed, modelno))
+    return prng.weakrandom32()
+
+def worker_seed(seed, i):
+    """Return a 32-bit Crosscat seed for worker `i` of a pool `seed`."""
+    prng = weakprng.weakprng(struct.pack('<QQQQ', 0, 1, seed, i))
+    return prng.weakrandom32()
+
+@contextlib.contextmanager
+def analysis_pool(processes, engine_class, seed, M_c, T):
+    """Yield an :class:`AnalysisPool`, or `None` if `processes` is `None`.
+
+    The pool's worker processes are shut down on exit.
+    """
+    if processes is None:
+        yield None
+        return
+    pool = AnalysisPool(processes, engine_class, seed, M_c, T)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+class AnalysisPool(object):
+    """Pool of `processes` workers analyzing models for `M_c` and `T`.
+
+    Each worker creates its engine by calling `engine_class` with its
+    own seed derived from `seed`.  With a single process, models are
+    analyzed in the calling process instead, with the same results.
+    """
+
+    def __init__(self, processes, engine_class, seed, M_c, T):
+        assert 0 < processes
+        if processes == 1:
+            engine = engine_class(seed=worker_seed(seed, 0))
+            self._pool = None
+            self._worker = _Worker(engine, M_c, T)
+        else:
+            # Hand each worker its own engine seed through a queue,
+            # and send the metadata and data to each worker once,
+            # rather than with every model.
+            queue = multiprocessing.Queue()
+            for i in range(processes):
+                queue.put(worker_seed(seed, i))
+            self._pool = multiprocessing.Pool(processes,
+                initializer=_worker_init,
+                initargs=(engine_class, queue, M_c, T))
+            self._worker = None
+
+    def close(self):
+        """Shut down the worker processes."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def analyze(self, seed, modelnos, kernel_list, X_L_list, X_D_list,
+            n_steps):
+        """Analyze the models `modelnos` for `n_steps` each.
+
+        Returns ``(X_L_list, X_D_list, diagnostics)`` like Crosscat's
+        own ``analyze``, except that the diagnostics cover only the
+        last step.
+        """
+        assert len(modelnos) == len(X_L_list)
+        assert len(modelnos) == len(X_D_list)
+        tasks = [
+            (model_seed(seed, modelno), kernel_list, X_L, X_D, n_steps)
+            for modelno, X_L, X_D in zip(modelnos, X_L_list, X_D_list)
+        ]
+        if self._pool is None:
+            results = map(self._worker.analyze, tasks)
+        else:
+            results = self._pool.map(_worker_analyze, tasks, chunksize=1)
+        X_L_list = [X_L for X_L, _X_D, _diagnostics in results]
+        X_D_list = [X_D for _X_L, X_D, _diagnostics in results]
+        diagnostics = dict(
+            (key, [[model_diagnostics[key]
+                    for _X_L, _X_D, model_diagnostics in results]])
+            for key in _DIAGNOSTICS)
+        return X_L_list, X_D_list, diagnostics
+
+_DIAGNOSTICS = ('logscore', 'num_views', 'column_crp_alpha')
+
+class _Worker(object):
+    def __init__(self, engine, M_c, T):
+        self._M_c = M_c
+        self._T = T
+        self._engine = engine
+
+    def analyze(self, task):
+        seed, kernel_list, X_L, X_D, n_steps = task
+        X_L_list, X_D_list, diagnostics = self._engine.analyze(
+            seed=seed,
+            M_c=self._M_c,
+            T=self._T,
+            do_diagnostics=True,
+            kernel_list=kernel_list,
+            X_L=[X_L],
+            X_D=[X_D],
+            n_steps=n_steps,
+        )
+        model_diagnostics = dict((key, diagnostics[key][-1][0])
+            for key in _DIAGNOSTICS)
+        return X_L_list[0], X_D_list[0], model_diagnostics
+
+# Per-process worker, set up by the pool's initializer.
+_worker = None
+
+def _worker_init(engine_class, seeds, M_c, T):
+    global _worker
+    _worker = _Worker(engine_class(seed=seeds.get()), M_c, T)
+
+def _worker_analyze(task):
+    return _worker.analyze(task)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Binary encoding of Crosscat model states.
+
+A theta is the dict described by ``crosscat_theta.schema.json``:
+``iterations``, ``model_config``, and the Crosscat latent state
+``X_L`` and ``X_D``.  The bulk of it is X_D, one row-to-category
+assignment per view per row, which as JSON costs several bytes per
+entry to store and a great deal of time to parse.
+
+The encoding, all little-endian, is::
+
+    magic 'BCCT', format version (u16)
+    u32 length, JSON of everything except X_L and X_D
+    u32 length, column partition:
+        f64 alpha, u32 ncols, u32 nviews,
+        i32 assignments[ncols], i32 counts[nviews]
+    u32 length, JSON of X_L without its column partition
+    u32 length, X_D: u32 nviews, u32 nrows, i32 X_D[nviews*nrows]
+
+Decoding is lazy: :func:`decode` reads only the section lengths and
+the small JSON header, and X_L and X_D are decoded the first time
+they are accessed.  :func:`theta_column_partition` can be answered
+from its own section without decoding either.
+
+A checkpoint that changes few row assignments can instead be stored
+as a delta against the previous state, made by :func:`encode_delta`
+and applied with :func:`apply_delta`::
+
+    magic 'BCCD', format version (u16)
+    u32 length, JSON of everything except X_L and X_D
+    u32 length, column partition, as above
+    u32 length, JSON of X_L without its column partition
+    u32 length, X_D changes: u32 nviews, u32 nrows, u32 nchanges,
+        i32 indices[nchanges], i32 X_D[nchanges]
+
+where the indices are into X_D flattened view by view.  Everything
+but X_D is small, so it is stored whole.
+"""
+
+import json
+import numpy
+import struct
+
+MAGIC = 'BCCT'
+DELTA_MAGIC = 'BCCD'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sH')
+_LENGTH = struct.Struct('<I')
+_PARTITION = struct.Struct('<dII')
+_XD = struct.Struct('<II')
+_XD_DELTA = struct.Struct('<III')
+
+def encode(theta):
+    """Encode `theta` as a binary string."""
+    X_D = theta['X_D']
+    nviews = len(X_D)
+    nrows = len(X_D[0]) if 0 < nviews else 0
+    if not all(len(X_D_view) == nrows for X_D_view in X_D):
+        raise ValueError('Ragged X_D')
+    X_D_bytes = _XD.pack(nviews, nrows) + _int32s(X_D)
+    return _join(MAGIC, _small_sections(theta) + [X_D_bytes])
+
+def encode_delta(old_X_D, theta):
+    """Encode `theta` as changes to a state with row assignments `old_X_D`.
+
+    Returns None if X_D has changed shape, in which case the theta
+    must be encoded whole with :func:`encode`.
+    """
+    X_D = numpy.asarray(theta['X_D'], dtype='<i4')
+    old_X_D = numpy.asarray(old_X_D, dtype='<i4')
+    if X_D.ndim != 2 or X_D.shape != old_X_D.shape:
+        return None
+    nviews, nrows = X_D.shape
+    indices = numpy.flatnonzero(X_D != old_X_D)
+    X_D_bytes = _XD_DELTA.pack(nviews, nrows, len(indices)) + \
+        _int32s(indices) + \
+        X_D.ravel()[indices].tostring()
+    return _join(DELTA_MAGIC, _small_sections(theta) + [X_D_bytes])
+
+def apply_delta(blob, delta):
+    """Apply a delta made by :func:`encode_delta` to an encoded theta.
+
+    Returns the encoding, as by :func:`encode`, of the changed theta.
+    """
+    offset, _length = _split(blob, MAGIC)[3]
+    nviews, nrows = _XD.unpack_from(blob, offset)
+    X_D = numpy.frombuffer(blob, dtype='<i4', count=nviews*nrows,
+        offset=offset + _XD.size).copy()
+    delta_sections = _split(delta, DELTA_MAGIC)
+    offset, _length = delta_sections[3]
+    delta_nviews, delta_nrows, nchanges = \
+        _XD_DELTA.unpack_from(delta, offset)
+    if (delta_nviews, delta_nrows) != (nviews, nrows):
+        raise ValueError('Binary Crosscat theta delta has wrong shape')
+    offset += _XD_DELTA.size
+    indices = numpy.frombuffer(delta, dtype='<i4', count=nchanges,
+        offset=offset)
+    offset += 4*nchanges
+    X_D[indices] = numpy.frombuffer(delta, dtype='<i4', count=nchanges,
+        offset=offset)
+    small_sections = [str(delta[start:start + size])
+        for start, size in delta_sections[:3]]
+    X_D_bytes = _XD.pack(nviews, nrows) + X_D.tostring()
+    return _join(MAGIC, small_sections + [X_D_bytes])
+
+def decode(blob):
+    """Decode a binary string made by :func:`encode`.
+
+    Returns a :class:`LazyTheta`, which behaves as a theta dict.
+    """
+    sections = _split(blob, MAGIC)
+    return LazyTheta(blob, sections)
+
+def theta_column_partition(theta):
+    """Return ``theta['X_L']['column_partition']``, decoding little."""
+    if isinstance(theta, LazyTheta):
+        return theta.column_partition()
+    return theta['X_L']['column_partition']
+
+class LazyTheta(dict):
+    """Theta dict whose X_L and X_D are decoded on first access.
+
+    Until they are accessed, ``'X_L' in theta`` and ``'X_D' in
+    theta`` are false and they do not appear in iteration, so callers
+    that wish to treat it as a complete dict, e.g. to validate or
+    serialize it, must access both first.
+    """
+
+    def __init__(self, blob, sections):
+        self._blob = blob
+        self._sections = sections
+        self._column_partition = None
+        dict.__init__(self, json.loads(self._section(0)))
+
+    def _section(self, i):
+        offset, length = self._sections[i]
+        return str(self._blob[offset:offset + length])
+
+    def __missing__(self, key):
+        if key == 'X_L':
+            X_L = json.loads(self._section(2))
+            X_L['column_partition'] = self.column_partition()
+            value = X_L
+        elif key == 'X_D':
+            offset, length = self._sections[3]
+            nviews, nrows = _XD.unpack_from(self._blob, offset)
+            X_D = numpy.frombuffer(self._blob, dtype='<i4',
+                count=nviews*nrows, offset=offset + _XD.size)
+            value = X_D.reshape((nviews, nrows)).tolist()
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+    def column_partition(self):
+        if dict.__contains__(self, 'X_L'):
+            return self['X_L']['column_partition']
+        if self._column_partition is None:
+            self._column_partition = self._decode_column_partition()
+        return self._column_partition
+
+    def _decode_column_partition(self):
+        offset, _length = self._sections[1]
+        alpha, ncols, nviews = _PARTITION.unpack_from(self._blob, offset)
+        offset += _PARTITION.size
+        assignments = numpy.frombuffer(self._blob, dtype='<i4', count=ncols,
+            offset=offset)
+        offset += 4*ncols
+        counts = numpy.frombuffer(self._blob, dtype='<i4', count=nviews,
+            offset=offset)
+        return {
+            'assignments': assignments.tolist(),
+            'counts': counts.tolist(),
+            'hypers': {'alpha': alpha},
+        }
+
+def _small_sections(theta):
+    X_L = theta['X_L']
+    meta = dict((k, v) for k, v in theta.iteritems()
+        if k not in ('X_L', 'X_D'))
+    column_partition = X_L['column_partition']
+    assert set(column_partition['hypers'].iterkeys()) == set(['alpha'])
+    assignments = column_partition['assignments']
+    counts = column_partition['counts']
+    partition = _PARTITION.pack(column_partition['hypers']['alpha'],
+            len(assignments), len(counts)) + \
+        _int32s(assignments) + \
+        _int32s(counts)
+    X_L_rest = dict((k, v) for k, v in X_L.iteritems()
+        if k != 'column_partition')
+    return [json.dumps(meta), partition, json.dumps(X_L_rest)]
+
+def _join(magic, sections):
+    return _HEADER.pack(magic, VERSION) + \
+        ''.join(_LENGTH.pack(len(section)) + section for section in sections)
+
+def _split(blob, magic):
+    what = 'binary Crosscat theta' + (' delta' if magic == DELTA_MAGIC else '')
+    blob_magic, version = _HEADER.unpack_from(blob, 0)
+    if blob_magic != magic:
+        raise ValueError('Not a %s' % (what,))
+    if version != VERSION:
+        raise ValueError('Unknown %s version: %d' % (what, version))
+    offset = _HEADER.size
+    sections = []
+    for _ in range(4):
+        (length,) = _LENGTH.unpack_from(blob, offset)
+        offset += _LENGTH.size
+        sections.append((offset, length))
+        offset += length
+    if offset != len(blob):
+        raise ValueError('Trailing garbage in %s' % (what,))
+    return sections
+
+def _int32s(array):
+    return numpy.asarray(array, dtype='<i4').tostring()
@@ -12,7 +12,7 @@ class Validator(object):
     def validate(self, obj):
         """Validate a Crosscat theta object.
 
-        The object should the json-deserialized version of something that would
-        be stored in the theta_json column of the bayesdb_crosscat_theta
-        column. Raises an exception when validation fails."""
+        The object should be the decoded version of something that would
+        be stored in the theta column of the bayesdb_crosscat_theta
+        table. Raises an exception when validation fails."""
         jsonschema.validate(obj, self.schema)
@@ -78,9 +78,17 @@ class StdNormalMetamodel(metamodel.IBayesDBMetamodel):
             modelno=None, num_predictions=1):
         return [[self.prng.gauss(0, 1) for _ in targets]
                 for _ in range(num_predictions)]
+    def simulate_joint_batch(self, _bdb, _generator_id, queries, modelno=None,
+            num_predictions=1):
+        return [[[self.prng.gauss(0, 1) for _ in targets]
+                 for _ in range(num_predictions)]
+                for (targets, _constraints) in queries]
     def logpdf_joint(self, _bdb, _generator_id, targets, _constraints,
             modelno=None):
         return sum(logpdf_gaussian(value, 0, 1) for (_, _, value) in targets)
+    def logpdf_joint_batch(self, _bdb, _generator_id, queries, modelno=None):
+        return [sum(logpdf_gaussian(value, 0, 1) for (_, _, value) in targets)
+                for (targets, _constraints) in queries]
     def insert(self, *args, **kwargs): pass
     def remove(self, *args, **kwargs): pass
     def infer(self, *args, **kwargs): pass
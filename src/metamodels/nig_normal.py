@@ -224,6 +224,23 @@ class NIGNormalMetamodel(metamodel.IBayesDBMetamodel):
                      for (_, colno) in targets]
                     for _ in range(num_predictions)]
 
+    def simulate_joint_batch(self, bdb, generator_id, queries, modelno=None,
+                             num_predictions=1):
+        # Note: Draws from the prng in the same order as simulate_joint
+        # would for each query in turn, but reads the models only once.
+        with bdb.savepoint():
+            if modelno is None:
+                modelnos = self._modelnos(bdb, generator_id)
+            (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+            results = []
+            for (targets, _constraints) in queries:
+                m = self.prng.choice(modelnos) if modelno is None else modelno
+                (mus, sigmas) = (all_mus[m], all_sigmas[m])
+                results.append([[self.prng.gauss(mus[colno], sigmas[colno])
+                                 for (_, colno) in targets]
+                                for _ in range(num_predictions)])
+            return results
+
     def _model_mus_sigmas(self, bdb, generator_id, modelno):
         # TODO Filter in the database by the columns I will actually use?
         # TODO Cache the results using bdb.cache?
@@ -253,6 +270,16 @@ class NIGNormalMetamodel(metamodel.IBayesDBMetamodel):
         modelwise = [model_log_pdf(m) for m in sorted(all_mus.keys())]
         return logmeanexp(modelwise)
 
+    def logpdf_joint_batch(self, bdb, generator_id, queries, modelno=None):
+        (all_mus, all_sigmas) = self._all_mus_sigmas(bdb, generator_id)
+        modelnos = sorted(all_mus.keys())
+        def model_log_pdf(modelno, targets):
+            return sum(logpdf_gaussian(value, all_mus[modelno][colno],
+                           all_sigmas[modelno][colno])
+                       for (_, colno, value) in targets)
+        return [logmeanexp([model_log_pdf(m, targets) for m in modelnos])
+                for (targets, _constraints) in queries]
+
     def _all_mus_sigmas(self, bdb, generator_id):
         params_sql = '''
             SELECT colno, modelno, mu, sigma FROM bayesdb_nig_normal_model
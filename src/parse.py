@@ -224,6 +224,16 @@ class BQLSemantics(object):
             ckpt_iterations, ckpt_seconds, wait)
     def p_command_drop_models(self, models, generator):
         return ast.DropModels(generator, models)
+    def p_command_show_analyses(self, generator):
+        return ast.ShowAnalyses(generator)
+    def p_command_pause_analysis(self, job):
+        return ast.PauseAnalysis(job)
+    def p_command_resume_analysis(self, job):
+        return ast.ResumeAnalysis(job)
+    def p_command_cancel_analysis(self, job):
+        return ast.CancelAnalysis(job)
+    def p_command_explain(self, analyze, query):
+        return ast.Explain(analyze, query)
 
     def p_temp_opt_none(self):                  return False
     def p_temp_opt_some(self):                  return True
@@ -252,6 +262,12 @@ class BQLSemantics(object):
     def p_wait_opt_none(self):                  return False
     def p_wait_opt_some(self):                  return True
 
+    def p_explain_analyze_opt_none(self):       return False
+    def p_explain_analyze_opt_some(self):       return True
+
+    def p_anfor_opt_none(self):                 return None
+    def p_anfor_opt_some(self, generator):      return generator
+
     def p_simulate_s(self, cols, generator, modelno, constraints, lim):
         return ast.Simulate(cols, generator, modelno, constraints, lim.limit)
     def p_simulate_nolimit(self, cols, generator, modelno, constraints):
@@ -32,6 +32,8 @@ grep -o 'K_[A-Z0-9_]*' < grammar.y | sort -u | awk '
 keywords = {
     "all": grammar.K_ALL,
     "alter": grammar.K_ALTER,
+    "analyses": grammar.K_ANALYSES,
+    "analysis": grammar.K_ANALYSIS,
     "analyze": grammar.K_ANALYZE,
     "and": grammar.K_AND,
     "as": grammar.K_AS,
@@ -40,6 +42,7 @@ keywords = {
     "between": grammar.K_BETWEEN,
     "btable": grammar.K_BTABLE,
     "by": grammar.K_BY,
+    "cancel": grammar.K_CANCEL,
     "case": grammar.K_CASE,
     "cast": grammar.K_CAST,
     "checkpoint": grammar.K_CHECKPOINT,
@@ -61,6 +64,7 @@ keywords = {
     "escape": grammar.K_ESCAPE,
     "estimate": grammar.K_ESTIMATE,
     "exists": grammar.K_EXISTS,
+    "explain": grammar.K_EXPLAIN,
     "explicit": grammar.K_EXPLICIT,
     "for": grammar.K_FOR,
     "from": grammar.K_FROM,
@@ -94,6 +98,7 @@ keywords = {
     "or": grammar.K_OR,
     "order": grammar.K_ORDER,
     "pairwise": grammar.K_PAIRWISE,
+    "pause": grammar.K_PAUSE,
     "predict": grammar.K_PREDICT,
     "predictive": grammar.K_PREDICTIVE,
     "probability": grammar.K_PROBABILITY,
@@ -101,6 +106,7 @@ keywords = {
     "regexp": grammar.K_REGEXP,
     "rename": grammar.K_RENAME,
     "respect": grammar.K_RESPECT,
+    "resume": grammar.K_RESUME,
     "rollback": grammar.K_ROLLBACK,
     "row": grammar.K_ROW,
     "samples": grammar.K_SAMPLES,
@@ -108,6 +114,7 @@ keywords = {
     "seconds": grammar.K_SECONDS,
     "select": grammar.K_SELECT,
     "set": grammar.K_SET,
+    "show": grammar.K_SHOW,
     "similarity": grammar.K_SIMILARITY,
     "simulate": grammar.K_SIMULATE,
     "table": grammar.K_TABLE,
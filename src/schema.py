@@ -19,7 +19,7 @@ from bayeslite.util import cursor_value
 
 APPLICATION_ID = 0x42594442
 STALE_VERSIONS = (1,)
-USABLE_VERSIONS = (5, 6, 7)
+USABLE_VERSIONS = (5, 6, 7, 8)
 
 LATEST_VERSION = USABLE_VERSIONS[-1]
 
@@ -118,6 +118,39 @@ CREATE TABLE bayesdb_session_entries (
 );
 '''
 
+bayesdb_schema_7to8 = '''
+PRAGMA user_version = 8;
+
+-- Background analysis jobs, started by ANALYZE without WAIT.
+CREATE TABLE bayesdb_analysis_job (
+	id		INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT
+				CHECK (0 < id),
+	generator_id	INTEGER NOT NULL REFERENCES bayesdb_generator(id),
+	-- JSON list of model numbers, or NULL for all models.
+	modelnos	TEXT,
+	state		TEXT NOT NULL
+				CHECK (state IN
+					('running', 'paused', 'cancelled',
+						'done', 'failed')),
+	-- Requested duration and checkpoint interval.
+	iterations	INTEGER CHECK (iterations IS NULL OR 0 < iterations),
+	seconds		INTEGER CHECK (seconds IS NULL OR 0 < seconds),
+	ckpt_iterations	INTEGER,
+	ckpt_seconds	INTEGER,
+	-- Progress as of the last checkpoint.
+	iterations_done	INTEGER NOT NULL DEFAULT 0,
+	seconds_done	REAL NOT NULL DEFAULT 0,
+	checkpoints	INTEGER NOT NULL DEFAULT 0,
+	logscore	REAL,
+	-- Timing is by the local POSIX clock.
+	start_time	REAL NOT NULL,
+	last_checkpoint	REAL,
+	end_time	REAL,
+	error		TEXT,
+	CHECK (iterations IS NOT NULL OR seconds IS NOT NULL)
+);
+'''
+
 ### BayesDB SQLite setup
 
 def bayesdb_install_schema(bdb, version=None, compatible=None):
@@ -191,6 +224,10 @@ def _upgrade_schema(bdb, current_version=None, desired_version=None):
         with bdb.transaction():
             bdb.sql_execute(bayesdb_schema_6to7)
         current_version = 7
+    if current_version == 7 and current_version < desired_version:
+        with bdb.transaction():
+            bdb.sql_execute(bayesdb_schema_7to8)
+        current_version = 8
     bdb.sql_execute('PRAGMA integrity_check')
     bdb.sql_execute('PRAGMA foreign_key_check')
 
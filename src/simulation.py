@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Bulk simulation.
+
+``CREATE TABLE <name> AS SIMULATE ...`` simulates rows a chunk at a
+time and inserts each chunk with a single prepared statement.  Each
+chunk is simulated with its own seed, derived by :func:`chunk_seed`
+from a seed drawn from the BayesDB's and the chunk number, so which
+process simulates which chunk does not affect the results, and they
+are the same for any number of worker processes.
+
+With `simulation_processes` given to :func:`~bayeslite.bayesdb_open`,
+chunks are simulated by a pool of worker processes, each with its own
+connection to the database file, while the calling process inserts
+them in order.  The workers see only committed data, and must not be
+blocked by the inserts, so this happens only for database files in
+write-ahead log journal mode, as for background analysis, and outside
+explicit transactions.  Otherwise the calling process simulates every
+chunk itself, with the same results, and says why with
+:func:`logging.info`.
+
+Progress, in rows inserted out of rows requested, is reported to the
+BQL tracer's :meth:`~bayeslite.IBayesDBTracer.progress` method after
+every chunk.
+"""
+
+import contextlib
+import logging
+import multiprocessing
+import struct
+
+import bayeslite.bqlfn as bqlfn
+
+from bayeslite.analysis import BUSY_TIMEOUT
+from bayeslite.util import cursor_value
+
+# Number of rows to simulate and insert at a time.
+CHUNK_SIZE = 10000
+
+def chunk_seed(seed, chunkno):
+    """Return a 32-byte BayesDB seed for `chunkno` in a round `seed`."""
+    return struct.pack('<QQQQ', 0, 0, seed, chunkno)
+
+def bayesdb_simulate_insert(bdb, insert_sql, generator_id, constraints,
+        colnos, modelno=None, numpredictions=1, processes=None,
+        chunksize=None):
+    """Simulate rows as by :func:`~bayeslite.bqlfn.bayesdb_simulate`
+    and insert them with `insert_sql`.
+
+    `insert_sql` is an ``INSERT`` statement with a parameter for each
+    column in `colnos`.  If `processes` is not `None`, it is the number
+    of worker processes with which to simulate, if possible.
+    """
+    if chunksize is None:
+        chunksize = CHUNK_SIZE
+    assert 0 < chunksize
+    seed = bdb.py_prng.randrange(2**64)
+    tasks = [
+        (chunk_seed(seed, chunkno), generator_id, constraints, colnos,
+            modelno, min(chunksize, numpredictions - start))
+        for chunkno, start in enumerate(xrange(0, numpredictions, chunksize))
+    ]
+    done = 0
+    with _simulator(bdb, processes) as simulate:
+        for rows in simulate(tasks):
+            bdb.sql_executemany(insert_sql, rows)
+            done += len(rows)
+            bdb.trace_progress(done, numpredictions)
+
+@contextlib.contextmanager
+def _simulator(bdb, processes):
+    # Yield a function mapping tasks to chunks of rows, in order.
+    serial = processes is None or processes == 1
+    if not serial:
+        reason = _unparallelizable(bdb)
+        if reason is not None:
+            logging.info('Simulating in one process, not %d: %s',
+                processes, reason)
+            serial = True
+    if serial:
+        yield lambda tasks: (_simulate_chunk(bdb, task) for task in tasks)
+        return
+    bdb._sqlite3.setbusytimeout(BUSY_TIMEOUT)
+    pool = multiprocessing.Pool(processes, initializer=_worker_init,
+        initargs=(bdb.pathname, bdb.metamodels.values()))
+    try:
+        yield lambda tasks: pool.imap(_worker_simulate, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _unparallelizable(bdb):
+    # Return why worker processes cannot simulate for bdb, or None if
+    # they can.
+    if bdb.pathname == ':memory:':
+        return 'the database is in memory'
+    # Within the caller's savepoint, but not in an explicit transaction
+    # whose uncommitted changes the workers could not see.
+    if 1 < bdb.txn_depth:
+        return 'in a transaction'
+    mode = cursor_value(bdb._sqlite3.cursor().execute('PRAGMA journal_mode'))
+    if mode != 'wal':
+        return 'the database is in %s journal mode, not wal' % (mode,)
+    return None
+
+def _simulate_chunk(bdb, task):
+    seed, generator_id, constraints, colnos, modelno, n = task
+    with bdb.savepoint():
+        with bdb.seeded(seed):
+            return bqlfn.bayesdb_simulate(bdb, generator_id, constraints,
+                colnos, modelno=modelno, numpredictions=n)
+
+# Per-process worker connection, set up by the pool's initializer.
+_worker_bdb = None
+
+def _worker_init(pathname, metamodels):
+    # Imported here because bayeslite.bayesdb imports bayeslite.bql,
+    # which imports us.
+    from bayeslite.bayesdb import bayesdb_open
+    from bayeslite.metamodel import bayesdb_register_metamodel
+    global _worker_bdb
+    _worker_bdb = bayesdb_open(pathname=pathname, builtin_metamodels=False,
+        compatible=True)
+    _worker_bdb._sqlite3.setbusytimeout(BUSY_TIMEOUT)
+    for metamodel in metamodels:
+        bayesdb_register_metamodel(_worker_bdb, metamodel)
+
+def _worker_simulate(task):
+    return _simulate_chunk(_worker_bdb, task)
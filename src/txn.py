@@ -20,6 +20,7 @@ from bayeslite.exception import BayesDBException
 from bayeslite.sqlite3_util import sqlite3_savepoint
 from bayeslite.sqlite3_util import sqlite3_savepoint_rollback
 from bayeslite.sqlite3_util import sqlite3_transaction
+from bayeslite.util import cursor_value
 
 # XXX Can't do this simultaneously in multiple threads.  Need
 # lightweight per-thread state.
@@ -38,6 +39,11 @@ def bayesdb_savepoint(bdb):
     try:
         with sqlite3_savepoint(bdb._sqlite3):
             yield
+    except:
+        # The savepoint was rolled back, so anything cached since it
+        # began may be stale.
+        bayesdb_txn_invalidate(bdb)
+        raise
     finally:
         bayesdb_txn_pop(bdb)
 
@@ -48,6 +54,7 @@ def bayesdb_savepoint_rollback(bdb):
         with sqlite3_savepoint_rollback(bdb._sqlite3):
             yield
     finally:
+        bayesdb_txn_invalidate(bdb)
         bayesdb_txn_pop(bdb)
 
 @contextlib.contextmanager
@@ -59,6 +66,9 @@ def bayesdb_transaction(bdb):
     try:
         with sqlite3_transaction(bdb._sqlite3):
             yield
+    except:
+        bayesdb_txn_invalidate(bdb)
+        raise
     finally:
         assert bdb.txn_depth == 1
         bdb.txn_depth = 0
@@ -75,6 +85,7 @@ def bayesdb_rollback_transaction(bdb):
     if bdb.txn_depth == 0:
         raise BayesDBTxnError(bdb, 'Not in a transaction!')
     bdb.sql_execute("ROLLBACK")
+    bayesdb_txn_invalidate(bdb)
     bdb.txn_depth = 0
     bayesdb_txn_fini(bdb)
 
@@ -109,6 +120,23 @@ def bayesdb_txn_init(bdb):
     assert bdb.txn_depth == 0
     assert bdb.cache is None
     bdb.cache = {}
+    # If another connection has committed changes to the database
+    # since we last looked, nothing we cached across transactions can
+    # be trusted any more.  Query sqlite3 directly so this does not
+    # show up in SQL traces.
+    cursor = bdb._sqlite3.cursor().execute('PRAGMA data_version')
+    data_version = cursor_value(cursor)
+    if data_version != bdb.data_version:
+        bdb.persistent_cache.clear()
+        bdb.catalog_version += 1
+        bdb.data_version = data_version
+
+def bayesdb_txn_invalidate(bdb):
+    """Forget everything cached about `bdb` after a rollback."""
+    if bdb.cache is not None:
+        bdb.cache.clear()
+    bdb.persistent_cache.clear()
+    bdb.catalog_version += 1
 
 def bayesdb_txn_fini(bdb):
     assert bdb.txn_depth == 0
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import apsw
+import pytest
+import tempfile
+import time
+
+import bayeslite
+import bayeslite.analysis as analysis
+
+from bayeslite.util import cursor_value
+
+import test_core
+
+def t1(pathname):
+    return test_core.bayesdb_generator(
+        test_core.bayesdb(pathname=pathname), 't1', 't1_cc',
+        test_core.t1_schema, test_core.t1_data,
+        columns=['label CATEGORICAL', 'age NUMERICAL', 'weight NUMERICAL'])
+
+def job_record(bdb, job):
+    sql = '''
+        SELECT state, iterations_done, checkpoints, logscore
+            FROM bayesdb_analysis_job WHERE id = ?
+    '''
+    return bdb.sql_execute(sql, (job,)).fetchall()[0]
+
+def model_iterations(bdb, modelno):
+    sql = '''
+        SELECT iterations FROM bayesdb_generator_model
+            WHERE generator_id = 1 AND modelno = ?
+    '''
+    return cursor_value(bdb.sql_execute(sql, (modelno,)))
+
+def await_job(bdb, job, predicate, timeout=60):
+    deadline = time.time() + timeout
+    while not predicate(job_record(bdb, job)):
+        assert time.time() < deadline, job_record(bdb, job)
+        time.sleep(0.01)
+
+def test_background_analysis():
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with t1(f.name) as (bdb, _generator_id):
+            bdb.execute('INITIALIZE 2 MODELS FOR t1_cc')
+            job = bdb.execute('ANALYZE t1_cc FOR 3 ITERATIONS').fetchvalue()
+            assert analysis.bayesdb_analysis_wait(bdb, job, timeout=60)
+            state, iterations, checkpoints, logscore = job_record(bdb, job)
+            assert (state, iterations, checkpoints) == ('done', 3, 3)
+            assert logscore is not None
+            assert model_iterations(bdb, 0) == 3
+            assert model_iterations(bdb, 1) == 3
+            jobs = bdb.execute('SHOW ANALYSES FOR t1_cc').fetchall()
+            assert [row[0] for row in jobs] == [job]
+            with pytest.raises(bayeslite.BQLError):
+                # Already done.
+                bdb.execute('PAUSE ANALYSIS %d' % (job,))
+            with pytest.raises(bayeslite.BQLError):
+                bdb.execute('CANCEL ANALYSIS %d' % (job + 1,))
+
+            job = bdb.execute('ANALYZE t1_cc MODEL 0 FOR 100000 ITERATIONS'
+                ' CHECKPOINT 2 ITERATIONS').fetchvalue()
+            # Queries see the checkpoints as they are committed.
+            await_job(bdb, job, lambda record: 0 < record[1])
+            assert 3 < model_iterations(bdb, 0)
+            assert model_iterations(bdb, 1) == 3
+            assert bdb.execute('ESTIMATE PROBABILITY OF age = 1 BY t1_cc') \
+                .fetchvalue() is not None
+            bdb.execute('PAUSE ANALYSIS %d' % (job,))
+            await_job(bdb, job, lambda record: record[0] == 'paused')
+            iterations = model_iterations(bdb, 0)
+            assert job_record(bdb, job)[1] == iterations - 3
+            assert job_record(bdb, job)[1] % 2 == 0
+            with pytest.raises(bayeslite.BQLError):
+                bdb.execute('DROP GENERATOR t1_cc')
+            bdb.execute('RESUME ANALYSIS %d' % (job,))
+            await_job(bdb, job, lambda record: iterations - 3 < record[1])
+            bdb.execute('CANCEL ANALYSIS %d' % (job,))
+            assert analysis.bayesdb_analysis_wait(bdb, job, timeout=60)
+            assert job_record(bdb, job)[0] == 'cancelled'
+            bdb.execute('DROP GENERATOR t1_cc')
+            assert bdb.execute('SHOW ANALYSES').fetchall() == []
+
+def test_background_analysis_resume_after_close():
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with t1(f.name) as (bdb, _generator_id):
+            bdb.execute('INITIALIZE 1 MODEL FOR t1_cc')
+            job = bdb.execute('ANALYZE t1_cc FOR 100000 ITERATIONS') \
+                .fetchvalue()
+            await_job(bdb, job, lambda record: 0 < record[1])
+        with test_core.bayesdb(pathname=f.name) as bdb:
+            # Closing the BayesDB paused the job.
+            state, iterations, _checkpoints, _logscore = job_record(bdb, job)
+            assert state == 'paused'
+            assert model_iterations(bdb, 0) == iterations
+            bdb.execute('RESUME ANALYSIS %d' % (job,))
+            await_job(bdb, job, lambda record: iterations < record[1])
+            bdb.execute('CANCEL ANALYSIS %d' % (job,))
+            assert analysis.bayesdb_analysis_wait(bdb, job, timeout=60)
+            state, iterations, _checkpoints, _logscore = job_record(bdb, job)
+            assert state == 'cancelled'
+            assert model_iterations(bdb, 0) == iterations
+
+def test_background_analysis_conflicts():
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with t1(f.name) as (bdb, _generator_id):
+            bdb.execute('INITIALIZE 1 MODEL FOR t1_cc')
+            metamodel = bdb.metamodels['crosscat']
+            copies = []
+            def copy():
+                # Make the worker's copy conflict with every write.
+                other = type(metamodel).copy(metamodel)
+                def analyze_models(*_args, **_kwargs):
+                    raise apsw.BusyError('database is locked')
+                other.analyze_models = analyze_models
+                copies.append(other)
+                return other
+            backoff = analysis.BUSY_BACKOFF
+            metamodel.copy = copy
+            analysis.BUSY_BACKOFF = 0
+            try:
+                job = bdb.execute('ANALYZE t1_cc FOR 1 ITERATION') \
+                    .fetchvalue()
+                assert analysis.bayesdb_analysis_wait(bdb, job, timeout=60)
+            finally:
+                analysis.BUSY_BACKOFF = backoff
+                del metamodel.copy
+            # The worker had its own metamodel, and gave up rather than
+            # retrying forever.
+            assert len(copies) == 1
+            assert copies[0] is not metamodel
+            assert copies[0]._crosscat is not metamodel._crosscat
+            assert job_record(bdb, job)[:3] == ('failed', 0, 0)
+            sql = 'SELECT error FROM bayesdb_analysis_job WHERE id = ?'
+            error = cursor_value(bdb.sql_execute(sql, (job,)))
+            assert 'gave up after %d conflicting writes' % \
+                (analysis.BUSY_RETRIES + 1,) in error
+            assert model_iterations(bdb, 0) == 0
+
+def test_background_analysis_errors():
+    with t1(None) as (bdb, _generator_id):
+        bdb.execute('INITIALIZE 1 MODEL FOR t1_cc')
+        with pytest.raises(bayeslite.BQLError):
+            # Needs a database file for the worker to open.
+            bdb.execute('ANALYZE t1_cc FOR 1 ITERATION')
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with t1(f.name) as (bdb, _generator_id):
+            with pytest.raises(bayeslite.BQLError):
+                # No models.
+                bdb.execute('ANALYZE t1_cc FOR 1 ITERATION')
+            bdb.execute('INITIALIZE 1 MODEL FOR t1_cc')
+            with pytest.raises(bayeslite.BQLError):
+                bdb.execute('ANALYZE t1_cc MODEL 1 FOR 1 ITERATION')
+            with bdb.savepoint():
+                with pytest.raises(bayeslite.BQLError):
+                    bdb.execute('ANALYZE t1_cc FOR 1 ITERATION')
@@ -20,12 +20,15 @@ import pytest
 
 import bayeslite
 import bayeslite.ast as ast
+import bayeslite.bqlfn as bqlfn
 import bayeslite.compiler as compiler
 import bayeslite.core as core
 import bayeslite.guess as guess
 import bayeslite.parse as parse
 import bayeslite.metamodels.troll_rng as troll
 
+from bayeslite.metamodels.nig_normal import NIGNormalMetamodel
+
 import test_core
 import test_csv
 
@@ -353,22 +356,22 @@ def test_estimate_bql():
     assert bql2sql('infer explicit predict age with confidence 0.9'
             ' from t1_cc;') == \
         'SELECT bql_predict(1, NULL, 2, _rowid_, 0.9) FROM "t1";'
+    # PREDICT ... CONFIDENCE is computed for all rows in a batch while
+    # compiling, so the models must exist by then.
+    def setup(bdb):
+        bdb.execute('initialize 1 model for t1_cc')
+        bdb.execute('analyze t1_cc for 1 iteration wait')
     assert bql2sql('infer explicit rowid, age,'
-            ' predict age confidence age_conf from t1_cc') == \
-        'SELECT c0 AS "rowid", c1 AS "age",' \
-            ' bql_json_get(c2, \'value\') AS "age",' \
-            ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
-            ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, 2, _rowid_) AS c2' \
-                ' FROM "t1");'
+            ' predict age confidence age_conf from t1_cc', setup=setup) == \
+        'SELECT pv.value0 AS "rowid", pv.value1 AS "age",' \
+            ' pv.value2 AS "age", pv.value3 AS "age_conf"' \
+            ' FROM "bayesdb_temp_0" AS pv ORDER BY pv.rowno ASC;'
     assert bql2sql('infer explicit rowid, age,'
-            ' predict age as age_inf confidence age_conf from t1_cc') == \
-        'SELECT c0 AS "rowid", c1 AS "age",' \
-            ' bql_json_get(c2, \'value\') AS "age_inf",' \
-            ' bql_json_get(c2, \'confidence\') AS "age_conf"' \
-            ' FROM (SELECT "rowid" AS c0, "age" AS c1,' \
-                ' bql_predict_confidence(1, NULL, 2, _rowid_) AS c2' \
-                ' FROM "t1");'
+            ' predict age as age_inf confidence age_conf from t1_cc',
+            setup=setup) == \
+        'SELECT pv.value0 AS "rowid", pv.value1 AS "age",' \
+            ' pv.value2 AS "age_inf", pv.value3 AS "age_conf"' \
+            ' FROM "bayesdb_temp_0" AS pv ORDER BY pv.rowno ASC;'
     assert bql2sql('infer rowid, age, weight from t1_cc') \
         == \
         'SELECT "rowid" AS "rowid",' \
@@ -505,6 +508,14 @@ def test_estimate_columns_trivial():
         prefix1 + \
         ' AND ("depprob" > 0.5)' \
         ' ORDER BY "mutinf" DESC;'
+    # Mutual information with a fixed column is computed in a batch
+    # only for the columns satisfying the condition.
+    assert bql2sql('estimate *, mutual information with weight as mutinf'
+            ' from columns of t1_cc where c.colno > 1') == \
+        prefix0 + ', pv.value0 AS "mutinf"' + \
+        prefix1.replace(' WHERE', ', "bayesdb_temp_0" AS pv WHERE') + \
+        ' AND pv.colno = c.colno' \
+        ' AND ("c"."colno" > 1);'
 
 def test_estimate_pairwise_trivial():
     prefix = 'SELECT 1 AS generator_id, c0.name AS name0, c1.name AS name1, '
@@ -517,18 +528,32 @@ def test_estimate_pairwise_trivial():
     infix0 += ' AND c0.tabname = g.tabname AND c0.colno = gc0.colno'
     infix0 += ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno'
     infix += infix0
+    # Bare dependence probability and mutual information are computed
+    # for all pairs at once into a temporary table.
+    pvinfix0 = infix0.replace(' WHERE', ', "bayesdb_temp_0" AS pv WHERE')
+    pvinfix0 += ' AND pv.colno0 = c0.colno AND pv.colno1 = c1.colno'
     assert bql2sql('estimate dependence probability'
             ' from pairwise columns of t1_cc;') == \
-        prefix + \
-        'bql_column_dependence_probability(1, NULL, c0.colno, c1.colno)' + \
-        infix + ';'
+        prefix + 'pv.value0 AS value' + pvinfix0 + ';'
     assert bql2sql('estimate mutual information'
             ' from pairwise columns of t1_cc where'
             ' (probability of age = 0) > 0.5;') == \
         prefix + \
         'bql_column_mutual_information(1, NULL, c0.colno, c1.colno, NULL)' + \
-        infix + \
-        ' AND (bql_pdf_joint(1, NULL, 2, 0) > 0.5);'
+        infix + ' AND (bql_pdf_joint(1, NULL, 2, 0) > 0.5);'
+    # With a condition that needs no BQL, only the pairs satisfying it
+    # are computed in the batch.
+    assert bql2sql('estimate mutual information'
+            ' from pairwise columns of t1_cc where name0 = \'age\';') == \
+        prefix + 'pv.value0 AS value' + pvinfix0 + \
+        ' AND ("name0" = \'age\');'
+    # With a LIMIT and nothing to order by, only the first pairs are
+    # computed.
+    assert bql2sql('estimate mutual information'
+            ' from pairwise columns of t1_cc limit 2;') == \
+        prefix + \
+        'bql_column_mutual_information(1, NULL, c0.colno, c1.colno, NULL)' + \
+        infix + ' LIMIT 2;'
     with pytest.raises(bayeslite.BQLError):
         # PROBABILITY OF VALUE is 1-column.
         bql2sql('estimate correlation from pairwise columns of t1_cc where' +
@@ -619,56 +644,291 @@ def test_estimate_pairwise_trivial():
             ' from pairwise columns of t1_cc'
             ' where depprob > 0.5 order by mutinf desc') == \
         prefix + \
-        'bql_column_dependence_probability(1, NULL, c0.colno, c1.colno)' \
-        ' AS "depprob",' \
+        'pv.value0 AS "depprob",' \
         ' bql_column_mutual_information(1, NULL, c0.colno, c1.colno, NULL)' \
-        ' AS "mutinf"' + \
-        infix0 + \
+            ' AS "mutinf"' + \
+        pvinfix0 + \
         ' AND ("depprob" > 0.5)' \
         ' ORDER BY "mutinf" DESC;'
+    assert bql2sql('estimate mutual information using 42 samples'
+            ' from pairwise columns of t1_cc'
+            ' where dependence probability > 0.5'
+            ' order by mutual information desc') == \
+        prefix + \
+        'bql_column_mutual_information(1, NULL, c0.colno, c1.colno, 42)' + \
+        infix + \
+        ' AND (bql_column_dependence_probability(1, NULL, c0.colno, c1.colno)' \
+            ' > 0.5)' \
+        ' ORDER BY bql_column_mutual_information(1, NULL, c0.colno, c1.colno,' \
+            ' NULL) DESC;'
+    assert bql2sql('estimate dependence probability'
+            ' from pairwise columns of t1_cc'
+            ' where dependence probability > 0.5'
+            ' order by dependence probability desc') == \
+        prefix + 'pv.value0 AS value' + pvinfix0 + \
+        ' AND (pv.value0 > 0.5) ORDER BY pv.value0 DESC;'
 
 def test_estimate_pairwise_row():
     prefix = 'SELECT r0._rowid_ AS rowid0, r1._rowid_ AS rowid1'
     infix = ' AS value FROM "t1" AS r0, "t1" AS r1'
+    pvinfix = infix + ', "bayesdb_temp_0" AS pv' \
+        ' WHERE pv.rowid0 = r0._rowid_ AND pv.rowid1 = r1._rowid_'
     assert bql2sql('estimate similarity from pairwise t1_cc;') == \
-        prefix + ', bql_row_similarity(1, NULL, r0._rowid_, r1._rowid_)' + \
-        infix + ';'
+        prefix + ', pv.value0' + pvinfix + ';'
     assert bql2sql('estimate similarity with respect to age' +
             ' from pairwise t1_cc;') == \
-        prefix + ', bql_row_similarity(1, NULL, r0._rowid_, r1._rowid_, 2)' + \
+        prefix + ', pv.value0' + pvinfix + ';'
+    # A condition that needs BQL would need every pair up front.
+    sim = 'bql_row_similarity(1, NULL, r0._rowid_, r1._rowid_)'
+    assert bql2sql('estimate similarity from pairwise t1_cc'
+            ' where similarity > 0.5 order by similarity desc limit 3;') == \
+        prefix + ', ' + sim + infix + \
+        ' WHERE (' + sim + ' > 0.5) ORDER BY ' + sim + ' DESC LIMIT 3;'
+    assert bql2sql('estimate similarity from pairwise t1_cc'
+            ' where rowid0 = 1;') == \
+        prefix + ', pv.value0' + pvinfix + ' AND ("rowid0" = 1);'
+    assert bql2sql('estimate similarity + 0 from pairwise t1_cc;') == \
+        prefix + \
+        ', (bql_row_similarity(1, NULL, r0._rowid_, r1._rowid_) + 0)' + \
         infix + ';'
     with pytest.raises(bayeslite.BQLError):
         # PREDICT is a 1-row function.
         bql2sql('estimate predict age with confidence 0.9 from pairwise t1;')
 
+def test_similarity_batch():
+    # Bare SIMILARITY FROM PAIRWISE is computed for all pairs at once,
+    # or only for the best pairs under ORDER BY ... DESC LIMIT; it
+    # must agree with the pairwise function.
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 4 models for t1_cc')
+        bdb.execute('analyze t1_cc for 2 iterations wait')
+        def check(columns, infix):
+            batch = bdb.execute('estimate similarity ' + columns +
+                ' from pairwise t1_cc ' + infix).fetchall()
+            pairwise = bdb.execute('estimate similarity ' + columns +
+                ' + 0 from pairwise t1_cc ' + infix).fetchall()
+            assert 0 < len(batch)
+            assert len(batch) == len(pairwise)
+            if 'order by' not in infix:
+                batch.sort()
+                pairwise.sort()
+            for (r0, r1, s), (p0, p1, p) in zip(batch, pairwise):
+                assert abs(s - p) < 1e-9
+                if 'order by' not in infix:
+                    assert (r0, r1) == (p0, p1)
+            assert [] == bdb.sql_execute('SELECT name FROM sqlite_temp_master'
+                ' WHERE name LIKE \'bayesdb_temp_%\'').fetchall()
+        check('', '')
+        check('with respect to (age, weight)', '')
+        check('', 'using model 2')
+        check('', 'where rowid0 < rowid1')
+        check('', 'order by similarity desc limit 5')
+        check('', 'order by similarity desc limit 5 offset 3')
+        check('', 'where rowid0 = 2')
+        check('', 'where similarity > 0.5')
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        # Only the pairs satisfying the condition are computed.
+        nrows = bdb.execute('select count(*) from t1').fetchvalue()
+        row_similarity_batch = metamodel.row_similarity_batch
+        computed = []
+        def spy(bdb, generator_id, modelno, rowids, target_rowids, colnos):
+            computed.append(len(rowids) * len(target_rowids))
+            return row_similarity_batch(bdb, generator_id, modelno, rowids,
+                target_rowids, colnos)
+        metamodel.row_similarity_batch = spy
+        try:
+            bdb.execute('estimate similarity from pairwise t1_cc'
+                ' where rowid0 = 2').fetchall()
+        finally:
+            del metamodel.row_similarity_batch
+        assert computed == [nrows]
+        rowids = [1, 3, 5, 7]
+        colnos = core.bayesdb_generator_column_numbers(bdb, generator_id)
+        matrix = metamodel.row_similarity_batch(bdb, generator_id, None,
+            rowids, rowids, colnos)
+        top = metamodel.row_similarity_topk(bdb, generator_id, None,
+            rowids, rowids, colnos, 3)
+        assert len(top) == 3
+        values = sorted((matrix[i][j] for i in range(4) for j in range(4)),
+            reverse=True)
+        assert [s for _r0, _r1, s in top] == values[:3]
+        for rowid0, rowid1, s in top:
+            assert matrix[rowids.index(rowid0)][rowids.index(rowid1)] == s
+
+def test_predprob_topk():
+    # ORDER BY PREDICTIVE PROBABILITY ... LIMIT computes predictive
+    # probabilities only for the first rows, which must agree with
+    # computing them for every row.
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 2 models for t1_cc')
+        bdb.execute('analyze t1_cc for 2 iterations wait')
+        def check(column, infix, order):
+            topk = bdb.execute('estimate label,'
+                ' predictive probability of ' + column + ' as p'
+                ' from t1_cc ' + infix + ' order by ' + order).fetchall()
+            full = bdb.execute('estimate label,'
+                ' predictive probability of ' + column + ' + 0 as p'
+                ' from t1_cc ' + infix + ' order by ' + order).fetchall()
+            assert 0 < len(topk)
+            assert len(topk) == len(full)
+            for (_l, p), (_m, q) in zip(topk, full):
+                assert (p is None) == (q is None)
+                assert p is None or abs(p - q) < 1e-9
+            assert [] == bdb.sql_execute('SELECT name FROM sqlite_temp_master'
+                ' WHERE name LIKE \'bayesdb_temp_%\'').fetchall()
+        check('weight', '', 'p limit 5')
+        check('weight', '', 'p desc limit 5')
+        check('weight', '', 'p asc limit 3 offset 4')
+        check('weight', 'where age > 10', 'p desc limit 4')
+        check('weight', 'where p > 0', 'p limit 5')
+        check('label', '', 'p limit 5')
+        check('label', '', 'p desc limit 5')
+        check('age', 'using model 1', 'p desc limit 100')
+        check('age', '', 'predictive probability of age limit 6')
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        rowids = [rowid for (rowid,) in
+            bdb.sql_execute('select _rowid_ from t1')]
+        colno = core.bayesdb_generator_column_number(bdb, generator_id,
+            'weight')
+        probabilities = metamodel.row_column_predictive_probability_batch(
+            bdb, generator_id, None, colno, rowids)
+        for rowid, p in zip(rowids, probabilities):
+            q = bdb.execute('estimate predictive probability of weight'
+                ' from t1_cc where _rowid_ = ?', (rowid,)).fetchvalue()
+            assert (p is None) == (q is None)
+            assert p is None or abs(p - q) < 1e-9
+        top = metamodel.row_column_predictive_probability_topk(bdb,
+            generator_id, None, colno, rowids, 3, True)
+        assert [p for _rowid, p in top] == \
+            sorted((p for p in probabilities if p is not None),
+                reverse=True)[:3]
+        for rowid, p in top:
+            assert probabilities[rowids.index(rowid)] == p
+
+def test_batch_1row():
+    # On large enough tables, 1-row BQL functions are computed for all
+    # rows at once and looked up by row id; they must agree with
+    # computing them row by row.
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 2 models for t1_cc')
+        bdb.execute('analyze t1_cc for 2 iterations wait')
+        queries = [
+            'estimate rowid, predictive probability of age,'
+                ' similarity to (rowid = 2) from t1_cc',
+            'estimate rowid, similarity to (label = \'baz\')'
+                ' with respect to (age, weight) from t1_cc using model 1'
+                ' where age > 10 order by predictive probability of weight',
+            'infer explicit rowid, predictive probability of weight as p'
+                ' from t1_cc where p is not null order by p desc limit 4',
+        ]
+        scalar = [bdb.execute(query).fetchall() for query in queries]
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        calls = []
+        def spy(name):
+            method = getattr(metamodel, name)
+            def counting(*args, **kwargs):
+                calls.append(name)
+                return method(*args, **kwargs)
+            setattr(metamodel, name, counting)
+        spy('row_column_predictive_probability_batch')
+        spy('row_similarity_batch')
+        spy('logpdf_joint')
+        saved = compiler.MIN_BATCH_ROWS
+        compiler.MIN_BATCH_ROWS = 0
+        bdb.plan_cache.clear()
+        try:
+            batch = [bdb.execute(query).fetchall() for query in queries]
+        finally:
+            compiler.MIN_BATCH_ROWS = saved
+            del metamodel.row_column_predictive_probability_batch
+            del metamodel.row_similarity_batch
+            del metamodel.logpdf_joint
+        # Each query computes each of its BQL functions in one batch.
+        assert calls == [
+            'row_column_predictive_probability_batch', 'row_similarity_batch',
+            'row_similarity_batch', 'row_column_predictive_probability_batch',
+            'row_column_predictive_probability_batch',
+        ]
+        for rows, expected in zip(batch, scalar):
+            assert 0 < len(rows)
+            assert len(rows) == len(expected)
+            for row, row_expected in zip(sorted(rows), sorted(expected)):
+                assert row[0] == row_expected[0]
+                for v, w in zip(row[1:], row_expected[1:]):
+                    assert (v is None) == (w is None)
+                    assert v is None or abs(v - w) < 1e-9
+        assert [] == bdb.sql_execute('SELECT name FROM sqlite_temp_master'
+            ' WHERE name LIKE \'bayesdb_temp_%\'').fetchall()
+    # A metamodel that overrides only logpdf_joint_batch gets the
+    # batch too, through the default batch method.
+    with bayeslite.bayesdb_open(builtin_metamodels=False) as bdb:
+        metamodel = NIGNormalMetamodel(seed=1)
+        bayeslite.bayesdb_register_metamodel(bdb, metamodel)
+        bdb.sql_execute('CREATE TABLE t (x NUMERIC, y NUMERIC)')
+        for i in range(10):
+            bdb.sql_execute('INSERT INTO t (x, y) VALUES (?, ?)',
+                (i, (i - 4.5)**2))
+        bdb.execute('CREATE GENERATOR t_nig FOR t USING nig_normal'
+            ' (x NUMERICAL, y NUMERICAL)')
+        bdb.execute('INITIALIZE 2 MODELS FOR t_nig')
+        bdb.execute('ANALYZE t_nig FOR 2 ITERATIONS WAIT')
+        query = 'ESTIMATE x, PREDICTIVE PROBABILITY OF y FROM t_nig' \
+            ' WHERE x > 2'
+        expected = bdb.execute(query).fetchall()
+        calls = []
+        def spy(name):
+            method = getattr(metamodel, name)
+            def counting(*args, **kwargs):
+                calls.append(name)
+                return method(*args, **kwargs)
+            setattr(metamodel, name, counting)
+        spy('logpdf_joint_batch')
+        spy('logpdf_joint')
+        saved = compiler.MIN_BATCH_ROWS
+        compiler.MIN_BATCH_ROWS = 0
+        bdb.plan_cache.clear()
+        try:
+            rows = bdb.execute(query).fetchall()
+        finally:
+            compiler.MIN_BATCH_ROWS = saved
+            del metamodel.logpdf_joint_batch
+            del metamodel.logpdf_joint
+        assert calls == ['logpdf_joint_batch']
+        assert len(rows) == len(expected) == 7
+        for (x, p), (y, q) in zip(rows, expected):
+            assert x == y
+            assert abs(p - q) < 1e-9
+
 def test_estimate_pairwise_selected_columns():
     assert bql2sql('estimate dependence probability'
             ' from pairwise columns of t1_cc for label, age') == \
         'SELECT 1 AS generator_id, c0.name AS name0, c1.name AS name1,' \
-        ' bql_column_dependence_probability(1, NULL, c0.colno, c1.colno)' \
-            ' AS value' \
+        ' pv.value0 AS value' \
         ' FROM bayesdb_generator AS g,' \
         ' bayesdb_generator_column AS gc0, bayesdb_column AS c0,' \
-        ' bayesdb_generator_column AS gc1, bayesdb_column AS c1' \
+        ' bayesdb_generator_column AS gc1, bayesdb_column AS c1,' \
+        ' "bayesdb_temp_0" AS pv' \
         ' WHERE g.id = 1' \
         ' AND gc0.generator_id = g.id AND gc1.generator_id = g.id' \
         ' AND c0.tabname = g.tabname AND c0.colno = gc0.colno' \
         ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno' \
+        ' AND pv.colno0 = c0.colno AND pv.colno1 = c1.colno' \
         ' AND c0.colno IN (1, 2) AND c1.colno IN (1, 2);'
     assert bql2sql('estimate dependence probability'
             ' from pairwise columns of t1_cc'
             ' for (ESTIMATE * FROM COLUMNS OF t1_cc'
                 ' ORDER BY name DESC LIMIT 2)') == \
         'SELECT 1 AS generator_id, c0.name AS name0, c1.name AS name1,' \
-        ' bql_column_dependence_probability(1, NULL, c0.colno, c1.colno)' \
-            ' AS value' \
+        ' pv.value0 AS value' \
         ' FROM bayesdb_generator AS g,' \
         ' bayesdb_generator_column AS gc0, bayesdb_column AS c0,' \
-        ' bayesdb_generator_column AS gc1, bayesdb_column AS c1' \
+        ' bayesdb_generator_column AS gc1, bayesdb_column AS c1,' \
+        ' "bayesdb_temp_0" AS pv' \
         ' WHERE g.id = 1' \
         ' AND gc0.generator_id = g.id AND gc1.generator_id = g.id' \
         ' AND c0.tabname = g.tabname AND c0.colno = gc0.colno' \
         ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno' \
+        ' AND pv.colno0 = c0.colno AND pv.colno1 = c1.colno' \
         ' AND c0.colno IN (3, 1) AND c1.colno IN (3, 1);'
 
 def test_select_columns_subquery():
@@ -988,15 +1248,6 @@ def test_parametrized():
         assert sqltraced_execute('estimate similarity to (rowid = 1)'
                 ' with respect to (estimate * from columns of t_cc limit 1)'
                 ' from t_cc;') == [
-            'SELECT COUNT(*) FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
             # ESTIMATE * FROM COLUMNS OF:
             'SELECT c.name AS name'
                 ' FROM bayesdb_generator AS g,'
@@ -1005,44 +1256,22 @@ def test_parametrized():
                 ' WHERE g.id = 1 AND gc.generator_id = g.id'
                     ' AND c.tabname = g.tabname AND c.colno = gc.colno'
                 ' LIMIT 1',
-            'SELECT c.colno'
-                ' FROM bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc,'
-                    ' bayesdb_column AS c'
-                ' WHERE g.id = :generator_id AND c.name = :column_name'
-                    ' AND g.id = gc.generator_id'
-                    ' AND g.tabname = c.tabname AND gc.colno = c.colno',
             # ESTIMATE SIMILARITY TO (rowid=1):
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
             'SELECT bql_row_similarity(1, NULL, _rowid_,'
                 ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT metamodel FROM bayesdb_generator WHERE id = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
-            'SELECT theta_json FROM bayesdb_crosscat_theta'
+            'SELECT iterations FROM bayesdb_generator_model'
                 ' WHERE generator_id = ? AND modelno = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
             'SELECT sql_rowid, cc_row_id FROM bayesdb_crosscat_subsample'
                 ' WHERE generator_id = ? AND sql_rowid IN (1)',
-            'SELECT metadata_json FROM bayesdb_crosscat_metadata'
-                ' WHERE generator_id = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
         ]
         assert sqltraced_execute('estimate similarity to (rowid = 1)'
                 ' with respect to (estimate * from columns of t_cc limit ?)'
                 ' from t_cc;',
                 (1,)) == [
-            'SELECT COUNT(*) FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
-            'SELECT COUNT(*) FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
             # ESTIMATE * FROM COLUMNS OF:
             'SELECT c.name AS name'
                 ' FROM bayesdb_generator AS g,'
@@ -1051,251 +1280,68 @@ def test_parametrized():
                 ' WHERE g.id = 1 AND gc.generator_id = g.id'
                     ' AND c.tabname = g.tabname AND c.colno = gc.colno'
                 ' LIMIT ?1',
-            'SELECT c.colno'
-                ' FROM bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc,'
-                    ' bayesdb_column AS c'
-                ' WHERE g.id = :generator_id AND c.name = :column_name'
-                    ' AND g.id = gc.generator_id'
-                    ' AND g.tabname = c.tabname AND gc.colno = c.colno',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
             # ESTIMATE SIMILARITY TO (rowid=1):
             'SELECT bql_row_similarity(1, NULL, _rowid_,'
                 ' (SELECT _rowid_ FROM "t" WHERE ("rowid" = 1)), 0) FROM "t"',
-            'SELECT metamodel FROM bayesdb_generator WHERE id = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
-            'SELECT theta_json FROM bayesdb_crosscat_theta'
+            'SELECT iterations FROM bayesdb_generator_model'
                 ' WHERE generator_id = ? AND modelno = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
             'SELECT sql_rowid, cc_row_id FROM bayesdb_crosscat_subsample'
                 ' WHERE generator_id = ? AND sql_rowid IN (1)',
-            'SELECT metadata_json FROM bayesdb_crosscat_metadata'
-                ' WHERE generator_id = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
         ]
         assert sqltraced_execute('create temp table if not exists sim as'
                     ' simulate age, RANK, division'
                     " from t_cc given gender = 'F' limit 4") == [
-            'SELECT COUNT(*) FROM bayesdb_generator WHERE name = ?',
             'PRAGMA table_info("sim")',
-            'SELECT COUNT(*) FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT metamodel FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
             'PRAGMA table_info("t")',
             "SELECT CAST(4 AS INTEGER), CAST(NULL AS INTEGER), 'F'",
-            'SELECT c.colno'
-                ' FROM bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc,'
-                    ' bayesdb_column AS c'
-                ' WHERE g.id = :generator_id AND c.name = :column_name'
-                    ' AND g.id = gc.generator_id'
-                    ' AND g.tabname = c.tabname AND gc.colno = c.colno',
-            'SELECT c.colno'
-                ' FROM bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc,'
-                    ' bayesdb_column AS c'
-                ' WHERE g.id = :generator_id AND c.name = :column_name'
-                    ' AND g.id = gc.generator_id'
-                    ' AND g.tabname = c.tabname AND gc.colno = c.colno',
-            'SELECT c.colno'
-                ' FROM bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc,'
-                    ' bayesdb_column AS c'
-                ' WHERE g.id = :generator_id AND c.name = :column_name'
-                    ' AND g.id = gc.generator_id'
-                    ' AND g.tabname = c.tabname AND gc.colno = c.colno',
-            'SELECT c.colno'
-                ' FROM bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc,'
-                    ' bayesdb_column AS c'
-                ' WHERE g.id = :generator_id AND c.name = :column_name'
-                    ' AND g.id = gc.generator_id'
-                    ' AND g.tabname = c.tabname AND gc.colno = c.colno',
             'CREATE TEMP TABLE IF NOT EXISTS "sim"'
                 ' ("age" NUMERIC,"RANK" NUMERIC,"division" NUMERIC)',
-            'SELECT metamodel FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
             'SELECT MAX(_rowid_) FROM "t"',
-            'SELECT metadata_json FROM bayesdb_crosscat_metadata'
-                ' WHERE generator_id = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
-            'SELECT theta_json FROM bayesdb_crosscat_theta'
+            'SELECT iterations FROM bayesdb_generator_model'
                 ' WHERE generator_id = ? AND modelno = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
             'SELECT sql_rowid, cc_row_id FROM bayesdb_crosscat_subsample'
                 ' WHERE generator_id = ? AND sql_rowid IN (8)',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
-            'SELECT c.name, c.colno, gc.stattype'
-                ' FROM bayesdb_column AS c,'
-                    ' bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc'
-                ' WHERE g.id = ? AND c.tabname = g.tabname'
-                    ' AND c.colno = gc.colno'
-                    ' AND gc.generator_id = g.id'
-                ' ORDER BY c.colno ASC',
-            'SELECT CAST("age" AS "text"),CAST("gender" AS "text"),'
-                'CAST("salary" AS "text"),CAST("height" AS "text"),'
-                'CAST("division" AS "text"),CAST("rank" AS "text")'
-                ' FROM "t" WHERE _rowid_ IN (8) ORDER BY _rowid_ ASC',
+            'SELECT CAST(t."age" AS "text"),CAST(t."gender" AS "text"),'
+                'CAST(t."salary" AS "text"),CAST(t."height" AS "text"),'
+                'CAST(t."division" AS "text"),CAST(t."rank" AS "text")'
+                ' FROM "t" AS t WHERE _rowid_ IN (8) ORDER BY _rowid_ ASC',
             'SELECT MAX(cc_row_id) + 1 FROM bayesdb_crosscat_subsample'
                 ' WHERE generator_id = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'INSERT INTO "sim" ("age","RANK","division") VALUES (?,?,?)',
-            'INSERT INTO "sim" ("age","RANK","division") VALUES (?,?,?)',
-            'INSERT INTO "sim" ("age","RANK","division") VALUES (?,?,?)',
+        ] + [
+            # One statement for all rows, traced once for each.
             'INSERT INTO "sim" ("age","RANK","division") VALUES (?,?,?)',
-        ]
+        ] * 4
         assert sqltraced_execute('select * from (simulate age from t_cc'
                     " given gender = 'F' limit 4)") == [
             'PRAGMA table_info("bayesdb_temp_0")',
-            'SELECT id FROM bayesdb_generator WHERE name = :name' \
-                ' OR (defaultp AND tabname = :name)',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
             'PRAGMA table_info("t")',
             "SELECT CAST(4 AS INTEGER), CAST(NULL AS INTEGER), 'F'",
-            'SELECT c.colno' \
-                ' FROM bayesdb_generator AS g,' \
-                    ' bayesdb_generator_column AS gc,' \
-                    ' bayesdb_column AS c' \
-                ' WHERE g.id = :generator_id' \
-                    ' AND c.name = :column_name' \
-                    ' AND g.id = gc.generator_id' \
-                    ' AND g.tabname = c.tabname' \
-                    ' AND gc.colno = c.colno',
-            'SELECT c.colno' \
-                ' FROM bayesdb_generator AS g,' \
-                    ' bayesdb_generator_column AS gc,' \
-                    ' bayesdb_column AS c' \
-                ' WHERE g.id = :generator_id' \
-                    ' AND c.name = :column_name' \
-                    ' AND g.id = gc.generator_id' \
-                    ' AND g.tabname = c.tabname' \
-                    ' AND gc.colno = c.colno',
-            'SELECT metamodel FROM bayesdb_generator WHERE id = ?',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
+            'CREATE VIRTUAL TABLE temp."bayesdb_temp_0" USING bql_simulate',
+            'SELECT * FROM (SELECT * FROM "bayesdb_temp_0")',
+            # Rows are simulated only once the query asks for them.
             'SELECT MAX(_rowid_) FROM "t"',
-            'SELECT metadata_json FROM bayesdb_crosscat_metadata' \
-                ' WHERE generator_id = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta' \
                 ' WHERE generator_id = ?',
-            'SELECT theta_json FROM bayesdb_crosscat_theta'
+            'SELECT iterations FROM bayesdb_generator_model'
                 ' WHERE generator_id = ? AND modelno = ?',
             'SELECT modelno FROM bayesdb_crosscat_theta' \
                 ' WHERE generator_id = ?',
             'SELECT sql_rowid, cc_row_id FROM bayesdb_crosscat_subsample'
                 ' WHERE generator_id = ? AND sql_rowid IN (8)',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
-            'SELECT c.name, c.colno, gc.stattype'
-                ' FROM bayesdb_column AS c,'
-                    ' bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc'
-                ' WHERE g.id = ? AND c.tabname = g.tabname'
-                    ' AND c.colno = gc.colno'
-                    ' AND gc.generator_id = g.id'
-                ' ORDER BY c.colno ASC',
-            'SELECT CAST("age" AS "text"),CAST("gender" AS "text"),'
-                'CAST("salary" AS "text"),CAST("height" AS "text"),'
-                'CAST("division" AS "text"),CAST("rank" AS "text")'
-                ' FROM "t" WHERE _rowid_ IN (8) ORDER BY _rowid_ ASC',
+            'SELECT CAST(t."age" AS "text"),CAST(t."gender" AS "text"),'
+                'CAST(t."salary" AS "text"),CAST(t."height" AS "text"),'
+                'CAST(t."division" AS "text"),CAST(t."rank" AS "text")'
+                ' FROM "t" AS t WHERE _rowid_ IN (8) ORDER BY _rowid_ ASC',
             'SELECT MAX(cc_row_id) + 1 FROM bayesdb_crosscat_subsample'
                 ' WHERE generator_id = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT stattype FROM bayesdb_generator_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column' \
-                ' WHERE generator_id = ? AND colno = ?',
-            'CREATE TEMP TABLE "bayesdb_temp_0" ("age" NUMERIC)',
-            'INSERT INTO "bayesdb_temp_0" ("age") VALUES (?)',
-            'INSERT INTO "bayesdb_temp_0" ("age") VALUES (?)',
-            'INSERT INTO "bayesdb_temp_0" ("age") VALUES (?)',
-            'INSERT INTO "bayesdb_temp_0" ("age") VALUES (?)',
-            'SELECT * FROM (SELECT * FROM "bayesdb_temp_0")',
             'DROP TABLE "bayesdb_temp_0"',
         ]
         bdb.execute('''
@@ -1310,66 +1356,33 @@ def test_parametrized():
         ''')
         bdb.execute('initialize 1 model for tu_cc;')
         assert sqltraced_execute('analyze tu_cc for 1 iteration wait;') == [
-            'SELECT COUNT(*) FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT id FROM bayesdb_generator'
-                ' WHERE name = :name OR (defaultp AND tabname = :name)',
-            'SELECT metamodel FROM bayesdb_generator WHERE id = ?',
-            'SELECT metadata_json FROM bayesdb_crosscat_metadata'
+            # The coded data were cached by INITIALIZE.
+            'SELECT modelno, iterations FROM bayesdb_generator_model'
+                ' WHERE generator_id = ?',
+            'SELECT modelno, 1 + MAX(checkpoint)'
+                ' FROM bayesdb_crosscat_diagnostics'
+                ' WHERE generator_id = ? GROUP BY modelno',
+            'SELECT t.modelno, LENGTH(t.theta),'
+                    ' 1 + MAX(d.seq), SUM(LENGTH(d.delta))'
+                ' FROM bayesdb_crosscat_theta AS t'
+                    ' LEFT OUTER JOIN bayesdb_crosscat_theta_delta AS d'
+                        ' ON d.generator_id = t.generator_id'
+                            ' AND d.modelno = t.modelno'
+                ' WHERE t.generator_id = ?'
+                ' GROUP BY t.modelno',
+            'SELECT processes FROM bayesdb_crosscat_parallel'
+                ' WHERE generator_id = ?',
+            'SELECT target FROM bayesdb_crosscat_subsample_growth'
                 ' WHERE generator_id = ?',
-            'SELECT tabname FROM bayesdb_generator WHERE id = ?',
-            'SELECT c.name, c.colno, gc.stattype'
-                ' FROM bayesdb_column AS c,'
-                    ' bayesdb_generator AS g,'
-                    ' bayesdb_generator_column AS gc'
-                ' WHERE g.id = ?'
-                    ' AND c.tabname = g.tabname'
-                    ' AND c.colno = gc.colno'
-                    ' AND gc.generator_id = g.id'
-                ' ORDER BY c.colno ASC',
-            'SELECT CAST(t."age" AS "real"),CAST(t."gender" AS "text"),'
-                    'CAST(t."salary" AS "real"),CAST(t."height" AS "real"),'
-                    'CAST(t."division" AS "text"),CAST(t."rank" AS "text")'
-                ' FROM "t" AS t,'
-                    ' bayesdb_crosscat_subsample AS s'
-                ' WHERE s.generator_id = ? AND s.sql_rowid = t._rowid_',
-        ] + 7*[                 # one per row of table
-            # age NUMERICAL
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            # gender CATEGORICAL
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            # salary NUMERICAL
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            # height NUMERICAL
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            # division CATEGORICAL
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            # rank CATEGORICAL
-            'SELECT stattype FROM bayesdb_generator_column'
-                ' WHERE generator_id = ? AND colno = ?',
-            'SELECT cc_colno FROM bayesdb_crosscat_column'
-                ' WHERE generator_id = ? AND colno = ?',
-        ] + [
             'SELECT modelno FROM bayesdb_crosscat_theta'
                 ' WHERE generator_id = ?',
-            'SELECT theta_json FROM bayesdb_crosscat_theta'
+            'SELECT iterations FROM bayesdb_generator_model'
                 ' WHERE generator_id = ? AND modelno = ?',
             'UPDATE bayesdb_generator_model'
                 ' SET iterations = iterations + :iterations'
                 ' WHERE generator_id = :generator_id AND modelno = :modelno',
             'UPDATE bayesdb_crosscat_theta'
-                ' SET theta_json = :theta_json'
-                ' WHERE generator_id = :generator_id AND modelno = :modelno',
-            'SELECT 1 + MAX(checkpoint) FROM bayesdb_crosscat_diagnostics'
+                ' SET theta = :theta'
                 ' WHERE generator_id = :generator_id AND modelno = :modelno',
             'INSERT INTO bayesdb_crosscat_diagnostics'
                 ' (generator_id, modelno, checkpoint, logscore,'
@@ -1590,6 +1603,170 @@ def test_txn():
         # XXX To do: Make sure other effects (e.g., analysis) get
         # rolled back by ROLLBACK.
 
+def test_plan_cache():
+    with test_core.t1() as (bdb, _generator_id):
+        def sqltraced_execute(query, bindings=()):
+            sql = []
+            def trace(string, _bindings):
+                sql.append(' '.join(string.split()))
+            bdb.sql_trace(trace)
+            result = bdb.execute(query, bindings).fetchall()
+            bdb.sql_untrace(trace)
+            return sql, result
+        cache = bdb.plan_cache
+        query = 'select label from t1 where age = :age and weight > :weight'
+        plain = 'SELECT "label" FROM "t1"' \
+            ' WHERE (("age" = ?1) AND ("weight" > ?2));'
+        hits, misses = cache.hits, cache.misses
+        sql, result = sqltraced_execute(query, (12, 0))
+        assert sql[-1] == plain
+        assert (cache.hits, cache.misses) == (hits, misses + 1)
+        # Reused with new bindings, without consulting the catalog.
+        sql, result = sqltraced_execute(query, {':age': 7, ':WEIGHT': 0})
+        assert sql == [plain]
+        assert (cache.hits, cache.misses) == (hits + 1, misses + 1)
+        assert result == bdb.sql_execute('SELECT label FROM t1'
+            ' WHERE age = 7 AND weight > 0').fetchall()
+        # Wrong bindings are still caught.
+        with pytest.raises(ValueError):
+            bdb.execute(query, (12,))
+        # Commands changing the catalog invalidate compiled queries.
+        estimate = 'estimate probability of age = 12 from t1_cc'
+        bdb.execute('initialize 1 model for t1_cc')
+        bdb.execute(estimate).fetchall()
+        hits = cache.hits
+        bdb.execute(estimate).fetchall()
+        assert cache.hits == hits + 1
+        bdb.execute('drop models from t1_cc')
+        bdb.execute('initialize 1 model for t1_cc')
+        misses = cache.misses
+        bdb.execute(estimate).fetchall()
+        assert cache.misses == misses + 1
+        # So do changes to tables in SQL, and rollbacks.
+        bdb.execute(query, (12, 0)).fetchall()
+        misses = cache.misses
+        bdb.sql_execute('CREATE TABLE u (x)')
+        bdb.execute(query, (12, 0)).fetchall()
+        assert cache.misses == misses + 1
+        with pytest.raises(ZeroDivisionError):
+            with bdb.savepoint():
+                bdb.sql_execute('INSERT INTO u (x) VALUES (0)')
+                1 // 0
+        bdb.execute(query, (12, 0)).fetchall()
+        assert cache.misses == misses + 2
+        # Queries evaluated in part while compiling are compiled anew.
+        subquery = 'estimate similarity to (rowid = 1) with respect to' \
+            ' (estimate * from columns of t1_cc limit 1) from t1_cc'
+        bdb.execute(subquery).fetchall()
+        misses = cache.misses
+        bdb.execute(subquery).fetchall()
+        assert cache.misses == misses + 1
+        # So are queries computed row by row only because the table
+        # is small, so that they are batched once it grows.
+        small = 'estimate predictive probability of age from t1_cc'
+        bdb.execute(small).fetchall()
+        misses = cache.misses
+        sql, _result = sqltraced_execute(small)
+        assert cache.misses == misses + 1
+        assert not any('bayesdb_temp_' in s for s in sql)
+        saved = compiler.MIN_BATCH_ROWS
+        compiler.MIN_BATCH_ROWS = 0
+        try:
+            sql, _result = sqltraced_execute(small)
+        finally:
+            compiler.MIN_BATCH_ROWS = saved
+        assert cache.misses == misses + 2
+        assert any('bayesdb_temp_' in s for s in sql)
+
+def test_plan_cache_disabled():
+    with bayeslite.bayesdb_open(plan_cache_size=0) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x)')
+        bdb.sql_execute('INSERT INTO t (x) VALUES (1)')
+        for _ in range(2):
+            assert bdb.execute('select x + ? from t', (1,)).fetchall() == \
+                [(2,)]
+        assert len(bdb.plan_cache) == 0
+        assert bdb.plan_cache.hits == 0
+
+def test_bql_memo():
+    # A BQL expression computed more than once for each row, here in
+    # the WHERE clause and in the results, is computed only once.
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 2 models for t1_cc')
+        bdb.execute('analyze t1_cc for 2 iterations wait')
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        logpdf_joint = metamodel.logpdf_joint
+        calls = [0]
+        def counting_logpdf_joint(*args, **kwargs):
+            calls[0] += 1
+            return logpdf_joint(*args, **kwargs)
+        metamodel.logpdf_joint = counting_logpdf_joint
+        try:
+            results = bdb.execute('estimate predictive probability of age'
+                ' as p from t1_cc'
+                ' where predictive probability of age is not null'
+                ' order by predictive probability of age').fetchall()
+            assert calls[0] == len(results)
+            assert len(results) == \
+                bdb.execute('select count(age) from t1').fetchvalue()
+            assert results == sorted(results)
+            assert bdb.bql_memo is None
+            # Without repetition, nothing need be remembered.
+            cursor = bdb.execute('estimate predictive probability of age'
+                ' from t1_cc')
+            assert cursor.memo is None
+            cursor.fetchall()
+            # The results are the same as without the memo.
+            calls[0] = 0
+            cursor = bdb.execute('estimate predictive probability of age'
+                ' as p, predictive probability of age + 0 as q from t1_cc')
+            assert cursor.memo is not None
+            for p, q in cursor:
+                assert p == q
+                assert bdb.bql_memo is None
+            assert calls[0] == len(results)
+        finally:
+            del metamodel.logpdf_joint
+
+def test_explain():
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 2 models for t1_cc')
+        bdb.execute('analyze t1_cc for 2 iterations wait')
+        nrows = bdb.execute('select count(*) from t1').fetchvalue()
+        query = 'estimate predictive probability of age from t1_cc'
+        rows = bdb.execute('explain ' + query).fetchall()
+        assert rows[0][0] == 'sql'
+        assert 'bql_row_column_predictive_probability' in rows[0][1]
+        assert ('bql calls', 'bql_row_column_predictive_probability',
+            nrows) in rows
+        assert not any(item == 'seconds' for item, _d, _v in rows)
+        # Explaining with a temporary table leaves nothing behind.
+        rows = bdb.execute('explain estimate * from t1_cc'
+            ' order by predictive probability of age limit 3').fetchall()
+        assert 0 < len([1 for item, _d, _v in rows if item == 'winder'])
+        assert 0 < len([1 for item, _d, _v in rows if item == 'unwinder'])
+        traced = []
+        bdb.sql_trace(lambda query, bindings: traced.append(query))
+        try:
+            rows = bdb.execute('explain analyze ' + query).fetchall()
+        finally:
+            bdb.sql_untrace(bdb.sql_tracer)
+        values = {}
+        for item, detail, value in rows:
+            values[item, detail] = value
+        assert values['rows', None] == nrows
+        assert 0 <= values['metamodel seconds', None] <= \
+            values['seconds', None]
+        # The user's tracer still sees every statement counted.
+        assert 0 < values['sql statements', None] <= len(traced)
+        assert values['metamodel calls', 'crosscat.logpdf_joint'] == \
+            bdb.execute('select count(age) from t1').fetchvalue()
+        # The metamodel was never modified, and is handed out as is
+        # again.
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        assert metamodel is bdb.metamodels['crosscat']
+        assert 'logpdf_joint' not in metamodel.__dict__
+
 def test_predprob_null():
     with test_core.bayesdb() as bdb:
         bdb.sql_execute('''
@@ -1701,8 +1878,8 @@ def test_misc_errors():
             with pytest.raises(bayeslite.BQLError):
                 # t1_xc already exists as a generator.
                 bdb.execute('alter generator t1_cc rename to t1_xc')
-        with pytest.raises(NotImplementedError):
-            # Need WAIT.
+        with pytest.raises(bayeslite.BQLError):
+            # Background analysis needs a database file.
             bdb.execute('analyze t1_cc for 1 iteration')
         with bdb.savepoint():
             bdb.execute('initialize 1 model for t1_cc')
@@ -1763,6 +1940,50 @@ def test_nested_simulate():
             ' given age = (simulate age from t1_cc limit 1)'
             ' limit 1').__del__()
 
+def test_simulate_streaming():
+    # SIMULATE simulates rows a chunk at a time as they are read.
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 1 model for t1_cc')
+        bdb.execute('analyze t1_cc for 1 iteration wait')
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        simulate_joint = metamodel.simulate_joint
+        counts = []
+        def counting_simulate_joint(*args, **kwargs):
+            counts.append(kwargs['num_predictions'])
+            return simulate_joint(*args, **kwargs)
+        metamodel.simulate_joint = counting_simulate_joint
+        chunk = bqlfn._SIMULATE_CHUNK
+        bqlfn._SIMULATE_CHUNK = 2
+        try:
+            cursor = bdb.execute('simulate age, weight from t1_cc limit 5')
+            assert cursor.fetchone() is not None
+            assert counts == [2]
+            assert len(cursor.fetchall()) == 4
+            assert counts == [2, 2, 1]
+            del cursor
+            assert bdb.simulations == {}
+            assert bdb.execute('simulate age from t1_cc limit 0').fetchall() \
+                == []
+            # A query scanning a simulation more than once simulates its
+            # rows only once.
+            del counts[:]
+            rows = bdb.execute('select a.age, b.age'
+                ' from (simulate age from t1_cc limit 3) as a,'
+                ' (simulate age from t1_cc limit 3) as b').fetchall()
+            assert sorted(counts) == [1, 1, 2, 2]
+            assert len(rows) == 9
+            assert bdb.simulations == {}
+            # Compiling a simulation without running it leaves nothing
+            # behind.
+            out = compiler.Output(0, {}, ())
+            phrase = parse.parse_bql_string('simulate age from t1_cc'
+                ' limit 1')[0]
+            compiler.compile_query(bdb, phrase, out)
+            assert bdb.simulations == {}
+        finally:
+            bqlfn._SIMULATE_CHUNK = chunk
+            del metamodel.simulate_joint
+
 def test_using_models():
     def setup(bdb):
         bdb.execute('initialize 1 model for t1_cc')
@@ -1774,31 +1995,44 @@ def test_using_models():
             ' using model 42') == \
         'SELECT bql_row_column_predictive_probability(1, 42, _rowid_, 3)' \
             ' FROM "t1";'
+    # Mutual information is computed in a batch while compiling, so
+    # the model must exist by then.
     assert bql2sql('estimate *, mutual information with weight as mi'
-            ' from columns of t1_cc using model 42') == \
-        'SELECT c.name AS name,' \
-            ' bql_column_mutual_information(1, 42, 3, c.colno, NULL) AS "mi"' \
+            ' from columns of t1_cc using model 0', setup=setup) == \
+        'SELECT c.name AS name, pv.value0 AS "mi"' \
         ' FROM bayesdb_generator AS g,' \
-            ' bayesdb_generator_column AS gc, bayesdb_column AS c' \
+            ' bayesdb_generator_column AS gc, bayesdb_column AS c,' \
+            ' "bayesdb_temp_0" AS pv' \
         ' WHERE g.id = 1 AND gc.generator_id = g.id' \
-        ' AND c.tabname = g.tabname AND c.colno = gc.colno;'
+        ' AND c.tabname = g.tabname AND c.colno = gc.colno' \
+        ' AND pv.colno = c.colno;'
+    with pytest.raises(bayeslite.BQLError):
+        bql2sql('estimate *, mutual information with weight as mi'
+            ' from columns of t1_cc using model 42')
     assert bql2sql('estimate mutual information from pairwise columns of t1_cc'
-            ' using model 42') == \
+            ' using model 0', setup=setup) == \
         'SELECT 1 AS generator_id, c0.name AS name0, c1.name AS name1,' \
-            ' bql_column_mutual_information(1, 42, c0.colno, c1.colno,' \
-                ' NULL) AS value' \
+            ' pv.value0 AS value' \
         ' FROM bayesdb_generator AS g,' \
             ' bayesdb_generator_column AS gc0, bayesdb_column AS c0,' \
-            ' bayesdb_generator_column AS gc1, bayesdb_column AS c1' \
+            ' bayesdb_generator_column AS gc1, bayesdb_column AS c1,' \
+            ' "bayesdb_temp_0" AS pv' \
         ' WHERE g.id = 1' \
             ' AND gc0.generator_id = g.id AND gc1.generator_id = g.id' \
             ' AND c0.tabname = g.tabname AND c0.colno = gc0.colno' \
-            ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno;'
+            ' AND c1.tabname = g.tabname AND c1.colno = gc1.colno' \
+            ' AND pv.colno0 = c0.colno AND pv.colno1 = c1.colno;'
+    with pytest.raises(bayeslite.BQLError):
+        bql2sql('estimate mutual information'
+            ' from pairwise columns of t1_cc using model 42')
     assert bql2sql('estimate similarity from pairwise t1_cc'
-            ' using model 42') == \
+            ' using model 0', setup=setup) == \
         'SELECT r0._rowid_ AS rowid0, r1._rowid_ AS rowid1,' \
-            ' bql_row_similarity(1, 42, r0._rowid_, r1._rowid_) AS value' \
-        ' FROM "t1" AS r0, "t1" AS r1;'
+            ' pv.value0 AS value' \
+        ' FROM "t1" AS r0, "t1" AS r1, "bayesdb_temp_0" AS pv' \
+        ' WHERE pv.rowid0 = r0._rowid_ AND pv.rowid1 = r1._rowid_;'
+    with pytest.raises(bayeslite.BQLError):
+        bql2sql('estimate similarity from pairwise t1_cc using model 42')
     assert bql2sql('infer id, age, weight from t1_cc using model 42') == \
         'SELECT "id" AS "id",' \
             ' "IFNULL"("age", bql_predict(1, 42, 2, _rowid_, 0)) AS "age",' \
@@ -1845,6 +2079,37 @@ def test_infer_confidence__ci_slow():
             ' age, predict age as age_inf confidence age_conf'
             ' from t1_cc').fetchall()
 
+def test_infer_predict_batch():
+    # INFER EXPLICIT PREDICT predicts all the rows in one batch.
+    with test_core.t1() as (bdb, generator_id):
+        bdb.execute('initialize 2 models for t1_cc')
+        bdb.execute('analyze t1_cc for 1 iteration wait')
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        batches = []
+        predict_confidence_batch = metamodel.predict_confidence_batch
+        def spy(bdb, generator_id, modelno, colno, rowids, **kwargs):
+            batches.append((colno, rowids))
+            return predict_confidence_batch(bdb, generator_id, modelno,
+                colno, rowids, **kwargs)
+        metamodel.predict_confidence_batch = spy
+        try:
+            results = bdb.execute('infer explicit rowid, label,'
+                ' predict age as age_inf confidence age_conf,'
+                ' predict label confidence label_conf'
+                ' from t1_cc where rowid > 2 order by rowid limit 5'
+                ).fetchall()
+        finally:
+            del metamodel.predict_confidence_batch
+        assert batches == [(2, [3, 4, 5, 6, 7]), (1, [3, 4, 5, 6, 7])]
+        assert [row[0] for row in results] == [3, 4, 5, 6, 7]
+        for _rowid, _label, age, age_conf, label, label_conf in results:
+            assert isinstance(age, float)
+            assert 0 <= age_conf <= 1
+            assert isinstance(label, unicode)
+            assert 0 <= label_conf <= 1
+        assert [] == bdb.sql_execute('SELECT name FROM sqlite_temp_master'
+            ' WHERE name LIKE \'bayesdb_temp_%\'').fetchall()
+
 def test_infer_as_estimate():
     with test_core.t1() as (bdb, _generator_id):
         bdb.execute('initialize 1 model for t1_cc')
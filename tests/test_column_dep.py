@@ -187,3 +187,116 @@ def test_impossible_nontransitive_dependency():
         # the CrossCat exception hierarchy.
         with pytest.raises(RuntimeError):
             bdb.execute('INITIALIZE 10 MODELS FOR bar')
+
+def test_dependence_probability_matrix():
+    # Bare DEPENDENCE PROBABILITY FROM PAIRWISE COLUMNS is computed for
+    # all pairs at once; it must agree with the pairwise function.
+    with bayeslite.bayesdb_open(builtin_metamodels=False) as bdb:
+        cc = crosscat.LocalEngine.LocalEngine(seed=0)
+        ccme = CrosscatMetamodel(cc)
+        bayeslite.bayesdb_register_metamodel(bdb, ccme)
+        bdb.sql_execute('CREATE TABLE foo(id,a,b,c,d)')
+        for i in xrange(20):
+            bdb.sql_execute('INSERT INTO foo VALUES(?,?,?,?,?)',
+                (i, i % 3, i % 2, float(i)/7, float(i*i)/11))
+        bdb.execute('''
+            CREATE GENERATOR bar FOR foo USING crosscat(
+                GUESS(*),
+                id IGNORE,
+                a CATEGORICAL,
+                b CATEGORICAL,
+                c NUMERICAL,
+                d NUMERICAL
+            )
+        ''')
+        def check(infix):
+            matrix = bdb.execute('ESTIMATE DEPENDENCE PROBABILITY'
+                ' FROM PAIRWISE COLUMNS OF bar ' + infix).fetchall()
+            # Not a bare dependence probability, so computed per pair.
+            pairwise = bdb.execute('ESTIMATE DEPENDENCE PROBABILITY + 0'
+                ' FROM PAIRWISE COLUMNS OF bar ' + infix).fetchall()
+            assert 0 < len(matrix)
+            assert len(matrix) == len(pairwise)
+            if 'ORDER BY' not in infix:
+                matrix.sort(key=lambda row: row[1:3])
+                pairwise.sort(key=lambda row: row[1:3])
+            for (_g, a0, b0, dp0), (_g, a1, b1, dp1) in zip(matrix, pairwise):
+                assert (a0, b0) == (a1, b1)
+                assert dp0 == dp1 or (dp0 is None and dp1 is None)
+            assert [] == bdb.sql_execute('SELECT name FROM sqlite_temp_master'
+                ' WHERE name LIKE \'bayesdb_temp_%\'').fetchall()
+        check('')
+        bdb.execute('INITIALIZE 4 MODELS FOR bar')
+        bdb.execute('ANALYZE bar FOR 2 ITERATIONS WAIT')
+        check('')
+        check('USING MODEL 1')
+        check('FOR b, d, a')
+        check('WHERE name0 < name1 ORDER BY name0, name1')
+        # Duplicates are harmless.
+        matrix = ccme.column_dependence_probability_matrix(bdb, 1, None,
+            [2, 4, 2])
+        assert [row[0] for row in matrix] == [row[2] for row in matrix]
+        assert matrix[0][2] == matrix[2][0] == 1
+
+def test_mutual_information_batch():
+    # Mutual information FROM PAIRWISE COLUMNS, or with a fixed column
+    # FROM COLUMNS, asks Crosscat once about each unordered pair.
+    with bayeslite.bayesdb_open(builtin_metamodels=False) as bdb:
+        cc = crosscat.LocalEngine.LocalEngine(seed=0)
+        ccme = CrosscatMetamodel(cc)
+        bayeslite.bayesdb_register_metamodel(bdb, ccme)
+        bdb.sql_execute('CREATE TABLE foo(id,a,b,c)')
+        for i in xrange(20):
+            bdb.sql_execute('INSERT INTO foo VALUES(?,?,?,?)',
+                (i, i % 3, i % 2, float(i)/7))
+        bdb.execute('''
+            CREATE GENERATOR bar FOR foo USING crosscat(
+                GUESS(*),
+                id IGNORE,
+                a CATEGORICAL,
+                b CATEGORICAL,
+                c NUMERICAL
+            )
+        ''')
+        bdb.execute('INITIALIZE 2 MODELS FOR bar')
+        queries = []
+        mutual_information = cc.mutual_information
+        def spy(**kwargs):
+            queries.append(kwargs['Q'])
+            return mutual_information(**kwargs)
+        cc.mutual_information = spy
+        results = bdb.execute('ESTIMATE MUTUAL INFORMATION USING 10 SAMPLES'
+            ' FROM PAIRWISE COLUMNS OF bar').fetchall()
+        assert len(queries) == 1
+        assert sorted(queries[0]) == \
+            [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+        assert len(results) == 9
+        mi = dict(((name0, name1), value)
+            for _g, name0, name1, value in results)
+        for (name0, name1), value in mi.iteritems():
+            assert value == mi[name1, name0]
+        del queries[:]
+        results = bdb.execute('ESTIMATE *,'
+            ' MUTUAL INFORMATION WITH a USING 10 SAMPLES'
+            ' FROM COLUMNS OF bar ORDER BY name').fetchall()
+        assert len(queries) == 1
+        assert sorted(queries[0]) == [(0, 0), (0, 1), (0, 2)]
+        assert [name for name, _value in results] == ['a', 'b', 'c']
+        # Categorical pairs are computed exactly, so they must agree.
+        assert results[1][1] == mi['a', 'b']
+        # Only the pairs satisfying a condition are computed.
+        del queries[:]
+        results = bdb.execute('ESTIMATE MUTUAL INFORMATION USING 10 SAMPLES'
+            ' FROM PAIRWISE COLUMNS OF bar WHERE name0 = \'a\'').fetchall()
+        assert len(queries) == 1
+        assert sorted(queries[0]) == [(0, 0), (0, 1), (0, 2)]
+        assert len(results) == 3
+        del queries[:]
+        results = bdb.execute('ESTIMATE *,'
+            ' MUTUAL INFORMATION WITH a USING 10 SAMPLES'
+            ' FROM COLUMNS OF bar WHERE c.name <> \'c\'').fetchall()
+        assert len(queries) == 1
+        assert sorted(queries[0]) == [(0, 0), (0, 1)]
+        assert sorted(name for name, _value in results) == ['a', 'b']
+        assert [] == bdb.sql_execute('SELECT name FROM sqlite_temp_master'
+            ' WHERE name LIKE \'bayesdb_temp_%\'').fetchall()
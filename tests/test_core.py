@@ -17,6 +17,9 @@
 import apsw
 import contextlib
 import itertools
+import json
+import math
+import numpy
 import pytest
 import tempfile
 
@@ -29,6 +32,8 @@ import bayeslite.core as core
 from bayeslite.metamodels.crosscat import CrosscatMetamodel
 import bayeslite.guess as guess
 import bayeslite.metamodel as metamodel
+import bayeslite.metamodels.crosscat_parallel as crosscat_parallel
+import bayeslite.metamodels.crosscat_theta_codec as crosscat_theta_codec
 
 from bayeslite import bql_quote_name
 from bayeslite.sqlite3_util import sqlite3_connection
@@ -526,6 +531,49 @@ def test_insert():
         row = (41, 'F', 96000, 73, 'data science', 2)
         bqlfn.bayesdb_insert(bdb, generator_id, row)
 
+def test_crosscat_data_cache():
+    from bayeslite.metamodels.crosscat import crosscat_codes_equal
+    mm = CrosscatMetamodel(local_crosscat(), verify=True)
+    with bayesdb(metamodel=mm) as bdb:
+        t1_schema(bdb)
+        t1_data(bdb)
+        bdb.execute('''
+            CREATE GENERATOR t1_cc FOR t1 USING crosscat(
+                label CATEGORICAL,
+                age NUMERICAL,
+                weight NUMERICAL
+            )
+        ''')
+        gid = core.bayesdb_get_generator(bdb, 't1_cc')
+        bdb.execute('INITIALIZE 2 MODELS FOR t1_cc')
+        M_c = mm._crosscat_metadata(bdb, gid)
+        T = mm._crosscat_data(bdb, gid, M_c)
+        assert T.shape == (len(t1_rows), 3)
+        assert mm._crosscat_data(bdb, gid, M_c) is T
+        with pytest.raises(ValueError):
+            T[0, 0] = 0
+        # Writing to the table through SQL invalidates the cache.
+        bdb.sql_execute('UPDATE t1 SET age = 42 WHERE age = 12')
+        T1 = mm._crosscat_data(bdb, gid, M_c)
+        assert T1 is not T
+        assert T1[0, 1] == 42
+        assert mm._crosscat_data(bdb, gid, M_c) is T1
+        # Inserting through the generator appends to the cache, and
+        # the new rows join the models' data.
+        bqlfn.bayesdb_insert(bdb, gid, (None, 'baz', 7, 14))
+        T2 = mm._crosscat_data(bdb, gid, M_c)
+        assert T2.shape == (len(t1_rows) + 1, 3)
+        assert crosscat_codes_equal(T2[:-1], T1)
+        assert T2[-1, 1:].tolist() == [7, 14]
+        assert mm._crosscat_data(bdb, gid, M_c) is T2
+        bdb.execute('ANALYZE t1_cc FOR 1 ITERATION WAIT')
+        # Rolling back forgets the cache.
+        with pytest.raises(apsw.SQLError):
+            with bdb.savepoint():
+                bqlfn.bayesdb_insert(bdb, gid, (None, 'baz', 8, 16))
+                bdb.sql_execute('SELECT * FROM nonexistent_table')
+        assert mm._crosscat_data(bdb, gid, M_c).shape == T2.shape
+
 def bayesdb_generator_cell_value(bdb, generator_id, colno, rowid):
     table_name = core.bayesdb_generator_table(bdb, generator_id)
     qt = bql_quote_name(table_name)
@@ -587,6 +635,61 @@ def test_crosscat_constraints():
         bdb.execute('SIMULATE weight FROM t1_cc GIVEN age = 8 LIMIT 1').next()
         assert engine._last_Y == [(28, 1, 8)]
 
+def test_crosscat_column_maps():
+    from bayeslite.metamodels.crosscat import CC_CATEGORICAL
+    from bayeslite.metamodels.crosscat import CC_NUMERICAL
+    from bayeslite.metamodels.crosscat import crosscat_codes_equal
+    mm = CrosscatMetamodel(crosscat.LocalEngine.LocalEngine(seed=0))
+    with bayesdb(metamodel=mm) as bdb:
+        t1_schema(bdb)
+        t1_data(bdb)
+        bdb.execute('''
+            CREATE GENERATOR t1_cc FOR t1 USING crosscat(
+                label CATEGORICAL,
+                weight NUMERICAL
+            )
+        ''')
+        gid = core.bayesdb_get_generator(bdb, 't1_cc')
+        columns = mm._crosscat_columns(bdb, gid)
+        assert columns is mm._crosscat_columns(bdb, gid)
+        assert columns.colnos == [1, 3]
+        assert columns.names == ['label', 'weight']
+        assert columns.stattypes == ['categorical', 'numerical']
+        assert columns.kinds == [CC_CATEGORICAL, CC_NUMERICAL]
+        assert columns.affinities == ['text', 'real']
+        assert columns.cc_colno(bdb, 3) == 1
+        with pytest.raises(bayeslite.BQLError):
+            columns.cc_colno(bdb, 2)
+        code = columns.value_to_code(bdb, 1, 'baz')
+        assert columns.code_to_value(bdb, 1, code) == 'baz'
+        assert math.isnan(columns.value_to_code(bdb, 1, None))
+        assert columns.code_to_value(bdb, 1, float('NaN')) is None
+        with pytest.raises(KeyError):
+            columns.value_to_code(bdb, 1, 'quagga')
+        codes = columns.encode([('baz', '16'), (None, 'x'), (u'foo', 2)])
+        assert codes.shape == (3, 2)
+        assert crosscat_codes_equal(codes, [
+            [code, 16.],
+            [float('NaN'), float('NaN')],
+            [columns.value_to_code(bdb, 1, 'foo'), 2.],
+        ])
+        assert columns.decode([0, 1], codes) == \
+            [['baz', 16.], [None, None], ['foo', 2.]]
+        assert columns.decode([1, 0], codes[:, ::-1]) == \
+            [[16., 'baz'], [None, None], [2., 'foo']]
+        assert columns.encode([]).shape == (0, 2)
+        with pytest.raises(KeyError):
+            columns.encode([('baz', 1), ('quagga', 2)])
+        bdb.execute('DROP GENERATOR t1_cc')
+        bdb.execute('''
+            CREATE GENERATOR t1_cc FOR t1 USING crosscat(
+                age NUMERICAL,
+                weight NUMERICAL
+            )
+        ''')
+        gid = core.bayesdb_get_generator(bdb, 't1_cc')
+        assert mm._crosscat_columns(bdb, gid).colnos == [2, 3]
+
 def test_bayesdb_generator_fresh_row_id():
     with bayesdb_generator(bayesdb(), 't1', 't1_cc', t1_schema, lambda x: 0,\
             columns=['label CATEGORICAL', 'age NUMERICAL', 'weight NUMERICAL'])\
@@ -595,3 +698,342 @@ def test_bayesdb_generator_fresh_row_id():
         t1_data(bdb)
         assert core.bayesdb_generator_fresh_row_id(bdb, generator_id) == \
             len(t1_rows) + 1
+        # Among shared rows, the row id is found once, until something
+        # is written.
+        with bqlfn.bayesdb_sharing_rows(bdb, bqlfn.bayesdb_shared_rows()):
+            traced = []
+            bdb.sql_trace(lambda sql, _bindings: traced.append(sql))
+            try:
+                for _ in range(3):
+                    assert core.bayesdb_generator_fresh_row_id(bdb,
+                        generator_id) == len(t1_rows) + 1
+            finally:
+                bdb.sql_untrace(bdb.sql_tracer)
+            assert len([sql for sql in traced if 'MAX(_rowid_)' in sql]) == 1
+            bdb.sql_execute('INSERT INTO t1 (label, age, weight)'
+                " VALUES ('foo', 1, 2)")
+            assert core.bayesdb_generator_fresh_row_id(bdb, generator_id) == \
+                len(t1_rows) + 2
+
+def test_hypothetical_row_per_query():
+    # PROBABILITY OF over many columns places the hypothetical row in
+    # the latent states once for the whole query, however its results
+    # are fetched.
+    with analyzed_bayesdb_generator(t1(), 2, 1) as (bdb, generator_id):
+        # One at a time, outside any query, nothing is shared.
+        expected = sorted(bqlfn.bql_column_value_probability(bdb,
+                generator_id, None, colno, 12)
+            for colno in core.bayesdb_generator_column_numbers(bdb,
+                generator_id))
+        bql = 'ESTIMATE PROBABILITY OF VALUE 12 FROM COLUMNS OF t1_cc'
+        def fetchall(cursor):
+            return cursor.fetchall()
+        def iterate(cursor):
+            return [row for row in cursor]
+        def fetchone(cursor):
+            return list(iter(cursor.fetchone, None))
+        for prefix, fetch in [('', fetchall), ('', iterate), ('', fetchone),
+                ('EXPLAIN ANALYZE ', iterate)]:
+            traced = []
+            bdb.sql_trace(lambda sql, _bindings: traced.append(sql))
+            try:
+                results = fetch(bdb.execute(prefix + bql))
+            finally:
+                bdb.sql_untrace(bdb.sql_tracer)
+            if prefix == '':
+                assert sorted(p for (p,) in results) == expected
+            assert len([sql for sql in traced if 'MAX(_rowid_)' in sql]) == 1
+            assert len([sql for sql in traced
+                    if 'bayesdb_crosscat_subsample' in sql]) == 1
+
+def test_crosscat_theta_cache_across_transactions():
+    with analyzed_bayesdb_generator(t1(), 2, 1) as (bdb, generator_id):
+        bql = 'ESTIMATE DEPENDENCE PROBABILITY OF age WITH weight BY t1_cc'
+        p = bdb.execute(bql).fetchvalue()
+        lru = bdb.persistent_cache['crosscat']
+        hits = lru.hits
+        # A second top-level query reuses the parsed thetas.
+        assert bdb.execute(bql).fetchvalue() == p
+        assert hits < lru.hits
+        assert (generator_id, 0, 1) in lru
+        assert (generator_id, 1, 1) in lru
+        # Analysis supersedes the cached thetas.
+        bdb.execute('ANALYZE t1_cc MODEL 0 FOR 1 ITERATION WAIT')
+        assert (generator_id, 0, 1) not in lru
+        assert (generator_id, 0, 2) in lru
+        # Rollback forgets everything.
+        with bdb.savepoint_rollback():
+            bdb.execute('ANALYZE t1_cc MODEL 1 FOR 1 ITERATION WAIT')
+        assert len(bdb.persistent_cache) == 0
+        assert bdb.execute(bql).fetchvalue() is not None
+        lru = bdb.persistent_cache['crosscat']
+        assert (generator_id, 1, 1) in lru
+        assert (generator_id, 1, 2) not in lru
+        # Dropping models forgets them too.
+        bdb.execute('DROP MODEL 1 FROM t1_cc')
+        assert (generator_id, 1, 1) not in lru
+
+def materialize_theta(theta_blob):
+    theta = crosscat_theta_codec.decode(theta_blob)
+    theta['X_L']
+    theta['X_D']
+    return dict(theta)
+
+def test_crosscat_parallel_analysis():
+    columns = ['label CATEGORICAL', 'age NUMERICAL', 'weight NUMERICAL']
+    def analyze(directives, **kwargs):
+        with analyzed_bayesdb_generator(
+                bayesdb_generator(bayesdb(**kwargs), 't1', 't1_cc',
+                    t1_schema, t1_data, columns=columns + directives),
+                3, 2) as (bdb, _generator_id):
+            sql = 'SELECT modelno, theta FROM bayesdb_crosscat_theta' \
+                ' ORDER BY modelno'
+            thetas = [(modelno, materialize_theta(theta))
+                for modelno, theta in bdb.sql_execute(sql)]
+            sql = 'SELECT modelno, checkpoint, logscore, iterations' \
+                ' FROM bayesdb_crosscat_diagnostics' \
+                ' ORDER BY modelno, checkpoint'
+            return thetas, bdb.sql_execute(sql).fetchall()
+    # Results do not depend on the number of worker processes.
+    parallel = analyze(['PARALLEL(1)'])
+    assert len(parallel[0]) == 3
+    assert analyze(['PARALLEL(3)']) == parallel
+    assert analyze([], analysis_processes=2) == parallel
+    assert analyze(['PARALLEL(2)'], analysis_processes=1) == parallel
+    # PARALLEL(OFF) overrides the BayesDB-wide setting.
+    assert analyze(['PARALLEL(OFF)'], analysis_processes=2) == analyze([])
+    with pytest.raises(ValueError):
+        with bayesdb(analysis_processes=0):
+            pass
+
+def test_crosscat_parallel_engine():
+    # Workers use the configured engine class, each with its own seed.
+    seeds = []
+    class Engine(object):
+        def __init__(self, seed=None):
+            seeds.append(seed)
+    pool = crosscat_parallel.AnalysisPool(1, Engine, 42, None, None)
+    pool.close()
+    assert seeds == [crosscat_parallel.worker_seed(42, 0)]
+    assert crosscat_parallel.worker_seed(42, 0) != \
+        crosscat_parallel.worker_seed(42, 1)
+    assert crosscat_parallel.worker_seed(42, 0) != \
+        crosscat_parallel.model_seed(42, 0)
+
+def test_crosscat_checkpoints():
+    # Each checkpoint writes all models with one statement per table,
+    # traced once for each model, and numbers the diagnostics
+    # consecutively across ANALYZEs.
+    with bayesdb_generator(bayesdb(), 't1', 't1_cc', t1_schema, t1_data,
+            columns=['label CATEGORICAL', 'age NUMERICAL',
+                'weight NUMERICAL']) as (bdb, generator_id):
+        bdb.execute('INITIALIZE 3 MODELS FOR t1_cc')
+        writes = []
+        def trace(string, bindings):
+            if string.lstrip().startswith(('UPDATE', 'INSERT')):
+                writes.append((string.split()[1], bindings['modelno']))
+        bdb.sql_trace(trace)
+        bdb.execute('ANALYZE t1_cc FOR 4 ITERATIONS'
+            ' CHECKPOINT 2 ITERATIONS WAIT')
+        bdb.sql_untrace(trace)
+        assert writes == 2*[
+            ('bayesdb_generator_model', 0),
+            ('bayesdb_generator_model', 1),
+            ('bayesdb_generator_model', 2),
+            ('bayesdb_crosscat_theta', 0),
+            ('bayesdb_crosscat_theta', 1),
+            ('bayesdb_crosscat_theta', 2),
+            ('INTO', 0),
+            ('INTO', 1),
+            ('INTO', 2),
+        ]
+        bdb.execute('ANALYZE t1_cc MODEL 1 FOR 1 ITERATION WAIT')
+        sql = 'SELECT modelno, checkpoint, iterations' \
+            ' FROM bayesdb_crosscat_diagnostics' \
+            ' ORDER BY modelno, checkpoint'
+        assert bdb.sql_execute(sql).fetchall() == [
+            (0, 0, 2), (0, 1, 4),
+            (1, 0, 2), (1, 1, 4), (1, 2, 5),
+            (2, 0, 2), (2, 1, 4),
+        ]
+        sql = 'SELECT modelno, iterations FROM bayesdb_generator_model' \
+            ' ORDER BY modelno'
+        assert bdb.sql_execute(sql).fetchall() == [(0, 4), (1, 5), (2, 4)]
+        # The cached thetas agree with the database.
+        metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+        for modelno in range(3):
+            theta = metamodel._crosscat_theta(bdb, generator_id, modelno)
+            assert theta['iterations'] == (5 if modelno == 1 else 4)
+
+def test_crosscat_checkpoint_deltas():
+    # Checkpoints written as deltas load as the same thetas as
+    # checkpoints written whole, and a zero ratio writes no deltas.
+    columns = ['label CATEGORICAL', 'age NUMERICAL', 'weight NUMERICAL']
+    def analyze(ratio):
+        metamodel = CrosscatMetamodel(local_crosscat(),
+            checkpoint_delta_ratio=ratio)
+        with bayesdb_generator(bayesdb(metamodel=metamodel), 't1', 't1_cc',
+                t1_schema, t1_data, columns=columns) as (bdb, generator_id):
+            bdb.execute('INITIALIZE 2 MODELS FOR t1_cc')
+            bdb.execute('ANALYZE t1_cc FOR 4 ITERATIONS'
+                ' CHECKPOINT 1 ITERATION WAIT')
+            ndeltas = cursor_value(bdb.sql_execute('SELECT COUNT(*)'
+                ' FROM bayesdb_crosscat_theta_delta'))
+            bdb.persistent_cache.clear()
+            thetas = [materialize_theta(crosscat_theta_codec.encode(
+                    metamodel._crosscat_theta_load(bdb, generator_id,
+                        modelno)))
+                for modelno in range(2)]
+            bdb.execute('DROP MODEL 0 FROM t1_cc')
+            assert cursor_value(bdb.sql_execute('SELECT COUNT(*)'
+                    ' FROM bayesdb_crosscat_theta_delta'
+                    ' WHERE modelno = 0')) == 0
+            return ndeltas, thetas
+    ndeltas_whole, thetas_whole = analyze(None)
+    ndeltas_none, thetas_none = analyze(0)
+    ndeltas_delta, thetas_delta = analyze(100)
+    assert ndeltas_whole == 0
+    assert ndeltas_none == 0
+    assert ndeltas_delta == 2*4
+    assert thetas_whole == thetas_none
+    assert thetas_whole == thetas_delta
+
+def test_crosscat_theta_json_upgrade():
+    with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+        with analyzed_bayesdb_generator(
+                bayesdb_generator(bayesdb(pathname=f.name), 't1', 't1_cc',
+                    t1_schema, t1_data, columns=['label CATEGORICAL',
+                        'age NUMERICAL', 'weight NUMERICAL']),
+                2, 1) as (bdb, generator_id):
+            sql = 'SELECT modelno, theta FROM bayesdb_crosscat_theta'
+            thetas = dict((modelno, materialize_theta(theta))
+                for modelno, theta in bdb.sql_execute(sql))
+            # Regress to version 6, which stored thetas as JSON and
+            # had no parallelism settings, theta deltas, or growing
+            # subsamples.
+            bdb.sql_execute('DROP TABLE bayesdb_crosscat_subsample_growth')
+            bdb.sql_execute('DROP TABLE bayesdb_crosscat_theta_delta')
+            bdb.sql_execute('DROP TABLE bayesdb_crosscat_parallel')
+            bdb.sql_execute('DROP TABLE bayesdb_crosscat_theta')
+            bdb.sql_execute('''
+                CREATE TABLE bayesdb_crosscat_theta (
+                    generator_id INTEGER NOT NULL,
+                    modelno INTEGER NOT NULL,
+                    theta_json BLOB NOT NULL,
+                    PRIMARY KEY(generator_id, modelno)
+                )
+            ''')
+            for modelno, theta in thetas.iteritems():
+                bdb.sql_execute('INSERT INTO bayesdb_crosscat_theta'
+                    ' VALUES (?, ?, ?)',
+                    (generator_id, modelno, json.dumps(theta)))
+            bdb.sql_execute("UPDATE bayesdb_metamodel SET version = 6"
+                " WHERE name = 'crosscat'")
+        with bayesdb(pathname=f.name) as bdb:
+            assert cursor_value(bdb.sql_execute('SELECT version'
+                    " FROM bayesdb_metamodel WHERE name = 'crosscat'")) == 10
+            sql = 'SELECT modelno, theta FROM bayesdb_crosscat_theta'
+            for modelno, theta in bdb.sql_execute(sql):
+                assert materialize_theta(theta) == thetas[modelno]
+            bdb.execute('ANALYZE t1_cc FOR 1 ITERATION WAIT')
+
+def test_crosscat_coding_1m_by_50__ci_slow():
+    # Coding a 1M x 50 table column by column agrees with coding it
+    # cell by cell, and decoding it, on a sample of rows.
+    from bayeslite.metamodels.crosscat import CrosscatColumns
+    from bayeslite.metamodels.crosscat import crosscat_codes_equal
+    from bayeslite.metamodels.crosscat import create_metadata_numerical
+    nrows = 1000000
+    ncols = 50
+    nsample = 10000
+    categories = [u'c%d' % (i,) for i in range(10)]
+    columns = [(colno, 'x%d' % (colno,),
+            'categorical' if colno % 2 == 0 else 'numerical')
+        for colno in range(ncols)]
+    column_metadata = []
+    for colno, _name, stattype in columns:
+        if stattype == 'categorical':
+            column_metadata.append({
+                'modeltype': 'symmetric_dirichlet_discrete',
+                'value_to_code': dict((unicode(c), v)
+                    for c, v in enumerate(categories)),
+                'code_to_value': dict((v, c)
+                    for c, v in enumerate(categories)),
+            })
+        else:
+            column_metadata.append(create_metadata_numerical(None, None,
+                colno))
+    cc_columns = CrosscatColumns(None, 1, columns, {
+        'column_metadata': column_metadata,
+    })
+    prng = numpy.random.RandomState(0)
+    values = numpy.empty((nrows, ncols), dtype=object)
+    for colno, _name, stattype in columns:
+        if stattype == 'categorical':
+            column = numpy.array(categories, dtype=object)[
+                prng.randint(len(categories), size=nrows)]
+            column[prng.randint(nrows, size=nrows//100)] = None
+        else:
+            column = prng.normal(size=nrows).astype(object)
+            column[prng.randint(nrows, size=nrows//100)] = None
+            column[prng.randint(nrows, size=nrows//100)] = u'bogus'
+        values[:, colno] = column
+    codes = cc_columns.encode(values)
+    sample = values[:nsample].tolist()
+    sample_codes = [[cc_columns.cc_value_to_code(cc_colno, value)
+            for cc_colno, value in enumerate(row)]
+        for row in sample]
+    assert crosscat_codes_equal(codes[:nsample], sample_codes)
+    decoded = cc_columns.decode(range(ncols), codes[:nsample])
+    assert decoded == [[cc_columns.cc_code_to_value(cc_colno, code)
+            for cc_colno, code in enumerate(row)]
+        for row in sample_codes]
+
+def test_catalog_mirror():
+    # Catalog lookups are answered from memory, and see every way the
+    # catalog can change.
+    with t1() as (bdb, generator_id):
+        sql = []
+        def trace(string, _bindings):
+            sql.append(string)
+        assert core.bayesdb_generator_column_names(bdb, generator_id) == \
+            ['label', 'age', 'weight']
+        bdb.sql_trace(trace)
+        assert core.bayesdb_has_generator_default(bdb, 'T1_CC')
+        assert core.bayesdb_get_generator(bdb, 't1_cc') == generator_id
+        assert core.bayesdb_generator_table(bdb, generator_id) == 't1'
+        assert core.bayesdb_generator_column_number(bdb, generator_id,
+            'WEIGHT') == 3
+        assert core.bayesdb_generator_column_name(bdb, generator_id, 2) == \
+            'age'
+        assert core.bayesdb_generator_column_stattype(bdb, generator_id,
+            1) == 'categorical'
+        assert core.bayesdb_table_column_names(bdb, 't1') == \
+            ['id', 'label', 'age', 'weight']
+        bdb.sql_untrace(trace)
+        assert sql == []
+        with pytest.raises(ValueError):
+            core.bayesdb_generator_column_stattype(bdb, generator_id, 0)
+        with pytest.raises(ValueError):
+            core.bayesdb_generator_column_number(bdb, generator_id, 'id')
+        bdb.execute('ALTER GENERATOR t1_cc RENAME TO t1_ccc')
+        assert not core.bayesdb_has_generator(bdb, 't1_cc')
+        assert core.bayesdb_generator_name(bdb, generator_id) == 't1_ccc'
+        assert not core.bayesdb_has_generator_default(bdb, 't1')
+        bdb.execute('ALTER TABLE t1 SET DEFAULT GENERATOR TO t1_ccc')
+        assert core.bayesdb_get_generator_default(bdb, 't1') == generator_id
+        bdb.sql_execute('ALTER TABLE t1 ADD COLUMN height')
+        assert core.bayesdb_table_has_column(bdb, 't1', 'height')
+        assert not core.bayesdb_generator_has_column(bdb, generator_id,
+            'height')
+        with pytest.raises(ZeroDivisionError):
+            with bdb.savepoint():
+                bdb.execute('ALTER TABLE t1 RENAME TO t2')
+                assert core.bayesdb_generator_table(bdb, generator_id) == \
+                    't2'
+                1 // 0
+        assert core.bayesdb_generator_table(bdb, generator_id) == 't1'
+        bdb.execute('DROP GENERATOR t1_ccc')
+        assert not core.bayesdb_has_generator_default(bdb, 't1')
+        with pytest.raises(ValueError):
+            core.bayesdb_generator_table(bdb, generator_id)
@@ -1,3 +1,7 @@
+import pytest
+
+from bayeslite.exception import BQLError
+
 import bayeslite.metamodels.crosscat_generator_schema as cgschema
 
 
@@ -8,7 +12,7 @@ def test_parses_a_column():
     parsed = cgschema.parse(schema, False)
     expected = cgschema.GeneratorSchema(
         guess=False, subsample=False, columns=[('x', 'NUMERICAL')],
-        dep_constraints=[])
+        dep_constraints=[], parallel=None)
     assert parsed == expected
 
 
@@ -21,7 +25,8 @@ def test_parses_dep_constraints():
     expected = cgschema.GeneratorSchema(
         guess=False, subsample=False,
         columns=[('a', 'NUMERICAL'), ('b', 'NUMERICAL'), ('c', 'NUMERICAL')],
-        dep_constraints=[(['a', 'b'], True), (['b', 'c'], False)])
+        dep_constraints=[(['a', 'b'], True), (['b', 'c'], False)],
+        parallel=None)
     assert parsed == expected
 
 
@@ -29,7 +34,8 @@ def test_parses_guess_and_subsample():
     schema = [['GUESS', ['*']], ['SUBSAMPLE', [5]]]
     parsed = cgschema.parse(schema, True)
     expected = cgschema.GeneratorSchema(
-        guess=True, subsample=5, columns=[], dep_constraints=[])
+        guess=True, subsample=5, columns=[], dep_constraints=[],
+        parallel=None)
     assert parsed == expected
 
 
@@ -37,5 +43,34 @@ def test_parses_subsample_off():
     schema = [['GUESS', ['*']], ['SUBSAMPLE', ['OFF']]]
     parsed = cgschema.parse(schema, True)
     expected = cgschema.GeneratorSchema(
-        guess=True, subsample=False, columns=[], dep_constraints=[])
+        guess=True, subsample=False, columns=[], dep_constraints=[],
+        parallel=None)
+    assert parsed == expected
+
+
+def test_parses_parallel():
+    schema = [['GUESS', ['*']], ['PARALLEL', [4]]]
+    parsed = cgschema.parse(schema, False)
+    expected = cgschema.GeneratorSchema(
+        guess=True, subsample=False, columns=[], dep_constraints=[],
+        parallel=4)
     assert parsed == expected
+
+
+def test_parses_parallel_off():
+    schema = [['GUESS', ['*']], ['PARALLEL', ['OFF']]]
+    parsed = cgschema.parse(schema, False)
+    assert parsed.parallel is False
+
+
+def test_parses_subsample_growth():
+    schema = [['GUESS', ['*']], ['SUBSAMPLE', ['GROW', 'FROM', 10, 'TO', 100]]]
+    parsed = cgschema.parse(schema, False)
+    assert parsed.subsample == (10, 100)
+    for clause in [
+            ['GROW', 'FROM', 100, 'TO', 10],
+            ['GROW', 'FROM', 0, 'TO', 10],
+            ['GROW', 'TO', 10],
+            ['SHRINK', 'FROM', 10, 'TO', 100]]:
+        with pytest.raises(BQLError):
+            cgschema.parse([['SUBSAMPLE', clause]], False)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import pytest
+
+import bayeslite.metamodels.crosscat_theta_codec as codec
+
+theta = {
+    'iterations': 3,
+    'model_config': {
+        'kernel_list': [],
+        'initialization': 'from_the_prior',
+        'row_initialization': 'from_the_prior',
+    },
+    'X_L': {
+        'column_partition': {
+            'assignments': [0, 1, 0],
+            'counts': [2, 1],
+            'hypers': {'alpha': 1.5},
+        },
+        'column_hypers': [
+            {'fixed': 0.0, 'mu': 0.5, 'nu': 1.0, 'r': 1.0, 's': 1.0},
+            {'fixed': 0.0, 'dirichlet_alpha': 1.0, 'K': 2},
+            {'fixed': 0.0, 'mu': 0.5, 'nu': 1.0, 'r': 1.0, 's': 1.0},
+        ],
+        'view_state': [
+            {
+                'column_names': ['x', 'z'],
+                'column_component_suffstats': [[{'N': 4}], [{'N': 4}]],
+                'row_partition_model': {
+                    'counts': [4],
+                    'hypers': {'alpha': 1.0},
+                },
+            },
+            {
+                'column_names': ['y'],
+                'column_component_suffstats': [[{'0': 1}, {'1': 3}]],
+                'row_partition_model': {
+                    'counts': [1, 3],
+                    'hypers': {'alpha': 2.0},
+                },
+            },
+        ],
+    },
+    'X_D': [[0, 0, 0, 0], [0, 1, 1, 1]],
+}
+
+def test_roundtrip():
+    decoded = codec.decode(codec.encode(theta))
+    assert decoded['iterations'] == 3
+    assert decoded['X_D'] == theta['X_D']
+    assert decoded['X_L'] == theta['X_L']
+    assert dict(decoded) == theta
+    # Buffers, as returned for blobs from sqlite3, work too.
+    decoded = codec.decode(buffer(codec.encode(theta)))
+    assert decoded['X_D'] == theta['X_D']
+
+def test_lazy():
+    decoded = codec.decode(codec.encode(theta))
+    assert 'X_L' not in decoded
+    assert 'X_D' not in decoded
+    assert codec.theta_column_partition(decoded) == \
+        theta['X_L']['column_partition']
+    assert 'X_L' not in decoded
+    assert 'X_D' not in decoded
+    decoded['X_L']
+    assert 'X_L' in decoded
+    assert 'X_D' not in decoded
+    assert codec.theta_column_partition(theta) == \
+        theta['X_L']['column_partition']
+
+def test_reject():
+    blob = codec.encode(theta)
+    with pytest.raises(ValueError):
+        codec.decode('XXXX' + blob[4:])
+    with pytest.raises(ValueError):
+        codec.decode(blob + '\0')
+    with pytest.raises(ValueError):
+        codec.encode(dict(theta, X_D=[[0, 0], [0]]))
+
+def test_delta():
+    theta1 = dict(theta, iterations=4, X_D=[[0, 1, 0, 0], [0, 1, 1, 1]])
+    blob = codec.encode(theta)
+    delta = codec.encode_delta(theta['X_D'], theta1)
+    assert len(delta) < len(codec.encode(theta1))
+    assert codec.apply_delta(blob, delta) == codec.encode(theta1)
+    # Buffers, as returned for blobs from sqlite3, work too.
+    decoded = codec.decode(codec.apply_delta(buffer(blob), buffer(delta)))
+    assert decoded['iterations'] == 4
+    assert decoded['X_D'] == theta1['X_D']
+    # No changes at all.
+    delta = codec.encode_delta(theta['X_D'], theta)
+    assert codec.apply_delta(blob, delta) == blob
+    # A change of shape needs a whole theta.
+    assert codec.encode_delta(theta['X_D'],
+            dict(theta, X_D=[[0, 0, 0, 0, 0], [0, 1, 1, 1, 1]])) is None
+    with pytest.raises(ValueError):
+        codec.decode(delta)
+    with pytest.raises(ValueError):
+        codec.apply_delta(delta, delta)
+    with pytest.raises(ValueError):
+        codec.apply_delta(codec.encode(dict(theta, X_D=[[0, 0], [0, 1]])),
+            delta)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from bayeslite.lrucache import LRUCache
+
+def test_lrucache_evict():
+    lru = LRUCache(10)
+    lru.put('a', 1, 4)
+    lru.put('b', 2, 4)
+    assert lru.get('a') == 1
+    # `b' is now least recently used, so it goes first.
+    lru.put('c', 3, 4)
+    assert 'b' not in lru
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert lru.size == 8
+    assert lru.get('b') is None
+    assert lru.hits == 3
+    assert lru.misses == 1
+
+def test_lrucache_oversize():
+    lru = LRUCache(10)
+    lru.put('a', 1, 4)
+    lru.put('b', 2, 11)
+    assert 'a' in lru
+    assert 'b' not in lru
+    lru.put('a', 3, 11)
+    assert 'a' not in lru
+    assert lru.size == 0
+
+def test_lrucache_discard():
+    lru = LRUCache(100)
+    for i in range(10):
+        lru.put((i % 3, i), i, 1)
+    lru.discard((0, 0))
+    assert len(lru) == 9
+    lru.discard_if(lambda key: key[0] == 1)
+    assert len(lru) == 6
+    assert lru.size == 6
+    assert (0, 3) in lru
+    assert (1, 4) not in lru
+    lru.clear()
+    assert len(lru) == 0
+    assert lru.size == 0
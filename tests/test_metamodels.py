@@ -14,6 +14,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import math
 import pytest
 import tempfile
 
@@ -22,10 +23,12 @@ import crosscat.LocalEngine
 import bayeslite
 
 import bayeslite.core as core
+import bayeslite.metamodel as metamodel
 
 from bayeslite import bql_quote_name
 from bayeslite.metamodels.crosscat import CrosscatMetamodel
 from bayeslite.metamodels.iid_gaussian import StdNormalMetamodel
+from bayeslite.metamodels.nig_normal import NIGNormalMetamodel
 
 examples = {
     'crosscat': (
@@ -195,3 +198,95 @@ def _retest_example(bdb, exname):
     bdb.execute('ANALYZE %s FOR 1 ITERATION WAIT' % (qg,))
     bdb.execute('ANALYZE %s MODEL 0 FOR 1 ITERATION WAIT' % (qg,))
     bdb.execute('ANALYZE %s MODEL 1 FOR 1 ITERATION WAIT' % (qg,))
+
+batch_examples = {
+    'crosscat': (
+        lambda: CrosscatMetamodel(crosscat.LocalEngine.LocalEngine(seed=0)),
+        'crosscat(x NUMERICAL, y NUMERICAL)',
+    ),
+    'iid_gaussian': (
+        lambda: StdNormalMetamodel(seed=0),
+        'std_normal(x NUMERICAL, y NUMERICAL)',
+    ),
+    'nig_normal': (
+        lambda: NIGNormalMetamodel(seed=0),
+        'nig_normal(x NUMERICAL, y NUMERICAL)',
+    ),
+}
+
+@pytest.mark.parametrize('exname', sorted(batch_examples.keys()))
+def test_batch_conformance(exname):
+    # The batch methods agree with the one-at-a-time methods.
+    mm, schema = batch_examples[exname]
+    with bayeslite.bayesdb_open(builtin_metamodels=False) as bdb:
+        m = mm()
+        bayeslite.bayesdb_register_metamodel(bdb, m)
+        bdb.sql_execute('CREATE TABLE t(x NUMERIC, y NUMERIC)')
+        for row in [(0, 1), (1.5, 2.5), (2, -1.2), (-1, .3), (.5, .5)]:
+            bdb.sql_execute('INSERT INTO t (x, y) VALUES (?, ?)', row)
+        bdb.execute('CREATE GENERATOR t_g FOR t USING ' + schema)
+        bdb.execute('INITIALIZE 2 MODELS FOR t_g')
+        bdb.execute('ANALYZE t_g FOR 1 ITERATION WAIT')
+        gid = core.bayesdb_get_generator(bdb, 't_g')
+        fresh = core.bayesdb_generator_fresh_row_id(bdb, gid)
+        queries = [
+            ([(1, 0, .5)], []),
+            ([(2, 0, 1.5), (2, 1, -1)], []),
+            ([(fresh, 1, .25)], [(fresh, 0, 1)]),
+            ([(3, 1, 3)], []),
+        ]
+        for modelno in (None, 1):
+            batch = m.logpdf_joint_batch(bdb, gid, queries, modelno)
+            assert len(batch) == len(queries)
+            for logp, (targets, constraints) in zip(batch, queries):
+                expected = m.logpdf_joint(bdb, gid, targets, constraints,
+                    modelno)
+                assert abs(logp - expected) < 1e-9
+        sim_queries = [([(rowid, colno) for rowid, colno, _ in targets],
+                constraints)
+            for targets, constraints in queries]
+        def simulate(simulate_batch):
+            # Same seeds for the BayesDB and the metamodel, if it has
+            # its own.
+            with bdb.seeded('\x01' * 32):
+                if hasattr(m, 'prng'):
+                    m.prng.seed(0)
+                return simulate_batch()
+        for modelno in (None, 0):
+            batch = simulate(lambda: m.simulate_joint_batch(bdb, gid,
+                sim_queries, modelno, num_predictions=3))
+            scalar = simulate(lambda: [m.simulate_joint(bdb, gid, targets,
+                    constraints, modelno, num_predictions=3)
+                for targets, constraints in sim_queries])
+            assert batch == scalar
+            assert [len(samples) for samples in batch] == [3] * len(queries)
+
+def test_select_topk():
+    values = [.3, None, .1, .7, float('nan'), .5, .2, .7, .05]
+    rowids = [10*(i + 1) for i in range(len(values))]
+    def bound(value):
+        if value is None or math.isnan(value):
+            return None
+        return (value/2, min(1, 2*value))
+    for descending in (False, True):
+        def key(i):
+            value = values[i]
+            if value is None or math.isnan(value):
+                return (0, 0, -i) if descending else (2, 0, -i)
+            return (1, value if descending else -value, -i)
+        expected = [(rowids[i], values[i])
+            for i in sorted(range(len(values)), key=key, reverse=True)]
+        for k in range(len(values) + 2):
+            for bounds in (None, [bound(value) for value in values]):
+                evaluated = []
+                def evaluate(indices):
+                    evaluated.extend(indices)
+                    return [values[i] for i in indices]
+                top = metamodel.bayesdb_select_topk(rowids, k, descending,
+                    evaluate, bounds=bounds, blocksize=2)
+                assert len(top) == min(k, len(values))
+                assert len(evaluated) == len(set(evaluated))
+                if bounds is not None and k == 1:
+                    assert len(evaluated) < len(values)
+                assert [rowid for rowid, _value in top] == \
+                    [rowid for rowid, _value in expected[:k]]
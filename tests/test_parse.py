@@ -550,6 +550,28 @@ def test_trivial_commands():
     assert parse_bql_string('analyze t for 10 seconds'
             ' checkpoint 3 seconds') == \
         [ast.AnalyzeModels('t', None, None, 10, None, 3, False)]
+    assert parse_bql_string('show analyses;') == [ast.ShowAnalyses(None)]
+    assert parse_bql_string('show analyses for t;') == \
+        [ast.ShowAnalyses('t')]
+    assert parse_bql_string('pause analysis 1;') == [ast.PauseAnalysis(1)]
+    assert parse_bql_string('resume analysis 2;') == [ast.ResumeAnalysis(2)]
+    assert parse_bql_string('cancel analysis 3;') == [ast.CancelAnalysis(3)]
+    assert parse_bql_string('explain select 0;') == \
+        [ast.Explain(False, ast.Select(ast.SELQUANT_ALL,
+            [ast.SelColExp(ast.ExpLit(ast.LitInt(0)), None)],
+            None, None, None, None, None))]
+    assert parse_bql_string('explain analyze select 0;') == \
+        [ast.Explain(True, ast.Select(ast.SELQUANT_ALL,
+            [ast.SelColExp(ast.ExpLit(ast.LitInt(0)), None)],
+            None, None, None, None, None))]
+    assert parse_bql_string('select show, pause from analysis;') == \
+        [ast.Select(ast.SELQUANT_ALL,
+            [
+                ast.SelColExp(ast.ExpCol(None, 'show'), None),
+                ast.SelColExp(ast.ExpCol(None, 'pause'), None),
+            ],
+            [ast.SelTab('analysis', None)],
+            None, None, None, None)]
     assert parse_bql_string('create temporary table tx as'
             ' infer explicit x, predict x as xi confidence xc from t_cc') == \
         [ast.CreateTabAs(True, False, 'tx',
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import contextlib
+import multiprocessing
+import pytest
+import tempfile
+
+import bayeslite
+import bayeslite.simulation as simulation
+
+import test_core
+
+def t1(pathname, **kwargs):
+    return test_core.bayesdb_generator(
+        test_core.bayesdb(pathname=pathname, **kwargs), 't1', 't1_cc',
+        test_core.t1_schema, test_core.t1_data,
+        columns=['label CATEGORICAL', 'age NUMERICAL', 'weight NUMERICAL'])
+
+@contextlib.contextmanager
+def chunksize(n):
+    saved = simulation.CHUNK_SIZE
+    simulation.CHUNK_SIZE = n
+    try:
+        yield
+    finally:
+        simulation.CHUNK_SIZE = saved
+
+@contextlib.contextmanager
+def spying_pools():
+    # Record the processes, function, and number of tasks of each
+    # pool's imap.
+    pools = []
+    Pool = multiprocessing.Pool
+    def spy(processes, *args, **kwargs):
+        pool = Pool(processes, *args, **kwargs)
+        imap = pool.imap
+        def imap_spy(function, tasks, **kwargs):
+            tasks = list(tasks)
+            pools.append((processes, function.__name__, len(tasks)))
+            return imap(function, tasks, **kwargs)
+        pool.imap = imap_spy
+        return pool
+    multiprocessing.Pool = spy
+    try:
+        yield pools
+    finally:
+        multiprocessing.Pool = Pool
+
+class ProgressTracer(bayeslite.IBayesDBTracer):
+    def __init__(self):
+        self.progress_reports = []
+    def progress(self, qid, done, total):
+        self.progress_reports.append((done, total))
+
+def simulate_table(bdb):
+    bdb.execute('INITIALIZE 2 MODELS FOR t1_cc')
+    bdb.execute('ANALYZE t1_cc FOR 1 ITERATION WAIT')
+    bdb.execute('CREATE TABLE s AS SIMULATE label, age, weight FROM t1_cc'
+        ' LIMIT 7')
+    return bdb.execute('SELECT * FROM s ORDER BY _rowid_').fetchall()
+
+def test_simulate_chunks():
+    with chunksize(3):
+        with t1(None) as (bdb, _generator_id):
+            tracer = ProgressTracer()
+            bdb.trace(tracer)
+            rows = simulate_table(bdb)
+            bdb.untrace(tracer)
+            assert len(rows) == 7
+            assert tracer.progress_reports == [(3, 7), (6, 7), (7, 7)]
+            bdb.execute('CREATE TABLE s0 AS SIMULATE age FROM t1_cc LIMIT 0')
+            assert bdb.execute('SELECT COUNT(*) FROM s0').fetchvalue() == 0
+        # The same seed gives the same rows.
+        with t1(None) as (bdb, _generator_id):
+            assert simulate_table(bdb) == rows
+    with chunksize(2):
+        with t1(None) as (bdb, _generator_id):
+            assert len(simulate_table(bdb)) == 7
+
+def test_simulate_parallel():
+    with chunksize(3):
+        with t1(None) as (bdb, _generator_id):
+            rows = simulate_table(bdb)
+        with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+            with t1(f.name, simulation_processes=2) as (bdb, _generator_id):
+                bdb.sql_execute('PRAGMA journal_mode = WAL')
+                with spying_pools() as pools:
+                    assert simulate_table(bdb) == rows
+                assert pools == [(2, '_worker_simulate', 3)]
+        # Workers could not see an in-memory database or one not in
+        # write-ahead log mode, so the chunks are simulated in process,
+        # with the same results.
+        with t1(None, simulation_processes=2) as (bdb, _generator_id):
+            with spying_pools() as pools:
+                assert simulate_table(bdb) == rows
+            assert pools == []
+        with tempfile.NamedTemporaryFile(prefix='bayeslite') as f:
+            with t1(f.name, simulation_processes=2) as (bdb, _generator_id):
+                with spying_pools() as pools:
+                    assert simulate_table(bdb) == rows
+                assert pools == []
+
+def test_simulation_processes_invalid():
+    with pytest.raises(ValueError):
+        bayeslite.bayesdb_open(simulation_processes=0)
@@ -19,6 +19,10 @@ import os
 import bayeslite
 from bayeslite.core import bayesdb_get_generator
 from bayeslite.metamodels.crosscat import CrosscatMetamodel
+from bayeslite.metamodels.crosscat import CrosscatPlacement
+from bayeslite.metamodels.crosscat import crosscat_extend_latent_state
+from bayeslite.metamodels.crosscat import crosscat_place_rows
+import bayeslite.metamodels.crosscat as crosscat_metamodel
 import bayeslite.read_csv as read_csv
 import crosscat.LocalEngine
 
@@ -73,3 +77,214 @@ def test_subsample():
         assert [row[0] for row in cursor] != range(1, 100 + 1)
         bdb.execute('DROP GENERATOR dhacc')
         bdb.execute('DROP GENERATOR dhacc_full')
+
+def test_subsample_extension():
+    # Rows outside the subsample are placed in the models' latent
+    # states each by itself, only once, across queries, until the
+    # models change, and never by a round trip through the engine.
+    with bayeslite.bayesdb_open(builtin_metamodels=False) as bdb:
+        cc = crosscat.LocalEngine.LocalEngine(seed=0)
+        metamodel = CrosscatMetamodel(cc)
+        bayeslite.bayesdb_register_metamodel(bdb, metamodel)
+        with open(dha_csv, 'rU') as f:
+            read_csv.bayesdb_read_csv(bdb, 'dha', f, header=True, create=True)
+        bdb.execute('''
+            CREATE GENERATOR dhacc FOR dha USING crosscat (
+                SUBSAMPLE(100),
+                GUESS(*),
+                name KEY
+            )
+        ''')
+        bdb.execute('INITIALIZE 2 MODELS FOR dhacc')
+        bdb.execute('ANALYZE dhacc FOR 1 ITERATION WAIT')
+        gid = bayesdb_get_generator(bdb, 'dhacc')
+        outside = [rowid for (rowid,) in bdb.sql_execute('''
+            SELECT _rowid_ FROM dha WHERE _rowid_ NOT IN
+                (SELECT sql_rowid FROM bayesdb_crosscat_subsample
+                    WHERE generator_id = ?)
+            ORDER BY _rowid_ ASC LIMIT 5
+        ''', (gid,))]
+        assert len(outside) == 5
+        inserted = []
+        insert = cc.insert
+        def spy(**kwargs):
+            inserted.append(len(kwargs['new_rows']))
+            return insert(**kwargs)
+        cc.insert = spy
+        placed = []
+        place_rows = crosscat_metamodel.crosscat_place_rows
+        def place_spy(M_c, X_L, X_D, rows, uniforms):
+            placed.append(len(rows))
+            return place_rows(M_c, X_L, X_D, rows, uniforms)
+        crosscat_metamodel.crosscat_place_rows = place_spy
+        try:
+            where = ' WHERE _rowid_ IN (%s)' % (','.join(map(str, outside)),)
+            query = 'ESTIMATE PREDICTIVE PROBABILITY OF mdcr_spnd_amblnc' \
+                ' FROM dhacc' + where
+            first = bdb.execute(query).fetchall()
+            # All five rows are placed in each model in one go.
+            assert inserted == []
+            assert placed == [5, 5]
+            assert bdb.execute(query).fetchall() == first
+            assert inserted == []
+            assert placed == [5, 5]
+            lru = bdb.persistent_cache['crosscat']
+            for modelno in range(2):
+                for rowid in outside:
+                    assert (gid, modelno, 1, 'placement', rowid) in lru
+            # A batch places each row it needs by itself too, without
+            # the engine, and the placements are shared with other
+            # queries.
+            bdb.execute('ANALYZE dhacc FOR 1 ITERATION WAIT')
+            bdb.execute('INFER EXPLICIT PREDICT mdcr_spnd_amblnc'
+                ' CONFIDENCE c FROM dhacc' + where).fetchall()
+            assert inserted == []
+            assert placed == [5, 5, 5, 5]
+            second = bdb.execute(query).fetchall()
+            assert inserted == []
+            assert placed == [5, 5, 5, 5]
+            # Where a row lands does not depend on the other rows asked
+            # about with it.
+            for rowid, (probability,) in zip(outside, second):
+                assert bdb.execute('ESTIMATE PREDICTIVE PROBABILITY OF'
+                        ' mdcr_spnd_amblnc FROM dhacc WHERE _rowid_ = ?',
+                        (rowid,)).fetchall() == [(probability,)]
+            assert inserted == []
+            assert placed == [5, 5, 5, 5]
+        finally:
+            crosscat_metamodel.crosscat_place_rows = place_rows
+
+def latent_state(counts, suffstats):
+    return {
+        'column_partition': {
+            'hypers': {'alpha': 1.},
+            'assignments': [0],
+            'counts': [1],
+        },
+        'column_hypers': [{'fixed': 0., 'mu': 0., 'r': 1., 's': 1.,
+            'nu': 1.}],
+        'view_state': [{
+            'column_names': ['x'],
+            'column_component_suffstats': [[
+                {'N': N, 'sum_x': sum_x, 'sum_x_squared': sum_x_squared}
+                for N, sum_x, sum_x_squared in suffstats
+            ]],
+            'row_partition_model': {
+                'hypers': {'alpha': 1.},
+                'counts': counts,
+            },
+        }],
+    }
+
+def test_place_rows():
+    # Each row draws its cluster by itself, from the clusters' counts
+    # and the predictive densities of its values.
+    M_c = {
+        'name_to_idx': {'x': 0},
+        'idx_to_name': {'0': 'x'},
+        'column_metadata': [{'modeltype': 'normal_inverse_gamma'}],
+    }
+    X_L = latent_state([50, 50], [(50, 0., 50.), (50, 5000., 500050.)])
+    X_D = [[0]*50 + [1]*50]
+    nan = float('nan')
+    rows = [[100.], [0.], [nan], [nan], [nan]]
+    uniforms = [[0.01], [0.5], [0.1], [0.6], [0.999]]
+    placements = crosscat_place_rows(M_c, X_L, X_D, rows, uniforms)
+    # Values join the cluster they are near; missing values go by
+    # the counts and the concentration alone.
+    assert [p.clusters for p in placements] == [[1], [0], [0], [1], [None]]
+    assert placements[0].suffstats == \
+        [[{'N': 1, 'sum_x': 100., 'sum_x_squared': 10000.}]]
+    assert placements[2].suffstats == \
+        [[{'N': 0, 'sum_x': 0., 'sum_x_squared': 0.}]]
+    # A row lands where it would alone, whatever is placed with it.
+    for row, u, placement in zip(rows, uniforms, placements):
+        [alone] = crosscat_place_rows(M_c, X_L, X_D, [row], [u])
+        assert alone.clusters == placement.clusters
+
+def test_extend_latent_state():
+    # Rows placed separately join their clusters, or get new clusters
+    # of their own.
+    X_L = latent_state([2, 1], [(2, 3., 5.), (1, 4., 16.)])
+    X_D = [[0, 0, 1]]
+    # x = 5 joins the second cluster.
+    a = CrosscatPlacement([1], [[{'N': 1, 'sum_x': 5., 'sum_x_squared': 25.}]])
+    # x = 7 gets a new cluster.
+    b = CrosscatPlacement([None],
+        [[{'N': 1, 'sum_x': 7., 'sum_x_squared': 49.}]])
+    X_L_new, X_D_new = crosscat_extend_latent_state(X_L, X_D, [a, b, b])
+    assert X_D_new == [[0, 0, 1, 1, 2, 3]]
+    assert X_L_new == latent_state([2, 2, 1, 1],
+        [(2, 3., 5.), (2, 9., 41.), (1, 7., 49.), (1, 7., 49.)])
+    assert X_L == latent_state([2, 1], [(2, 3., 5.), (1, 4., 16.)])
+    assert X_D == [[0, 0, 1]]
+
+def test_subsample_growth():
+    # The subsample doubles before each iteration after the models'
+    # first until it reaches its target, keeping the rows it had,
+    # with or without checkpoints.
+    with bayeslite.bayesdb_open(builtin_metamodels=False) as bdb:
+        cc = crosscat.LocalEngine.LocalEngine(seed=0)
+        metamodel = CrosscatMetamodel(cc)
+        bayeslite.bayesdb_register_metamodel(bdb, metamodel)
+        with open(dha_csv, 'rU') as f:
+            read_csv.bayesdb_read_csv(bdb, 'dha', f, header=True, create=True)
+        bdb.execute('''
+            CREATE GENERATOR dhacc FOR dha USING crosscat (
+                SUBSAMPLE(GROW FROM 20 TO 100),
+                GUESS(*),
+                name KEY
+            )
+        ''')
+        gid = bayesdb_get_generator(bdb, 'dhacc')
+        sql = '''
+            SELECT sql_rowid FROM bayesdb_crosscat_subsample
+                WHERE generator_id = ?
+                ORDER BY cc_row_id ASC
+        '''
+        initial = [rowid for (rowid,) in bdb.sql_execute(sql, (gid,))]
+        assert len(initial) == 20
+        assert initial == sorted(initial)
+        bdb.execute('INITIALIZE 2 MODELS FOR dhacc')
+        sizes = []
+        insert = cc.insert
+        def spy(**kwargs):
+            sizes.append((len(kwargs['T']), len(kwargs['new_rows'])))
+            return insert(**kwargs)
+        cc.insert = spy
+        bdb.execute('ANALYZE dhacc FOR 4 ITERATIONS'
+            ' CHECKPOINT 1 ITERATION WAIT')
+        assert sizes == [(20, 20), (40, 40), (80, 20)]
+        rowids = [rowid for (rowid,) in bdb.sql_execute(sql, (gid,))]
+        assert len(rowids) == 100
+        assert len(set(rowids)) == 100
+        assert rowids[:20] == initial
+        for modelno in range(2):
+            theta = metamodel._crosscat_theta(bdb, gid, modelno)
+            assert all(len(X_D_view) == 100 for X_D_view in theta['X_D'])
+        bdb.execute('ESTIMATE PREDICTIVE PROBABILITY OF mdcr_spnd_amblnc'
+            ' FROM dhacc WHERE _rowid_ = ?', (rowids[-1],)).fetchall()
+        del sizes[:]
+        bdb.execute('ANALYZE dhacc FOR 1 ITERATION WAIT')
+        assert sizes == []
+        # Growth does not wait for a checkpoint, and never comes after
+        # the last iteration, when the new rows would go unanalyzed.
+        bdb.execute('''
+            CREATE GENERATOR dhacc1 FOR dha USING crosscat (
+                SUBSAMPLE(GROW FROM 20 TO 100),
+                GUESS(*),
+                name KEY
+            )
+        ''')
+        gid1 = bayesdb_get_generator(bdb, 'dhacc1')
+        bdb.execute('INITIALIZE 2 MODELS FOR dhacc1')
+        bdb.execute('ANALYZE dhacc1 FOR 1 ITERATION WAIT')
+        assert sizes == []
+        bdb.execute('ANALYZE dhacc1 FOR 3 ITERATIONS WAIT')
+        assert sizes == [(20, 20), (40, 40), (80, 20)]
+        assert len(bdb.sql_execute(sql, (gid1,)).fetchall()) == 100
+        sql = '''
+            SELECT modelno, iterations FROM bayesdb_generator_model
+                WHERE generator_id = ? ORDER BY modelno
+        '''
+        assert bdb.sql_execute(sql, (gid1,)).fetchall() == [(0, 4), (1, 4)]